@@ -54,6 +54,12 @@ db_info = None
 # stores ItemInfo objects so we can quickly fetch them
 item_info_cache = None
 
+# FeedCountTracker that keeps item counts for feeds and folders
+feed_count_tracker = None
+
+# ItemSearchIndex that indexes the search terms for all items
+item_search_index = None
+
 # command line arguments for thumbnailer (linux)
 movie_data_program_info = None
 
@@ -121,6 +127,9 @@ inline_search_memory = None
 # tracks channel/item updates from the backend
 info_updater = None
 
+# ItemSearchTermsIndex that searches database items
+item_search_terms_index = None
+
 # manages the menu system
 menu_manager = None
 
@@ -103,7 +103,7 @@ def _get_item_for_path(path):
         app.controller.failed_soft("commandline.add_video", msg)
         return None
 
-@eventloop.idle_iterator
+@eventloop.idle_iterator(priority=eventloop.PRIORITY_UI)
 def add_videos(paths):
     # filter out non-existent paths
     paths = [p for p in paths if fileutil.exists(p)]
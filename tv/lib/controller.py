@@ -109,6 +109,11 @@ class Controller:
         app.db.finish_transaction()
         if app.item_info_cache is not None:
             app.item_info_cache.save()
+            app.item_info_cache.close()
+        if app.feed_count_tracker is not None:
+            app.feed_count_tracker.save()
+        if app.item_search_index is not None:
+            app.item_search_index.save()
         logging.info("Closing Database...")
         if app.db is not None:
             app.db.close()
@@ -34,6 +34,8 @@ import threading
 
 from miro import app
 from miro import signals
+from miro import util
+from miro import viewpredicate
 
 class DatabaseException(StandardError):
     """Superclass database errors."""
@@ -252,6 +254,15 @@ class ViewTrackerManager(object):
         for tracker in self.trackers_for_ddb_class(obj.__class__):
             tracker.object_changed(obj, can_change_views)
 
+    def bulk_update_view_trackers_for_objects(self, table_name, objects,
+                                              can_change_views=True):
+        """Update view trackers based on changes to a list of objects.
+
+        All objects must be stored in table_name.
+        """
+        for tracker in self.trackers_for_table(table_name):
+            tracker.objects_changed(objects, can_change_views)
+
     def bulk_update_view_trackers(self, table_name):
         for tracker in self.trackers_for_table(table_name):
             tracker.check_all_objects()
@@ -267,6 +278,10 @@ class ViewTrackerManager(object):
             tracker.remove_object(obj)
 
 class ViewTracker(signals.SignalEmitter):
+    # If our values leave room for fewer ids than this in an IN (...) clause,
+    # _objects_in_view() fetches all the ids in the view instead
+    MIN_ID_CHUNK_SIZE = 100
+
     def __init__(self, fetcher, where, values, joins, db_info):
         signals.SignalEmitter.__init__(self, 'added', 'removed', 'changed',
                 'bulk-added', 'bulk-removed', 'bulk-changed')
@@ -279,6 +294,9 @@ class ViewTracker(signals.SignalEmitter):
         self.joins = joins
         self.db_info = db_info
         self.bulk_mode = False
+        self.predicate = viewpredicate.compile_view(self.table_name, where,
+                values, joins, db_info.db.table_columns,
+                db_info.db.get_loaded_object)
         self.current_ids = self._view_object_ids()
         vt_manager = self.db_info.view_tracker_manager
         vt_manager.trackers_for_table(self.table_name).add(self)
@@ -296,8 +314,34 @@ class ViewTracker(signals.SignalEmitter):
         """
         self.bulk_mode = bulk_mode
 
+    def _check_predicate(self, obj):
+        """Check if an object is in our view without using SQL.
+
+        :returns: True/False if we could check the object in memory, None if
+            we need to ask SQLite.
+        """
+        if (self.predicate is not None and
+                self.db_info.db.get_loaded_object(self.table_name,
+                                                  obj.id) is obj):
+            try:
+                return self.predicate.matches(obj)
+            except viewpredicate.CantEvaluate:
+                pass
+        return None
+
     def _obj_in_view(self, obj):
-        """Check if a single object is in our view."""
+        """Check if a single object is in our view.
+
+        If we were able to compile our where clause, we check the object in
+        memory.  Otherwise we have to ask SQLite.
+        """
+        rv = self._check_predicate(obj)
+        if rv is None:
+            rv = self._obj_in_view_sql(obj)
+        return rv
+
+    def _obj_in_view_sql(self, obj):
+        """Check if a single object is in our view using an SQL query."""
         where = '%s.id = ?' % (self.table_name,)
         if self.where:
             where += ' AND (%s)' % (self.where,)
@@ -306,6 +350,42 @@ class ViewTracker(signals.SignalEmitter):
         return self.db_info.db.query_count(self.table_name, where, values,
                 self.joins) > 0
 
+    def _objects_in_view(self, objects):
+        """Check which objects in a list are in our view.
+
+        Objects that we can't check in memory are checked using one SELECT
+        statement per chunk of ids.
+
+        :returns: set of ids for objects in the view
+        """
+        in_view = set()
+        to_query = []
+        for obj in objects:
+            rv = self._check_predicate(obj)
+            if rv is None:
+                to_query.append(obj.id)
+            elif rv:
+                in_view.add(obj.id)
+        if not to_query:
+            return in_view
+        if (util.SQLITE_CHUNK_SIZE - len(self.values) <
+                self.MIN_ID_CHUNK_SIZE):
+            # Our own values leave too little room for the ids (for example
+            # views created by ManualItemTracker), fetch the whole view
+            # instead.
+            in_view.update(self._view_object_ids().intersection(to_query))
+            return in_view
+        for id_chunk in util.split_values_for_sqlite(to_query,
+                                                     len(self.values)):
+            where = '%s.id IN (%s)' % (self.table_name,
+                                       ', '.join('?' for i in id_chunk))
+            if self.where:
+                where += ' AND (%s)' % (self.where,)
+            values = tuple(id_chunk) + self.values
+            in_view.update(self.db_info.db.query_ids(self.table_name,
+                where, values, joins=self.joins))
+        return in_view
+
     def _view_object_ids(self):
         """Get all object ids in our view."""
         return set(self.db_info.db.query_ids(self.table_name,
@@ -318,6 +398,15 @@ class ViewTracker(signals.SignalEmitter):
         elif obj.id in self.current_ids:
             self.emit('changed', self.fetcher.fetch_obj_for_ddb_object(obj))
 
+    def objects_changed(self, objects, can_change_views):
+        if can_change_views:
+            self.check_objects(objects)
+        else:
+            changed = [self.fetcher.fetch_obj_for_ddb_object(obj)
+                       for obj in objects if obj.id in self.current_ids]
+            if changed:
+                self._emit_for_objects('changed', changed)
+
     def remove_object(self, obj):
         if obj.id in self.current_ids:
             self.current_ids.remove(obj.id)
@@ -340,6 +429,36 @@ class ViewTracker(signals.SignalEmitter):
         elif before and now:
             self.emit('changed', self.fetcher.fetch_obj_for_ddb_object(obj))
 
+    def check_objects(self, objects):
+        """Check a list of objects that may have changed.
+
+        This works like calling check_object() for each object, but uses at
+        most one SELECT statement per chunk of objects.  In bulk mode, we
+        emit a single bulk-added/bulk-removed/bulk-changed signal.
+        """
+        if not objects:
+            return
+        in_view = self._objects_in_view(objects)
+        added = []
+        removed = []
+        changed = []
+        for obj in objects:
+            before = (obj.id in self.current_ids)
+            now = (obj.id in in_view)
+            if before and not now:
+                self.current_ids.remove(obj.id)
+                removed.append(self.fetcher.fetch_obj_for_ddb_object(obj))
+            elif now and not before:
+                self.current_ids.add(obj.id)
+                added.append(self.fetcher.fetch_obj_for_ddb_object(obj))
+            elif before and now:
+                changed.append(self.fetcher.fetch_obj_for_ddb_object(obj))
+        for signal, signal_objects in (('removed', removed),
+                                       ('added', added),
+                                       ('changed', changed)):
+            if signal_objects:
+                self._emit_for_objects(signal, signal_objects)
+
     def _emit_for_objects(self, signal, objects):
         if self.bulk_mode:
             self.emit('bulk-' + signal, objects)
@@ -383,8 +502,10 @@ class BulkSQLManager(object):
         self.active = False
         self.to_insert = {}
         self.to_remove = {}
+        self.to_change = {}
         self.pending_inserts = set()
         self.pending_removes = set()
+        self.pending_changes = {}
 
         self.last_call = None
 
@@ -417,22 +538,29 @@ class BulkSQLManager(object):
         for x in range(100):
             to_insert = self.to_insert
             to_remove = self.to_remove
+            to_change = self.to_change
             self.to_insert = {}
             self.to_remove = {}
+            self.to_change = {}
+            self.pending_changes = {}
             self._commit_sql(to_insert, to_remove)
             self._update_view_trackers(to_insert, to_remove)
-            if len(self.to_insert) == len(self.to_remove) == 0:
+            self._update_view_trackers_for_changes(to_change)
+            if (len(self.to_insert) == len(self.to_remove) ==
+                    len(self.to_change) == 0):
                 break
             # inside _commit_sql() or _update_view_trackers(), we were
-            # asked to insert or remove more items, repeat the
+            # asked to insert, remove or change more items, repeat the
             # proccess again
         else:
             raise AssertionError("Called _commit_sql 100 times and still "
                     "have items to commit.  Are we in a circular loop?")
         self.to_insert = {}
         self.to_remove = {}
+        self.to_change = {}
         self.pending_inserts = set()
         self.pending_removes = set()
+        self.pending_changes = {}
 
     def _commit_sql(self, to_insert, to_remove):
         for table_name, objects in to_insert.items():
@@ -457,17 +585,25 @@ class BulkSQLManager(object):
         # Figure out which strategy is fastest based on the number of objects
         # that have changed
         if len(changed_objs) < 100:
-            self._update_view_trackers_by_object(changed_objs)
+            self._update_view_trackers_by_object(to_insert, to_remove)
         else:
             self._update_view_trackers_by_table(to_insert, to_remove)
 
-    def _update_view_trackers_by_object(self, changed_objs):
-        """Update view trackers by checking each changed object.
+    def _update_view_trackers_by_object(self, to_insert, to_remove):
+        """Update view trackers by checking the changed objects.
+
+        Each tracker checks all of the objects for a table at once, using one
+        SELECT statement for each chunk of object ids.
 
         This method is the fastest when there are not a lot of changed objects
         """
-        for obj in changed_objs:
-            self.view_tracker_manager.update_view_trackers(obj)
+        objects_by_table = {}
+        for changes in (to_insert, to_remove):
+            for table_name, objects in changes.items():
+                objects_by_table.setdefault(table_name, []).extend(objects)
+        for table_name, objects in objects_by_table.items():
+            self.view_tracker_manager.bulk_update_view_trackers_for_objects(
+                table_name, objects)
 
     def _update_view_trackers_by_table(self, to_insert, to_remove):
         """Update view trackers by checking each table
@@ -484,6 +620,25 @@ class BulkSQLManager(object):
             self.view_tracker_manager.bulk_remove_from_view_trackers(
                 table_name, objects)
 
+    def _update_view_trackers_for_changes(self, to_change):
+        """Update view trackers for objects that called signal_change().
+
+        :param to_change: dict mapping table names to lists of (object,
+            can_change_views) tuples
+        """
+        for table_name, changes in to_change.items():
+            check_objs = [obj for obj, can_change_views in changes
+                          if can_change_views]
+            other_objs = [obj for obj, can_change_views in changes
+                          if not can_change_views]
+            vt_manager = self.view_tracker_manager
+            if check_objs:
+                vt_manager.bulk_update_view_trackers_for_objects(table_name,
+                        check_objs)
+            if other_objs:
+                vt_manager.bulk_update_view_trackers_for_objects(table_name,
+                        other_objs, can_change_views=False)
+
     def add_insert(self, obj):
         table_name = self.db.table_name(obj.__class__)
         try:
@@ -515,6 +670,27 @@ class BulkSQLManager(object):
         self.pending_removes.add(obj.id)
         removes_for_table.append(obj)
 
+    def add_change(self, obj, can_change_views):
+        """Delay updating view trackers for a changed object until commit().
+
+        If an object changes multiple times, we only check it once.
+        """
+        table_name = self.db.table_name(obj.__class__)
+        key = (table_name, obj.id)
+        try:
+            changes_for_table = self.to_change[table_name]
+        except KeyError:
+            changes_for_table = []
+            self.to_change[table_name] = changes_for_table
+        try:
+            index = self.pending_changes[key]
+        except KeyError:
+            self.pending_changes[key] = len(changes_for_table)
+            changes_for_table.append((obj, can_change_views))
+        else:
+            if can_change_views:
+                changes_for_table[index] = (obj, True)
+
 class AttributeUpdateTracker(object):
     """Used by DDBObject to track changes to attributes."""
 
@@ -705,6 +881,16 @@ class DDBObject(signals.SignalEmitter):
         """
         return self.id
 
+    def is_pinned(self):
+        """Check if this object needs to stay in memory.
+
+        LiveStorage may evict objects from memory and restore them from disk
+        later.  Objects with unsaved changes or connected signal handlers
+        can't be evicted.  Subclasses that keep other state in memory should
+        extend this.
+        """
+        return bool(self.changed_attributes) or self.has_live_callbacks()
+
     def id_exists(self):
         try:
             self.get_by_id(self.id, self.db_info)
@@ -763,8 +949,13 @@ class DDBObject(signals.SignalEmitter):
             return
         if needs_save:
             self.db_info.db.update_obj(self)
-        self.db_info.view_tracker_manager.update_view_trackers(
-            self, can_change_views)
+        if self.db_info.bulk_sql_manager.active:
+            # Check all the objects that changed at once in
+            # BulkSQLManager.finish()
+            self.db_info.bulk_sql_manager.add_change(self, can_change_views)
+        else:
+            self.db_info.view_tracker_manager.update_view_trackers(
+                self, can_change_views)
 
     def on_signal_change(self):
         pass
@@ -37,11 +37,13 @@
 """
 
 from urlparse import urlparse
+import cPickle
 import datetime
 import itertools
 import os
 import re
 import logging
+import marshal
 import shutil
 import time
 import urllib
@@ -156,13 +158,21 @@ def alter_table_columns(cursor, table, delete_columns, rename_columns,
     for sql in index_sql:
         cursor.execute(sql)
 
+# Tables that store extra data for DDBObjects, rather than the objects
+# themselves.  They are keyed by the id of the object they belong to and don't
+# have an id column, so get_object_tables() skips them.
+AUXILIARY_TABLES = frozenset([
+    'feed_item_counts',
+    'item_search_terms',
+])
+
 def get_object_tables(cursor):
     """Returns a list of tables that store ``DDBObject`` subclasses.
     """
     cursor.execute("SELECT name FROM sqlite_master "
             "WHERE type='table' AND name != 'dtv_variables' AND "
             "name NOT LIKE 'sqlite%'")
-    return [row[0] for row in cursor]
+    return [row[0] for row in cursor if row[0] not in AUXILIARY_TABLES]
 
 def get_next_id(cursor):
     """Calculate the next id to assign to new rows.
@@ -3800,3 +3810,56 @@ def upgrade178(cursor):
                    "WHERE item.deleted)")
     cursor.execute("DELETE FROM metadata_status WHERE path IN "
                    "(SELECT filename FROM item WHERE item.deleted)")
+
+def upgrade179(cursor):
+    """Convert pythonrepr columns from repr() strings to a binary format."""
+    # This matches storedatabase.dump_repr_value().  We copy it here so
+    # that this upgrade keeps working if that format changes.
+    def dump_value(value):
+        try:
+            return buffer('\x01' + marshal.dumps(value, 2))
+        except ValueError:
+            return buffer('\x02' + cPickle.dumps(value,
+                                                 cPickle.HIGHEST_PROTOCOL))
+
+    cursor.execute("SELECT name FROM sqlite_master WHERE type='table'")
+    for table in [r[0] for r in cursor.fetchall()]:
+        cursor.execute("PRAGMA table_info('%s')" % table)
+        columns = [r[1] for r in cursor.fetchall()
+                   if r[2].lower() == 'pythonrepr']
+        for column in columns:
+            cursor.execute("SELECT id, %s FROM %s WHERE typeof(%s)='text'" %
+                           (column, table, column))
+            new_values = []
+            for id_, value in cursor.fetchall():
+                try:
+                    new_values.append((dump_value(eval_container(value)),
+                                       id_))
+                except StandardError:
+                    # Leave malformed values alone.  They will get handled
+                    # by the handle_malformed_* methods when the object is
+                    # restored.
+                    logging.warn("upgrade179: can't convert %s.%s for %s",
+                                 table, column, id_)
+            cursor.executemany("UPDATE %s SET %s=? WHERE id=?" %
+                               (table, column), new_values)
+
+def upgrade180(cursor):
+    """Create the feed_item_counts table"""
+    cursor.execute("CREATE TABLE feed_item_counts(item_id INTEGER PRIMARY KEY, "
+                   "feed_id INTEGER, flags INTEGER)")
+
+def upgrade181(cursor):
+    """Add indexes for Item views that were doing slow queries."""
+    # watchable_other_view() and the rd.main_item_id=item.id checks join
+    # on remote_downloader.main_item_id
+    cursor.execute("CREATE INDEX downloader_main_item ON remote_downloader "
+                   "(main_item_id)")
+    # latest_in_feed_view() orders by releaseDateObj
+    cursor.execute("CREATE INDEX item_feed_release ON item "
+                   "(feed_id, releaseDateObj)")
+
+def upgrade182(cursor):
+    """Create the item_search_terms table"""
+    cursor.execute("CREATE TABLE item_search_terms(item_id INTEGER PRIMARY KEY, "
+                   "terms TEXT, dirty INTEGER NOT NULL DEFAULT 0)")
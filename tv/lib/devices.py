@@ -1019,7 +1019,8 @@ class DeviceSyncManager(object):
         if not self._copy_iter_running:
             self._copy_iter_running = True
             eventloop.idle_iterate(self._copy_as_iter,
-                                   'copying files to device')
+                                   'copying files to device',
+                                   priority=eventloop.PRIORITY_UI)
 
     def _copy_as_iter(self):
         while self.copying:
@@ -1544,7 +1545,7 @@ def _device_not_valid(device):
         return True
     return False
 
-@eventloop.idle_iterator
+@eventloop.idle_iterator(priority=eventloop.PRIORITY_BACKGROUND)
 def scan_device_for_files(device):
     # XXX is this as_idle() safe?
 
@@ -1555,8 +1556,6 @@ def scan_device_for_files(device):
     logging.debug('starting scan on %r', device.mount)
     known_files = clean_database(device)
     item_data = []
-    start = time.time()
-    filenames = []
 
     for filename in fileutil.miro_allfiles(device.mount):
         short_filename = filename[len(device.mount):]
@@ -1570,13 +1569,9 @@ def scan_device_for_files(device):
             item_type = u'audio'
         if item_type is not None:
             item_data.append((ufilename, item_type))
-            filenames.append(filename)
-        if time.time() - start > 0.3:
-            yield # let other stuff run
+        if (yield): # let other stuff run
             if _device_not_valid(device):
                 break
-            start = time.time()
-            filenames = []
 
     if app.device_manager.running and os.path.exists(device.mount):
         # we don't re-check if the device is hidden because we still want to
@@ -72,10 +72,15 @@ class DownloadStateManager(object):
     RESTORE = command.DownloaderBatchCommand.RESTORE
 
     UPDATE_INTERVAL = 1
+    # how long we wait to batch up download progress for the frontend
+    PROGRESS_INTERVAL = 0.5
 
     def __init__(self):
         self.total_up_rate = 0
         self.total_down_rate = 0
+        # maps item ids to progress tuples to send to the frontend
+        self.progress = {}
+        self._send_progress_dc = None
         # a hash of download ids that the server knows about.
         self.downloads = {}
         self.daemon_starter = None
@@ -116,6 +121,34 @@ class DownloadStateManager(object):
                               self.send_updates,
                               "Send Download Command Updates")
 
+    def queue_progress(self, item_id, downloaded_size, rate, eta, state):
+        """Queue download progress for an item to send to the frontend.
+
+        Progress for all active downloads gets sent in a single
+        DownloadProgress message.
+        """
+        self.progress[item_id] = (item_id, downloaded_size, rate, eta, state)
+        if self._send_progress_dc is None:
+            self._send_progress_dc = eventloop.add_timeout(
+                self.PROGRESS_INTERVAL, self.send_progress,
+                "Send Download Progress")
+
+    def discard_progress(self, item_id):
+        """Forget queued progress for an item.
+
+        Call this when a full update for the item gets sent, so that the
+        frontend doesn't get older values after it.
+        """
+        self.progress.pop(item_id, None)
+
+    def send_progress(self):
+        self._send_progress_dc = None
+        progress = self.progress
+        self.progress = {}
+        if progress:
+            from miro.messages import DownloadProgress
+            DownloadProgress(progress.values()).send_to_frontend()
+
     def get_download(self, dlid):
         try:
             return self.downloads[dlid]
@@ -217,6 +250,9 @@ def generate_dlid():
 class RemoteDownloader(DDBObject):
     """Download a file using the downloader daemon."""
     MIN_STATUS_UPDATE_SPACING = 0.7
+    # status keys that only track the progress of a download
+    PROGRESS_STATUS_KEYS = frozenset(('currentSize', 'rate', 'eta'))
+
     def setup_new(self, url, item, contentType=None, channelName=None):
         check_u(url)
         if contentType:
@@ -280,6 +316,7 @@ class RemoteDownloader(DDBObject):
         DDBObject.signal_change(self, needs_save=needs_save)
         if needs_signal_item:
             for item in self.item_list:
+                app.download_state_manager.discard_progress(item.id)
                 item.signal_change(needs_save=False)
         if needs_save:
             self._cancel_save_later()
@@ -473,6 +510,7 @@ class RemoteDownloader(DDBObject):
 
             was_finished = self.is_finished()
             old_filename = self.get_filename()
+            old_status = self.status
             self.before_changing_status()
 
             # FIXME: how do we get all of the possible bit torrent
@@ -507,8 +545,17 @@ class RemoteDownloader(DDBObject):
                 # update_status() often, this results in a fairly
                 # large performance gain and alleviates #12101
                 self._save_later()
-                self.signal_change(needs_signal_item=needs_signal_item,
-                                   needs_save=False)
+                if needs_signal_item and self._only_progress_changed(
+                        old_status):
+                    # Rebuilding the ItemInfos and sending ItemsChanged is
+                    # expensive to do every second for every download.
+                    # Send the new values with DownloadProgress instead.
+                    self.signal_change(needs_signal_item=False,
+                                       needs_save=False)
+                    self._queue_progress()
+                else:
+                    self.signal_change(needs_signal_item=needs_signal_item,
+                                       needs_save=False)
             else:
                 self.signal_change()
 
@@ -537,6 +584,33 @@ class RemoteDownloader(DDBObject):
 
         return True
 
+    def _only_progress_changed(self, old_status):
+        """Check if the only status changes are to the download progress.
+
+        ItemInfos for torrents include other stats from the status dict
+        (seeders, upload rate, ...), so they always need a full update.
+        """
+        if (self.get_type() == u'bittorrent' or
+                len(old_status) != len(self.status)):
+            return False
+        for key, value in self.status.iteritems():
+            if key in self.PROGRESS_STATUS_KEYS:
+                continue
+            if key not in old_status or old_status[key] != value:
+                return False
+        return True
+
+    def _queue_progress(self):
+        downloaded_size = self.get_current_size()
+        rate = self.get_rate()
+        eta = self.get_eta()
+        state = self.get_state()
+        for item in self.item_list:
+            app.item_info_cache.update_download_progress(item.id,
+                    downloaded_size, rate, eta, state)
+            app.download_state_manager.queue_progress(item.id,
+                    downloaded_size, rate, eta, state)
+
     def run_downloader(self):
         """This is the actual download thread.
         """
@@ -35,12 +35,17 @@ network requests and scheduling.
 TODO: handle user setting clock back
 """
 
+import bisect
+import collections
 import errno
 import heapq
+import itertools
 import logging
+import math
 import Queue
 import select
 import socket
+import sys
 import threading
 import traceback
 
@@ -54,13 +59,213 @@ from miro.plat.utils import thread_body
 
 cumulative = {}
 
+class Histogram(object):
+    """Counts timing samples in exponentially sized buckets."""
+
+    # upper bounds of the buckets, in seconds.  There's an extra bucket
+    # for anything bigger than the last one.
+    BOUNDS = (0.0001, 0.0005, 0.001, 0.005, 0.01, 0.05, 0.1, 0.5, 1.0, 5.0)
+
+    def __init__(self):
+        self.counts = [0] * (len(self.BOUNDS) + 1)
+        self.count = 0
+        self.total = 0.0
+        self.max = 0.0
+
+    def add(self, value):
+        self.counts[bisect.bisect_left(self.BOUNDS, value)] += 1
+        self.count += 1
+        self.total += value
+        if value > self.max:
+            self.max = value
+
+    def mean(self):
+        if self.count == 0:
+            return 0.0
+        return self.total / self.count
+
+    def percentile(self, pct):
+        """Get an upper bound for the pct percentile of our samples."""
+        if self.count == 0:
+            return 0.0
+        needed = self.count * pct / 100.0
+        seen = 0
+        for bound, count in zip(self.BOUNDS, self.counts):
+            seen += count
+            if seen >= needed:
+                return min(bound, self.max)
+        return self.max
+
+class EventLoopInstrumentation(object):
+    """Collects timing information for the event loop.
+
+    We track how long callbacks take to run and how long they wait
+    before running, for each kind of event ('idle', 'urgent', 'timeout'
+    and 'socket') and each callback name.  We also track how long each
+    loop iteration takes and which callbacks have been slow recently.
+
+    This is only created when instrumentation is enabled, so it doesn't
+    cost anything otherwise.  All methods should be called from the
+    event loop thread.
+    """
+
+    KINDS = ('urgent', 'idle', 'timeout', 'socket')
+    # number of samples to use for loop iteration percentiles and the
+    # slowest callbacks
+    WINDOW_SIZE = 1000
+
+    def __init__(self):
+        self.reset()
+
+    def reset(self):
+        self.started_at = clock()
+        self.run_times = {}
+        self.wait_times = {}
+        self.kind_run_times = dict((k, Histogram()) for k in self.KINDS)
+        self.kind_wait_times = dict((k, Histogram()) for k in self.KINDS)
+        self.iteration_times = Histogram()
+        self.recent_iterations = collections.deque(maxlen=self.WINDOW_SIZE)
+        self.recent_calls = collections.deque(maxlen=self.WINDOW_SIZE)
+
+    def record_event(self, kind, name, wait_time, run_time):
+        """Record that a callback ran.
+
+        :param kind: 'idle', 'urgent', 'timeout' or 'socket'
+        :param name: name of the callback
+        :param wait_time: seconds between when the callback was ready to
+            run and when it ran or None if we don't know
+        :param run_time: seconds the callback took to run
+        """
+        key = (kind, name)
+        try:
+            histogram = self.run_times[key]
+        except KeyError:
+            histogram = self.run_times[key] = Histogram()
+        histogram.add(run_time)
+        self.kind_run_times[kind].add(run_time)
+        if wait_time is not None:
+            wait_time = max(0, wait_time)
+            try:
+                histogram = self.wait_times[key]
+            except KeyError:
+                histogram = self.wait_times[key] = Histogram()
+            histogram.add(wait_time)
+            self.kind_wait_times[kind].add(wait_time)
+        self.recent_calls.append((run_time, kind, name))
+
+    def record_iteration(self, duration):
+        """Record how long it took to process the events for one loop
+        iteration.
+        """
+        self.iteration_times.add(duration)
+        self.recent_iterations.append(duration)
+
+    def iteration_percentiles(self, percentiles=(50, 90, 99)):
+        """Get percentiles of recent loop iteration times.
+
+        :returns: dict mapping percentiles to times in seconds
+        """
+        samples = sorted(self.recent_iterations)
+        rv = {}
+        for pct in percentiles:
+            if samples:
+                index = int(math.ceil(len(samples) * pct / 100.0)) - 1
+                rv[pct] = samples[max(0, index)]
+            else:
+                rv[pct] = 0.0
+        return rv
+
+    def slowest_calls(self, count=10):
+        """Get the slowest callbacks that ran recently.
+
+        :returns: list of (max_run_time, kind, name, calls) tuples,
+            slowest first
+        """
+        slowest = {}
+        for run_time, kind, name in self.recent_calls:
+            key = (kind, name)
+            try:
+                max_time, calls = slowest[key]
+            except KeyError:
+                max_time, calls = 0.0, 0
+            slowest[key] = (max(max_time, run_time), calls + 1)
+        rv = [(slowest_time, call_kind, call_name, call_count)
+              for (call_kind, call_name), (slowest_time, call_count)
+              in slowest.items()]
+        rv.sort(reverse=True)
+        return rv[:count]
+
+    def format_report(self, top_count=10):
+        """Get a human readable report of our statistics."""
+        lines = []
+        lines.append("Event loop statistics (%.1f secs)" %
+                     (clock() - self.started_at))
+        lines.append("")
+        lines.append("%-10s %8s %10s %10s %10s %10s" % ("kind", "calls",
+                     "run mean", "run max", "wait mean", "wait p90"))
+        for kind in self.KINDS:
+            run_times = self.kind_run_times[kind]
+            wait_times = self.kind_wait_times[kind]
+            lines.append("%-10s %8d %10.4f %10.4f %10.4f %10.4f" % (kind,
+                         run_times.count, run_times.mean(), run_times.max,
+                         wait_times.mean(), wait_times.percentile(90)))
+        lines.append("")
+        percentiles = self.iteration_percentiles()
+        lines.append("loop iterations: %d (p50: %.4f p90: %.4f p99: %.4f "
+                     "max: %.4f)" % (self.iteration_times.count,
+                                     percentiles[50], percentiles[90],
+                                     percentiles[99],
+                                     self.iteration_times.max))
+        lines.append("")
+        lines.append("slowest recent calls:")
+        for max_time, kind, name, calls in self.slowest_calls(top_count):
+            lines.append("  %8.4f %-8s %s (%d calls)" % (max_time, kind,
+                                                         name, calls))
+        lines.append("")
+        lines.append("%-60s %8s %10s %10s %10s" % ("name", "calls",
+                     "run total", "run max", "wait max"))
+        items = self.run_times.items()
+        items.sort(key=lambda item: item[1].total, reverse=True)
+        for key, run_times in items:
+            wait_times = self.wait_times.get(key)
+            if wait_times is not None:
+                wait_max = wait_times.max
+            else:
+                wait_max = 0.0
+            lines.append("%-60s %8d %10.4f %10.4f %10.4f" % (
+                "%s: %s" % key, run_times.count, run_times.total,
+                run_times.max, wait_max))
+        return "\n".join(lines)
+
+    def dump(self, path):
+        """Write our report to path."""
+        f = open(path, 'w')
+        try:
+            f.write(self.format_report())
+            f.write("\n")
+        finally:
+            f.close()
+
+def _callback_name(function):
+    try:
+        return '%s.%s' % (function.im_class.__name__, function.__name__)
+    except AttributeError:
+        return getattr(function, '__name__', repr(function))
+
 class DelayedCall(object):
+    # set when instrumentation is enabled
+    queued_at = None
+    # set by dispatch()
+    dispatched_at = run_time = None
+
     def __init__(self, function, name, args, kwargs):
         self.function = function
         self.name = name
         self.args = args
         self.kwargs = kwargs
         self.canceled = False
+        # Scheduler that has us in its heap, if any
+        self.scheduler = None
 
     def _unlink(self):
         """Removes the references that this object has to the outside
@@ -70,7 +275,11 @@ class DelayedCall(object):
         self.function = self.args = self.kwargs = None
 
     def cancel(self):
-        self.canceled = True
+        scheduler = self.scheduler
+        if scheduler is not None:
+            scheduler.cancel(self)
+        else:
+            self.canceled = True
         self._unlink()
 
     def dispatch(self):
@@ -81,6 +290,8 @@ class DelayedCall(object):
             success = trapcall.trap_call(when, self.function, *self.args,
                     **self.kwargs)
             end = clock()
+            self.dispatched_at = start
+            self.run_time = end - start
             if end-start > 0.5:
                 logging.timing("%s too slow (%.3f secs)",
                                self.name, end-start)
@@ -98,37 +309,185 @@ class DelayedCall(object):
         return success
 
 class Scheduler(object):
-    def __init__(self):
+    """Runs DelayedCalls at some point in the future.
+
+    Timeouts are stored in a heap.  Canceling a timeout just marks it as
+    canceled; it gets dropped when it reaches the top of the heap.  If
+    canceled entries start to dominate the heap, we rebuild it without
+    them.
+
+    Timeouts that are more than ``slack`` seconds away get rounded up to
+    a multiple of ``slack``, so that timeouts scheduled close to each
+    other run in the same event loop iteration rather than waking us up
+    several times.
+    """
+
+    # timeout coalescing window, in seconds
+    DEFAULT_SLACK = 0.01
+    # don't bother compacting the heap until we have this many canceled
+    # entries
+    COMPACT_THRESHOLD = 256
+
+    def __init__(self, slack=None):
+        if slack is None:
+            slack = self.DEFAULT_SLACK
+        self.slack = slack
         self.heap = []
+        # add_timeout() and DelayedCall.cancel() can be called from other
+        # threads
+        self.lock = threading.Lock()
+        self.counter = 0
+        self.canceled_count = 0
+        self.compactions = 0
+        self.dispatch_count = 0
+        self.last_dispatch_lag = 0.0
+        self.max_dispatch_lag = 0.0
+        self.total_dispatch_lag = 0.0
+        self.instrumentation = None
+
+    def calc_scheduled_time(self, delay):
+        scheduled_time = clock() + delay
+        if self.slack > 0 and delay > self.slack:
+            scheduled_time = (math.ceil(scheduled_time / self.slack) *
+                              self.slack)
+        return scheduled_time
 
     def add_timeout(self, delay, function, name, args=None, kwargs=None):
         if args is None:
             args = ()
         if kwargs is None:
             kwargs = {}
-        scheduled_time = clock() + delay
+        scheduled_time = self.calc_scheduled_time(delay)
         dc = DelayedCall(function,  "timeout (%s)" % (name,), args, kwargs)
-        heapq.heappush(self.heap, (scheduled_time, dc))
+        self.lock.acquire()
+        try:
+            dc.scheduler = self
+            # counter keeps timeouts with the same scheduled time in FIFO
+            # order
+            self.counter += 1
+            heapq.heappush(self.heap, (scheduled_time, self.counter, dc))
+        finally:
+            self.lock.release()
         return dc
 
+    def cancel(self, dc):
+        """Cancel a DelayedCall.  Use DelayedCall.cancel() instead of
+        calling this directly.
+        """
+        self.lock.acquire()
+        try:
+            if not dc.canceled and dc.scheduler is self:
+                self.canceled_count += 1
+            dc.canceled = True
+            if (self.canceled_count >= self.COMPACT_THRESHOLD and
+                    self.canceled_count * 2 > len(self.heap)):
+                self._compact()
+        finally:
+            self.lock.release()
+
+    def _compact(self):
+        live = []
+        for entry in self.heap:
+            if entry[2].canceled:
+                entry[2].scheduler = None
+            else:
+                live.append(entry)
+        heapq.heapify(live)
+        self.heap = live
+        self.canceled_count = 0
+        self.compactions += 1
+
+    def _pop_canceled(self):
+        """Remove canceled calls from the top of the heap.
+
+        Must be called with the lock held.
+        """
+        while self.heap and self.heap[0][2].canceled:
+            heapq.heappop(self.heap)[2].scheduler = None
+            self.canceled_count -= 1
+
     def next_timeout(self):
-        if len(self.heap) == 0:
-            return None
-        else:
-            return max(0, self.heap[0][0] - clock())
+        self.lock.acquire()
+        try:
+            self._pop_canceled()
+            if len(self.heap) == 0:
+                return None
+            else:
+                return max(0, self.heap[0][0] - clock())
+        finally:
+            self.lock.release()
 
     def has_pending_timeout(self):
-        return len(self.heap) > 0 and self.heap[0][0] < clock()
+        self.lock.acquire()
+        try:
+            self._pop_canceled()
+            return len(self.heap) > 0 and self.heap[0][0] < clock()
+        finally:
+            self.lock.release()
 
     def process_next_timeout(self):
-        time, dc = heapq.heappop(self.heap)
-        return dc.dispatch()
+        self.lock.acquire()
+        try:
+            scheduled_time, counter, dc = heapq.heappop(self.heap)
+            dc.scheduler = None
+            if dc.canceled:
+                self.canceled_count -= 1
+                return True
+        finally:
+            self.lock.release()
+        lag = clock() - scheduled_time
+        self.dispatch_count += 1
+        self.last_dispatch_lag = lag
+        self.total_dispatch_lag += lag
+        self.max_dispatch_lag = max(self.max_dispatch_lag, lag)
+        success = dc.dispatch()
+        instrumentation = self.instrumentation
+        if instrumentation is not None and dc.run_time is not None:
+            instrumentation.record_event('timeout', dc.name,
+                                         dc.dispatched_at - scheduled_time,
+                                         dc.run_time)
+        return success
+
+    def get_stats(self):
+        """Get statistics about the scheduler.
+
+        :returns: dict with these keys:
+          - live_timers: number of timeouts waiting to run
+          - canceled_entries: canceled timeouts still in the heap
+          - compactions: number of times we've rebuilt the heap
+          - dispatched: number of timeouts we've run
+          - dispatch_lag: how late the last timeout ran, in seconds
+          - max_dispatch_lag: how late the latest timeout ran
+          - avg_dispatch_lag: average amount timeouts ran late
+        """
+        self.lock.acquire()
+        try:
+            heap_size = len(self.heap)
+            canceled_count = self.canceled_count
+        finally:
+            self.lock.release()
+        if self.dispatch_count > 0:
+            avg_lag = self.total_dispatch_lag / self.dispatch_count
+        else:
+            avg_lag = 0.0
+        return {
+            'live_timers': heap_size - canceled_count,
+            'canceled_entries': canceled_count,
+            'compactions': self.compactions,
+            'dispatched': self.dispatch_count,
+            'dispatch_lag': self.last_dispatch_lag,
+            'max_dispatch_lag': self.max_dispatch_lag,
+            'avg_dispatch_lag': avg_lag,
+        }
 
 class CallQueue(object):
-    def __init__(self):
+    def __init__(self, kind='idle'):
         self.queue = Queue.Queue()
         self.quit_flag = False
         self.queue_size_warning_count = 0
+        # 'idle' or 'urgent', used for instrumentation
+        self.kind = kind
+        self.instrumentation = None
 
     def add_idle(self, function, name, args=None, kwargs=None):
         if args is None:
@@ -136,6 +495,8 @@ class CallQueue(object):
         if kwargs is None:
             kwargs = {}
         dc = DelayedCall(function, "idle (%s)" % (name,), args, kwargs)
+        if self.instrumentation is not None:
+            dc.queued_at = clock()
         self.queue.put(dc)
 
         # Check if our queue size is too big and log a warning if so.  Only do
@@ -154,7 +515,16 @@ class CallQueue(object):
 
     def process_next_idle(self):
         dc = self.queue.get()
-        return dc.dispatch()
+        success = dc.dispatch()
+        instrumentation = self.instrumentation
+        if instrumentation is not None and dc.run_time is not None:
+            if dc.queued_at is not None:
+                wait_time = dc.dispatched_at - dc.queued_at
+            else:
+                wait_time = None
+            instrumentation.record_event(self.kind, dc.name, wait_time,
+                                         dc.run_time)
+        return success
 
     def has_pending_idle(self):
         return not self.queue.empty()
@@ -165,35 +535,193 @@ class CallQueue(object):
             self.process_next_idle()
 
 
-class ThreadPool(object):
-    """The thread pool is used to handle calls like gethostbyname()
-    that block and there's no asynchronous workaround.  What we do
-    instead is call them in a separate thread and return the result in
-    a callback that executes in the event loop.
+# priorities for idle_iterate() and call_in_thread_pool().  Lower numbers
+# run first.
+PRIORITY_UI = 0
+PRIORITY_NORMAL = 1
+PRIORITY_BACKGROUND = 2
+
+class IdleIteratorTask(object):
+    def __init__(self, iterator, name, priority):
+        self.iterator = iterator
+        self.name = name
+        self.priority = priority
+        self.started = False
+        self.finished = False
+
+class IteratorScheduler(object):
+    """Runs the generators passed to idle_iterate().
+
+    Each time the scheduler runs, it steps through the generators until
+    it has used up ``budget`` seconds, then lets the rest of the event
+    loop run before continuing on the next loop iteration.  We always
+    run at least one step each time.
+
+    Generators with a lower priority number run first.  Generators with
+    the same priority are run round-robin, one step at a time.
+
+    Each yield statement gets a value that says if other code has run
+    since the generator last yielded.  Generators can use this to only
+    re-check their state when they need to::
+
+        for path in paths:
+            handle_path(path)
+            if (yield):
+                if not self.id_exists():
+                    return
     """
-    THREADS = 4
+
+    # CPU time to spend on generators for each event loop iteration, in
+    # seconds
+    BUDGET = 0.05
 
     def __init__(self, event_loop):
         self.event_loop = event_loop
-        self.queue = Queue.Queue()
+        self.budget = self.BUDGET
+        self.queues = {}
+        self.run_scheduled = False
+
+    def add(self, iterator, name, priority):
+        """Add a generator to the scheduler.  This should be called from
+        the event loop thread.
+        """
+        task = IdleIteratorTask(iterator, name, priority)
+        try:
+            queue = self.queues[priority]
+        except KeyError:
+            queue = self.queues[priority] = collections.deque()
+        queue.append(task)
+        if not self.run_scheduled:
+            self.run_scheduled = True
+            self.event_loop.idle_queue.add_idle(self.run, "idle iterators")
+
+    def has_tasks(self):
+        for queue in self.queues.itervalues():
+            if queue:
+                return True
+        return False
+
+    def _next_task(self):
+        for priority in sorted(self.queues):
+            queue = self.queues[priority]
+            if queue:
+                return queue.popleft()
+        return None
+
+    def run(self):
+        """Step through our generators until we use up our budget."""
+        self.run_scheduled = False
+        start = clock()
+        last_task = None
+        while True:
+            task = self._next_task()
+            if task is None:
+                return
+            paused = task is not last_task
+            when = "While handling idle iterator (%s)" % (task.name,)
+            if (trapcall.trap_call(when, self._step, task, paused) and
+                    not task.finished):
+                self.queues[task.priority].append(task)
+            last_task = task
+            if clock() - start >= self.budget:
+                break
+        if self.has_tasks():
+            self.run_scheduled = True
+            self.event_loop.run_idle_next_loop(self.run, "idle iterators")
+
+    def _step(self, task, paused):
+        try:
+            if not task.started:
+                task.started = True
+                retval = task.iterator.next()
+            elif hasattr(task.iterator, 'send'):
+                retval = task.iterator.send(paused)
+            else:
+                retval = task.iterator.next()
+        except StopIteration:
+            task.finished = True
+        else:
+            if retval is not None:
+                logging.warn("idle_iterate yield value ignored: %s (%s)",
+                             retval, task.name)
+
+class ThreadPool(object):
+    """A named pool of threads.
+
+    Thread pools handle calls like gethostbyname() that block and
+    there's no asynchronous workaround.  What we do instead is call them
+    in a separate thread and return the result in a callback that
+    executes in the event loop.
+
+    Calls with a lower priority number run first, calls with the same
+    priority run in the order they were queued.
+
+    Threads are started as calls get queued, up to size threads, so pools
+    that are rarely used don't cost anything.
+    """
+
+    # priority for the QUIT messages.  It's higher than any real
+    # priority, so we finish the pending calls before quitting.
+    QUIT_PRIORITY = sys.maxint
+
+    def __init__(self, event_loop, name, size):
+        self.event_loop = event_loop
+        self.name = name
+        self.size = size
+        self.queue = Queue.PriorityQueue()
         self.threads = []
+        self.threads_lock = threading.Lock()
+        self.counter = itertools.count()
+        self.started = False
+        self.closing = False
+        # stats, protected by stats_lock since all our threads update
+        # them
+        self.stats_lock = threading.Lock()
+        self.busy_count = 0
+        self.wait_times = Histogram()
+        self.run_times = Histogram()
 
     def init_threads(self):
-        while len(self.threads) < ThreadPool.THREADS:
-            t = threading.Thread(name='ThreadPool - %d' % len(self.threads),
+        """Start running calls.
+
+        We only start threads for the calls that are already queued,
+        queue_call() starts more as needed.
+        """
+        self.closing = False
+        self.started = True
+        for x in xrange(self.queue.qsize()):
+            self._start_thread()
+
+    def _start_thread(self):
+        """Start a new thread, unless we already have size threads."""
+        self.threads_lock.acquire()
+        try:
+            if len(self.threads) >= self.size:
+                return
+            t = threading.Thread(name='ThreadPool (%s) - %d' %
+                                 (self.name, len(self.threads)),
                                  target=thread_body,
                                  args=[self.thread_loop])
             t.setDaemon(True)
             t.start()
             self.threads.append(t)
+        finally:
+            self.threads_lock.release()
 
     def thread_loop(self):
         while True:
-            next_item = self.queue.get()
+            priority, counter, queued_at, next_item = self.queue.get()
             if next_item == "QUIT":
                 break
             else:
                 callback, errback, func, name, args, kwargs, = next_item
+            start = clock()
+            self.stats_lock.acquire()
+            try:
+                self.busy_count += 1
+                self.wait_times.add(start - queued_at)
+            finally:
+                self.stats_lock.release()
             try:
                 result = func(*args, **kwargs)
             except KeyboardInterrupt:
@@ -209,16 +737,42 @@ class ThreadPool(object):
                 func = callback
                 name = 'Thread Pool Callback (%s)' % name
                 args = (result,)
+            self.stats_lock.acquire()
+            try:
+                self.busy_count -= 1
+                self.run_times.add(clock() - start)
+            finally:
+                self.stats_lock.release()
             if not self.event_loop.quit_flag:
                 self.event_loop.idle_queue.add_idle(func, name, args=args)
                 self.event_loop.wakeup()
 
-    def queue_call(self, callback, errback, function, name, *args, **kwargs):
-        self.queue.put((callback, errback, function, name, args, kwargs))
+    def queue_call(self, priority, callback, errback, function, name, args,
+                   kwargs):
+        if self.closing:
+            logging.debug("ThreadPool (%s) closed, dropping call: %s",
+                          self.name, name)
+            return
+        self.queue.put((priority, self.counter.next(), clock(),
+                        (callback, errback, function, name, args, kwargs)))
+        if self.started:
+            self._start_thread()
 
-    def close_threads(self):
+    def has_pending_calls(self):
+        return not self.queue.empty()
+
+    def start_closing(self):
+        """Stop accepting calls and tell our threads to quit once they've
+        finished the calls that are already queued.
+        """
+        self.closing = True
+        self.started = False
         for x in xrange(len(self.threads)):
-            self.queue.put("QUIT")
+            self.queue.put((self.QUIT_PRIORITY, self.counter.next(), None,
+                            "QUIT"))
+
+    def join_threads(self, deadline):
+        """Wait for our threads to finish, until deadline."""
         # Why is there a timeout on the join() here, what's wrong?  On
         # shutdown, the system waits for the eventloop to finish using 
         # eventloop.join() but eventloop calls close_threads() which wait
@@ -228,11 +782,309 @@ class ThreadPool(object):
         # in time let the daemon flag in the Thread() do its job.  See #16584.
         for t in self.threads:
             try:
-                t.join(0.5)
+                t.join(max(0, deadline - clock()))
             except StandardError:
                 pass
         self.threads = []
 
+    def close_threads(self, timeout=0.5):
+        self.start_closing()
+        self.join_threads(clock() + timeout)
+
+    def get_stats(self):
+        """Get statistics for this pool.
+
+        :returns: dict with these keys:
+          - size: maximum number of threads
+          - threads: number of threads started
+          - queue_depth: calls waiting to run
+          - busy: calls currently running
+          - calls: total number of calls that have started
+          - avg_wait, max_wait, p90_wait: how long calls waited to start
+          - avg_run, max_run: how long calls took to run
+        """
+        self.stats_lock.acquire()
+        try:
+            return {
+                'size': self.size,
+                'threads': len(self.threads),
+                'queue_depth': self.queue.qsize(),
+                'busy': self.busy_count,
+                'calls': self.wait_times.count,
+                'avg_wait': self.wait_times.mean(),
+                'max_wait': self.wait_times.max,
+                'p90_wait': self.wait_times.percentile(90),
+                'avg_run': self.run_times.mean(),
+                'max_run': self.run_times.max,
+            }
+        finally:
+            self.stats_lock.release()
+
+class ThreadPoolManager(object):
+    """Manages the thread pools for call_in_thread().
+
+    Each pool handles a category of calls, so that slow disk operations
+    don't hold up quick network ones:
+
+      - 'default': calls that don't specify a category
+      - 'network': DNS lookups, SSL handshakes, etc.
+      - 'disk': file operations, hashing and other IO heavy calls
+    """
+
+    POOL_SIZES = {
+        'default': 4,
+        'network': 4,
+        'disk': 2,
+    }
+    # total time to wait for the threads to finish on shutdown
+    SHUTDOWN_TIMEOUT = 2.0
+
+    def __init__(self, event_loop):
+        self.pools = {}
+        for name, size in self.POOL_SIZES.items():
+            self.pools[name] = ThreadPool(event_loop, name, size)
+
+    def get_pool(self, category):
+        try:
+            return self.pools[category]
+        except KeyError:
+            raise ValueError("Unknown thread pool category: %s" % category)
+
+    def set_pool_size(self, category, size):
+        """Change the maximum number of threads for a pool.  This must be
+        called before init_threads().
+        """
+        self.get_pool(category).size = size
+
+    def queue_call(self, category, priority, callback, errback, function,
+                   name, *args, **kwargs):
+        self.get_pool(category).queue_call(priority, callback, errback,
+                                           function, name, args, kwargs)
+
+    def init_threads(self):
+        for pool in self.pools.values():
+            pool.init_threads()
+
+    def has_pending_calls(self):
+        for pool in self.pools.values():
+            if pool.has_pending_calls():
+                return True
+        return False
+
+    def close_threads(self):
+        # Let all pools start draining at once, then wait for them
+        for pool in self.pools.values():
+            pool.start_closing()
+        deadline = clock() + self.SHUTDOWN_TIMEOUT
+        for pool in self.pools.values():
+            pool.join_threads(deadline)
+
+    def get_stats(self):
+        """Get statistics for each pool.
+
+        :returns: dict mapping pool names to ThreadPool.get_stats() dicts
+        """
+        return dict((name, pool.get_stats())
+                    for name, pool in self.pools.items())
+
+class SelectPoller(object):
+    """Poller that uses ``select.select()``.
+
+    This works everywhere, but it's O(n) for each call to poll() and
+    it's limited to FD_SETSIZE file descriptors.  We only use it when
+    nothing better is available.
+
+    All pollers share the same interface: file descriptors are
+    registered for reading/writing using add_reader(), add_writer(),
+    remove_reader() and remove_writer(), then poll() returns the lists
+    of (read_ready, write_ready, exc_ready) fds.  Fds for exceptional
+    conditions can only be registered with set_fds().
+    """
+    def __init__(self):
+        self.readers = set()
+        self.writers = set()
+        self.exc_fds = set()
+
+    def add_reader(self, fd):
+        if fd not in self.readers:
+            self.readers.add(fd)
+            self._update(fd)
+
+    def remove_reader(self, fd):
+        if fd in self.readers:
+            self.readers.discard(fd)
+            self._update(fd)
+
+    def add_writer(self, fd):
+        if fd not in self.writers:
+            self.writers.add(fd)
+            self._update(fd)
+
+    def remove_writer(self, fd):
+        if fd in self.writers:
+            self.writers.discard(fd)
+            self._update(fd)
+
+    def set_fds(self, readfds, writefds, excfds=()):
+        """Change the registered fds to readfds, writefds and excfds.
+
+        This is for event loops that recalculate their fds on each
+        iteration (for example LibCURLManager).  Only fds that changed
+        are registered/unregistered.
+        """
+        readfds = set(readfds)
+        writefds = set(writefds)
+        excfds = set(excfds)
+        for fd in self.readers - readfds:
+            self.remove_reader(fd)
+        for fd in self.writers - writefds:
+            self.remove_writer(fd)
+        for fd in readfds - self.readers:
+            self.add_reader(fd)
+        for fd in writefds - self.writers:
+            self.add_writer(fd)
+        changed_exc_fds = self.exc_fds.symmetric_difference(excfds)
+        self.exc_fds = excfds
+        for fd in changed_exc_fds:
+            self._update(fd)
+
+    def _update(self, fd):
+        """Called when the events we're interested in for fd change."""
+        pass
+
+    def poll(self, timeout):
+        """Wait for fds to be ready.
+
+        :param timeout: time to wait in seconds or None to wait forever
+        :returns: (read_ready, write_ready, exc_ready) tuple of fd lists
+        """
+        return select.select(list(self.readers), list(self.writers),
+                             list(self.exc_fds), timeout)
+
+    def close(self):
+        pass
+
+class PollPoller(SelectPoller):
+    """Poller that uses ``select.poll()``."""
+
+    READ_EVENTS = select.POLLIN | select.POLLPRI
+    WRITE_EVENTS = select.POLLOUT
+    # select() reports urgent data as an exceptional condition
+    EXC_EVENTS = select.POLLPRI
+    # for errors, we wake up all callbacks registered for the fd.  They
+    # will get the error when they try to read/write the socket.
+    ERROR_EVENTS = select.POLLERR | select.POLLHUP | select.POLLNVAL
+
+    def __init__(self):
+        SelectPoller.__init__(self)
+        self._poll = select.poll()
+
+    def _calc_events(self, fd):
+        events = 0
+        if fd in self.readers:
+            events |= self.READ_EVENTS
+        if fd in self.writers:
+            events |= self.WRITE_EVENTS
+        if fd in self.exc_fds:
+            events |= self.EXC_EVENTS
+        return events
+
+    def _update(self, fd):
+        events = self._calc_events(fd)
+        if events:
+            # register() also modifies an existing registration
+            self._poll.register(fd, events)
+        else:
+            try:
+                self._poll.unregister(fd)
+            except KeyError:
+                pass
+
+    def _wait(self, timeout):
+        if timeout is None:
+            return self._poll.poll()
+        else:
+            return self._poll.poll(int(math.ceil(timeout * 1000)))
+
+    def poll(self, timeout):
+        read_ready = []
+        write_ready = []
+        exc_ready = []
+        for fd, events in self._wait(timeout):
+            if (events & (self.EXC_EVENTS | self.ERROR_EVENTS) and
+                    fd in self.exc_fds):
+                exc_ready.append(fd)
+            if events & self.ERROR_EVENTS:
+                events |= self.READ_EVENTS | self.WRITE_EVENTS
+            if events & self.READ_EVENTS and fd in self.readers:
+                read_ready.append(fd)
+            if events & self.WRITE_EVENTS and fd in self.writers:
+                write_ready.append(fd)
+        return read_ready, write_ready, exc_ready
+
+if hasattr(select, 'epoll'):
+    class EpollPoller(PollPoller):
+        """Poller that uses ``select.epoll()``.
+
+        Registrations live in the kernel, so the cost of poll()
+        depends on the number of ready fds, not the number of
+        registered ones.
+        """
+
+        READ_EVENTS = select.EPOLLIN | select.EPOLLPRI
+        WRITE_EVENTS = select.EPOLLOUT
+        EXC_EVENTS = select.EPOLLPRI
+        ERROR_EVENTS = select.EPOLLERR | select.EPOLLHUP
+
+        def __init__(self):
+            SelectPoller.__init__(self)
+            self._poll = select.epoll()
+            self.registered = set()
+
+        def _update(self, fd):
+            events = self._calc_events(fd)
+            try:
+                if not events:
+                    self.registered.discard(fd)
+                    self._poll.unregister(fd)
+                elif fd in self.registered:
+                    self._poll.modify(fd, events)
+                else:
+                    self.registered.add(fd)
+                    self._poll.register(fd, events)
+            except (IOError, OSError), e:
+                # The kernel drops fds from the epoll set when they get
+                # closed, which means our bookkeeping can be out of
+                # date if a socket was closed before being removed or
+                # if its fd number was reused.
+                if e.errno == errno.ENOENT and events:
+                    self._poll.register(fd, events)
+                elif e.errno == errno.EEXIST:
+                    self._poll.modify(fd, events)
+                elif e.errno not in (errno.ENOENT, errno.EBADF):
+                    raise
+
+        def _wait(self, timeout):
+            if timeout is None:
+                timeout = -1
+            return self._poll.poll(timeout)
+
+        def close(self):
+            self._poll.close()
+
+def make_poller():
+    """Create the best poller available on this platform.
+
+    We use epoll on Linux and fall back to poll, then select.  poll is
+    unreliable on OS X, so we don't use it there.
+    """
+    if hasattr(select, 'epoll'):
+        return EpollPoller()
+    elif hasattr(select, 'poll') and sys.platform != 'darwin':
+        return PollPoller()
+    else:
+        return SelectPoller()
+
 class SimpleEventLoop(signals.SignalEmitter):
     def __init__(self):
         signals.SignalEmitter.__init__(self, 'thread-will-start',
@@ -242,6 +1094,8 @@ class SimpleEventLoop(signals.SignalEmitter):
                                        'end-loop')
         self.quit_flag = False
         self.wake_sender, self.wake_receiver = util.make_dummy_socket_pair()
+        self.poller = make_poller()
+        self.poller.add_reader(self.wake_receiver.fileno())
         self.loop_ready = threading.Event()
 
     def loop(self):
@@ -253,14 +1107,16 @@ class SimpleEventLoop(signals.SignalEmitter):
         while not self.quit_flag:
             self.emit('begin-loop')
             timeout = self.calc_timeout()
-            readfds, writefds, excfds = self.calc_fds()
-            readfds.append(self.wake_receiver.fileno())
+            self.update_poller()
             try:
                 read_fds_ready, write_fds_ready, exc_fds_ready = \
-                        select.select(readfds, writefds, excfds, timeout)
-            except select.error, (err, detail):
-                if err == errno.EINTR:
-                    logging.warning ("eventloop: %s", detail)
+                        self.poller.poll(timeout)
+            except (select.error, IOError, OSError), e:
+                # select and poll raise select.error, epoll raises IOError
+                if e.args[0] == errno.EINTR:
+                    logging.warning ("eventloop: %s", e)
+                    read_fds_ready, write_fds_ready, exc_fds_ready = \
+                            [], [], []
                 else:
                     self.emit('end-loop')
                     raise
@@ -272,6 +1128,18 @@ class SimpleEventLoop(signals.SignalEmitter):
             self.process_events(read_fds_ready, write_fds_ready, exc_fds_ready)
             self.emit('end-loop')
 
+    def update_poller(self):
+        """Make sure our poller is watching the right fds.
+
+        By default, we call calc_fds() and register the difference with
+        the poller.  Subclasses that keep the poller registrations up to
+        date as they change can override this to do nothing.
+        """
+        readfds, writefds, excfds = self.calc_fds()
+        readfds = list(readfds)
+        readfds.append(self.wake_receiver.fileno())
+        self.poller.set_fds(readfds, writefds, excfds)
+
     def wakeup(self):
         try:
             self.wake_sender.send("b")
@@ -287,12 +1155,49 @@ class EventLoop(SimpleEventLoop):
         self.create_signal('event-finished')
         self.scheduler = Scheduler()
         self.idle_queue = CallQueue()
-        self.urgent_queue = CallQueue()
-        self.threadpool = ThreadPool(self)
+        self.urgent_queue = CallQueue('urgent')
+        self.threadpool = ThreadPoolManager(self)
+        self.iterator_scheduler = IteratorScheduler(self)
         self.read_callbacks = {}
         self.write_callbacks = {}
         self.clear_removed_callbacks()
         self.idles_for_next_loop = []
+        self.instrumentation = None
+        self.instrumentation_dump_path = None
+        self.events_ready_at = None
+
+    def enable_instrumentation(self, dump_path=None):
+        """Start collecting timing statistics.
+
+        :param dump_path: if given, write a report to this path when we
+            shutdown
+        """
+        if self.instrumentation is None:
+            self.instrumentation = EventLoopInstrumentation()
+        self.instrumentation_dump_path = dump_path
+        self._set_instrumentation(self.instrumentation)
+
+    def disable_instrumentation(self):
+        self.instrumentation = None
+        self.instrumentation_dump_path = None
+        self._set_instrumentation(None)
+
+    def _set_instrumentation(self, instrumentation):
+        self.scheduler.instrumentation = instrumentation
+        self.idle_queue.instrumentation = instrumentation
+        self.urgent_queue.instrumentation = instrumentation
+
+    def dump_instrumentation(self):
+        """Write our timing report to the dump path passed to
+        enable_instrumentation(), if there is one.
+        """
+        if (self.instrumentation is None or
+                self.instrumentation_dump_path is None):
+            return
+        try:
+            self.instrumentation.dump(self.instrumentation_dump_path)
+        except (IOError, OSError):
+            logging.exception("Error writing event loop statistics")
 
     def clear_removed_callbacks(self):
         self.removed_read_callbacks = set()
@@ -300,28 +1205,48 @@ class EventLoop(SimpleEventLoop):
 
     def add_read_callback(self, sock, callback):
         self.read_callbacks[sock.fileno()] = callback
+        self.poller.add_reader(sock.fileno())
 
     def remove_read_callback(self, sock):
         del self.read_callbacks[sock.fileno()]
         self.removed_read_callbacks.add(sock.fileno())
+        self.poller.remove_reader(sock.fileno())
 
     def add_write_callback(self, sock, callback):
         self.write_callbacks[sock.fileno()] = callback
+        self.poller.add_writer(sock.fileno())
 
     def remove_write_callback(self, sock):
         del self.write_callbacks[sock.fileno()]
         self.removed_write_callbacks.add(sock.fileno())
+        self.poller.remove_writer(sock.fileno())
 
     def call_in_thread(self, callback, errback, function, name,
                        *args, **kwargs):
-        self.threadpool.queue_call(callback, errback, function, name,
-                                  *args, **kwargs)
+        self.threadpool.queue_call('default', PRIORITY_NORMAL, callback,
+                                   errback, function, name, *args, **kwargs)
+
+    def call_in_thread_pool(self, category, priority, callback, errback,
+                            function, name, *args, **kwargs):
+        self.threadpool.queue_call(category, priority, callback, errback,
+                                   function, name, *args, **kwargs)
 
     def run_idle_next_loop(self, function, name, args=None, kwargs=None):
         """Add an idle callback to be called on the next event loop."""
         self.idles_for_next_loop.append((function, name, args, kwargs))
 
     def process_events(self, read_fds_ready, write_fds_ready, exc_fds_ready):
+        instrumentation = self.instrumentation
+        if instrumentation is None:
+            self._process_events(read_fds_ready, write_fds_ready)
+            return
+        self.events_ready_at = clock()
+        try:
+            self._process_events(read_fds_ready, write_fds_ready)
+        finally:
+            instrumentation.record_iteration(clock() - self.events_ready_at)
+
+    def _process_events(self, read_fds_ready, write_fds_ready):
         self._process_urgent_events()
         if self.quit_flag:
             return
@@ -337,6 +1262,10 @@ class EventLoop(SimpleEventLoop):
     def calc_fds(self):
         return (self.read_callbacks.keys(), self.write_callbacks.keys(), [])
 
+    def update_poller(self):
+        # add_read_callback(), etc. keep the poller up to date
+        pass
+
     def calc_timeout(self):
         return self.scheduler.next_timeout()
 
@@ -370,18 +1299,20 @@ class EventLoop(SimpleEventLoop):
         """
         for callback in self.generate_callbacks(write_fds_ready,
                                                self.write_callbacks,
-                                               self.removed_write_callbacks):
+                                               self.removed_write_callbacks,
+                                               self.poller.remove_writer):
             yield callback
         for callback in self.generate_callbacks(read_fds_ready,
                                                self.read_callbacks,
-                                               self.removed_read_callbacks):
+                                               self.removed_read_callbacks,
+                                               self.poller.remove_reader):
             yield callback
         while self.scheduler.has_pending_timeout():
             yield self.scheduler.process_next_timeout
         while self.idle_queue.has_pending_idle():
             yield self.idle_queue.process_next_idle
 
-    def generate_callbacks(self, ready_list, map_, removed):
+    def generate_callbacks(self, ready_list, map_, removed, unregister):
         for fd in ready_list:
             try:
                 function = map_[fd]
@@ -394,9 +1325,22 @@ class EventLoop(SimpleEventLoop):
                     continue
                 when = "While talking to the network"
                 def callback_event():
-                    success = trapcall.trap_call(when, function)
+                    instrumentation = self.instrumentation
+                    if instrumentation is None:
+                        success = trapcall.trap_call(when, function)
+                    else:
+                        start = clock()
+                        success = trapcall.trap_call(when, function)
+                        if self.events_ready_at is not None:
+                            wait_time = start - self.events_ready_at
+                        else:
+                            wait_time = None
+                        instrumentation.record_event('socket',
+                                _callback_name(function), wait_time,
+                                clock() - start)
                     if not success:
                         del map_[fd]
+                        unregister(fd)
                     return success
                 yield callback_event
 
@@ -455,6 +1399,18 @@ def add_timeout(delay, function, name, args=None, kwargs=None):
     _eventloop.wakeup()
     return dc
 
+def scheduler_stats():
+    """Get statistics about scheduled timeouts.  See
+    Scheduler.get_stats() for details.
+    """
+    return _eventloop.scheduler.get_stats()
+
+def set_timeout_slack(slack):
+    """Set how many seconds timeouts can be delayed so they run
+    together with other timeouts.  0 disables coalescing.
+    """
+    _eventloop.scheduler.slack = slack
+
 def add_idle(function, name, args=None, kwargs=None):
     """Schedule a function to be called when we get some spare time.
     Returns a ``DelayedCall`` object that can be used to cancel the
@@ -483,6 +1439,30 @@ def call_in_thread(callback, errback, function, name, *args, **kwargs):
     _eventloop.call_in_thread(
         callback, errback, function, name, *args, **kwargs)
 
+def call_in_thread_pool(category, priority, callback, errback, function,
+                        name, *args, **kwargs):
+    """Like call_in_thread(), but run the function in the thread pool
+    for category.
+
+    :param category: 'default', 'network' or 'disk'.  See
+        ThreadPoolManager.
+    :param priority: PRIORITY_UI, PRIORITY_NORMAL or PRIORITY_BACKGROUND
+    """
+    _eventloop.call_in_thread_pool(category, priority,
+        callback, errback, function, name, *args, **kwargs)
+
+def thread_pool_stats():
+    """Get statistics for the thread pools.  See
+    ThreadPoolManager.get_stats().
+    """
+    return _eventloop.threadpool.get_stats()
+
+def set_thread_pool_size(category, size):
+    """Change the number of threads in a thread pool.  This must be
+    called before the event loop starts.
+    """
+    _eventloop.threadpool.set_pool_size(category, size)
+
 lt = None
 
 profile_file = None
@@ -515,10 +1495,26 @@ def join():
 def shutdown():
     """Shuts down the thread pool and eventloop.
     """
+    _eventloop.dump_instrumentation()
     thread_pool_quit()
     _eventloop.quit()
     _eventloop.wakeup()
 
+def enable_instrumentation(dump_path=None):
+    """Start collecting event loop timing statistics.  If dump_path is
+    given, a report will be written there on shutdown.
+    """
+    _eventloop.enable_instrumentation(dump_path)
+
+def disable_instrumentation():
+    _eventloop.disable_instrumentation()
+
+def get_instrumentation():
+    """Get the EventLoopInstrumentation for the event loop, or None if
+    instrumentation isn't enabled.
+    """
+    return _eventloop.instrumentation
+
 def connect(signal, callback):
     _eventloop.connect(signal, callback)
 
@@ -560,13 +1556,14 @@ def as_urgent(func):
                                args=args, kwargs=kwargs)
     return queuer
 
-def idle_iterate(func, name, args=None, kwargs=None):
-    """Iterate over a generator function using add_idle for each
-    iteration.
+def idle_iterate(func, name, args=None, kwargs=None,
+                 priority=PRIORITY_NORMAL):
+    """Iterate over a generator function in the event loop.
 
     This allows long running functions to be split up into distinct
-    steps, after each step other idle functions will have a chance to
-    run.
+    steps.  The generator should yield whenever it's safe to stop
+    running.  The event loop decides whether to continue running it or
+    to let other code run first (see IteratorScheduler).
 
     For example::
 
@@ -579,33 +1576,31 @@ def idle_iterate(func, name, args=None, kwargs=None):
             yield
 
         eventloop.idle_iterate(foo, 'Foo', args=(1, 2, 3))
+
+    :param priority: PRIORITY_UI, PRIORITY_NORMAL or PRIORITY_BACKGROUND
     """
     if args is None:
         args = ()
     if kwargs is None:
         kwargs = {}
     iterator = func(*args, **kwargs)
-    add_idle(_idle_iterate_step, name, args=(iterator, name))
+    add_idle(_idle_iterate_start, name, args=(iterator, name, priority))
 
-def _idle_iterate_step(iterator, name):
-    try:
-        retval = iterator.next()
-    except StopIteration:
-        return
-    else:
-        if retval is not None:
-            logging.warn("idle_iterate yield value ignored: %s (%s)",
-                         retval, name)
-        _eventloop.run_idle_next_loop(_idle_iterate_step, name,
-                args=(iterator, name))
+def _idle_iterate_start(iterator, name, priority):
+    _eventloop.iterator_scheduler.add(iterator, name, priority)
 
-def idle_iterator(func):
+def idle_iterator(func=None, priority=PRIORITY_NORMAL):
     """Decorator to wrap a generator function in a ``idle_iterate()``
     call.
+
+    Can be used either as ``@idle_iterator`` or as
+    ``@idle_iterator(priority=PRIORITY_BACKGROUND)``.
     """
+    if func is None:
+        return lambda func: idle_iterator(func, priority)
     def queuer(*args, **kwargs):
         return idle_iterate(func, "%s() (using idle_iterator)" % func.__name__, 
-                            args=args, kwargs=kwargs)
+                            args=args, kwargs=kwargs, priority=priority)
     return queuer
 
 class DelayedFunctionCaller(object):
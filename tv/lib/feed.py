@@ -577,54 +577,35 @@ class Feed(DDBObject, iconcache.IconCacheOwnerMixin):
         if self.actualFeed:
             return self.actualFeed.clean_old_items()
 
-    def invalidate_counts(self):
-        for cached_count_attr in ('_num_available', '_num_unwatched',
-                '_num_downloaded', '_num_downloading'):
-            if cached_count_attr in self.__dict__:
-                del self.__dict__[cached_count_attr]
-
     def recalc_counts(self):
-        self.invalidate_counts()
-        self.signal_change(needs_save=False)
-        if self.in_folder():
-            self.get_folder().signal_change(needs_save=False)
+        """Recalculate the item counts for this feed.
+
+        app.feed_count_tracker keeps the counts up to date as items change,
+        but it can't see changes to other tables (for example the state of
+        an item's downloader).  Call this when those may have changed.
+        """
+        app.feed_count_tracker.check_feed(self.id)
 
     def num_downloaded(self):
         """Returns the number of downloaded items in the feed.
         """
-        try:
-            return self._num_downloaded
-        except AttributeError:
-            self._num_downloaded = self.downloaded_items.count()
-            return self._num_downloaded
+        return app.feed_count_tracker.feed_count(self.id, 'downloaded')
 
     def num_downloading(self):
         """Returns the number of downloading items in the feed.
         """
-        try:
-            return self._num_downloading
-        except AttributeError:
-            self._num_downloading = self.downloading_items.count()
-            return self._num_downloading
+        return app.feed_count_tracker.feed_count(self.id, 'downloading')
 
     def num_unwatched(self):
         """Returns string with number of unwatched videos in feed
         """
-        try:
-            return self._num_unwatched
-        except AttributeError:
-            self._num_unwatched = self.unwatched_items.count()
-            return self._num_unwatched
+        return app.feed_count_tracker.feed_count(self.id, 'unwatched')
 
     def num_available(self):
         """Returns string with number of available videos in feed
         """
-        try:
-            return self._num_available
-        except AttributeError:
-            self._num_available = (self.available_items.count() -
-                    self.auto_pending_items.count())
-            return self._num_available
+        return (app.feed_count_tracker.feed_count(self.id, 'available') -
+                app.feed_count_tracker.feed_count(self.id, 'auto_pending'))
 
     def get_viewed(self):
         """Returns true iff this feed has been looked at
@@ -637,10 +618,6 @@ class Feed(DDBObject, iconcache.IconCacheOwnerMixin):
         # get the list of available items before we reset the time
         available_items = list(self.available_items)
         self.last_viewed = datetime.now()
-        try:
-            del self._num_available
-        except AttributeError:
-            pass
         if self.in_folder():
             self.get_folder().signal_change()
         self.signal_change()
@@ -841,6 +818,7 @@ class Feed(DDBObject, iconcache.IconCacheOwnerMixin):
         else:
             self.folder_id = None
         self.signal_change()
+        app.feed_count_tracker.feed_folder_changed(self.id, self.folder_id)
         if update_trackers:
             models.Item.update_folder_trackers()
         if new_folder:
@@ -1171,6 +1149,7 @@ class Feed(DDBObject, iconcache.IconCacheOwnerMixin):
             app.bulk_sql_manager.finish()
         self.remove_icon_cache()
         DDBObject.remove(self)
+        app.feed_count_tracker.feed_removed(self.id)
         self.actualFeed.remove()
         if self.in_folder():
             self.get_folder().signal_change()
@@ -2105,7 +2084,7 @@ class DirectoryScannerImplBase(FeedImpl):
                     self.handle_watcher_updates,
                     "handle directory watcher updates")
 
-    @eventloop.idle_iterator
+    @eventloop.idle_iterator(priority=eventloop.PRIORITY_BACKGROUND)
     def handle_watcher_updates(self):
         # If we are not longer valid just return
         if not self.ufeed.id_exists():
@@ -2120,14 +2099,11 @@ class DirectoryScannerImplBase(FeedImpl):
         for x in self.items:
             known_files.add_path(x.get_filename())
         to_add = []
-        start = time.time()
         for f in self._filter_paths(self._watcher_paths_added, known_files):
             to_add.append(f)
-            if time.time() - start > 0.4:
-                yield
+            if (yield):
                 if not self.id_exists():
                     return
-                start = time.time()
         # commit changes
         with app.local_metadata_manager.bulk_add():
             app.bulk_sql_manager.start()
@@ -2170,13 +2146,14 @@ class DirectoryScannerImplBase(FeedImpl):
             self.updating = True
             self.schedule_update()
 
-    @eventloop.idle_iterator
+    @eventloop.idle_iterator(priority=eventloop.PRIORITY_BACKGROUND)
     def do_update(self):
 
         def should_halt_early():
             """Check if we should halt before completing the entire update.
 
-            This should be called after each yield statement.
+            This should be called after each yield statement that let
+            other code run.
             """
             return not self.id_exists()
 
@@ -2196,7 +2173,6 @@ class DirectoryScannerImplBase(FeedImpl):
         # Remove items with deleted files or that that are in feeds
         to_remove = []
         duplicate_paths = []
-        start = time.time()
         for item in my_items:
             if not item.id_exists():
                 continue
@@ -2210,11 +2186,9 @@ class DirectoryScannerImplBase(FeedImpl):
             else:
                 duplicate_paths.append(filename)
                 to_remove.append(item)
-            if time.time() - start > 0.4:
-                yield
+            if (yield):
                 if should_halt_early():
                     return
-                start = time.time()
         if duplicate_paths:
             app.controller.failed_soft("scanning directory",
                 "duplicate paths in directory watcher: %s (impl: %s" %
@@ -2238,23 +2212,17 @@ class DirectoryScannerImplBase(FeedImpl):
         scan_dir = self._scan_dir()
         if fileutil.isdir(scan_dir) and not is_file_bundle(scan_dir):
             all_files = []
-            start = time.time()
             for f in fileutil.miro_allfiles(scan_dir):
                 all_files.append(f)
-                if time.time() - start > 0.4:
-                    yield
+                if (yield):
                     if should_halt_early():
                         return
-                    start = time.time()
-            start = time.time()
             to_add = []
             for path in self._filter_paths(all_files, known_files):
                 to_add.append(path)
-                if time.time() - start > 0.4:
-                    yield
+                if (yield):
                     if should_halt_early():
                         return
-                    start = time.time()
 
             # Keep track of the paths we will add in case we get directory
             # watcher updates.  In that case, we want these paths to be in
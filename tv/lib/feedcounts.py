@@ -0,0 +1,538 @@
+# Miro - an RSS based video player application
+# Copyright (C) 2005, 2006, 2007, 2008, 2009, 2010, 2011
+# Participatory Culture Foundation
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 51 Franklin St, Fifth Floor, Boston, MA  02110-1301 USA
+#
+# In addition, as a special exception, the copyright holders give
+# permission to link the code of portions of this program with the OpenSSL
+# library.
+#
+# You must obey the GNU General Public License in all respects for all of
+# the code used other than OpenSSL. If you modify file(s) with this
+# exception, you may extend this exception to your version of the file(s),
+# but you are not obligated to do so. If you do not wish to do so, delete
+# this exception statement from your version. If you delete this exception
+# statement from all source files in the program, then also delete it here.
+
+"""``miro.feedcounts`` -- Track item counts for feeds and channel folders.
+
+The sidebar displays unwatched/available counts for every feed and folder,
+and the feed code checks the downloaded/downloading counts.  Running COUNT
+queries for each of those gets expensive when there are lots of feeds.
+
+Instead, FeedCountTracker remembers which counts each item is included in
+and updates the feed/folder totals as items change.  It hooks into the
+ViewTrackerManager for the item table, so it sees the same changes that
+ViewTrackers do.  The per-item data is saved in the feed_item_counts table
+so that we don't have to recalculate it at startup, and every so often we
+reconcile everything against the item table to fix any counts that have
+drifted.
+"""
+
+import logging
+
+from miro import app
+from miro import eventloop
+from miro import models
+from miro import schema
+from miro import util
+from miro.database import ObjectNotFoundError
+
+_DOWNLOADED_WHERE = ("(item.is_file_item OR rd.state IN ('finished', "
+                     "'uploading', 'uploading-paused'))")
+
+# (name, SQL expression) for each count we track.  These need to match the
+# where clauses for Item.feed_downloaded_view(), feed_downloading_view(),
+# feed_unwatched_view(), feed_available_view() and
+# feed_auto_pending_view().  They also need to match _calc_item_flags().
+COUNTS = [
+    ('downloaded', _DOWNLOADED_WHERE),
+    ('downloading', "rd.state IN ('downloading', 'uploading') AND "
+                    "rd.main_item_id=item.id"),
+    ('unwatched', "NOT item.seen AND "
+                  "item.file_type IN ('audio', 'video') AND " +
+                  _DOWNLOADED_WHERE),
+    ('available', "NOT item.autoDownloaded AND "
+                  "item.downloadedTime IS NULL AND "
+                  "NOT item.is_file_item AND "
+                  "feed.last_viewed <= item.creationTime"),
+    ('auto_pending', "feed.autoDownloadable AND "
+                     "NOT item.was_downloaded AND "
+                     "(item.eligibleForAutoDownload OR feed.getEverything)"),
+]
+
+COUNT_INDEXES = dict((name, i) for i, (name, where) in enumerate(COUNTS))
+
+def _flags_sql(where):
+    """Get SQL that selects (id, feed_id, flags) for items.
+
+    flags is a bitmask with bit N set if the item is included in the Nth
+    count from COUNTS.
+    """
+    flags = ' + '.join('(CASE WHEN %s THEN %d ELSE 0 END)' % (sql, 1 << i)
+                       for i, (name, sql) in enumerate(COUNTS))
+    return ("SELECT item.id, item.feed_id, %s FROM item "
+            "LEFT JOIN remote_downloader AS rd ON item.downloader_id=rd.id "
+            "LEFT JOIN feed ON item.feed_id=feed.id "
+            "WHERE item.feed_id IS NOT NULL AND (%s)" % (flags, where))
+
+def _calc_item_flags(item):
+    """Get the (feed_id, flags) value for an Item that's in memory.
+
+    This calculates the same thing that the SQL from _flags_sql() does, but
+    uses the Item's attributes rather than querying the database.
+
+    :returns: (feed_id, flags) tuple or None if the item isn't in a feed
+    """
+    if item.feed_id is None:
+        return None
+    try:
+        feed = item.get_feed()
+    except ObjectNotFoundError:
+        feed = None
+    dler = item.downloader
+    if dler is not None:
+        dler_state = dler.state
+    else:
+        dler_state = None
+    downloaded = bool(item.is_file_item or
+                      dler_state in ('finished', 'uploading',
+                                     'uploading-paused'))
+    checks = {
+        'downloaded': downloaded,
+        'downloading': (dler_state in ('downloading', 'uploading') and
+                        dler.main_item_id == item.id),
+        'unwatched': (not item.seen and
+                      item.file_type in ('audio', 'video') and downloaded),
+        'available': (not item.autoDownloaded and
+                      item.downloadedTime is None and
+                      not item.is_file_item and
+                      feed is not None and
+                      feed.last_viewed is not None and
+                      item.creationTime is not None and
+                      feed.last_viewed <= item.creationTime),
+        'auto_pending': (feed is not None and feed.autoDownloadable and
+                         not item.was_downloaded and
+                         bool(item.eligibleForAutoDownload or
+                              feed.getEverything)),
+    }
+    flags = 0
+    for i, (name, sql) in enumerate(COUNTS):
+        if checks[name]:
+            flags |= 1 << i
+    return (item.feed_id, flags)
+
+class FeedCountTracker(object):
+    """Maintains item counts for each feed and channel folder.
+
+    For each item in a feed we store a (feed_id, flags) tuple.  flags is a
+    bitmask of the counts the item is included in (see COUNTS).  Whenever
+    those change, we update the totals for the feed and its folder and
+    schedule a signal_change() call for them.
+
+    FeedCountTracker adds itself to the ViewTrackerManager's trackers for
+    the item table, so it implements the same object_changed(),
+    objects_changed(), remove_object(), remove_objects() and
+    check_all_objects() methods that ViewTracker does.
+    """
+
+    # bump this when the COUNTS change
+    VERSION = 1
+    VERSION_KEY = 'feed_item_counts_db_version'
+    # how often should we save changes to the DB? (in seconds)
+    SAVE_INTERVAL = 30
+    # how often should we check our counts against the item table?
+    RECONCILE_INTERVAL = 600
+    # we don't care about the item's folder_id (see
+    # Item.update_folder_trackers())
+    where = None
+
+    def __init__(self):
+        self.loaded = False
+        self.db_info = None
+        # maps item ids -> (feed_id, flags)
+        self._item_flags = {}
+        # maps feed ids -> set of item ids
+        self._feed_items = {}
+        # maps feed/folder ids -> list of counts, in the same order as
+        # COUNTS
+        self._feed_counts = {}
+        self._folder_counts = {}
+        # maps feed ids -> folder ids for feeds that are in folders
+        self._feed_folders = {}
+        self._changed_item_ids = set()
+        self._feeds_to_signal = set()
+        self._save_dc = None
+        self._signal_dc = None
+        self._reconcile_dc = None
+        self.reconcile_count = 0
+        self.reconcile_fixes = 0
+
+    def load(self, saved_data=None):
+        """Load the counts.
+
+        :param saved_data: result of read_saved_data(), if it's already been
+            read in a worker thread.  If None, we read it here.
+        """
+        self.db_info = app.db_info
+        self._changed_item_ids = set()
+        self._feeds_to_signal = set()
+        item_flags = None
+        try:
+            item_flags = self._quick_load(saved_data)
+        except StandardError, e:
+            logging.warn("Error loading feed item counts: %s", e)
+        if item_flags is None:
+            item_flags = self._calc_flags()
+            # the saved data is suspect, replace it
+            app.db.cursor.execute("DELETE FROM feed_item_counts")
+            if item_flags:
+                self._changed_item_ids.update(item_flags)
+                self.schedule_save_to_db()
+        app.db.set_variable(self.VERSION_KEY, self.version())
+        self._item_flags = {}
+        self._feed_items = {}
+        self._feed_counts = {}
+        self._folder_counts = {}
+        self._feed_folders = self._get_feed_folders()
+        for item_id, value in item_flags.iteritems():
+            self._add_item(item_id, value)
+        self.db_info.view_tracker_manager.trackers_for_table('item').add(self)
+        self.loaded = True
+        self.schedule_reconcile()
+
+    def unlink(self):
+        if self.db_info is not None:
+            trackers = self.db_info.view_tracker_manager.trackers_for_table(
+                'item')
+            trackers.discard(self)
+        for dc in (self._save_dc, self._signal_dc, self._reconcile_dc):
+            if dc is not None:
+                dc.cancel()
+        self._save_dc = self._signal_dc = self._reconcile_dc = None
+        self.loaded = False
+
+    def version(self):
+        return "%s-%s" % (schema.VERSION, self.VERSION)
+
+    def read_saved_data(self, cursor):
+        """Read the data that _quick_load() uses.
+
+        This only uses cursor, so it can be run in a worker thread with
+        LiveStorage.read_in_thread().
+
+        :returns: (item_flags, item_count) tuple
+        """
+        cursor.execute("SELECT item_id, feed_id, flags "
+                       "FROM feed_item_counts")
+        item_flags = dict((row[0], (row[1], row[2])) for row in cursor)
+        cursor.execute("SELECT COUNT(*) FROM item "
+                       "WHERE feed_id IS NOT NULL")
+        return item_flags, cursor.fetchone()[0]
+
+    def _quick_load(self, saved_data=None):
+        """Load the per-item data from the feed_item_counts table.
+
+        :returns: dict mapping item ids to (feed_id, flags) or None if the
+            saved data isn't usable.
+        """
+        try:
+            saved_version = app.db.get_variable(self.VERSION_KEY)
+        except KeyError:
+            return None
+        if saved_version != self.version():
+            return None
+        if saved_data is None:
+            cursor = app.db.acquire_read_cursor()
+            try:
+                saved_data = self.read_saved_data(cursor)
+            finally:
+                app.db.release_read_cursor(cursor)
+        item_flags, item_count = saved_data
+        # double check that we have the right number of rows
+        if len(item_flags) != item_count:
+            return None
+        return item_flags
+
+    def _calc_flags(self, where='1', values=()):
+        """Calculate (feed_id, flags) values using the item table.
+
+        We use the main cursor so that we see uncommitted changes.
+
+        :returns: dict mapping item ids to (feed_id, flags)
+        """
+        app.db.cursor.execute(_flags_sql(where), values)
+        return dict((row[0], (row[1], row[2])) for row in app.db.cursor)
+
+    def _get_feed_folders(self):
+        app.db.cursor.execute("SELECT id, folder_id FROM feed "
+                              "WHERE folder_id IS NOT NULL")
+        return dict(app.db.cursor.fetchall())
+
+    def _totals_for_feed(self, feed_id):
+        """Get the count lists that an item in feed_id contributes to."""
+        totals = [self._feed_counts.setdefault(feed_id, [0] * len(COUNTS))]
+        folder_id = self._feed_folders.get(feed_id)
+        if folder_id is not None:
+            totals.append(self._folder_counts.setdefault(folder_id,
+                                                         [0] * len(COUNTS)))
+        return totals
+
+    def _apply_flags(self, feed_id, flags, delta):
+        for i in xrange(len(COUNTS)):
+            if flags & (1 << i):
+                for counts in self._totals_for_feed(feed_id):
+                    counts[i] += delta
+
+    def _add_item(self, item_id, value):
+        feed_id, flags = value
+        self._item_flags[item_id] = value
+        self._feed_items.setdefault(feed_id, set()).add(item_id)
+        self._apply_flags(feed_id, flags, 1)
+
+    def _remove_item(self, item_id):
+        feed_id, flags = self._item_flags.pop(item_id)
+        self._feed_items[feed_id].discard(item_id)
+        self._apply_flags(feed_id, flags, -1)
+
+    def _set_item_flags(self, item_id, value):
+        """Update the (feed_id, flags) value for an item.
+
+        value can be None if the item is removed or not in a feed.
+
+        :returns: True if the value changed
+        """
+        old_value = self._item_flags.get(item_id)
+        if old_value == value:
+            return False
+        if old_value is not None:
+            self._remove_item(item_id)
+            self._feeds_to_signal.add(old_value[0])
+        if value is not None:
+            self._add_item(item_id, value)
+            self._feeds_to_signal.add(value[0])
+        self._changed_item_ids.add(item_id)
+        return True
+
+    def _update_items(self, item_ids, new_values):
+        """Update items using new (feed_id, flags) values.
+
+        Items in item_ids that aren't in new_values are dropped.
+
+        :returns: number of items that changed
+        """
+        changed = 0
+        for item_id in item_ids:
+            if self._set_item_flags(item_id, new_values.get(item_id)):
+                changed += 1
+        if changed:
+            self.schedule_save_to_db()
+            self._schedule_signal()
+        return changed
+
+    def _check_items(self, items):
+        new_values = {}
+        for item in items:
+            value = _calc_item_flags(item)
+            if value is not None:
+                new_values[item.id] = value
+        return self._update_items([item.id for item in items], new_values)
+
+    # ViewTracker-style methods.  ViewTrackerManager calls these for
+    # changes to the item table.
+
+    def object_changed(self, obj, can_change_views):
+        if can_change_views:
+            self.check_item(obj)
+
+    def objects_changed(self, objects, can_change_views):
+        if can_change_views:
+            self._check_items(objects)
+
+    def remove_object(self, obj):
+        self.remove_objects([obj])
+
+    def remove_objects(self, objects):
+        self._update_items([obj.id for obj in objects], {})
+
+    def check_all_objects(self):
+        new_values = self._calc_flags()
+        self._update_items(set(self._item_flags).union(new_values),
+                           new_values)
+
+    # public API
+
+    def check_item(self, item):
+        """Recalculate the counts for an item.
+
+        Call this when something that's not stored in the item table (for
+        example the state of its downloader) changes.
+
+        :returns: True if the counts changed
+        """
+        items = [item]
+        if item.parent_id is not None:
+            try:
+                items.append(item.get_parent())
+            except ObjectNotFoundError:
+                pass
+        return self._check_items(items) > 0
+
+    def check_feed(self, feed_id):
+        """Recalculate the counts for each item in a feed.
+
+        :returns: True if the counts changed
+        """
+        new_values = self._calc_flags('item.feed_id=?', (feed_id,))
+        item_ids = self._feed_items.get(feed_id, set()).union(new_values)
+        return self._update_items(item_ids, new_values) > 0
+
+    def feed_folder_changed(self, feed_id, folder_id):
+        """Call this when a feed moves in or out of a folder."""
+        if self._feed_folders.get(feed_id) == folder_id:
+            return
+        for item_id in self._feed_items.get(feed_id, ()):
+            self._apply_flags(feed_id, self._item_flags[item_id][1], -1)
+        if folder_id is not None:
+            self._feed_folders[feed_id] = folder_id
+        else:
+            self._feed_folders.pop(feed_id, None)
+        for item_id in self._feed_items.get(feed_id, ()):
+            self._apply_flags(feed_id, self._item_flags[item_id][1], 1)
+
+    def feed_removed(self, feed_id):
+        """Call this after a feed has been removed."""
+        self.feed_folder_changed(feed_id, None)
+        if not self._feed_items.get(feed_id):
+            self._feed_items.pop(feed_id, None)
+            self._feed_counts.pop(feed_id, None)
+        self._feeds_to_signal.discard(feed_id)
+
+    def feed_count(self, feed_id, name):
+        """Get a count for a feed.
+
+        :param name: name of the count from COUNTS
+        """
+        try:
+            return self._feed_counts[feed_id][COUNT_INDEXES[name]]
+        except KeyError:
+            return 0
+
+    def folder_count(self, folder_id, name):
+        """Get a count for a ChannelFolder.
+
+        :param name: name of the count from COUNTS
+        """
+        try:
+            return self._folder_counts[folder_id][COUNT_INDEXES[name]]
+        except KeyError:
+            return 0
+
+    def _schedule_signal(self):
+        if self._signal_dc is None:
+            self._signal_dc = eventloop.add_idle(self._signal_feeds,
+                    'signal feed count changes')
+
+    def _signal_feeds(self):
+        """Call signal_change() for feeds/folders whose counts changed."""
+        self._signal_dc = None
+        feed_ids = self._feeds_to_signal
+        self._feeds_to_signal = set()
+        folder_ids = set()
+        for feed_id in feed_ids:
+            try:
+                feed = models.Feed.get_by_id(feed_id)
+            except ObjectNotFoundError:
+                continue
+            feed.signal_change(needs_save=False)
+            if feed.folder_id is not None:
+                folder_ids.add(feed.folder_id)
+        for folder_id in folder_ids:
+            try:
+                folder = models.ChannelFolder.get_by_id(folder_id)
+            except ObjectNotFoundError:
+                continue
+            folder.signal_change(needs_save=False)
+
+    def schedule_reconcile(self):
+        if self._reconcile_dc is None:
+            self._reconcile_dc = eventloop.add_timeout(
+                    self.RECONCILE_INTERVAL, self._reconcile_timeout,
+                    'reconcile feed item counts')
+
+    def _reconcile_timeout(self):
+        self._reconcile_dc = None
+        self.reconcile()
+        self.schedule_reconcile()
+
+    def reconcile(self):
+        """Check our counts against the item table and fix any problems.
+
+        :returns: number of items whose counts were wrong
+        """
+        self._feed_folders = self._get_feed_folders()
+        self._folder_counts = {}
+        for feed_id, counts in self._feed_counts.iteritems():
+            folder_id = self._feed_folders.get(feed_id)
+            if folder_id is not None:
+                folder_counts = self._folder_counts.setdefault(folder_id,
+                        [0] * len(COUNTS))
+                for i, count in enumerate(counts):
+                    folder_counts[i] += count
+        new_values = self._calc_flags()
+        fixes = self._update_items(set(self._item_flags).union(new_values),
+                                   new_values)
+        self.reconcile_count += 1
+        self.reconcile_fixes += fixes
+        if fixes:
+            logging.warn("FeedCountTracker.reconcile(): fixed counts for "
+                         "%s items", fixes)
+        return fixes
+
+    def schedule_save_to_db(self):
+        if self._save_dc is None:
+            self._save_dc = eventloop.add_timeout(self.SAVE_INTERVAL,
+                    self.save, 'save feed item counts')
+
+    def save(self):
+        self._save_dc = None
+        if not self._changed_item_ids:
+            return
+        to_save = []
+        to_delete = []
+        for item_id in self._changed_item_ids:
+            try:
+                feed_id, flags = self._item_flags[item_id]
+            except KeyError:
+                to_delete.append(item_id)
+            else:
+                to_save.append((item_id, feed_id, flags))
+        app.db.run_in_transaction(self._write_rows, to_save, to_delete)
+        self._changed_item_ids = set()
+
+    def _write_rows(self, cursor, to_save, to_delete):
+        cursor.executemany("INSERT OR REPLACE INTO "
+                "feed_item_counts (item_id, feed_id, flags) "
+                "VALUES (?, ?, ?)", to_save)
+        for id_chunk in util.split_values_for_sqlite(to_delete):
+            cursor.execute("DELETE FROM feed_item_counts "
+                    "WHERE item_id IN (%s)" %
+                    ', '.join('?' for i in id_chunk), id_chunk)
+
+def create_sql():
+    """Get the SQL needed to create the table for FeedCountTracker."""
+    return ("CREATE TABLE feed_item_counts(item_id INTEGER PRIMARY KEY, "
+            "feed_id INTEGER, flags INTEGER)")
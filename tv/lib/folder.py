@@ -32,6 +32,7 @@
 
 import logging
 
+from miro import app
 from miro import feed
 from miro import playlist
 from miro.database import DDBObject, ObjectNotFoundError
@@ -133,34 +134,23 @@ class ChannelFolder(FolderBase):
     def has_downloaded_items(self):
         """True if this folder has feeds with downloaded items.
         """
-        for mem in self.get_children_view():
-            if mem.has_downloaded_items():
-                return True
-        return False
+        return app.feed_count_tracker.folder_count(self.id, 'downloaded') > 0
 
     def has_downloading_items(self):
         """True if this folder has feeds with downloading items.
         """
-        for mem in self.get_children_view():
-            if mem.has_downloading_items():
-                return True
-        return False
+        return app.feed_count_tracker.folder_count(self.id, 'downloading') > 0
 
     def num_unwatched(self):
         """Returns number of unwatched items in feed.
         """
-        unwatched = 0
-        for child in self.get_children_view():
-            unwatched += child.num_unwatched()
-        return unwatched
+        return app.feed_count_tracker.folder_count(self.id, 'unwatched')
 
     def num_available(self):
         """Returns number of available items in feed
         """
-        available = 0
-        for child in self.get_children_view():
-            available += child.num_available()
-        return available
+        return (app.feed_count_tracker.folder_count(self.id, 'available') -
+                app.feed_count_tracker.folder_count(self.id, 'auto_pending'))
 
     def mark_as_viewed(self):
         """Marks all children as viewed.
@@ -101,6 +101,9 @@ class CliMessageHandler(messages.MessageHandler):
     def handle_items_changed(self, message):
         pass
 
+    def handle_download_progress(self, message):
+        pass
+
     def handle_database_upgrade_end(self, message):
         print "Done with database upgrades"
 
@@ -423,3 +423,30 @@ class MiroInterpreter(cmd.Cmd):
         def callback(dialog):
             print "TEST CHOICE: %s" % dialog.choice
         d.run(callback)
+
+    @run_in_event_loop
+    def do_loopstats(self, line):
+        """loopstats [on [dump path]|off|reset] -- Shows event loop timing statistics."""
+        args = line.split(None, 1)
+        if not args:
+            instrumentation = eventloop.get_instrumentation()
+            if instrumentation is None:
+                print "Event loop statistics are off.  Use \"loopstats on\"."
+            else:
+                print instrumentation.format_report()
+        elif args[0] == 'on':
+            if len(args) > 1:
+                dump_path = args[1]
+            else:
+                dump_path = None
+            eventloop.enable_instrumentation(dump_path)
+            print "Event loop statistics enabled."
+        elif args[0] == 'off':
+            eventloop.disable_instrumentation()
+            print "Event loop statistics disabled."
+        elif args[0] == 'reset':
+            instrumentation = eventloop.get_instrumentation()
+            if instrumentation is not None:
+                instrumentation.reset()
+        else:
+            print "Error: unknown loopstats command: %s" % args[0]
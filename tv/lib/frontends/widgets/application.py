@@ -70,6 +70,7 @@ from miro.frontends.widgets import removefeeds
 from miro.frontends.widgets import diagnostics
 from miro.frontends.widgets import crashdialog
 from miro.frontends.widgets import itemlistcontroller
+from miro.frontends.widgets import itemtrack
 from miro.frontends.widgets import prefpanel
 from miro.frontends.widgets import displays
 from miro.frontends.widgets import menus
@@ -103,6 +104,7 @@ class Application:
         self.ui_initialized = False
         messages.FrontendMessage.install_handler(self.message_handler)
         app.info_updater = InfoUpdater()
+        app.item_search_terms_index = itemtrack.ItemSearchTermsIndex()
         app.saved_items = set()
         app.watched_folder_manager = watchedfolders.WatchedFolderManager()
         app.store_manager = stores.StoreManager()
@@ -155,6 +157,7 @@ class Application:
         messages.QueryViewStates().send_to_backend()
         messages.QueryGlobalState().send_to_backend()
         messages.TrackChannels().send_to_backend()
+        app.item_search_terms_index.start_tracking()
 
         self.setup_globals()
         self.ui_initialized = True
@@ -1570,9 +1573,18 @@ class WidgetsMessageHandler(messages.MessageHandler):
     def handle_item_list(self, message):
         app.info_updater.handle_item_list(message)
 
+    def handle_item_infos_fetched(self, message):
+        app.info_updater.handle_item_infos_fetched(message)
+
     def handle_items_changed(self, message):
         app.info_updater.handle_items_changed(message)
 
+    def handle_download_progress(self, message):
+        app.info_updater.handle_download_progress(message)
+
+    def handle_item_search_terms_changed(self, message):
+        app.item_search_terms_index.handle_search_terms_changed(message)
+
     def handle_download_count_changed(self, message):
         app.widgetapp.download_count = message.count
         library_tab_list = app.tabs['library']
@@ -41,6 +41,7 @@ import itertools
 import sys
 
 from miro import app
+from miro import search
 from miro import util
 from miro.frontends.widgets import itemfilter
 from miro.frontends.widgets.widgetstatestore import WidgetStateStore
@@ -50,6 +51,11 @@ from miro.plat.frontends.widgets import widgetset
 class ItemSort(object):
     """Class that sorts items in an item list."""
 
+    # Can the backend call sort_key() to order the items it sends first (see
+    # TrackItems)?  Sorters whose keys depend on state that we change must
+    # set this to False.
+    BACKEND_CAN_SORT = True
+
     def __init__(self, ascending):
         self.reverse = not ascending
 
@@ -70,6 +76,21 @@ class ItemSort(object):
         changes to the item list.
         """
 
+    def items_removed(self, id_list):
+        """Called when items are removed from the item list.
+
+        Subclasses can override this to forget about the items.
+        """
+
+    def set_search(self, search_text):
+        """Called when the search for the item list changes.
+
+        Subclasses can override this if their sort depends on the search.
+
+        :returns: True if the item list needs to be resorted
+        """
+        return False
+
 class DateSort(ItemSort):
     KEY = 'date'
     def sort_key(self, info):
@@ -288,10 +309,59 @@ class KindSort(ItemSort):
     def sort_key(self, info):
         return info.kind
 
+class RelevanceSort(ItemSort):
+    """Sort that orders search results by how well they match the search.
+
+    Items are scored with search.ItemScorer.  The best matches always come
+    first, the sort direction only changes whether items with the same score
+    are ordered newest or oldest first.
+    """
+    KEY = 'relevance'
+    BACKEND_CAN_SORT = False
+
+    def __init__(self, ascending):
+        ItemSort.__init__(self, ascending)
+        self.search_text = None
+        self.scorer = search.ItemScorer(u'')
+        # maps ids -> (ItemInfo, score) for the current search
+        self._scores = {}
+
+    def set_search(self, search_text):
+        if search_text == self.search_text:
+            return False
+        self.search_text = search_text
+        self.scorer = search.ItemScorer(search_text)
+        self._scores = {}
+        return True
+
+    def items_removed(self, id_list):
+        for id_ in id_list:
+            self._scores.pop(id_, None)
+
+    def score(self, info):
+        """Get the score for an ItemInfo, using the cached value if we can."""
+        try:
+            scored_info, score = self._scores[info.id]
+        except KeyError:
+            scored_info = None
+        if scored_info is not info:
+            # ItemInfos get replaced when the item changes, so this also
+            # catches changed items
+            score = self.scorer.score(info)
+            self._scores[info.id] = (info, score)
+        return score
+
+    def sort_key(self, info):
+        if self.reverse:
+            return (self.score(info), info.release_date)
+        else:
+            return (-self.score(info), info.release_date)
+
 class PlaylistSort(ItemSort):
     """Sort that orders items by their order in the playlist.
     """
     KEY = 'playlist'
+    BACKEND_CAN_SORT = False
 
     def __init__(self, initial_items=None):
         ItemSort.__init__(self, True)
@@ -457,6 +527,7 @@ class ItemList(object):
 
     def __init__(self):
         self._sorter = DEFAULT_SORT
+        self._search_text = u''
         self.model = widgetset.InfoListModel(self._sorter.sort_key,
                 self._sorter.reverse)
         self.filter_set = itemfilter.ItemFilterSet()
@@ -467,8 +538,15 @@ class ItemList(object):
 
     def set_sort(self, sorter):
         self._sorter = sorter
+        sorter.set_search(self._search_text)
         self.model.change_sort(sorter.sort_key, sorter.reverse)
 
+    def set_search(self, search_text):
+        """Tell our sorter that the search changed."""
+        self._search_text = search_text
+        if self._sorter.set_search(search_text):
+            self.resort()
+
     def set_resort_on_update(self, resort):
         self.resort_on_update = resort
 
@@ -580,6 +658,32 @@ class ItemList(object):
         self.model.update_infos(to_update, resort=self.resort_on_update)
         self.model.remove_ids(to_remove)
 
+    def update_download_progress(self, progress):
+        """Apply download progress from a DownloadProgress message.
+
+        We only touch the DownloadInfo of items we are displaying.  Download
+        progress doesn't affect our filters, so we don't re-run them.
+
+        :param progress: list of (item_id, downloaded_size, rate, eta, state)
+            tuples
+        :returns: list of the updated ItemInfos
+        """
+        to_update = []
+        for (item_id, downloaded_size, rate, eta, state) in progress:
+            try:
+                info = self.model.get_info(item_id)
+            except KeyError:
+                continue
+            if info.download_info is None:
+                continue
+            download_info = info.download_info.with_progress(downloaded_size,
+                    rate, eta, state)
+            to_update.append(info.with_download_info(download_info))
+        if to_update:
+            self.model.update_infos(to_update,
+                                    resort=self.resort_on_update)
+        return to_update
+
     def remove_items(self, id_list):
         ids_in_model = []
         for id_ in id_list:
@@ -588,9 +692,13 @@ class ItemList(object):
             else:
                 ids_in_model.append(id_)
         self.model.remove_ids(ids_in_model)
+        self._sorter.items_removed(id_list)
 
     def remove_all(self):
         """Remove items from the list."""
+        self._sorter.items_removed(
+                [info.id for info in self.model.info_list()] +
+                self._hidden_items.keys())
         self.model.remove_all()
         self._hidden_items = {}
 
@@ -80,6 +80,12 @@ class ItemListTracker(signals.SignalEmitter):
     # maps (type, id) -> ItemListTracker objects
     _live_trackers = weakref.WeakValueDictionary()
 
+    # How many items should the backend send in its ItemList message?  The
+    # rest get fetched in pages of FETCH_PAGE_SIZE items, in the order that
+    # we display them.  Set to None to get all the items at once.
+    INITIAL_WINDOW_SIZE = 300
+    FETCH_PAGE_SIZE = 500
+
     @classmethod
     def create(cls, type_, id_):
         """Get a ItemListTracker 
@@ -115,8 +121,24 @@ class ItemListTracker(signals.SignalEmitter):
         self.item_list = itemlist.ItemList()
         self.id = id_
         self.is_tracking = False
-        self.search_filter = SearchFilter()
+        self.search_filter = SearchFilter(self._make_searcher())
         self.saw_initial_list = False
+        # ids from the ItemList message that we still need to fetch
+        self._pending_ids = []
+        self._fetch_in_progress = False
+        # maps ids to the latest ItemInfo that we have for each item.  We
+        # apply the deltas in ItemsChanged to these.
+        self._infos = {}
+
+    def _make_searcher(self):
+        # Lists of database items can use the shared search index, rather
+        # than building their own.
+        index = app.item_search_terms_index
+        if (self.type not in ('device', 'sharing') and index is not None and
+                index.is_ready()):
+            return SharedIndexSearcher(index)
+        else:
+            return search.ItemSearcher()
 
     def connect(self, name, func, *extra_args):
         if not self.is_tracking:
@@ -148,10 +170,22 @@ class ItemListTracker(signals.SignalEmitter):
                 self.on_item_list)
         app.info_updater.item_changed_callbacks.add(self.type, self.id,
                 self.on_items_changed)
+        app.info_updater.item_infos_fetched_callbacks.add(self.type, self.id,
+                self.on_item_infos_fetched)
+        self._download_progress_handle = app.info_updater.connect(
+                'download-progress', self.on_download_progress)
         self.is_tracking = True
 
     def _send_track_items_message(self):
-        messages.TrackItems(self.type, self.id).send_to_backend()
+        sorter = self.item_list.get_sort()
+        if self.INITIAL_WINDOW_SIZE is not None and sorter.BACKEND_CAN_SORT:
+            message = messages.TrackItems(self.type, self.id,
+                    self.INITIAL_WINDOW_SIZE, sorter.sort_key,
+                    sorter.reverse, send_deltas=True)
+        else:
+            message = messages.TrackItems(self.type, self.id,
+                    send_deltas=True)
+        message.send_to_backend()
 
     def _stop_tracking(self):
         if not self.is_tracking:
@@ -163,10 +197,41 @@ class ItemListTracker(signals.SignalEmitter):
                 self.on_item_list)
         app.info_updater.item_changed_callbacks.remove(self.type, self.id,
                 self.on_items_changed)
+        app.info_updater.item_infos_fetched_callbacks.remove(self.type,
+                self.id, self.on_item_infos_fetched)
+        self._pending_ids = []
+        self._fetch_in_progress = False
+        self._infos = {}
+        app.info_updater.disconnect(self._download_progress_handle)
         self.is_tracking = False
 
     def on_item_list(self, message):
+        self._pending_ids = list(message.pending_ids)
+        self._fetch_in_progress = False
         self.add_initial_items(message.items)
+        self._fetch_pending_infos()
+
+    def _fetch_pending_infos(self):
+        """Fetch the next page of items that were left out of our ItemList.
+        """
+        if self._fetch_in_progress or not self._pending_ids:
+            return
+        ids = self._pending_ids[:self.FETCH_PAGE_SIZE]
+        del self._pending_ids[:self.FETCH_PAGE_SIZE]
+        messages.FetchItemInfos(self.type, self.id, ids).send_to_backend()
+        self._fetch_in_progress = True
+
+    def on_item_infos_fetched(self, message):
+        self._fetch_in_progress = False
+        self._remember_infos(message.items)
+        added, changed, removed = self.search_filter.filter_changes(
+                message.items, [], [])
+        self.emit('items-will-change', added, [], [])
+        self.item_list.add_items(added)
+        self.emit("items-changed", added, [], [])
+        # The next page gets added when the backend replies, so the UI can
+        # handle events in between pages.
+        self._fetch_pending_infos()
 
     def is_filtering(self):
         """Check if we are filtering out any items."""
@@ -174,6 +239,8 @@ class ItemListTracker(signals.SignalEmitter):
 
     def add_initial_items(self, items):
         self.saw_initial_list = True
+        self._infos = {}
+        self._remember_infos(items)
         items = self.search_filter.filter_initial_list(items)
         self.emit('items-will-change', items, [], [])
         # call remove all to handle the race described in #16089.  We may get
@@ -189,8 +256,14 @@ class ItemListTracker(signals.SignalEmitter):
             # way, we could get an ItemsChanged message for our old list,
             # before the ItemList message for our new one.
             return
+        all_changed = list(message.changed)
+        all_changed.extend(self._apply_deltas(message.deltas))
+        self._remember_infos(message.added)
+        self._remember_infos(all_changed)
+        for id_ in message.removed:
+            self._infos.pop(id_, None)
         added, changed, removed = self.search_filter.filter_changes(
-                message.added, message.changed, message.removed)
+                message.added, all_changed, message.removed)
         self.emit('items-will-change', added, changed, removed)
         self.item_list.add_items(added)
         self.item_list.update_items(changed)
@@ -199,9 +272,37 @@ class ItemListTracker(signals.SignalEmitter):
         self.emit("items-removed-from-source", message.removed)
         self.emit("items-changed", added, changed, removed)
 
+    def on_download_progress(self, info_updater, progress):
+        if not self.saw_initial_list:
+            return
+        updated = self.item_list.update_download_progress(progress)
+        self._remember_infos(updated)
+
+    def _remember_infos(self, infos):
+        for info in infos:
+            self._infos[info.id] = info
+
+    def _apply_deltas(self, deltas):
+        """Patch the ItemInfos that we have with the deltas from an
+        ItemsChanged message.
+
+        :returns: list of patched ItemInfos
+        """
+        patched = []
+        for id_, delta in deltas.iteritems():
+            try:
+                info = self._infos[id_]
+            except KeyError:
+                logging.warn("ItemListTracker: delta for unknown item: %s",
+                             id_)
+                continue
+            patched.append(info.apply_delta(delta))
+        return patched
+
     def set_search(self, query):
         added, removed = self.search_filter.set_search(query)
         self.emit("items-will-change", added, [], removed)
+        self.item_list.set_search(query)
         self.item_list.add_items(added)
         self.item_list.remove_items(removed)
         self.emit("items-changed", added, [], removed)
@@ -212,6 +313,9 @@ class PlaylistItemListTracker(ItemListTracker):
     This class adds a playlist_sort attribute, that contains a
     itemlist.PlaylistSort object that is kept up to date.
     """
+    # PlaylistSort needs to see all the items in the playlist
+    INITIAL_WINDOW_SIZE = None
+
     def __init__(self, type_, id_):
         ItemListTracker.__init__(self, type_, id_)
         self.playlist_sort = itemlist.PlaylistSort()
@@ -245,11 +349,78 @@ class ManualItemListTracker(ItemListTracker):
     def _send_track_items_message(self):
         messages.TrackItemsManually(self.id, self.info_list).send_to_backend()
 
-class SearchFilter(object):
-    """SearchFilter filter out non-matching items from item lists
+class ItemSearchTermsIndex(object):
+    """Index of the search terms for all database items.
+
+    This is the frontend's copy of the backend's ItemSearchIndex.  We build
+    an ItemSearcher from the terms in the ItemSearchTermsChanged messages
+    that the backend sends after start_tracking() is called.
     """
     def __init__(self):
         self.searcher = search.ItemSearcher()
+        self.ready = False
+
+    def start_tracking(self):
+        messages.TrackItemSearchTerms().send_to_backend()
+
+    def is_ready(self):
+        """Check if the backend has sent us terms for every item."""
+        return self.ready
+
+    def handle_search_terms_changed(self, message):
+        for item_id in message.removed:
+            self.searcher.remove_item(item_id)
+        for item_id, terms in message.changed.iteritems():
+            try:
+                self.searcher.remove_item(item_id)
+            except KeyError:
+                pass
+            self.searcher.add_item_terms(item_id, terms)
+        self.ready = message.ready
+
+    def search(self, search_text, item_ids=None):
+        """Search the index.
+
+        :param search_text: search_text to search with
+        :param item_ids: if given, only return ids in this set
+        :returns: set of ids that match the search
+        """
+        matches = self.searcher.search(search_text)
+        if item_ids is not None:
+            matches.intersection_update(item_ids)
+        return matches
+
+class SharedIndexSearcher(object):
+    """Searches database items using an ItemSearchTermsIndex.
+
+    This implements the parts of the ItemSearcher API that SearchFilter uses.
+    The index gets updated by the backend, so we only need to track which
+    items are in our list.
+    """
+    def __init__(self, index):
+        self.index = index
+        self.item_ids = set()
+
+    def add_item(self, item_info):
+        self.item_ids.add(item_info.id)
+
+    def update_item(self, item_info):
+        if item_info.id not in self.item_ids:
+            raise KeyError(item_info.id)
+
+    def remove_item(self, item_id):
+        self.item_ids.remove(item_id)
+
+    def search(self, search_text):
+        return self.index.search(search_text, self.item_ids)
+
+class SearchFilter(object):
+    """SearchFilter filter out non-matching items from item lists
+    """
+    def __init__(self, searcher=None):
+        if searcher is None:
+            searcher = search.ItemSearcher()
+        self.searcher = searcher
         self.query = ''
         self.all_items = {} # maps id to item info
         self.matching_ids = set()
@@ -280,6 +280,7 @@ def get_app_menu():
                 MenuItem(_("Force Feedparser Processing"),
                     "ForceFeedparserProcessing"),
                 MenuItem(_("Clog Backend"), "ClogBackend"),
+                MenuItem(_("Audit Query Plans"), "AuditQueryPlans"),
                 MenuItem(_("Run Echoprint"), "RunEchoprint"),
                 MenuItem(_("Run ENMFP"), "RunENMFP"),
                 MenuItem(_("Force Main DB Save Error"),
@@ -599,6 +600,10 @@ def on_force_feedparser_processing():
 def on_clog_backend():
     app.widgetapp.clog_backend()
 
+@action_handler("AuditQueryPlans")
+def on_audit_query_plans():
+    messages.AuditQueryPlans().send_to_backend()
+
 @action_handler("RunEchoprint")
 def on_run_echoprint():
     print 'Running echoprint'
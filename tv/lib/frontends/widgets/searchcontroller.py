@@ -36,6 +36,7 @@ from miro.gtcache import gettext as _
 from miro.frontends.widgets import imagepool
 from miro.frontends.widgets import itemlistcontroller
 from miro.frontends.widgets import itemlistwidgets
+from miro.frontends.widgets import style
 from miro.frontends.widgets import widgetutil
 from miro.plat import resources
 from miro.plat.frontends.widgets import widgetset
@@ -145,6 +146,14 @@ class SearchController(itemlistcontroller.SimpleItemListController):
         if app.search_manager.text != '':
             self.titlebar.set_search_text(app.search_manager.text)
         self.titlebar.set_search_engine(app.search_manager.engine)
+        # RelevanceSort ranks the results against the engine search
+        self.item_list.set_search(app.search_manager.text)
+
+    def build_column_renderers(self):
+        column_renderers = itemlistwidgets.ListViewColumnRendererSet()
+        column_renderers.add_renderer('relevance',
+                style.RelevanceRenderer(self.item_list))
+        return column_renderers
 
     def calc_list_empty_mode(self):
         # "empty list mode" is used differently for search engines.  We want
@@ -193,6 +202,7 @@ class SearchController(itemlistcontroller.SimpleItemListController):
     def _on_search_started(self, search_manager):
         self.titlebar.set_search_text(search_manager.text)
         self.titlebar.set_search_engine(search_manager.engine)
+        self.item_list.set_search(search_manager.text)
         self.check_for_empty_list()
 
     def _on_search_complete(self, search_manager, result_count):
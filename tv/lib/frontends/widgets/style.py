@@ -436,6 +436,22 @@ class PlaylistOrderRenderer(ListViewRendererText):
     def get_value(self, info):
         return str(self.playlist_sorter.sort_key(info) + 1)
 
+class RelevanceRenderer(ListViewRendererText):
+    """Displays how well an item matches the search.
+
+    We only have scores while the item list is sorted by relevance, otherwise
+    the column is blank.
+    """
+    def __init__(self, item_list):
+        ListViewRendererText.__init__(self)
+        self.item_list = item_list
+
+    def get_value(self, info):
+        sorter = self.item_list.get_sort()
+        if sorter.KEY != 'relevance':
+            return ''
+        return '%.1f' % sorter.score(info)
+
 class ListViewRenderer(widgetset.InfoListRenderer):
     """Renderer for more complex list view columns.
 
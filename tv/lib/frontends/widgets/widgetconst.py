@@ -79,10 +79,11 @@ COLUMN_LABELS = {
     u'show': _('Show'),
     u'kind': _('Video Kind'),
     u'playlist': _('Order'),
+    u'relevance': _('Relevance'),
 }
 NO_RESIZE_COLUMNS = set(['state', 'rating'])
 NO_PAD_COLUMNS = set(['state'])
-DESCENDING_BY_DEFAULT = frozenset(['date', 'date-added', 'rate'])
+DESCENDING_BY_DEFAULT = frozenset(['date', 'date-added', 'rate', 'relevance'])
 COLUMN_WIDTH_WEIGHTS = {
     u'description': 1.2,
     u'name': 1.0,
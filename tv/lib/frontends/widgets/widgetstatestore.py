@@ -75,6 +75,7 @@ class WidgetStateStore(object):
         u'name': 200,
         u'rate': 60,
         u'rating': 75,
+        u'relevance': 70,
         u'playlist': 30,
         u'show': 70,
         u'size': 65,
@@ -93,7 +94,7 @@ class WidgetStateStore(object):
         u'music': u'artist',
         u'others': u'name',
         u'playlist': u'playlist',
-        u'search': u'name',
+        u'search': u'-relevance',
         u'videos': u'name',
     }
     DEFAULT_SORT_COLUMN[u'device-audio'] = DEFAULT_SORT_COLUMN[u'music']
@@ -120,7 +121,7 @@ class WidgetStateStore(object):
             [u'state', u'name', u'length', u'size', u'date', u'status'],
         u'search':
             [u'state', u'name', u'description', u'status', u'file-type',
-            u'feed-name', u'date'],
+            u'feed-name', u'date', u'relevance'],
         u'playlist':
             [u'playlist', u'name', u'artist', u'album', u'track', u'length',
                 u'genre', u'year', u'rating'],
@@ -84,9 +84,9 @@ class InfoUpdaterCallbackList(object):
 class InfoUpdater(signals.SignalEmitter):
     """Track channel/item updates from the backend.
 
-    To track item updates, use the item_list_callbacks and
-    item_changed_callbacks attributes, both are instances of
-    InfoUpdaterCallbackList.  To track tab updates, connect to one of the
+    To track item updates, use the item_list_callbacks,
+    item_changed_callbacks and item_infos_fetched_callbacks attributes, all
+    are instances of InfoUpdaterCallbackList.  To track tab updates, connect to one of the
     signals below.
 
     Signals:
@@ -100,6 +100,8 @@ class InfoUpdater(signals.SignalEmitter):
     * playlists-added (self, info_list) -- New playlists were added
     * playlists-changed (self, info_list) -- Playlists were changed
     * playlists-removed (self, info_list) -- Playlists were removed
+    * download-progress (self, progress) -- Progress for active downloads,
+      a list of (item_id, downloaded_size, rate, eta, state) tuples
     """
     def __init__(self):
         signals.SignalEmitter.__init__(self)
@@ -107,9 +109,11 @@ class InfoUpdater(signals.SignalEmitter):
             self.create_signal('%s-added' % prefix)
             self.create_signal('%s-changed' % prefix)
             self.create_signal('%s-removed' % prefix)
+        self.create_signal('download-progress')
 
         self.item_list_callbacks = InfoUpdaterCallbackList()
         self.item_changed_callbacks = InfoUpdaterCallbackList()
+        self.item_infos_fetched_callbacks = InfoUpdaterCallbackList()
 
     def handle_items_changed(self, message):
         callback_list = self.item_changed_callbacks
@@ -121,6 +125,14 @@ class InfoUpdater(signals.SignalEmitter):
         for callback in callback_list.get(message.type, message.id):
             callback(message)
 
+    def handle_item_infos_fetched(self, message):
+        callback_list = self.item_infos_fetched_callbacks
+        for callback in callback_list.get(message.type, message.id):
+            callback(message)
+
+    def handle_download_progress(self, message):
+        self.emit('download-progress', message.progress)
+
     def handle_tabs_changed(self, message):
         if message.type == 'feed':
             signal_start = 'feeds'
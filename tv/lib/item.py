@@ -473,7 +473,11 @@ class Item(DDBObject, iconcache.IconCacheOwnerMixin):
         self.expiring = None
         self.showMoreInfo = False
         self.playing = False
-        Item._path_count_tracker.add_item(self)
+        # Don't add ourselves to _path_count_tracker here.  New items get
+        # added by set_filename() and restored items are already counted by
+        # the query in _init_counts_for_paths().  Adding them again would
+        # make the counts drift upward each time LiveStorage evicts and
+        # restores an item.
 
     def after_setup_new(self):
         app.item_info_cache.item_created(self)
@@ -833,7 +837,7 @@ class Item(DDBObject, iconcache.IconCacheOwnerMixin):
             # bit of a hack here.  We only need to update ViewTrackers
             # that care about the item's folder.  This seems like a
             # safe way to check if that's true.
-            if 'folder_id' in tracker.where:
+            if tracker.where is not None and 'folder_id' in tracker.where:
                 tracker.check_all_objects()
 
     @classmethod
@@ -1060,7 +1064,9 @@ class Item(DDBObject, iconcache.IconCacheOwnerMixin):
             del self._size
 
     def recalc_feed_counts(self):
-        self.get_feed().recalc_counts()
+        # our downloader may have changed, which app.feed_count_tracker
+        # doesn't see by itself.
+        app.feed_count_tracker.check_item(self)
 
     def get_viewed(self):
         """Returns True iff this item has never been viewed in the
@@ -2090,6 +2096,15 @@ class Item(DDBObject, iconcache.IconCacheOwnerMixin):
     def is_playing(self):
         return self.playing
 
+    def is_pinned(self):
+        if DDBObject.is_pinned(self) or self.playing:
+            return True
+        # Keep items with in-flight downloads in memory.  Use __dict__ so
+        # that we don't lookup the downloader just to check this.
+        dler = self.__dict__.get('_downloader')
+        return dler is not None and dler.state in (u'downloading',
+                u'paused', u'uploading', u'uploading-paused')
+
     def __str__(self):
         return "Item - %s" % stringify(self.get_title())
 
@@ -46,11 +46,26 @@ The general strategy is to just dumbly pickle the data and if we notice any
 errors, or if the DB version changes, throw away the cache and rebuild.  We
 use a lot of direct SQL queries in this code, borrowing app.db's cursor.  This
 is slightly naughty, but results in fast peformance.
+
+Unpickling every ItemInfo at startup takes a long time for large databases,
+so we load them lazily.  load() only reads the pickle data.  ItemInfos get
+unpickled the first time they are accessed, or in batches from idle
+callbacks.
+
+Saving is the reverse problem.  During heavy downloads thousands of
+ItemInfos can change between saves, so the periodic save just takes a
+snapshot of the changes and hands it to ItemInfoCacheWriter, which pickles
+them in a worker thread.  In WAL mode (the dbUseWAL pref, off by default)
+the worker also writes them using its own connection.
 """
 
 import cPickle
 import itertools
 import logging
+import Queue
+import sqlite3
+import threading
+import time
 
 from miro import app
 from miro import dbupgradeprogress
@@ -59,6 +74,360 @@ from miro import itemsource
 from miro import models
 from miro import schema
 from miro import signals
+from miro.plat.utils import thread_body
+
+def _info_to_blob(info):
+    return buffer(cPickle.dumps(info, cPickle.HIGHEST_PROTOCOL))
+
+class _SaveSnapshot(object):
+    """Changes to the item info cache that need to be saved.
+
+    :attribute added: dict mapping ids to ItemInfos to insert
+    :attribute changed: dict mapping ids to ItemInfos to update
+    :attribute deleted: set of ids to delete
+    :attribute failed_added: ids from added that make_rows() couldn't
+        pickle
+    :attribute failed_changed: ids from changed that make_rows() couldn't
+        pickle
+    """
+    def __init__(self, added, changed, deleted):
+        self.added = added
+        self.changed = changed
+        self.deleted = deleted
+        self.failed_added = []
+        self.failed_changed = []
+        self.created = time.time()
+
+    def is_empty(self):
+        return not (self.added or self.changed or self.deleted)
+
+    def has_failures(self):
+        return bool(self.failed_added or self.failed_changed)
+
+    def make_rows(self):
+        """Pickle the ItemInfos
+
+        ItemInfos that can't be pickled are left out of the rows and their
+        ids get added to failed_added/failed_changed.
+
+        :returns: (insert_rows, update_rows, delete_ids)
+        """
+        insert_rows = []
+        for id_, info in self.added.iteritems():
+            try:
+                insert_rows.append((id_, _info_to_blob(info)))
+            except (StandardError, cPickle.PicklingError):
+                logging.exception("Error pickling item info for %s", id_)
+                self.failed_added.append(id_)
+        update_rows = []
+        for id_, info in self.changed.iteritems():
+            try:
+                update_rows.append((_info_to_blob(info), id_))
+            except (StandardError, cPickle.PicklingError):
+                logging.exception("Error pickling item info for %s", id_)
+                self.failed_changed.append(id_)
+        return insert_rows, update_rows, list(self.deleted)
+
+def _split_rows(rows, chunk_size):
+    """Split rows from _SaveSnapshot.make_rows() into smaller chunks.
+
+    Deletes come last, so that the chunks get written in the same order
+    that _write_rows() would write the unsplit rows.
+
+    :returns: list of (insert_rows, update_rows, delete_ids) tuples
+    """
+    chunks = []
+    for i, part in enumerate(rows):
+        for start in xrange(0, len(part), chunk_size):
+            chunk = ([], [], [])
+            chunk[i].extend(part[start:start+chunk_size])
+            chunks.append(chunk)
+    return chunks
+
+def _write_rows(cursor, rows):
+    """Write rows from _SaveSnapshot.make_rows() to the database.
+
+    This should be run inside a transaction.
+    """
+    insert_rows, update_rows, delete_ids = rows
+    if insert_rows:
+        cursor.executemany("INSERT OR REPLACE INTO item_info_cache "
+                           "(id, pickle) VALUES (?, ?)", insert_rows)
+    if update_rows:
+        cursor.executemany("UPDATE item_info_cache SET pickle=? WHERE id=?",
+                           update_rows)
+    if delete_ids:
+        cursor.execute("DELETE FROM item_info_cache WHERE id IN (%s)" %
+                       ', '.join(str(id_) for id_ in delete_ids))
+
+def _write_rows_with_main_cursor(rows):
+    app.db.run_in_transaction(_write_rows, rows)
+
+class ItemInfoCacheWriter(object):
+    """Saves item info cache changes in a worker thread.
+
+    Snapshots are pickled in the worker thread.  If the database is in WAL
+    mode, the worker writes them using its own connection.  Otherwise a
+    second connection would block the main one, so the rows get written
+    with app.db's cursor from idle callbacks, MAIN_THREAD_CHUNK_SIZE rows
+    at a time.
+
+    ItemInfos that can't be pickled get passed to retry_callback from the
+    event loop, so that they can be saved again later.
+
+    The queue of snapshots is bounded.  Use is_full() to check if there's
+    room before calling queue_snapshot().
+    """
+
+    # max number of snapshots waiting to be written
+    QUEUE_SIZE = 4
+    # how long should our connection wait for app.db to finish writing?
+    BUSY_TIMEOUT = 10.0
+    # max number of rows to write in each idle callback when we have to use
+    # app.db's cursor
+    MAIN_THREAD_CHUNK_SIZE = 200
+
+    def __init__(self, db_path=None, retry_callback=None):
+        """Create an ItemInfoCacheWriter
+
+        :param db_path: path to the database for the worker thread to open,
+            or None to write using app.db's cursor
+        :param retry_callback: function to call with snapshots that have
+            ItemInfos that we couldn't pickle
+        """
+        self.db_path = db_path
+        self.retry_callback = retry_callback
+        self.queue = Queue.Queue(self.QUEUE_SIZE)
+        self.thread = None
+        self.connection = None
+        # chunks of rows that the worker thread pickled, but we need to
+        # write using app.db.cursor
+        self._main_thread_rows = []
+        self._main_thread_rows_lock = threading.Lock()
+        self._main_thread_dc = None
+        # _record_save() gets called from both threads
+        self._stats_lock = threading.Lock()
+        self.reset_stats()
+
+    def reset_stats(self):
+        self._stats_lock.acquire()
+        try:
+            self.save_count = 0
+            self.save_time_total = 0.0
+            self.save_time_max = 0.0
+            self.rows_written = 0
+            self.max_queue_depth = 0
+            self.queue_full_count = 0
+            self.pickle_error_count = 0
+        finally:
+            self._stats_lock.release()
+
+    def get_stats(self):
+        """Get metrics for our saves.
+
+        save times include pickling the data and writing it, but not the
+        time a snapshot spends waiting in the queue.
+        """
+        self._stats_lock.acquire()
+        try:
+            return {
+                'saves': self.save_count,
+                'save_time_total': self.save_time_total,
+                'save_time_max': self.save_time_max,
+                'save_time_avg': (self.save_time_total /
+                                  max(self.save_count, 1)),
+                'rows_written': self.rows_written,
+                'queue_depth': self.queue.qsize(),
+                'max_queue_depth': self.max_queue_depth,
+                'queue_full_count': self.queue_full_count,
+                'pickle_errors': self.pickle_error_count,
+            }
+        finally:
+            self._stats_lock.release()
+
+    def start(self):
+        if self.thread is not None:
+            return
+        self.thread = threading.Thread(target=thread_body,
+                                       args=[self._thread_loop],
+                                       name="Item Info Cache Writer")
+        self.thread.setDaemon(True)
+        self.thread.start()
+
+    def is_full(self):
+        """Check if the snapshot queue is full.
+
+        Only the event loop adds snapshots, so if this returns False, the
+        next call to queue_snapshot() will succeed.
+        """
+        if self.queue.full():
+            self._stats_lock.acquire()
+            try:
+                self.queue_full_count += 1
+            finally:
+                self._stats_lock.release()
+            return True
+        return False
+
+    def queue_snapshot(self, snapshot):
+        """Queue a snapshot to be written in the worker thread.
+
+        :raises Queue.Full: the queue is full (check is_full() first)
+        """
+        self.start()
+        self.queue.put_nowait(snapshot)
+        self._stats_lock.acquire()
+        try:
+            self.max_queue_depth = max(self.max_queue_depth,
+                                       self.queue.qsize())
+        finally:
+            self._stats_lock.release()
+
+    def save_now(self, snapshot):
+        """Write everything that's queued and a snapshot before returning.
+
+        The snapshot is written from the current thread using app.db's
+        cursor.
+        """
+        self.flush()
+        start = time.time()
+        rows = snapshot.make_rows()
+        _write_rows_with_main_cursor(rows)
+        self._record_save(start, rows, snapshot)
+        if snapshot.has_failures():
+            self._retry_snapshot(snapshot)
+
+    def flush(self):
+        """Wait for all queued snapshots to be written."""
+        if self.thread is not None:
+            self.queue.join()
+        self._write_main_thread_rows()
+
+    def close(self):
+        """Write everything that's queued, then stop the worker thread."""
+        if self.thread is not None:
+            self.queue.put(None)
+            self.thread.join()
+            self.thread = None
+        self._write_main_thread_rows()
+
+    def _thread_loop(self):
+        while True:
+            snapshot = self.queue.get()
+            try:
+                if snapshot is None:
+                    if self.connection is not None:
+                        self.connection.close()
+                        self.connection = None
+                    return
+                self._save_snapshot(snapshot)
+            finally:
+                self.queue.task_done()
+
+    def _save_snapshot(self, snapshot):
+        start = time.time()
+        rows = snapshot.make_rows()
+        self._main_thread_rows_lock.acquire()
+        try:
+            # If there are rows waiting for the event loop, we need to let
+            # those get written first to keep things in order.
+            written = (not self._main_thread_rows and
+                       self._write_rows_with_connection(rows))
+            if not written:
+                self._main_thread_rows.extend(_split_rows(rows,
+                    self.MAIN_THREAD_CHUNK_SIZE))
+        finally:
+            self._main_thread_rows_lock.release()
+        if not written:
+            eventloop.add_idle(self._schedule_main_thread_write,
+                               'schedule item info cache write')
+        self._record_save(start, rows, snapshot)
+        if snapshot.has_failures():
+            eventloop.add_idle(self._retry_snapshot,
+                               'retry item info cache save',
+                               args=(snapshot,))
+
+    def _retry_snapshot(self, snapshot):
+        if self.retry_callback is not None:
+            self.retry_callback(snapshot)
+
+    def _record_save(self, start, rows, snapshot):
+        elapsed = time.time() - start
+        self._stats_lock.acquire()
+        try:
+            self.save_count += 1
+            self.save_time_total += elapsed
+            self.save_time_max = max(self.save_time_max, elapsed)
+            self.rows_written += sum(len(part) for part in rows)
+            self.pickle_error_count += (len(snapshot.failed_added) +
+                                        len(snapshot.failed_changed))
+        finally:
+            self._stats_lock.release()
+
+    def _write_rows_with_connection(self, rows):
+        """Try to write rows using our own connection.
+
+        :returns: True if the rows were written
+        """
+        if self.db_path is None:
+            return False
+        try:
+            if self.connection is None:
+                self.connection = sqlite3.connect(self.db_path,
+                        isolation_level=None, timeout=self.BUSY_TIMEOUT)
+            cursor = self.connection.cursor()
+            cursor.execute("BEGIN IMMEDIATE TRANSACTION")
+            try:
+                _write_rows(cursor, rows)
+            except StandardError:
+                cursor.execute("ROLLBACK TRANSACTION")
+                raise
+            else:
+                cursor.execute("COMMIT TRANSACTION")
+        except sqlite3.Error, e:
+            logging.warn("Error saving item info cache data from the "
+                         "writer thread: %s", e)
+            return False
+        return True
+
+    def _schedule_main_thread_write(self):
+        if self._main_thread_dc is None:
+            self._main_thread_dc = eventloop.add_idle(
+                    self._write_main_thread_chunk,
+                    'write item info cache rows')
+
+    def _write_main_thread_chunk(self):
+        """Write one chunk of rows using app.db's cursor.
+
+        We only write one chunk per idle callback, so that we don't block
+        the event loop for too long.
+        """
+        self._main_thread_dc = None
+        self._main_thread_rows_lock.acquire()
+        try:
+            if not self._main_thread_rows:
+                return
+            rows = self._main_thread_rows.pop(0)
+            more_rows = bool(self._main_thread_rows)
+        finally:
+            self._main_thread_rows_lock.release()
+        _write_rows_with_main_cursor(rows)
+        if more_rows:
+            self._schedule_main_thread_write()
+
+    def _write_main_thread_rows(self):
+        """Write all the rows waiting for the event loop."""
+        if self._main_thread_dc is not None:
+            self._main_thread_dc.cancel()
+            self._main_thread_dc = None
+        self._main_thread_rows_lock.acquire()
+        try:
+            rows_list = self._main_thread_rows
+            self._main_thread_rows = []
+        finally:
+            self._main_thread_rows_lock.release()
+        for rows in rows_list:
+            _write_rows_with_main_cursor(rows)
 
 class ItemInfoCache(signals.SignalEmitter):
     """ItemInfoCache stores the latest ItemInfo objects for each item
@@ -80,23 +449,48 @@ class ItemInfoCache(signals.SignalEmitter):
     # how often should we save cache data to the DB? (in seconds)
     SAVE_INTERVAL = 30
     VERSION_KEY = 'item_info_cache_db_version'
+    # how many ItemInfos should we unpickle in each idle callback after
+    # load()?
+    LOAD_BATCH_SIZE = 500
 
     def __init__(self):
         signals.SignalEmitter.__init__(self)
         self.create_signal('added')
         self.create_signal('changed')
         self.create_signal('removed')
+        # maps ids to ItemInfos that we've unpickled
         self.id_to_info = None
+        # maps ids to pickle data for ItemInfos that we haven't unpickled yet
+        self._id_to_blob = {}
+        # ids to unpickle in _load_batch()
+        self._ids_to_load = []
+        self._load_batch_dc = None
         self.loaded = False
+        self._save_dc = None
+        self.writer = ItemInfoCacheWriter(self._writer_db_path(),
+                                          self._retry_failed_saves)
+
+    def _writer_db_path(self):
+        # The writer can only use its own connection in WAL mode.  Otherwise
+        # it would block app.db.
+        if app.db.wal_enabled:
+            return app.db.path
+        else:
+            return None
+
+    def load(self, saved_data=None):
+        """Load ItemInfos for all items in the database.
 
-    def load(self):
+        :param saved_data: result of read_saved_data(), if it's already been
+            read in a worker thread.  If None, we read it here.
+        """
         # call _reset_changes() first.  This way if we throw an exception
         # inside this method, we're at least ready to shutdown cleanly
         # (see #17729)
         self._reset_changes()
         did_failsafe_load = False
         try:
-            self._quick_load()
+            self._quick_load(saved_data)
         except (StandardError, cPickle.UnpicklingError), e:
             logging.warn("Error loading item info cache: %s", e)
         if self.id_to_info is None:
@@ -110,15 +504,14 @@ class ItemInfoCache(signals.SignalEmitter):
             # Need to save the cache data we just created
             self._infos_added = self.id_to_info.copy()
             self.schedule_save_to_db()
+        else:
+            self._schedule_load_batch()
         self.loaded = True
 
     def version(self):
         return "%s-%s" % (schema.VERSION,
                           itemsource.DatabaseItemSource.VERSION)
 
-    def _info_to_blob(self, info):
-        return buffer(cPickle.dumps(info))
-
     def _blob_to_info(self, blob):
         info = cPickle.loads(str(blob))
         # Download stats are no longer valid, reset them
@@ -131,24 +524,91 @@ class ItemInfoCache(signals.SignalEmitter):
             info.download_info.eta = 0
         return info
 
-    def _quick_load(self):
+    def read_saved_data(self, cursor):
+        """Read the data that _quick_load() uses.
+
+        This only uses cursor, so it can be run in a worker thread with
+        LiveStorage.read_in_thread().
+
+        :returns: (id_to_blob, item_count) tuple
+        """
+        cursor.execute("SELECT id, pickle FROM item_info_cache")
+        id_to_blob = dict((row[0], row[1]) for row in cursor)
+        cursor.execute("SELECT COUNT(*) from item")
+        return id_to_blob, cursor.fetchone()[0]
+
+    def _quick_load(self, saved_data=None):
         """Load ItemInfos using the item_info_cache table
 
         This is much faster than _failsafe_load(), but could result in errors.
+        We don't unpickle the data here, see _load_info() for that.
         """
         saved_db_version = app.db.get_variable(self.VERSION_KEY)
         if saved_db_version == self.version():
-            quick_load_values = {}
-            app.db.cursor.execute("SELECT id, pickle FROM item_info_cache")
-            for row in app.db.cursor:
-                quick_load_values[row[0]] = self._blob_to_info(row[1])
+            if saved_data is None:
+                cursor = app.db.acquire_read_cursor()
+                try:
+                    saved_data = self.read_saved_data(cursor)
+                finally:
+                    app.db.release_read_cursor(cursor)
+            id_to_blob, item_count = saved_data
             # double check that we have the right number of rows
-            if len(quick_load_values) == self._db_item_count():
-                self.id_to_info = quick_load_values
+            if len(id_to_blob) != item_count:
+                return
+            id_to_info = {}
+            if id_to_blob:
+                # Unpickle one ItemInfo right away.  If the data is bogus,
+                # it's most likely all bogus and we're better off doing a
+                # failsafe load now.
+                id_, blob = id_to_blob.popitem()
+                id_to_info[id_] = self._blob_to_info(blob)
+            self.id_to_info = id_to_info
+            self._id_to_blob = id_to_blob
+            self._ids_to_load = id_to_blob.keys()
+
+    def _load_info(self, id_):
+        """Unpickle an ItemInfo that _quick_load() didn't load."""
+        blob = self._id_to_blob.pop(id_)
+        try:
+            info = self._blob_to_info(blob)
+        except (StandardError, cPickle.UnpicklingError), e:
+            logging.warn("Error loading item info for %s: %s", id_, e)
+            # rebuild the info and fix the data in the DB
+            item = models.Item.get_by_id(id_)
+            info = itemsource.DatabaseItemSource._item_info_for(item)
+            self._infos_changed[id_] = info
+            self.schedule_save_to_db()
+        self.id_to_info[id_] = info
+        return info
+
+    def _load_all(self):
+        for id_ in self._id_to_blob.keys():
+            self._load_info(id_)
+        self._ids_to_load = []
+
+    def _schedule_load_batch(self):
+        if self._load_batch_dc is None and self._id_to_blob:
+            self._load_batch_dc = eventloop.add_idle(self._load_batch,
+                    'load item info cache')
+
+    def _load_batch(self):
+        self._load_batch_dc = None
+        count = 0
+        while self._ids_to_load and count < self.LOAD_BATCH_SIZE:
+            id_ = self._ids_to_load.pop()
+            # skip ids that have been loaded some other way
+            if id_ in self._id_to_blob:
+                self._load_info(id_)
+                count += 1
+        self._schedule_load_batch()
 
     def _db_item_count(self):
-        app.db.cursor.execute("SELECT COUNT(*) from item")
-        return app.db.cursor.fetchone()[0]
+        cursor = app.db.acquire_read_cursor()
+        try:
+            cursor.execute("SELECT COUNT(*) from item")
+            return cursor.fetchone()[0]
+        finally:
+            app.db.release_read_cursor(cursor)
 
     def _failsafe_load(self):
         """Load ItemInfos using Item objects.
@@ -157,6 +617,8 @@ class ItemInfoCache(signals.SignalEmitter):
         """
 
         self.id_to_info = {}
+        self._id_to_blob = {}
+        self._ids_to_load = []
 
         count = itertools.count(1)
         total_count = self._db_item_count()
@@ -168,54 +630,68 @@ class ItemInfoCache(signals.SignalEmitter):
     def schedule_save_to_db(self):
         if self._save_dc is None:
             self._save_dc = eventloop.add_timeout(self.SAVE_INTERVAL,
-                    self.save, 'save item info cache')
+                    self._save_in_background, 'save item info cache')
 
     def _reset_changes(self):
         self._infos_added = {}
         self._infos_changed = {}
         self._infos_deleted = set()
 
-    def save(self):
-        app.db.cursor.execute("BEGIN TRANSACTION")
-        try:
-            self._run_inserts()
-            self._run_updates()
-            self._run_deletes()
-        except StandardError:
-            app.db.cursor.execute("ROLLBACK TRANSACTION")
-            raise
-        else:
-            app.db.cursor.execute("COMMIT TRANSACTION")
+    def _take_snapshot(self):
+        snapshot = _SaveSnapshot(self._infos_added, self._infos_changed,
+                                 self._infos_deleted)
         self._reset_changes()
+        return snapshot
 
-    def _run_inserts(self):
-        if not self._infos_added:
+    def _save_in_background(self):
+        self._save_dc = None
+        if self.writer.is_full():
+            # The writer is falling behind.  Keep our changes and try again
+            # later.
+            self.schedule_save_to_db()
             return
-        sql = "INSERT INTO item_info_cache (id, pickle) VALUES (?, ?)"
-        values = ((id, self._info_to_blob(info)) for (id,
-            info) in self._infos_added.iteritems())
-        app.db.cursor.executemany(sql, values)
+        snapshot = self._take_snapshot()
+        if not snapshot.is_empty():
+            self.writer.queue_snapshot(snapshot)
 
-    def _run_updates(self):
-        if not self._infos_changed:
-            return
-        sql = "UPDATE item_info_cache SET PICKLE=? WHERE id=?"
-        values = ((self._info_to_blob(info), id) for (id, info) in
-                self._infos_changed.iteritems())
-        app.db.cursor.executemany(sql, values)
+    def _retry_failed_saves(self, snapshot):
+        """Mark ItemInfos that the writer couldn't pickle as unsaved.
 
-    def _run_deletes(self):
-        if not self._infos_deleted:
-            return
-        id_list = ', '.join(str(id_) for id_ in self._infos_deleted)
-        app.db.cursor.execute("DELETE FROM item_info_cache "
-                "WHERE id IN (%s)" % id_list)
+        We use the current ItemInfo for each item, since it may have
+        changed since the snapshot was taken.
+        """
+        for id_ in snapshot.failed_added:
+            if id_ in self.id_to_info:
+                # the row was never inserted, so make sure that any changes
+                # since then get inserted rather than updated.
+                self._infos_changed.pop(id_, None)
+                self._infos_added[id_] = self.id_to_info[id_]
+        for id_ in snapshot.failed_changed:
+            if (id_ in self.id_to_info and id_ not in self._infos_added and
+                    id_ not in self._infos_changed):
+                self._infos_changed[id_] = self.id_to_info[id_]
+        self.schedule_save_to_db()
+
+    def save(self):
+        """Save all changes and wait for them to be written to the DB."""
+        self.writer.save_now(self._take_snapshot())
+
+    def close(self):
+        """Stop the writer thread.
+
+        Call this after the last call to save().
+        """
+        self.writer.close()
+
+    def get_save_stats(self):
+        return self.writer.get_stats()
 
     def all_infos(self):
         """Return all ItemInfo objects that in the database.
 
         This method is optimized to avoid constructing Item objects.
         """
+        self._load_all()
         return self.id_to_info.values()
 
     def get_info(self, id_):
@@ -223,6 +699,8 @@ class ItemInfoCache(signals.SignalEmitter):
         try:
             return self.id_to_info[id_]
         except KeyError:
+            if id_ in self._id_to_blob:
+                return self._load_info(id_)
             # Let's not kick up the crash report - there are some cases
             # where an abnormal shutdown does not save the database (e.g.
             # hard crash or loss of power)
@@ -251,9 +729,12 @@ class ItemInfoCache(signals.SignalEmitter):
             # signal_change() called in Item.setup_restored(), while we were
             # doing a failsafe load
             return
-        if item.id not in self.id_to_info:
+        if (item.id not in self.id_to_info and
+                item.id not in self._id_to_blob):
             # signal_change() called inside setup_new(), just ignor it
             return
+        # no need to unpickle the old data, since we're replacing it
+        self._id_to_blob.pop(item.id, None)
         info = itemsource.DatabaseItemSource._item_info_for(item)
         self.id_to_info[item.id] = info
         if item.id in self._infos_added:
@@ -264,12 +745,41 @@ class ItemInfoCache(signals.SignalEmitter):
         self.schedule_save_to_db()
         self.emit("changed", info)
 
+    def update_download_progress(self, item_id, downloaded_size, rate, eta,
+                                 state):
+        """Update the download progress for an item.
+
+        This is much cheaper than item_changed(), since we copy the
+        current ItemInfo rather than building a new one.  We don't emit the
+        changed signal, the frontend gets these values from the
+        DownloadProgress message.  We also don't save the new ItemInfo,
+        progress will get saved with the next real change.
+        """
+        if item_id in self._id_to_blob:
+            # Items that were downloading at startup may not be unpickled
+            # yet.  Load them now, otherwise we would lose the progress.
+            self._load_info(item_id)
+        info = self.id_to_info.get(item_id)
+        if info is None or info.download_info is None:
+            return
+        download_info = info.download_info.with_progress(downloaded_size,
+                rate, eta, state)
+        info = info.with_download_info(download_info)
+        self.id_to_info[item_id] = info
+        if item_id in self._infos_added:
+            self._infos_added[item_id] = info
+        elif item_id in self._infos_changed:
+            self._infos_changed[item_id] = info
+
     def item_removed(self, item):
         if not self.loaded:
             # Item.remove() called in Item.setup_restored() while we were
             # doing a failsafe load
             del self.id_to_info[item.id]
             return
+        if item.id in self._id_to_blob:
+            # we need the ItemInfo to emit the removed signal
+            self._load_info(item.id)
         try:
             info = self.id_to_info.pop(item.id)
         except KeyError:
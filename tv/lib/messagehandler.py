@@ -51,6 +51,7 @@ from miro import itemsource
 from miro import messages
 from miro import filetypes
 from miro import prefs
+from miro import queryplan
 from miro import singleclick
 from miro import subscription
 from miro import tabs
@@ -346,6 +347,12 @@ class SourceTrackerBase(ViewTracker):
     def __init__(self):
         ViewTracker.__init__(self)
         self.sent_initial_list = False
+        # maps ids to the latest ItemInfos for items that we left out of the
+        # initial list because of its window size.
+        self._pending_infos = {}
+        # send deltas for items that the frontend already has (see
+        # TrackItems)
+        self.send_deltas = False
 
     def get_sources(self):
         return [self.source]
@@ -357,20 +364,88 @@ class SourceTrackerBase(ViewTracker):
             source.connect('removed', self.on_object_id_removed)
             self.trackers.append(source)
 
-    def send_initial_list(self):
+    def send_initial_list(self, window_size=None, sort_key=None,
+                          reverse=False):
         infos = []
         for source in self.trackers:
             infos.extend(source.fetch_all())
+        self._pending_infos = {}
+        pending_ids = []
+        if window_size is not None and len(infos) > window_size:
+            if sort_key is not None:
+                infos.sort(key=sort_key, reverse=reverse)
+            for info in infos[window_size:]:
+                self._pending_infos[info.id] = info
+                pending_ids.append(info.id)
+            del infos[window_size:]
         self._last_sent_info.update([(info.id, info) for info in infos])
-        messages.ItemList(self.type, self.id, infos).send_to_frontend()
+        messages.ItemList(self.type, self.id, infos,
+                          pending_ids).send_to_frontend()
         self.sent_initial_list = True
 
+    def send_pending_infos(self, ids):
+        """Send ItemInfos that send_initial_list() left out."""
+        infos = []
+        for id_ in ids:
+            try:
+                info = self._pending_infos.pop(id_)
+            except KeyError:
+                continue
+            self._last_sent_info[id_] = info
+            infos.append(info)
+        messages.ItemInfosFetched(self.type, self.id,
+                                  infos).send_to_frontend()
+
+    def on_object_changed(self, tracker, obj):
+        if obj.id in self._pending_infos:
+            # the frontend will get the latest info when it fetches it
+            self._pending_infos[obj.id] = obj
+        else:
+            ViewTracker.on_object_changed(self, tracker, obj)
+
+    def on_object_id_removed(self, tracker, id_):
+        if id_ in self._pending_infos:
+            # The frontend never got this item.  It will be skipped if the
+            # frontend tries to fetch it.
+            del self._pending_infos[id_]
+        else:
+            ViewTracker.on_object_id_removed(self, tracker, id_)
+
     def make_changed_message(self, added, changed, removed):
         return messages.ItemsChanged(self.type, self.id, added, changed,
                                      removed)
 
     def send_messages(self):
-        ViewTracker.send_messages(self)
+        if not self.send_deltas:
+            ViewTracker.send_messages(self)
+            return
+        added = self._make_added_list(self._get_added_objects())
+        changed, deltas = self._make_changed_deltas(self.changed.values())
+        removed = self._make_removed_list(self.removed)
+        if added or changed or deltas or removed:
+            messages.ItemsChanged(self.type, self.id, added, changed,
+                                  removed, deltas).send_to_frontend()
+        self.reset_changes()
+
+    def _make_changed_deltas(self, changed):
+        """Like _make_changed_list(), but calculates deltas.
+
+        :returns: (changed_list, deltas).  changed_list contains ItemInfos
+            for items that we haven't sent yet, deltas maps ids to the
+            attributes that changed for the rest.
+        """
+        changed_list = []
+        deltas = {}
+        for info in changed:
+            if info.id in self._last_sent_info:
+                delta = info.delta_from(self._last_sent_info[info.id])
+                if not delta:
+                    continue
+                deltas[info.id] = delta
+            else:
+                changed_list.append(info)
+            self._last_sent_info[info.id] = info
+        return changed_list, deltas
 
 class DatabaseSourceTrackerBase(SourceTrackerBase):
 
@@ -1336,7 +1411,7 @@ New ids: %s""", playlist_item_ids, message.item_ids)
             # make sure the item list is a tuple, so it can be hashed.
             return (message.type, tuple(message.id))
 
-    def handle_track_items(self, message):
+    def _get_item_tracker(self, message):
         key = self.item_tracker_key(message)
         if key not in self.item_trackers:
             try:
@@ -1344,18 +1419,37 @@ New ids: %s""", playlist_item_ids, message.item_ids)
             except database.ObjectNotFoundError:
                 logging.warn("TrackItems called for deleted object (%s %s)",
                         message.type, message.id)
-                return
+                return None
             if item_tracker is None:
                 # message type was wrong
-                return
+                return None
             self.item_trackers[key] = item_tracker
-        else:
-            item_tracker = self.item_trackers[key]
-        item_tracker.send_initial_list()
+        return self.item_trackers[key]
+
+    def handle_track_items(self, message):
+        item_tracker = self._get_item_tracker(message)
+        if item_tracker is not None:
+            item_tracker.send_deltas = message.send_deltas
+            item_tracker.send_initial_list(message.window_size,
+                    message.sort_key, message.reverse)
 
     def handle_track_items_manually(self, message):
-        # handle_track_items can handle this message too
-        self.handle_track_items(message)
+        item_tracker = self._get_item_tracker(message)
+        if item_tracker is not None:
+            item_tracker.send_initial_list()
+
+    def handle_track_item_search_terms(self, message):
+        app.item_search_index.start_tracking()
+
+    def handle_fetch_item_infos(self, message):
+        try:
+            item_tracker = self.item_trackers[self.item_tracker_key(message)]
+        except KeyError:
+            # we stopped tracking the items before the message got to us
+            logging.debug("FetchItemInfos: item tracker not found (%s %s)",
+                          message.type, message.id)
+        else:
+            item_tracker.send_pending_infos(message.ids)
 
     def handle_stop_tracking_items(self, message):
         key = self.item_tracker_key(message)
@@ -1972,6 +2066,9 @@ New ids: %s""", playlist_item_ids, message.item_ids)
         time.sleep(message.n)
         logging.debug('handle_clog_backend: Backend out of snooze.  Yawn!')
 
+    def handle_audit_query_plans(self, message):
+        queryplan.log_report()
+
     def handle_force_feedparser_processing(self, message):
         # For all our RSS feeds, force an update
         for f in feed.Feed.make_view():
@@ -40,6 +40,7 @@ This module defines the messages that are passed between the two threads.
 """
 
 import copy
+import hashlib
 import logging
 
 from miro.gtcache import gettext as _
@@ -146,10 +147,28 @@ class TrackItems(BackendMessage):
 
     id should be the id of a feed/playlist. For new, downloading and library
     it is ignored.
-    """
-    def __init__(self, typ, id_):
+
+    If window_size is given, the ItemList message will only contain
+    ItemInfos for the first window_size items.  The ids for the rest will be
+    in ItemList.pending_ids and can be fetched with FetchItemInfos.  Items
+    are ordered using sort_key, a function that takes an ItemInfo, so that
+    the window holds the items that the frontend will display first.
+    sort_key gets called from the backend thread, so it must not depend on
+    frontend state that can change.
+
+    If send_deltas is True, ItemsChanged messages will contain deltas for
+    items that the frontend already has, rather than full ItemInfos.  The
+    sender needs to keep the ItemInfos that it gets so that it can apply
+    the deltas to them.
+    """
+    def __init__(self, typ, id_, window_size=None, sort_key=None,
+                 reverse=False, send_deltas=False):
         self.type = typ
         self.id = id_
+        self.window_size = window_size
+        self.sort_key = sort_key
+        self.reverse = reverse
+        self.send_deltas = send_deltas
 
 class TrackItemsManually(BackendMessage):
     """Track a manually specified list of items.
@@ -168,6 +187,30 @@ class TrackItemsManually(BackendMessage):
         self.infos_to_track = infos_to_track
         self.type = 'manual'
 
+class FetchItemInfos(BackendMessage):
+    """Fetch ItemInfos that were left out of an ItemList message.
+
+    The backend will reply with an ItemInfosFetched message.  Ids that are
+    no longer pending (for example because the item was removed) are
+    skipped.
+
+    :param ids: list of ids from ItemList.pending_ids
+    """
+    def __init__(self, typ, id_, ids):
+        self.type = typ
+        self.id = id_
+        self.ids = ids
+
+class TrackItemSearchTerms(BackendMessage):
+    """Start tracking the search terms for database items.
+
+    After this message is received, the backend will send an
+    ItemSearchTermsChanged message with the terms for every item that it's
+    indexed.  It will send more ItemSearchTermsChanged messages as it indexes
+    items and whenever their terms change.
+    """
+    pass
+
 class StopTrackingItems(BackendMessage):
     """Stop tracking items for a feed.
     """
@@ -928,6 +971,12 @@ class ForceDBSaveError(BackendMessage):
     """Simulate an error running an INSERT/UPDATE statement on the main DB.
     """
 
+class AuditQueryPlans(BackendMessage):
+    """Dev message: log the query plans for all Item views that do full
+    table scans, along with index suggestions.
+    """
+    pass
+
 class ForceDeviceDBSaveError(BackendMessage):
     """Simulate an error running an INSERT/UPDATE statement on a device DB.
     """
@@ -1210,21 +1259,30 @@ class ItemInfo(object):
 
     html_stripper = util.HTMLStripper()
 
+    # We pickle the attributes that we calculate from other attributes
+    # (description_stripped, search_terms, the sort keys, etc), since
+    # calculating them is slow.  derived_hash is a hash of the attributes
+    # that they're calculated from, when we unpickle we only recalculate
+    # them if it doesn't match.  Change DERIVED_VERSION if the way we
+    # calculate them changes.
+    DERIVED_VERSION = 1
+
     def __repr__(self):
         return "<ItemInfo %r>" % self.id
 
     def __getstate__(self):
         d = self.__dict__.copy()
         d['device'] = None
-        del d['description_stripped']
-        del d['search_terms']
         return d
 
     def __setstate__(self, d):
         self.__dict__.update(d)
-        self.description_stripped = ItemInfo.html_stripper.strip(
-                self.description)
-        self.search_terms = search.calc_search_terms(self)
+        if d.get('derived_hash') != self._calc_derived_hash():
+            self.description_stripped = ItemInfo.html_stripper.strip(
+                    self.description)
+            self.search_terms = search.calc_search_terms(self)
+            self._calc_sort_keys()
+            self.derived_hash = self._calc_derived_hash()
 
     def __init__(self, id_, **kwargs):
         self.id = id_
@@ -1238,6 +1296,20 @@ class ItemInfo(object):
                 self.description)
         if not hasattr(self, 'search_terms'):
             self.search_terms = search.calc_search_terms(self)
+        self._calc_sort_keys()
+        self.derived_hash = self._calc_derived_hash()
+
+    def _calc_derived_hash(self):
+        """Calculate a hash of the attributes that description_stripped,
+        search_terms and the sort keys get calculated from.
+        """
+        torrent = bool(self.download_info and self.download_info.torrent)
+        source = (ItemInfo.DERIVED_VERSION, self.name, self.description,
+                  self.artist, self.album, self.album_artist, self.genre,
+                  self.feed_name, torrent, self.video_path)
+        return hashlib.md5(repr(source)).digest()
+
+    def _calc_sort_keys(self):
         self.name_sort_key = util.name_sort_key(self.name)
         self.album_sort_key = util.name_sort_key(self.album)
         self.artist_sort_key = util.name_sort_key(self.artist)
@@ -1249,6 +1321,35 @@ class ItemInfo(object):
         self.description_oneline = (
                 self.description_stripped[0].replace('\n', '$'))
 
+    def with_download_info(self, download_info):
+        """Make a copy of this ItemInfo with a new DownloadInfo."""
+        info = copy.copy(self)
+        info.download_info = download_info
+        return info
+
+    def delta_from(self, old_info):
+        """Calculate the attributes that changed since old_info.
+
+        :returns: dict mapping attribute names to their values in this
+            ItemInfo
+        """
+        old = old_info.__dict__
+        delta = {}
+        for name, value in self.__dict__.iteritems():
+            if name not in old or old[name] != value:
+                delta[name] = value
+        return delta
+
+    def apply_delta(self, delta):
+        """Make a copy of this ItemInfo with a delta from delta_from() applied.
+
+        The derived attributes are part of the delta if they changed, so we
+        don't need to recalculate anything.
+        """
+        info = copy.copy(self)
+        info.__dict__.update(delta)
+        return info
+
 class DownloadInfo(object):
     """Tracks the download state of an item.
 
@@ -1279,6 +1380,22 @@ class DownloadInfo(object):
             self.short_reason_failed = u""
         self.eta = downloader.get_eta()
 
+    def with_progress(self, downloaded_size, rate, eta, state):
+        """Make a copy of this DownloadInfo with new progress values."""
+        download_info = copy.copy(self)
+        download_info.downloaded_size = downloaded_size
+        download_info.rate = rate
+        download_info.eta = eta
+        download_info.state = state
+        return download_info
+
+    def __eq__(self, other):
+        return (isinstance(other, DownloadInfo) and
+                self.__dict__ == other.__dict__)
+
+    def __ne__(self, other):
+        return not self.__eq__(other)
+
 class PendingDownloadInfo(DownloadInfo):
     """DownloadInfo object for pending downloads (downloads queued,
     but not started because we've reached some limit)
@@ -1417,6 +1534,23 @@ class TabsChanged(FrontendMessage):
 class ItemList(FrontendMessage):
     """Sends the frontend the initial list of items for a feed
 
+    :param type: type of object being tracked (same as in TrackItems)
+    :param id: id of the object being tracked (same as in TrackItems)
+    :param items: list of ItemInfo objects
+    :param pending_ids: ids for items that were left out because of
+                        TrackItems.window_size, in sorted order.
+    """
+    def __init__(self, typ, id_, item_infos, pending_ids=None):
+        self.type = typ
+        self.id = id_
+        self.items = item_infos
+        if pending_ids is None:
+            pending_ids = []
+        self.pending_ids = pending_ids
+
+class ItemInfosFetched(FrontendMessage):
+    """Sends the frontend ItemInfos requested with FetchItemInfos.
+
     :param type: type of object being tracked (same as in TrackItems)
     :param id: id of the object being tracked (same as in TrackItems)
     :param items: list of ItemInfo objects
@@ -1435,18 +1569,44 @@ class ItemsChanged(FrontendMessage):
                   The order will be the order they were added.
     :param changed: set containing an ItemInfo for each changed item.
     :param removed: set containing ids for each item that was removed
+    :param deltas: dict mapping ids of changed items to the attributes that
+                   changed since the last ItemInfo sent for that item (see
+                   ItemInfo.delta_from()).  Only used if TrackItems was sent
+                   with send_deltas=True.  Items with a delta are not in
+                   changed.
     """
-    def __init__(self, typ, id_, added, changed, removed):
+    def __init__(self, typ, id_, added, changed, removed, deltas=None):
         self.type = typ
         self.id = id_
         self.added = added
         self.changed = changed
         self.removed = removed
+        if deltas is None:
+            deltas = {}
+        self.deltas = deltas
 
     def __str__(self):
         return ('<miro.messages.ItemsChanged %s:%s '
     '(%d added, %d changed, %d removed)>') % (self.type, self.id,
-    len(self.added), len(self.changed), len(self.removed))
+    len(self.added), len(self.changed) + len(self.deltas),
+    len(self.removed))
+
+class ItemSearchTermsChanged(FrontendMessage):
+    """Informs the frontend that the search terms for some items changed.
+
+    :param changed: dict mapping item ids to tuples of search terms for
+                    added and changed items
+    :param removed: list of ids for removed items
+    :param ready: True if the backend has indexed every item in the database
+    """
+    def __init__(self, changed, removed, ready):
+        self.changed = changed
+        self.removed = removed
+        self.ready = ready
+
+    def __str__(self):
+        return ('<miro.messages.ItemSearchTermsChanged '
+    '(%d changed, %d removed)>') % (len(self.changed), len(self.removed))
 
 class WatchedFolderList(FrontendMessage):
     """Sends the frontend the initial list of watched folders.
@@ -1477,6 +1637,23 @@ class CurrentSearchInfo(FrontendMessage):
         self.engine = engine
         self.text = text
 
+class DownloadProgress(FrontendMessage):
+    """Informs the frontend about progress for active downloads.
+
+    These are sent instead of ItemsChanged when only the amount downloaded,
+    the rate or the ETA changed.  The frontend should apply them to the
+    DownloadInfo of the items it has.
+
+    :param progress: list of (item_id, downloaded_size, rate, eta, state)
+                     tuples
+    """
+    def __init__(self, progress):
+        self.progress = progress
+
+    def __str__(self):
+        return '<miro.messages.DownloadProgress (%d items)>' % (
+            len(self.progress))
+
 class DownloadCountChanged(FrontendMessage):
     """Informs the frontend that number of downloads has changed. Includes the
     number of non downloading items which should be displayed.
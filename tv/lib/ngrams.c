@@ -122,6 +122,237 @@ static PyObject *breakup_list(PyObject *self, PyObject *args)
     return ngram_list;
 }
 
+/*
+ * breakup_set support.
+ *
+ * N-grams are interned using these dicts, which map each N-gram to itself.
+ * We use separate dicts for str and unicode objects, since 'abc' == u'abc'.
+ */
+static PyObject *interned_strings = NULL;
+static PyObject *interned_unicode = NULL;
+
+/*
+ * The same words come up over and over, so we cache the N-grams for each
+ * word.  These dicts map words to tuples of N-grams.  The cache is only
+ * valid for one set of (min, max, hashed) arguments.
+ */
+static PyObject *string_word_cache = NULL;
+static PyObject *unicode_word_cache = NULL;
+static long cache_min = -1;
+static long cache_max = -1;
+static int cache_hashed = -1;
+/* Clear the caches when they get this big */
+#define MAX_CACHED_WORDS 100000
+
+#define FNV_OFFSET_BASIS 2166136261U
+#define FNV_PRIME 16777619U
+
+static void clear_caches(void)
+{
+    PyDict_Clear(string_word_cache);
+    PyDict_Clear(unicode_word_cache);
+    PyDict_Clear(interned_strings);
+    PyDict_Clear(interned_unicode);
+}
+
+/* Return an interned version of ngram.  Steals a reference to ngram and
+ * returns a new reference.
+ */
+static PyObject *intern_ngram(PyObject *interned, PyObject *ngram)
+{
+    PyObject *existing;
+
+    existing = PyDict_GetItem(interned, ngram);
+    if(existing) {
+        Py_INCREF(existing);
+        Py_DECREF(ngram);
+        return existing;
+    }
+    if(PyDict_SetItem(interned, ngram, ngram) < 0) {
+        Py_DECREF(ngram);
+        return NULL;
+    }
+    return ngram;
+}
+
+/* Calculate the N-grams for a word.
+ *
+ * Returns a new reference to a tuple of N-grams, which may contain
+ * duplicates.
+ */
+static PyObject *word_ngrams(PyObject *word, long min, long max, int hashed)
+{
+    Py_UNICODE *unicode_data = NULL;
+    char *string_data = NULL;
+    PyObject *interned;
+    PyObject *ngram_list;
+    PyObject *ngram;
+    PyObject *rv;
+    Py_ssize_t len, i, j;
+    unsigned long hash;
+
+    if(PyUnicode_Check(word)) {
+        unicode_data = PyUnicode_AS_UNICODE(word);
+        len = PyUnicode_GET_SIZE(word);
+        interned = interned_unicode;
+    } else {
+        string_data = PyString_AS_STRING(word);
+        len = PyString_GET_SIZE(word);
+        interned = interned_strings;
+    }
+
+    ngram_list = PyList_New(0);
+    if(!ngram_list) return NULL;
+
+    for(i=0; i + min <= len; i++) {
+        hash = FNV_OFFSET_BASIS;
+        for(j=i; j < i + max && j < len; j++) {
+            if(hashed) {
+                /* 32-bit FNV-1a hash.  We extend the hash for the
+                 * (j - i)-gram, so we don't need to create any strings.
+                 */
+                if(unicode_data) {
+                    hash ^= (unsigned long)unicode_data[j];
+                } else {
+                    hash ^= (unsigned char)string_data[j];
+                }
+                hash = (hash * FNV_PRIME) & 0xffffffffUL;
+            }
+            if(j + 1 - i < min) continue;
+            if(hashed) {
+                ngram = PyInt_FromLong((long)hash);
+            } else {
+                if(unicode_data) {
+                    ngram = PyUnicode_FromUnicode(unicode_data + i,
+                            j + 1 - i);
+                } else {
+                    ngram = PyString_FromStringAndSize(string_data + i,
+                            j + 1 - i);
+                }
+                if(ngram) {
+                    ngram = intern_ngram(interned, ngram);
+                }
+            }
+            if(!ngram) {
+                Py_DECREF(ngram_list);
+                return NULL;
+            }
+            if(PyList_Append(ngram_list, ngram) < 0) {
+                Py_DECREF(ngram);
+                Py_DECREF(ngram_list);
+                return NULL;
+            }
+            Py_DECREF(ngram);
+        }
+    }
+    rv = PyList_AsTuple(ngram_list);
+    Py_DECREF(ngram_list);
+    return rv;
+}
+
+/* Get the N-grams for a word from the cache, calculating them if needed.
+ *
+ * Returns a borrowed reference.
+ */
+static PyObject *cached_word_ngrams(PyObject *word, long min, long max,
+        int hashed)
+{
+    PyObject *cache;
+    PyObject *ngrams;
+
+    if(PyUnicode_Check(word)) {
+        cache = unicode_word_cache;
+    } else {
+        cache = string_word_cache;
+    }
+    ngrams = PyDict_GetItem(cache, word);
+    if(ngrams) {
+        return ngrams;
+    }
+    ngrams = word_ngrams(word, min, max, hashed);
+    if(!ngrams) {
+        return NULL;
+    }
+    if(PyDict_Size(cache) >= MAX_CACHED_WORDS) {
+        clear_caches();
+    }
+    if(PyDict_SetItem(cache, word, ngrams) < 0) {
+        Py_DECREF(ngrams);
+        return NULL;
+    }
+    /* the cache holds a reference now */
+    Py_DECREF(ngrams);
+    return ngrams;
+}
+
+static PyObject *breakup_set(PyObject *self, PyObject *args)
+{
+    PyObject* source_list;
+    PyObject* iter;
+    PyObject* item;
+    PyObject* ngrams;
+    PyObject* ngram_set;
+    long min, max;
+    int hashed = 0;
+    Py_ssize_t i;
+
+    if (!PyArg_ParseTuple(args, "Oll|i:breakup_set", &source_list, &min,
+                &max, &hashed)) {
+        return NULL;
+    }
+    if(min < 1) {
+        PyErr_SetString(PyExc_ValueError, "breakup_set() min must be > 0");
+        return NULL;
+    }
+    hashed = hashed ? 1 : 0;
+    if(min != cache_min || max != cache_max || hashed != cache_hashed) {
+        clear_caches();
+        cache_min = min;
+        cache_max = max;
+        cache_hashed = hashed;
+    }
+
+    iter = PyObject_GetIter(source_list);
+    if(!iter) return NULL;
+
+    /* We can add to a frozenset, as long as no other code has seen it yet */
+    ngram_set = PyFrozenSet_New(NULL);
+    if(!ngram_set) {
+        Py_DECREF(iter);
+        return NULL;
+    }
+
+    while ((item = PyIter_Next(iter))) {
+        if(!PyUnicode_Check(item) && !PyString_Check(item)) {
+            PyErr_SetString(PyExc_TypeError,
+                    "breakup_set() words must be str or unicode");
+            Py_DECREF(item);
+            goto error;
+        }
+        ngrams = cached_word_ngrams(item, min, max, hashed);
+        Py_DECREF(item);
+        if(!ngrams) {
+            goto error;
+        }
+        for(i=0; i < PyTuple_GET_SIZE(ngrams); i++) {
+            if(PySet_Add(ngram_set, PyTuple_GET_ITEM(ngrams, i)) < 0) {
+                goto error;
+            }
+        }
+    }
+    if(PyErr_Occurred()) {
+        goto error;
+    }
+
+    Py_DECREF(iter);
+    return ngram_set;
+
+error:
+    Py_DECREF(iter);
+    Py_DECREF(ngram_set);
+    return NULL;
+}
+
 static PyMethodDef NgramsMethods[] =
 {
     {"breakup_word", (PyCFunction)breakup_word, METH_VARARGS,
@@ -130,6 +361,10 @@ static PyMethodDef NgramsMethods[] =
     {"breakup_list", (PyCFunction)breakup_list, METH_VARARGS,
         "split a sequence of words into a list of ngrams"
     },
+    {"breakup_set", (PyCFunction)breakup_set, METH_VARARGS,
+        "split a sequence of words into a frozenset of interned ngrams, or "
+        "their 32-bit hashes if the optional hashed argument is true"
+    },
     { NULL, NULL, 0, NULL }
 };
 
@@ -138,4 +373,9 @@ PyMODINIT_FUNC initngrams(void)
     PyObject *m;
 
     m = Py_InitModule("ngrams", NgramsMethods);
+    if(!m) return;
+    interned_strings = PyDict_New();
+    interned_unicode = PyDict_New();
+    string_word_cache = PyDict_New();
+    unicode_word_cache = PyDict_New();
 }
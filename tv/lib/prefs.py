@@ -136,6 +136,13 @@ REMEMBER_LAST_DISPLAY       = Pref(key='rememberLastDisplay', default=False, pla
 PODCASTS_DEFAULT_VIEW       = Pref(key='podcastsDefaultView', default=0, platformSpecific=False)
 # metadata
 LAST_RETRY_NET_LOOKUP       = Pref(key='lastRetryNetLookup', default=0, platformSpecific=False)
+# database tuning (see LiveStorage)
+DB_USE_WAL                  = Pref(key='dbUseWAL', default=False, platformSpecific=False)
+# max items to keep in memory, 0 for no limit
+DB_OBJECT_CACHE_SIZE        = Pref(key='dbObjectCacheSize', default=50000, platformSpecific=False)
+DB_GROUP_COMMIT             = Pref(key='dbGroupCommit', default=False, platformSpecific=False)
+DB_GROUP_COMMIT_DELAY       = Pref(key='dbGroupCommitDelay', default=1.0, platformSpecific=False)
+DB_GROUP_COMMIT_MAX_STATEMENTS = Pref(key='dbGroupCommitMaxStatements', default=500, platformSpecific=False)
 # This doesn't need to be defined on the platform, but it can be overridden there if the platform wants to.
 SHOW_ERROR_DIALOG           = Pref(key='showErrorDialog',       default=True,  platformSpecific=True)
 
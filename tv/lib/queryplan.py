@@ -0,0 +1,371 @@
+# Miro - an RSS based video player application
+# Copyright (C) 2005, 2006, 2007, 2008, 2009, 2010, 2011
+# Participatory Culture Foundation
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 51 Franklin St, Fifth Floor, Boston, MA  02110-1301 USA
+#
+# In addition, as a special exception, the copyright holders give
+# permission to link the code of portions of this program with the OpenSSL
+# library.
+#
+# You must obey the GNU General Public License in all respects for all of
+# the code used other than OpenSSL. If you modify file(s) with this
+# exception, you may extend this exception to your version of the file(s),
+# but you are not obligated to do so. If you do not wish to do so, delete
+# this exception statement from your version. If you delete this exception
+# statement from all source files in the program, then also delete it here.
+
+"""``miro.queryplan`` -- Audit the SQL query plans for Item views.
+
+Item defines lots of views and most of them join against the
+remote_downloader and/or feed tables.  It's easy to write one that makes
+SQLite scan the entire item table, which gets slow once a user has
+thousands of items.
+
+This module runs EXPLAIN QUERY PLAN for every Item view, flags the ones
+that do full table scans or sort using a temporary B-tree, and suggests
+indexes that could help.  The suggestions are just hints.  Before adding
+an index to the schema, check that it actually helps using the
+QueryPlanPerformanceTest benchmark.
+"""
+
+import datetime
+import inspect
+import logging
+import re
+import sqlite3
+
+from miro import app
+from miro import models
+from miro.database import View
+from miro.fileobject import FilenameType
+
+# Partial indexes were added in SQLite 3.8.0
+PARTIAL_INDEXES_SUPPORTED = sqlite3.sqlite_version_info >= (3, 8, 0)
+
+# Values to use for view arguments.  Any argument not listed here gets
+# DEFAULT_SAMPLE_ARG.
+SAMPLE_ARGS = {
+    'path': FilenameType('/sample/path.avi'),
+    'watched_before': datetime.datetime(2000, 1, 1),
+}
+DEFAULT_SAMPLE_ARG = 1
+
+# Max number of columns we put in a covering index suggestion
+MAX_COVERING_COLUMNS = 4
+
+_scan_re = re.compile(r'^SCAN (?:TABLE )?(\w+)(?: AS (\w+))?(.*)$')
+_column_ref_re = re.compile(r'\b(?:(\w+)\.)?(\w+)\b')
+_string_literal_re = re.compile(r"'[^']*'")
+_equality_after_re = re.compile(r'^(=|IN\b|IS\b)', re.IGNORECASE)
+_and_term_re = re.compile(r'\(|\)|\bAND\b', re.IGNORECASE)
+_or_re = re.compile(r'\bOR\b', re.IGNORECASE)
+
+class IndexSuggestion(object):
+    """An index that might speed up a view.
+
+    :attribute kind: "index", "covering" or "partial"
+    :attribute table: table to create the index on
+    :attribute columns: tuple of columns to index
+    :attribute where: WHERE clause for partial indexes, otherwise None
+    """
+    def __init__(self, kind, table, name, columns, where=None):
+        self.kind = kind
+        self.table = table
+        self.name = name
+        self.columns = tuple(columns)
+        self.where = where
+
+    def sql(self):
+        sql = "CREATE INDEX %s ON %s (%s)" % (self.name, self.table,
+                                              ', '.join(self.columns))
+        if self.where is not None:
+            sql += " WHERE %s" % self.where
+        return sql
+
+    def __eq__(self, other):
+        return (isinstance(other, IndexSuggestion) and
+                self.sql() == other.sql())
+
+    def __ne__(self, other):
+        return not self == other
+
+    def __hash__(self):
+        return hash(self.sql())
+
+    def __repr__(self):
+        return '<IndexSuggestion: %s>' % self.sql()
+
+class ViewPlan(object):
+    """Query plan for a single view.
+
+    :attribute name: name of the view
+    :attribute sql: SQL statement that the view runs
+    :attribute details: list of detail strings from EXPLAIN QUERY PLAN
+    :attribute full_scans: list of tables that get a full table scan
+    :attribute temp_sort: True if SQLite sorts the results using a
+        temporary B-tree
+    :attribute suggestions: list of IndexSuggestion objects
+    :attribute error: error message if we couldn't get the query plan
+        (for example because the view uses a column that doesn't exist),
+        otherwise None
+    """
+    def __init__(self, name, sql, details, error=None):
+        self.name = name
+        self.sql = sql
+        self.details = details
+        self.full_scans = []
+        self.temp_sort = False
+        self.suggestions = []
+        self.error = error
+
+    def has_problems(self):
+        return bool(self.full_scans or self.temp_sort or self.error)
+
+def explain(cursor, sql, values=()):
+    """Run EXPLAIN QUERY PLAN for a statement.
+
+    :returns: list of detail strings, one for each step of the plan
+    """
+    cursor.execute("EXPLAIN QUERY PLAN %s" % sql, values)
+    # the detail string is always the last column, but the number of
+    # columns before it depends on the SQLite version
+    return [row[-1] for row in cursor.fetchall()]
+
+def item_views():
+    """Get all the views that Item defines.
+
+    We call each Item classmethod that returns a view using arguments from
+    SAMPLE_ARGS.
+
+    :returns: list of (name, view) tuples
+    """
+    views = []
+    for name in sorted(dir(models.Item)):
+        if name == 'make_view' or not (name.endswith('_view') or
+                                       name.endswith('_items')):
+            continue
+        method = getattr(models.Item, name)
+        if not inspect.ismethod(method) or method.im_self is not models.Item:
+            # not a classmethod
+            continue
+        arg_names = inspect.getargspec(method)[0][1:]
+        defaults = inspect.getargspec(method)[3] or ()
+        required = arg_names[:len(arg_names) - len(defaults)]
+        args = [SAMPLE_ARGS.get(arg, DEFAULT_SAMPLE_ARG) for arg in required]
+        view = method(*args)
+        if isinstance(view, View):
+            views.append((name, view))
+    return views
+
+def _table_aliases(view):
+    """Map the table names/aliases used in a view to the actual tables."""
+    aliases = {view.table_name: view.table_name}
+    if view.joins is not None:
+        for join_table in view.joins:
+            parts = join_table.split()
+            aliases[parts[-1]] = parts[0]
+            aliases[parts[0]] = parts[0]
+    return aliases
+
+def _table_columns(cursor, table):
+    cursor.execute("PRAGMA table_info(%s)" % table)
+    return [row[1] for row in cursor.fetchall()]
+
+def _and_terms(sql):
+    """Split an SQL expression into the terms that are ANDed together."""
+    terms = []
+    depth = 0
+    start = 0
+    for match in _and_term_re.finditer(sql):
+        token = match.group()
+        if token == '(':
+            depth += 1
+        elif token == ')':
+            depth -= 1
+        elif depth == 0:
+            terms.append(sql[start:match.start()].strip())
+            start = match.end()
+    terms.append(sql[start:].strip())
+    return terms
+
+def _columns_used(sql, alias, table, columns, is_main_table):
+    """Get the columns from a table that an SQL expression uses.
+
+    Qualified columns are matched using alias.  Unqualified columns are
+    only matched for the main table of a view.
+
+    A column is an equality column if it's compared with "=", "IN" or "IS"
+    in a term that's ANDed with the rest of the expression.  Those are the
+    columns that SQLite can use to look things up in an index.
+
+    :returns: list of (column, is_equality) tuples
+    """
+    lower_columns = dict((c.lower(), c) for c in columns)
+    sql = _string_literal_re.sub("''", sql)
+    rv = []
+    for term in _and_terms(sql):
+        indexable = (_or_re.search(term) is None and
+                     not term.upper().startswith('NOT'))
+        for match in _column_ref_re.finditer(term):
+            qualifier, name = match.groups()
+            if qualifier is not None:
+                if qualifier not in (alias, table):
+                    continue
+            elif not is_main_table:
+                continue
+            column = lower_columns.get(name.lower())
+            if column is None:
+                continue
+            after = term[match.end():].lstrip()
+            before = term[:match.start()].rstrip()
+            is_equality = indexable and (
+                    _equality_after_re.match(after) is not None or
+                    (before.endswith('=') and
+                     not before.endswith('!=') and
+                     not before.endswith('<=') and
+                     not before.endswith('>=')))
+            rv.append((column, is_equality))
+    return rv
+
+def _index_name(table, columns):
+    return '%s_%s' % (table, '_'.join(c.lower() for c in columns))
+
+def _unique(seq):
+    rv = []
+    for obj in seq:
+        if obj not in rv:
+            rv.append(obj)
+    return rv
+
+def _suggest_indexes(cursor, name, view, alias):
+    """Suggest indexes to avoid a full scan of a table used in a view."""
+    aliases = _table_aliases(view)
+    table = aliases.get(alias, alias)
+    is_main_table = (table == view.table_name)
+    columns = _table_columns(cursor, table)
+    if is_main_table:
+        # the WHERE clause decides which rows we look at
+        used = _columns_used(view.where or '', alias, table, columns, True)
+    else:
+        # joined tables are looked up using their join condition, unless
+        # SQLite decides to loop over them first.  In that case the WHERE
+        # clause matters too.
+        used = _columns_used(view.where or '', alias, table, columns, False)
+        for join_table, join_where in view.joins.items():
+            if join_table.split()[-1] == alias:
+                used.extend(_columns_used(join_where, alias, table, columns,
+                                          False))
+    used = [(c, eq) for (c, eq) in used if c != 'id']
+    key_columns = _unique(c for (c, eq) in used if eq)
+    other_columns = _unique(c for (c, eq) in used
+                            if c not in key_columns)
+    order_column = None
+    if is_main_table and view.order_by is not None:
+        order_column = view.order_by.split()[0].split('.')[-1]
+        if order_column not in columns:
+            order_column = None
+
+    suggestions = []
+    if key_columns:
+        index_columns = list(key_columns)
+        if order_column is not None and order_column not in index_columns:
+            index_columns.append(order_column)
+        suggestions.append(IndexSuggestion('index', table,
+                _index_name(table, index_columns), index_columns))
+        covering = _unique(index_columns + other_columns)
+        if (len(covering) > len(index_columns) and
+                len(covering) <= MAX_COVERING_COLUMNS):
+            suggestions.append(IndexSuggestion('covering', table,
+                    _index_name(table, covering), covering))
+    elif (is_main_table and PARTIAL_INDEXES_SUPPORTED and
+            not view.joins and view.where and '?' not in view.where):
+        # The view only filters on constant expressions, for example
+        # "isContainerItem".  A regular index doesn't help for those, but
+        # a partial index that only contains the matching rows does.
+        where = view.where.replace('%s.' % table, '')
+        suggestions.append(IndexSuggestion('partial', table,
+                '%s_%s' % (table, name), ['id'], where))
+    return suggestions
+
+def audit_view(name, view, cursor=None):
+    """Get the query plan for a view.
+
+    If SQLite can't explain the view's query, the error gets recorded in the
+    ViewPlan's error attribute.
+
+    :returns: ViewPlan
+    """
+    if cursor is None:
+        cursor = view.db_info.db.cursor
+    sql = view.db_info.db._query_sql("%s.id" % view.table_name,
+            view.table_name, view.where, view.joins, view.order_by,
+            view.limit)
+    try:
+        details = explain(cursor, sql, view.values)
+    except sqlite3.Error, e:
+        return ViewPlan(name, sql, [], error=str(e))
+    plan = ViewPlan(name, sql, details)
+    for detail in plan.details:
+        if detail.startswith('USE TEMP B-TREE FOR ORDER BY'):
+            plan.temp_sort = True
+        match = _scan_re.match(detail)
+        if match is None or 'INDEX' in match.group(3):
+            continue
+        alias = match.group(2) or match.group(1)
+        plan.full_scans.append(_table_aliases(view).get(alias, alias))
+        plan.suggestions.extend(_suggest_indexes(cursor, name, view, alias))
+    if plan.temp_sort and not plan.full_scans:
+        plan.suggestions.extend(_suggest_indexes(cursor, name, view,
+                                                 view.table_name))
+    plan.suggestions = _unique(plan.suggestions)
+    return plan
+
+def audit_item_views(cursor=None):
+    """Get query plans for all Item views.
+
+    :returns: list of ViewPlan objects
+    """
+    return [audit_view(name, view, cursor) for name, view in item_views()]
+
+def format_report(plans):
+    """Format a list of ViewPlans into a human readable report."""
+    lines = []
+    problem_count = 0
+    for plan in plans:
+        if not plan.has_problems():
+            continue
+        problem_count += 1
+        if plan.error is not None:
+            lines.append('%s: error: %s' % (plan.name, plan.error))
+            lines.append('    sql: %s' % plan.sql.replace('\n', ' '))
+            continue
+        problems = ['full scan of %s' % table for table in plan.full_scans]
+        if plan.temp_sort:
+            problems.append('temporary B-tree for ORDER BY')
+        lines.append('%s: %s' % (plan.name, ', '.join(problems)))
+        for detail in plan.details:
+            lines.append('    plan: %s' % detail)
+        for suggestion in plan.suggestions:
+            lines.append('    suggest (%s): %s' % (suggestion.kind,
+                                                   suggestion.sql()))
+    lines.insert(0, '%d of %d views have query plan problems' % (
+        problem_count, len(plans)))
+    return '\n'.join(lines)
+
+def log_report():
+    """Audit all Item views and log the results."""
+    logging.info("Query plan audit (SQLite %s)\n%s", sqlite3.sqlite_version,
+                 format_report(audit_item_views(app.db.cursor)))
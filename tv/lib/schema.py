@@ -501,6 +501,7 @@ class ItemSchema(MultiClassObjectSchema):
             ('item_parent', ('parent_id',)),
             ('item_downloader', ('downloader_id',)),
             ('item_feed_downloader', ('feed_id', 'downloader_id',)),
+            ('item_feed_release', ('feed_id', 'releaseDateObj')),
             ('item_file_type', ('file_type',)),
             ('item_filename', ('filename',)),
     )
@@ -636,6 +637,7 @@ class RemoteDownloaderSchema(DDBObjectSchema):
 
     indexes = (
         ('downloader_state', ('state',)),
+        ('downloader_main_item', ('main_item_id',)),
     )
 
     @staticmethod
@@ -879,7 +881,7 @@ class MetadataEntrySchema(DDBObjectSchema):
         ('metadata_entry_status_and_source', ('status_id', 'source')),
     )
 
-VERSION = 178
+VERSION = 182
 
 object_schemas = [
     IconCacheSchema, ItemSchema, FeedSchema,
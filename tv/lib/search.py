@@ -31,7 +31,9 @@
 
 To make incremental search fast, we index the N-grams for each item.
 """
-import collections
+import array
+import bisect
+import heapq
 import os
 import re
 
@@ -45,6 +47,9 @@ SLASHKILLER = re.compile(r'\\.')
 WORDMATCHER = re.compile("\w+", re.UNICODE)
 NGRAM_MIN = 3
 NGRAM_MAX = 5
+# Used to join search terms in list_matches().  WORDMATCHER never includes it
+# in a term.
+TERM_SEPARATOR = u'\x00'
 SEARCHOBJECTS = {}
 
 def _get_boolean_search(search_string):
@@ -96,21 +101,47 @@ class BooleanSearch:
     def as_string(self):
         return self.string
 
-def _calc_search_text(item_info):
-    match_against = [item_info.name, item_info.description]
+# Weights for the fields that we search.  Matches in the name are the most
+# important, then artist/album, feed name/genre, description and finally the
+# filename.
+NAME_WEIGHT = 16.0
+ARTIST_ALBUM_WEIGHT = 8.0
+FEED_NAME_WEIGHT = 4.0
+DESCRIPTION_WEIGHT = 2.0
+FILENAME_WEIGHT = 1.0
+# How much a word counts towards the term frequency depending on how the
+# search term matches it
+EXACT_MATCH_SCORE = 1.0
+PREFIX_MATCH_SCORE = 0.6
+SUBSTRING_MATCH_SCORE = 0.3
+# Bonus for fields that start with the search term, as a multiple of the
+# field weight
+FIELD_PREFIX_BONUS = 0.5
+
+def _calc_search_fields(item_info):
+    """Get the text that we search for an ItemInfo.
+
+    :returns: list of (weight, text) tuples
+    """
+    fields = [(NAME_WEIGHT, item_info.name),
+              (DESCRIPTION_WEIGHT, item_info.description)]
     if item_info.artist is not None:
-        match_against.append(item_info.artist)
+        fields.append((ARTIST_ALBUM_WEIGHT, item_info.artist))
     if item_info.album is not None:
-        match_against.append(item_info.album)
+        fields.append((ARTIST_ALBUM_WEIGHT, item_info.album))
     if item_info.genre is not None:
-        match_against.append(item_info.genre)
+        fields.append((FEED_NAME_WEIGHT, item_info.genre))
     if item_info.feed_name is not None:
-        match_against.append(item_info.feed_name)
+        fields.append((FEED_NAME_WEIGHT, item_info.feed_name))
     if item_info.download_info and item_info.download_info.torrent:
-        match_against.append(u'torrent')
+        fields.append((FILENAME_WEIGHT, u'torrent'))
     if item_info.video_path:
         filename = os.path.basename(item_info.video_path)
-        match_against.append(filename_to_unicode(filename))
+        fields.append((FILENAME_WEIGHT, filename_to_unicode(filename)))
+    return fields
+
+def _calc_search_text(item_info):
+    match_against = [text for weight, text in _calc_search_fields(item_info)]
     return (' '.join(match_against)).lower()
 
 def calc_search_terms(item_info):
@@ -137,9 +168,14 @@ def _ngrams_for_term(term):
         return ngrams.breakup_word(term, NGRAM_MAX, NGRAM_MAX)
 
 def _ngrams_for_item(item_info):
-    """Given an ItemInfo, return a list of N-grams contained."""
+    """Given an ItemInfo, return a frozenset of N-grams contained."""
+
+    return _ngrams_for_terms(item_info.search_terms)
 
-    return ngrams.breakup_list(item_info.search_terms, NGRAM_MIN, NGRAM_MAX)
+def _ngrams_for_terms(terms):
+    """Given a list of search terms, return a frozenset of N-grams contained.
+    """
+    return ngrams.breakup_set(terms, NGRAM_MIN, NGRAM_MAX)
 
 def item_matches(item_info, search_text):
     """Test if a single ItemInfo matches a search
@@ -160,6 +196,80 @@ def item_matches(item_info, search_text):
             return False
     return True
 
+class ItemScorer(object):
+    """Scores how well ItemInfos match a search.
+
+    For each positive term in the search, and each field we search, we
+    calculate a term frequency.  Words that equal the term count the most,
+    then words that start with the term, then words that just contain it.
+    The frequency is scaled so that repeating a term doesn't count for too
+    much, then multiplied by the weight of the field.  Fields that start with
+    the term get a bonus.
+    """
+
+    def __init__(self, search_text):
+        parsed_search = _get_boolean_search(search_text)
+        self.terms = [t for t in parsed_search.positive_terms if t]
+
+    def _term_frequency(self, term, words):
+        tf = 0.0
+        for word in words:
+            if word == term:
+                tf += EXACT_MATCH_SCORE
+            elif word.startswith(term):
+                tf += PREFIX_MATCH_SCORE
+            elif term in word:
+                tf += SUBSTRING_MATCH_SCORE
+        return tf
+
+    def score(self, item_info):
+        """Calculate the score for an ItemInfo.
+
+        :returns: a float, higher scores are better matches
+        """
+        if not self.terms:
+            return 0.0
+        total = 0.0
+        for weight, text in _calc_search_fields(item_info):
+            if not text:
+                continue
+            text = text.lower()
+            words = WORDMATCHER.findall(text)
+            for term in self.terms:
+                if term not in text:
+                    continue
+                tf = self._term_frequency(term, words)
+                total += weight * (tf / (tf + 1.0))
+                if text.startswith(term):
+                    total += weight * FIELD_PREFIX_BONUS
+        return total
+
+def rank_items(item_infos, search_text, limit=None):
+    """Sort ItemInfos by how well they match a search.
+
+    This doesn't filter out non-matching items, use list_matches() or
+    ItemSearcher for that.
+
+    :param item_infos: iterable of ItemInfos
+    :param search_text: search_text to score with
+    :param limit: if given, only return the best limit items.  We use a heap
+        for this, so it's faster than sorting everything.
+    :returns: list of ItemInfos, best matches first
+    """
+    scorer = ItemScorer(search_text)
+    if limit is not None:
+        return heapq.nlargest(limit, item_infos, key=scorer.score)
+    else:
+        return sorted(item_infos, key=scorer.score, reverse=True)
+
+def list_matches_ranked(item_infos, search_text, limit=None):
+    """Version of list_matches() that returns results by their score.
+
+    :returns: list of matching ItemInfos, best matches first
+    """
+    return rank_items(list_matches(item_infos, search_text), search_text,
+                      limit)
+
 def list_matches(item_infos, search_text):
     """
     Optimized version of item_matches() which filters a iterable
@@ -177,28 +287,70 @@ def list_matches(item_infos, search_text):
     for term in parsed_search.negative_terms:
         negative_set |= set(_ngrams_for_term(term))
 
+    # Calculating the N-grams for each item is slow.  Instead, we use the
+    # fact that an N-gram is in an item's N-grams exactly when it's a
+    # substring of one of its search terms.  Joining the terms with
+    # TERM_SEPARATOR lets us check all of them at once.  N-grams that
+    # contain TERM_SEPARATOR can't be in any term.
+    for ngram in positive_set:
+        if TERM_SEPARATOR in ngram:
+            return
+    negative_list = [ngram for ngram in negative_set
+                     if TERM_SEPARATOR not in ngram]
+
     for info in item_infos:
-        item_ngrams_set = set(_ngrams_for_item(info))
-        match = positive_set.issubset(item_ngrams_set)
-        if match and negative_set:
-            match = negative_set.isdisjoint(item_ngrams_set)
+        terms_text = TERM_SEPARATOR.join(info.search_terms)
+        match = True
+        for ngram in positive_set:
+            if ngram not in terms_text:
+                match = False
+                break
+        if match:
+            for ngram in negative_list:
+                if ngram in terms_text:
+                    match = False
+                    break
 
         if match:
             yield info
 
 class ItemSearcher(object):
-    """Index Item objects so that they can be searched quickly """
+    """Index Item objects so that they can be searched quickly
+
+    Each distinct N-gram gets an integer id.  For each N-gram id, we store a
+    posting list, which is a sorted array of the ids of the items that
+    contain it.  For each item we store an array of its N-gram ids, so that
+    we can remove it from the posting lists later.  This uses a lot less
+    memory than storing sets of item ids and lists of N-gram strings.
+
+    When a posting list becomes empty, we forget its N-gram and reuse the id
+    for the next new N-gram, so the index doesn't grow as items come and go.
+    """
 
     def __init__(self):
-        # map N-grams -> set of item ids
-        self._ngram_map = collections.defaultdict(set)
-        # map item id -> list of N-grams
+        # map N-grams -> N-gram ids
+        self._ngram_ids = {}
+        # N-grams, indexed by N-gram id.  None for unused ids.
+        self._ngrams = []
+        # posting lists, indexed by N-gram id
+        self._postings = []
+        # N-gram ids that we can reuse
+        self._free_ngram_ids = []
+        # map item id -> array of N-gram ids
         self._item_ngrams = {}
 
     def add_item(self, item_info):
         """Add an item info to the index."""
         self._add_item(item_info)
 
+    def add_item_terms(self, item_id, terms):
+        """Add an item to the index using search terms.
+
+        :param item_id: id of the item
+        :param terms: list of terms, as returned by calc_search_terms()
+        """
+        self._add_ngrams(item_id, _ngrams_for_terms(terms))
+
     def update_item(self, item_info):
         """Update the index based on an item info changing.
 
@@ -215,23 +367,68 @@ class ItemSearcher(object):
         self._remove_item(item_id)
 
     def _add_item(self, item_info):
-        item_ngrams = _ngrams_for_item(item_info)
-        for ngram in item_ngrams:
-            self._ngram_map[ngram].add(item_info.id)
-        self._item_ngrams[item_info.id] = item_ngrams
+        self._add_ngrams(item_info.id, _ngrams_for_item(item_info))
+
+    def _ngram_id(self, ngram):
+        try:
+            return self._ngram_ids[ngram]
+        except KeyError:
+            if self._free_ngram_ids:
+                # the posting list for a free id is empty, we can use it as-is
+                ngram_id = self._free_ngram_ids.pop()
+                self._ngrams[ngram_id] = ngram
+            else:
+                ngram_id = len(self._postings)
+                self._ngrams.append(ngram)
+                self._postings.append(array.array('i'))
+            self._ngram_ids[ngram] = ngram_id
+            return ngram_id
+
+    def _add_ngrams(self, item_id, item_ngrams):
+        ngram_ids = array.array('i', [self._ngram_id(ngram)
+                                      for ngram in item_ngrams])
+        for ngram_id in ngram_ids:
+            posting = self._postings[ngram_id]
+            if not posting or posting[-1] < item_id:
+                # Items are usually added in id order, so this is the
+                # common case
+                posting.append(item_id)
+            else:
+                bisect.insort_left(posting, item_id)
+        self._item_ngrams[item_id] = ngram_ids
 
     def _remove_item(self, item_id):
-        for ngram in self._item_ngrams.pop(item_id):
-            self._ngram_map[ngram].discard(item_id)
+        for ngram_id in self._item_ngrams.pop(item_id):
+            posting = self._postings[ngram_id]
+            pos = bisect.bisect_left(posting, item_id)
+            if pos < len(posting) and posting[pos] == item_id:
+                del posting[pos]
+            if not posting:
+                del self._ngram_ids[self._ngrams[ngram_id]]
+                self._ngrams[ngram_id] = None
+                self._free_ngram_ids.append(ngram_id)
+
+    def _ngram_ids_for_term(self, term):
+        """Get the N-gram ids to search for for a term.
+
+        :returns: set of N-gram ids, or None if one of the N-grams isn't in
+            our index
+        """
+        try:
+            return set(self._ngram_ids[gram]
+                       for gram in _ngrams_for_term(term))
+        except KeyError:
+            return None
+
+    def _search_ngram_ids(self, ngram_ids):
+        """Get the set of ids for items that contain all N-grams."""
+        if ngram_ids is None:
+            return set()
+        return set(_intersect_postings([self._postings[ngram_id]
+                                        for ngram_id in ngram_ids]))
 
     def _term_search(self, term):
-        grams = _ngrams_for_term(term)
-        # note that we need to copy the value from _ngram_map.  We don't want
-        # our calls to intersection_update to change it.
-        rv = set(self._ngram_map[grams[0]])
-        for gram in grams[1:]:
-            rv.intersection_update(self._ngram_map[gram])
-        return rv
+        return self._search_ngram_ids(self._ngram_ids_for_term(term))
 
     def search(self, search_text):
         """Search through the index items.
@@ -248,13 +445,76 @@ class ItemSearcher(object):
                 if len(t) >= NGRAM_MIN]
 
         if positive_terms:
-            first_term = positive_terms[0]
-            matching_ids = self._term_search(first_term)
-            for term in positive_terms[1:]:
-                matching_ids.intersection_update(self._term_search(term))
+            # Every N-gram from every positive term needs to match, so we
+            # can intersect all the posting lists at once.
+            ngram_ids = set()
+            for term in positive_terms:
+                term_ngram_ids = self._ngram_ids_for_term(term)
+                if term_ngram_ids is None:
+                    return set()
+                ngram_ids.update(term_ngram_ids)
+            matching_ids = self._search_ngram_ids(ngram_ids)
         else:
             matching_ids = set(self._item_ngrams.keys())
 
         for term in negative_terms:
+            if not matching_ids:
+                break
             matching_ids.difference_update(self._term_search(term))
         return matching_ids
+
+    def search_ranked(self, search_text, id_to_info, limit=None):
+        """Search through the index and sort the results by their score.
+
+        :param search_text: search_text to search with
+        :param id_to_info: dict mapping ids to ItemInfos for the items in the
+            index
+        :param limit: if given, only return the best limit items
+        :returns: list of ItemInfos, best matches first
+        """
+        matching_ids = self.search(search_text)
+        return rank_items((id_to_info[id_] for id_ in matching_ids),
+                          search_text, limit)
+
+def _galloping_intersection(small, large):
+    """Intersect 2 sorted sequences of ids.
+
+    For each value in small, we search forward in large using exponentially
+    growing steps, then binary search the last step.  This is fast when
+    small is much shorter than large.
+
+    :returns: array of ids in both sequences
+    """
+    result = array.array('i')
+    large_len = len(large)
+    pos = 0
+    for value in small:
+        # find bound so that large[pos:bound] contains the first value that's
+        # >= value.  Everything before pos is < value.
+        bound = pos
+        step = 1
+        while bound < large_len and large[bound] < value:
+            pos = bound + 1
+            bound += step
+            step <<= 1
+        pos = bisect.bisect_left(large, value, pos, min(bound, large_len))
+        if pos == large_len:
+            break
+        if large[pos] == value:
+            result.append(value)
+            pos += 1
+    return result
+
+def _intersect_postings(postings):
+    """Intersect a list of posting lists.
+
+    We start with the shortest lists, so the intermediate results stay as
+    small as possible.
+    """
+    postings = sorted(postings, key=len)
+    result = postings[0]
+    for posting in postings[1:]:
+        if not result:
+            break
+        result = _galloping_intersection(result, posting)
+    return result
@@ -0,0 +1,339 @@
+# Miro - an RSS based video player application
+# Copyright (C) 2005, 2006, 2007, 2008, 2009, 2010, 2011
+# Participatory Culture Foundation
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 51 Franklin St, Fifth Floor, Boston, MA  02110-1301 USA
+#
+# In addition, as a special exception, the copyright holders give
+# permission to link the code of portions of this program with the OpenSSL
+# library.
+#
+# You must obey the GNU General Public License in all respects for all of
+# the code used other than OpenSSL. If you modify file(s) with this
+# exception, you may extend this exception to your version of the file(s),
+# but you are not obligated to do so. If you do not wish to do so, delete
+# this exception statement from your version. If you delete this exception
+# statement from all source files in the program, then also delete it here.
+
+"""``miro.searchindex`` -- Search terms for database items.
+
+itemtrack.SearchFilter used to build its own search.ItemSearcher for each
+item list, which meant calculating the N-grams for every ItemInfo in the
+list whenever it was opened.  ItemSearchIndex keeps the search terms for all
+database items in the backend, keyed by item id.  It follows the
+ItemInfoCache added/changed/removed signals to stay up to date.
+
+The search terms for each item are saved in the item_search_terms table.
+At startup we load the terms from there, so we don't need to unpickle
+ItemInfos or re-tokenize their text.  Loading happens in idle callbacks,
+is_ready() returns False until it's done.
+
+When an item's terms change, we mark its row dirty in the same transaction
+as the item change.  The new terms are saved later, so if we quit before
+that, the next startup re-indexes dirty rows and items without a row.
+
+The frontend keeps its own ItemSearcher, built from the terms that we send
+it with ItemSearchTermsChanged messages (see
+itemtrack.ItemSearchTermsIndex).  It never touches our data.
+"""
+
+import logging
+
+from miro import app
+from miro import eventloop
+from miro import messages
+from miro import schema
+from miro import util
+from miro.database import ObjectNotFoundError
+
+def _unique_terms(terms):
+    """Get a canonical tuple of search terms for an item."""
+    return tuple(sorted(set(terms)))
+
+class ItemSearchIndex(object):
+    """Search terms for all items in the database.
+
+    For each item we store a tuple of its unique search terms.
+    """
+
+    # bump this when the way we store terms changes
+    VERSION = 1
+    VERSION_KEY = 'item_search_terms_db_version'
+    # how often should we save changes to the DB? (in seconds)
+    SAVE_INTERVAL = 30
+    # how many items should we index in each idle callback after load()?
+    LOAD_BATCH_SIZE = 500
+
+    def __init__(self):
+        self.loaded = False
+        # maps item ids -> tuple of terms for indexed items
+        self._item_terms = {}
+        # maps item ids -> terms for items that we haven't indexed yet.  The
+        # terms are a string from the item_search_terms table, or None if
+        # we need to get them from the ItemInfo.
+        self._pending = {}
+        self._rebuilding = False
+        self._changed_item_ids = set()
+        self._tracking = False
+        self._load_dc = None
+        self._save_dc = None
+        self._callback_handles = []
+        self._item_info_cache = None
+
+    def load(self, saved_data=None):
+        """Load the search terms.
+
+        :param saved_data: result of read_saved_data(), if it's already been
+            read in a worker thread.  If None, we read it here.
+        """
+        self._changed_item_ids = set()
+        self._pending = None
+        try:
+            self._pending = self._quick_load(saved_data)
+        except StandardError, e:
+            logging.warn("Error loading item search terms: %s", e)
+        if self._pending is None:
+            # the saved data is suspect, rebuild it using the ItemInfos.
+            # Unset the version until we're done, so that a partial save
+            # doesn't look valid.
+            self._changed_item_ids = set()
+            app.db.cursor.execute("DELETE FROM item_search_terms")
+            app.db.unset_variable(self.VERSION_KEY)
+            app.db.cursor.execute("SELECT id FROM item")
+            self._pending = dict((row[0], None) for row in app.db.cursor)
+            self._rebuilding = True
+        else:
+            self._rebuilding = False
+            if self._changed_item_ids:
+                self.schedule_save_to_db()
+        self._item_info_cache = app.item_info_cache
+        for name, func in (('added', self._on_info_added),
+                           ('changed', self._on_info_changed),
+                           ('removed', self._on_info_removed)):
+            self._callback_handles.append(
+                self._item_info_cache.connect(name, func))
+        self.loaded = True
+        self._schedule_load_batch()
+        if not self._pending:
+            self._finish_loading()
+
+    def unlink(self):
+        for handle in self._callback_handles:
+            self._item_info_cache.disconnect(handle)
+        self._callback_handles = []
+        for dc in (self._load_dc, self._save_dc):
+            if dc is not None:
+                dc.cancel()
+        self._load_dc = self._save_dc = None
+        self._tracking = False
+        self.loaded = False
+
+    def version(self):
+        return "%s-%s-%s" % (schema.VERSION, self.VERSION,
+                             messages.ItemInfo.DERIVED_VERSION)
+
+    def is_ready(self):
+        """Check if every item has been indexed."""
+        return self.loaded and not self._pending
+
+    def read_saved_data(self, cursor):
+        """Read the data that _quick_load() uses.
+
+        This only uses cursor, so it can be run in a worker thread with
+        LiveStorage.read_in_thread().
+
+        :returns: (rows, removed_ids) tuple.  rows contains (item_id, terms,
+            dirty) for each item, removed_ids has the ids of rows for items
+            that no longer exist.
+        """
+        cursor.execute("SELECT item.id, terms.terms, terms.dirty "
+                       "FROM item "
+                       "LEFT JOIN item_search_terms terms "
+                       "ON terms.item_id=item.id")
+        rows = cursor.fetchall()
+        cursor.execute("SELECT item_id FROM item_search_terms "
+                       "WHERE item_id NOT IN (SELECT id FROM item)")
+        return rows, [row[0] for row in cursor]
+
+    def _quick_load(self, saved_data=None):
+        """Read the saved terms from the item_search_terms table.
+
+        Items without a row or with a dirty row map to None, so that we
+        re-index them.  Rows for items that no longer exist get added to
+        _changed_item_ids so that save() deletes them.
+
+        :returns: dict mapping item ids to term strings or None if the saved
+            data isn't usable.
+        """
+        try:
+            saved_version = app.db.get_variable(self.VERSION_KEY)
+        except KeyError:
+            return None
+        if saved_version != self.version():
+            return None
+        if saved_data is None:
+            cursor = app.db.acquire_read_cursor()
+            try:
+                saved_data = self.read_saved_data(cursor)
+            finally:
+                app.db.release_read_cursor(cursor)
+        rows, removed_ids = saved_data
+        item_terms = {}
+        for item_id, terms, dirty in rows:
+            if dirty:
+                terms = None
+            item_terms[item_id] = terms
+        self._changed_item_ids.update(removed_ids)
+        return item_terms
+
+    def _schedule_load_batch(self):
+        if self._load_dc is None and self._pending:
+            self._load_dc = eventloop.add_idle(self._load_batch,
+                    'load item search index')
+
+    def _load_batch(self):
+        self._load_dc = None
+        changed = {}
+        while self._pending and len(changed) < self.LOAD_BATCH_SIZE:
+            item_id, terms = self._pending.popitem()
+            if terms is not None:
+                terms = _unique_terms(terms.split())
+            else:
+                try:
+                    info = app.item_info_cache.get_info(item_id)
+                except ObjectNotFoundError:
+                    # item was removed before we got to it
+                    continue
+                terms = _unique_terms(info.search_terms)
+                # The row is either missing or dirty, so there's no need to
+                # mark it.
+                self._mark_changed(item_id, mark_dirty=False)
+            self._item_terms[item_id] = terms
+            changed[item_id] = terms
+        self._send_changes(changed, [])
+        if self._pending:
+            self._schedule_load_batch()
+        else:
+            self._finish_loading()
+
+    def load_all(self):
+        """Index all pending items now, rather than in idle callbacks."""
+        if self._load_dc is not None:
+            self._load_dc.cancel()
+            self._load_dc = None
+        while self._pending:
+            self._load_batch()
+
+    def _finish_loading(self):
+        if self._rebuilding:
+            self._rebuilding = False
+            self.save()
+        app.db.set_variable(self.VERSION_KEY, self.version())
+
+    def _mark_changed(self, item_id, mark_dirty=True):
+        """Remember that we need to save the terms for an item.
+
+        If mark_dirty is True, we also mark the item's row dirty, as part
+        of the transaction for the item change that caused it.
+        """
+        if item_id in self._changed_item_ids:
+            return
+        self._changed_item_ids.add(item_id)
+        if mark_dirty:
+            app.db.execute_update("UPDATE item_search_terms SET dirty=1 "
+                                  "WHERE item_id=?", (item_id,))
+        self.schedule_save_to_db()
+
+    def _send_changes(self, changed, removed):
+        if self._tracking and (changed or removed or self.is_ready()):
+            messages.ItemSearchTermsChanged(changed, removed,
+                                            self.is_ready()).send_to_frontend()
+
+    def _on_info_added(self, item_info_cache, info):
+        # If the item is still pending with saved terms, its row is clean.
+        # If it's been indexed, it probably has a row.  Either way we need to
+        # mark the row dirty.
+        saved_terms = self._pending.pop(info.id, None)
+        has_row = saved_terms is not None or info.id in self._item_terms
+        terms = _unique_terms(info.search_terms)
+        if self._item_terms.get(info.id) == terms:
+            return
+        self._item_terms[info.id] = terms
+        self._mark_changed(info.id, mark_dirty=has_row)
+        # Send the terms now, so that the frontend gets them before the
+        # ItemsChanged messages for this change.
+        self._send_changes({info.id: terms}, [])
+
+    _on_info_changed = _on_info_added
+
+    def _on_info_removed(self, item_info_cache, info):
+        # Leave the row alone for now, _quick_load() ignores rows for items
+        # that don't exist.
+        if info.id in self._pending:
+            # we never indexed the item, but it may have a row in the DB
+            del self._pending[info.id]
+            self._mark_changed(info.id, mark_dirty=False)
+        if info.id in self._item_terms:
+            del self._item_terms[info.id]
+            self._mark_changed(info.id, mark_dirty=False)
+            self._send_changes({}, [info.id])
+
+    # public API
+
+    def start_tracking(self):
+        """Start sending ItemSearchTermsChanged messages to the frontend.
+
+        The first message contains the terms for every item that we've
+        indexed so far.
+        """
+        self._tracking = True
+        self._send_changes(self._item_terms.copy(), [])
+
+    def schedule_save_to_db(self):
+        if self._save_dc is None:
+            self._save_dc = eventloop.add_timeout(self.SAVE_INTERVAL,
+                    self.save, 'save item search terms')
+
+    def save(self):
+        if self._save_dc is not None:
+            self._save_dc.cancel()
+        self._save_dc = None
+        if not self._changed_item_ids:
+            return
+        to_save = []
+        to_delete = []
+        for item_id in self._changed_item_ids:
+            try:
+                terms = self._item_terms[item_id]
+            except KeyError:
+                to_delete.append(item_id)
+            else:
+                to_save.append((item_id, u' '.join(terms)))
+        app.db.run_in_transaction(self._write_rows, to_save, to_delete)
+        self._changed_item_ids = set()
+
+    def _write_rows(self, cursor, to_save, to_delete):
+        cursor.executemany("INSERT OR REPLACE INTO "
+                "item_search_terms (item_id, terms, dirty) "
+                "VALUES (?, ?, 0)", to_save)
+        for id_chunk in util.split_values_for_sqlite(to_delete):
+            cursor.execute("DELETE FROM item_search_terms "
+                    "WHERE item_id IN (%s)" %
+                    ', '.join('?' for i in id_chunk), id_chunk)
+
+def create_sql():
+    """Get the SQL needed to create the table for ItemSearchIndex."""
+    return ("CREATE TABLE item_search_terms(item_id INTEGER PRIMARY KEY, "
+            "terms TEXT, dirty INTEGER NOT NULL DEFAULT 0)")
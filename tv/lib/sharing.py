@@ -317,10 +317,11 @@ class SharingTracker(object):
                 raise IOError('test connect failed')
             client.disconnect()
 
-        eventloop.call_in_thread(success,
-                                 failure,
-                                 testconnect,
-                                 'DAAP test connect')
+        eventloop.call_in_thread_pool('network', eventloop.PRIORITY_NORMAL,
+                                      success,
+                                      failure,
+                                      testconnect,
+                                      'DAAP test connect')
 
     def mdns_callback_backend(self, added, fullname, host, port):
         # SAFE: the shared name should be unique.  (Or else you could not
@@ -676,10 +677,11 @@ class SharingItemTrackerImpl(signals.SignalEmitter):
     def client_disconnect(self):
         client = self.client
         self.client = None
-        eventloop.call_in_thread(self.client_disconnect_callback,
-                                 self.client_disconnect_error_callback,
-                                 client.disconnect,
-                                 'DAAP client connect')
+        eventloop.call_in_thread_pool('network', eventloop.PRIORITY_NORMAL,
+                                      self.client_disconnect_callback,
+                                      self.client_disconnect_error_callback,
+                                      client.disconnect,
+                                      'DAAP client connect')
 
     def client_disconnect_error_callback(self, unused):
         self.client_disconnect_callback_common(unused)
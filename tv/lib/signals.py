@@ -122,6 +122,17 @@ class SignalEmitter(object):
         except KeyError:
             raise KeyError("Signal: %s doesn't exist" % signal_name)
 
+    def has_live_callbacks(self):
+        """Check if any callbacks are connected to our signals.
+
+        Weak callbacks whose object has been garbage collected don't count.
+        """
+        for callbacks in self.signal_callbacks.itervalues():
+            for callback in callbacks.itervalues():
+                if not callback.is_dead():
+                    return True
+        return False
+
     def _check_already_connected(self, name, func):
         for callback in self.get_callbacks(name).values():
             if callback.compare_function(func):
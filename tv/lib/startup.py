@@ -69,6 +69,8 @@ from miro import item
 from miro import itemsource
 from miro import iteminfocache
 from miro import feed
+from miro import feedcounts
+from miro import searchindex
 from miro import folder
 from miro import messages
 from miro import messagehandler
@@ -277,7 +279,10 @@ def finish_startup(obj, thread):
     item.setup_deleted_checker()
     logging.info("Restoring database...")
     start = time.time()
-    app.db = storedatabase.LiveStorage()
+    app.db = storedatabase.LiveStorage(
+            use_wal=app.config.get(prefs.DB_USE_WAL),
+            object_cache_size=(app.config.get(prefs.DB_OBJECT_CACHE_SIZE) or
+                               None))
     try:
         app.db.upgrade_database()
     except databaseupgrade.DatabaseTooNewError:
@@ -297,6 +302,9 @@ def finish_startup(obj, thread):
     database.initialize()
     end = time.time()
     logging.timing("Database upgrade time: %.3f", end - start)
+    app.db.set_group_commit(app.config.get(prefs.DB_GROUP_COMMIT),
+            app.config.get(prefs.DB_GROUP_COMMIT_DELAY),
+            app.config.get(prefs.DB_GROUP_COMMIT_MAX_STATEMENTS))
     if app.db.startup_version != app.db.current_version:
         databaselog.info("Upgraded database from version %s to %s",
                 app.db.startup_version, app.db.current_version)
@@ -304,11 +312,40 @@ def finish_startup(obj, thread):
     models.initialize()
     if DEBUG_DB_MEM_USAGE:
         util.db_mem_usage_test()
+        util.db_object_cache_test()
         mem_usage_test_event.set()
 
     item.setup_metadata_manager()
-    app.item_info_cache = iteminfocache.ItemInfoCache()
-    app.item_info_cache.load()
+    item_info_cache = iteminfocache.ItemInfoCache()
+    feed_count_tracker = feedcounts.FeedCountTracker()
+    item_search_index = searchindex.ItemSearchIndex()
+    def read_saved_data(cursor):
+        return (item_info_cache.read_saved_data(cursor),
+                feed_count_tracker.read_saved_data(cursor),
+                item_search_index.read_saved_data(cursor))
+    def on_read_error(error):
+        logging.warn("Error reading saved cache data: %s", error)
+        # let each load() read the data and handle the errors itself
+        finish_loading_caches(item_info_cache, feed_count_tracker,
+                              item_search_index, (None, None, None))
+    # Reading the saved data is the slow part of loading our caches, so do
+    # it in a worker thread.  The worker only sees committed data.
+    app.db.finish_transaction()
+    app.db.read_in_thread(
+            lambda saved_data: finish_loading_caches(item_info_cache,
+                feed_count_tracker, item_search_index, saved_data),
+            on_read_error, read_saved_data, 'read saved cache data')
+
+@startup_function
+def finish_loading_caches(item_info_cache, feed_count_tracker,
+                          item_search_index, saved_data):
+    item_info_saved, feed_counts_saved, search_terms_saved = saved_data
+    app.item_info_cache = item_info_cache
+    app.item_info_cache.load(item_info_saved)
+    app.feed_count_tracker = feed_count_tracker
+    app.feed_count_tracker.load(feed_counts_saved)
+    app.item_search_index = item_search_index
+    app.item_search_index.load(search_terms_saved)
     dbupgradeprogress.upgrade_end()
 
     logging.info("Loading video converters...")
@@ -550,7 +587,7 @@ def _get_theme_history():
     else:
         return theme.ThemeHistory()
 
-@eventloop.idle_iterator
+@eventloop.idle_iterator(priority=eventloop.PRIORITY_BACKGROUND)
 def clear_icon_cache_orphans():
     # delete icon_cache rows from the database with no associated
     # item/feed/guide.
@@ -40,10 +40,10 @@ separate column.
 Most columns are stored using SQLite datatypes (``INTEGER``, ``REAL``,
 ``TEXT``, ``DATETIME``, etc.).  However some of our python values,
 don't have an equivalent (lists, dicts and timedelta objects).  For
-those, we store the python representation of the object.  This makes
-the column look similar to a JSON value, although not quite the same.
-The hope is that it will be human readable.  We use the type
-``pythonrepr`` to label these columns.
+those, we store a compact binary encoding of the object (see
+dump_repr_value()).  We use the type ``pythonrepr`` to label these
+columns, since older databases stored the python representation of the
+object there.  load_repr_value() still accepts those values.
 """
 
 import glob
@@ -54,8 +54,11 @@ import logging
 import datetime
 import traceback
 import time
+import threading
 import os
+import marshal
 import sys
+import weakref
 from cStringIO import StringIO
 
 try:
@@ -70,10 +73,12 @@ from miro import databaseupgrade
 from miro import dbupgradeprogress
 from miro import dialogs
 from miro import eventloop
+from miro import feedcounts
 from miro import fileutil
 from miro import iteminfocache
 from miro import messages
 from miro import schema
+from miro import searchindex
 from miro import prefs
 from miro import util
 from miro.gtcache import gettext as _
@@ -109,6 +114,110 @@ _sqlite_type_map = {
 
 VERSION_KEY = "Democracy Version"
 
+class CommitStats(object):
+    """Tracks how our transactions get committed.
+
+    We record how long the COMMIT statement takes, how long changes waited
+    before being committed and how many statements went into each commit.
+    """
+    def __init__(self):
+        self.reset()
+
+    def reset(self):
+        self.commit_count = 0
+        self.statement_count = 0
+        self.max_statements = 0
+        self.total_commit_time = 0.0
+        self.max_commit_time = 0.0
+        self.total_delay = 0.0
+        self.max_delay = 0.0
+
+    def record_commit(self, statement_count, commit_time, delay):
+        """Record a COMMIT.
+
+        :param statement_count: number of statements in the transaction
+        :param commit_time: time it took to run COMMIT
+        :param delay: time between the first statement and the COMMIT
+        """
+        self.commit_count += 1
+        self.statement_count += statement_count
+        self.max_statements = max(self.max_statements, statement_count)
+        self.total_commit_time += commit_time
+        self.max_commit_time = max(self.max_commit_time, commit_time)
+        self.total_delay += delay
+        self.max_delay = max(self.max_delay, delay)
+
+    def get_stats(self):
+        """Get a dict summarizing the commits we've recorded."""
+        if self.commit_count:
+            count = float(self.commit_count)
+        else:
+            count = 1.0
+        return {
+            'commits': self.commit_count,
+            'statements': self.statement_count,
+            'statements_per_commit': self.statement_count / count,
+            'max_statements_per_commit': self.max_statements,
+            'avg_commit_latency': self.total_commit_time / count,
+            'max_commit_latency': self.max_commit_time,
+            'avg_commit_delay': self.total_delay / count,
+            'max_commit_delay': self.max_delay,
+        }
+
+class SQLStringCache(object):
+    """Caches the SQL text that LiveStorage builds for its queries.
+
+    Besides saving the work of building the strings, using the exact same
+    text for a query each time lets sqlite3 reuse the prepared statement for
+    it.  Keys are tuples that describe the query (table, where clause,
+    joins, order, limit, columns, etc.).  Values must always be bound as
+    parameters rather than being part of the key.
+    """
+    def __init__(self, max_size=500):
+        self.max_size = max_size
+        self._sql = {}
+        self.reset_stats()
+
+    def reset_stats(self):
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, key, build_func, *args):
+        """Get the SQL for key, calling build_func(*args) to create it if
+        it's not in the cache.
+        """
+        try:
+            sql = self._sql[key]
+        except KeyError:
+            self.misses += 1
+            sql = build_func(*args)
+            if len(self._sql) >= self.max_size:
+                # Callers that put values in their where clauses can create
+                # an unbounded number of keys.  Just start over when we fill
+                # up rather than tracking which keys are in use.
+                self._sql.clear()
+            self._sql[key] = sql
+        else:
+            self.hits += 1
+        return sql
+
+    def clear(self):
+        self._sql.clear()
+
+    def get_stats(self):
+        """Get a dict summarizing the cache hits and misses."""
+        lookups = self.hits + self.misses
+        if lookups:
+            hit_rate = float(self.hits) / lookups
+        else:
+            hit_rate = 0.0
+        return {
+            'hits': self.hits,
+            'misses': self.misses,
+            'hit_rate': hit_rate,
+            'size': len(self._sql),
+        }
+
 class DatabaseObjectCache(object):
     """Handles caching objects for a database.
 
@@ -169,6 +278,85 @@ class DatabaseObjectCache(object):
             if key[0] == category:
                 del self._objects[key]
 
+class ReadConnectionPool(object):
+    """Pool of read-only connections to a WAL-mode database.
+
+    In WAL mode readers don't block the writer and the writer doesn't block
+    readers, so LiveStorage.read_in_thread() can use these connections from
+    worker threads while the event loop keeps writing with the main
+    connection.  LiveStorage.acquire_read_cursor() also lends them out for
+    large reads on the event loop, which keeps them from filling up the main
+    connection's page cache.  They only see committed data.
+
+    Connections are opened lazily, up to size of them.  acquire() blocks if
+    they are all in use.
+    """
+    def __init__(self, path, size):
+        self.path = path
+        self.size = size
+        self._condition = threading.Condition()
+        self._idle = []
+        self._connections = set()
+        self._closed = False
+
+    def _open_connection(self):
+        connection = sqlite3.connect(self.path,
+                isolation_level=None,
+                detect_types=sqlite3.PARSE_DECLTYPES,
+                check_same_thread=False)
+        # query_only is ignored by versions of sqlite before 3.8.0
+        connection.execute("PRAGMA query_only=1")
+        connection.execute("PRAGMA temp_store=MEMORY")
+        return connection
+
+    def acquire(self):
+        """Get a connection from the pool.
+
+        :raises ValueError: the pool has been closed
+        """
+        self._condition.acquire()
+        try:
+            while True:
+                if self._closed:
+                    raise ValueError("ReadConnectionPool closed")
+                if self._idle:
+                    return self._idle.pop()
+                if len(self._connections) < self.size:
+                    connection = self._open_connection()
+                    self._connections.add(connection)
+                    return connection
+                self._condition.wait()
+        finally:
+            self._condition.release()
+
+    def release(self, connection):
+        """Return a connection from acquire() to the pool."""
+        self._condition.acquire()
+        try:
+            if self._closed or connection not in self._connections:
+                connection.close()
+            else:
+                self._idle.append(connection)
+                self._condition.notify()
+        finally:
+            self._condition.release()
+
+    def close(self):
+        """Close all connections.
+
+        Connections that are currently in use get closed when they are
+        released.
+        """
+        self._condition.acquire()
+        try:
+            self._closed = True
+            for connection in self._idle:
+                connection.close()
+            self._idle = []
+            self._condition.notifyAll()
+        finally:
+            self._condition.release()
+
 class LiveStorageErrorHandler(object):
     """Handle database errors for LiveStorage.
     """
@@ -345,13 +533,42 @@ class LiveStorage:
     - Loads the initial object list (and runs database upgrades)
     - Handles updating the database based on changes to DDBObjects.
 
+    Normally we commit our changes at the end of every event.  In
+    group-commit mode (see set_group_commit()), the changes from several
+    events get coalesced into one transaction.
+
     Attributes:
 
     - cache -- DatabaseObjectCache object
+    - commit_stats -- CommitStats object
+    - sql_cache -- SQLStringCache object
+    - durable_tables -- tables where inserts should be committed right away
+      in group-commit mode
+    - evictable_tables -- tables whose objects can be evicted from memory
+      when we have more than object_cache_size of them loaded
     """
+
+    durable_tables = frozenset(['feed'])
+    evictable_tables = frozenset(['item'])
+
+    # pragmas that we use in WAL mode.  With WAL, synchronous=NORMAL is
+    # still safe from corruption, we just might lose the last transactions
+    # on a power failure.
+    WAL_PRAGMAS = [
+        'synchronous=NORMAL',
+        'cache_size=-8192',
+        'mmap_size=67108864',
+        'temp_store=MEMORY',
+    ]
+    READ_POOL_SIZE = 2
+
+    # number of prepared statements sqlite3 keeps for our main connection
+    STATEMENT_CACHE_SIZE = 200
+
     def __init__(self, path=None, error_handler=None, preallocate=None,
                  object_schemas=None, schema_version=None,
-                 start_in_temp_mode=False):
+                 start_in_temp_mode=False, use_wal=False,
+                 object_cache_size=None):
         """Create a LiveStorage for a database
 
         :param path: path to the database (or ":memory:")
@@ -365,6 +582,12 @@ class LiveStorage:
         :param start_in_temp_mode: True if this database should start in
                                    temporary mode (running in memory, but
                                    checking if it can write to the disk)
+        :param use_wal: Use WAL journaling and a pool of read-only
+                        connections.  If this is False, databases in WAL
+                        mode get switched back to our normal journal mode.
+        :param object_cache_size: Max number of objects from
+                                  evictable_tables to keep in memory.  None
+                                  means no limit.
         """
         if path is None:
             path = app.config.get(prefs.SQLITE_PATHNAME)
@@ -392,6 +615,9 @@ class LiveStorage:
         else:
             self.created_new = True
         self.temp_mode = False
+        self.use_wal = use_wal
+        self.wal_enabled = False
+        self.read_pool = None
         self.preallocate = preallocate
         self.error_handler = error_handler
         self.cache = DatabaseObjectCache()
@@ -399,16 +625,43 @@ class LiveStorage:
         self.force_directory_creation = True # False for device databases
         self._dc = None
         self._query_times = {}
+        self.slow_query_count = 0
+        self.sql_cache = SQLStringCache()
         self.path = path
         self._quitting_from_operational_error = False
         self._object_schemas = object_schemas
         self._schema_version = schema_version
         self._schema_map = {}
         self._schema_column_map = {}
+        self._table_column_map = {}
         self._all_schemas = []
+        self._converter = SQLiteConverter()
+        # maps schemas to functions built by
+        # SQLiteConverter.make_row_decoder() and make_row_encoder()
+        self._row_decoders = {}
+        self._row_encoders = {}
         self._object_map = {} # maps object id -> DDBObjects in memory
         self._ids_loaded = set()
+        # Objects that we've evicted from _object_map.  If something else
+        # still references one, we keep using it rather than restoring a
+        # second copy.
+        self._evicted_objects = weakref.WeakValueDictionary()
+        # maps keys of evictable objects -> when they were last used
+        self._access_ticks = {}
+        self._access_counter = itertools.count()
+        self.object_cache_size = object_cache_size
+        self._next_eviction_size = object_cache_size
         self._statements_in_transaction = []
+        self._transaction_start = None
+        # index in _statements_in_transaction where the current event's
+        # changes start (only used in group-commit mode)
+        self._savepoint_index = None
+        self._durable_change = False
+        self._group_commit = False
+        self._group_commit_delay = 1.0
+        self._group_commit_max_statements = 500
+        self._group_commit_dc = None
+        self.commit_stats = CommitStats()
         eventloop.connect("event-finished", self.on_event_finished)
         for oschema in object_schemas:
             self._all_schemas.append(oschema)
@@ -416,9 +669,15 @@ class LiveStorage:
                 self._schema_map[klass] = oschema
                 for field_name, schema_item in oschema.fields:
                     klass.track_attribute_changes(field_name)
+            table_columns = {}
             for name, schema_item in oschema.fields:
                 self._schema_column_map[oschema, name] = schema_item
-        self._converter = SQLiteConverter()
+                table_columns[name.lower()] = (name, schema_item)
+            self._table_column_map[oschema.table_name] = table_columns
+            self._row_decoders[oschema] = \
+                    self._converter.make_row_decoder(oschema)
+            self._row_encoders[oschema] = \
+                    self._converter.make_row_encoder(oschema)
 
         self.open_connection(start_in_temp_mode=start_in_temp_mode)
 
@@ -430,6 +689,7 @@ class LiveStorage:
     def open_connection(self, path=None, start_in_temp_mode=False):
         if path is None:
             path = self.path
+        self._close_read_pool()
         if start_in_temp_mode:
             self._switch_to_temp_mode()
         else:
@@ -438,7 +698,8 @@ class LiveStorage:
             try:
                 self.connection = sqlite3.connect(path,
                         isolation_level=None,
-                        detect_types=sqlite3.PARSE_DECLTYPES)
+                        detect_types=sqlite3.PARSE_DECLTYPES,
+                        cached_statements=self.STATEMENT_CACHE_SIZE)
             except sqlite3.Error, e:
                 logging.warn("Error opening sqlite database: %s", e)
                 action = self.error_handler.handle_open_error()
@@ -456,14 +717,40 @@ class LiveStorage:
 
         self.cursor = self.connection.cursor()
         try:
-            self.cursor.execute("PRAGMA journal_mode=PERSIST");
+            self._set_journal_mode(path)
         except sqlite3.DatabaseError:
-            msg = "Error running 'PRAGMA journal_mode=PERSIST'"
+            msg = "Error setting journal mode"
             self.error_handler.handle_load_error()
             self._handle_load_error(msg, init_schema=False)
             self.created_new = True
             # rerun the command with our fresh database
-            self.cursor.execute("PRAGMA journal_mode=PERSIST");
+            self._set_journal_mode(path)
+        if self.wal_enabled:
+            self.read_pool = ReadConnectionPool(path, self.READ_POOL_SIZE)
+
+    def _set_journal_mode(self, path):
+        """Set the journal mode for a newly opened connection.
+
+        Switching the journal mode is persistent, so this also handles
+        migrating databases in and out of WAL mode.
+        """
+        self.wal_enabled = False
+        if self.use_wal and not self.temp_mode and path != ':memory:':
+            self.cursor.execute("PRAGMA journal_mode=WAL")
+            mode = self.cursor.fetchone()[0]
+            if mode.lower() == 'wal':
+                for pragma in self.WAL_PRAGMAS:
+                    self.cursor.execute("PRAGMA %s" % pragma)
+                self.wal_enabled = True
+                return
+            logging.warn("Couldn't switch database to WAL mode "
+                         "(journal mode: %s)", mode)
+        self.cursor.execute("PRAGMA journal_mode=PERSIST");
+
+    def _close_read_pool(self):
+        if self.read_pool is not None:
+            self.read_pool.close()
+            self.read_pool = None
 
     def _ensure_database_directory_exists(self, path):
         if not self.force_directory_creation:
@@ -478,9 +765,12 @@ class LiveStorage:
         disk every 5 minutes.  Temporary mode is used to handle errors when
         trying to open a database file.
         """
+        self._close_read_pool()
         self.connection = sqlite3.connect(':memory:',
                                           isolation_level=None,
-                                          detect_types=sqlite3.PARSE_DECLTYPES)
+                                          detect_types=sqlite3.PARSE_DECLTYPES,
+                                          cached_statements=
+                                          self.STATEMENT_CACHE_SIZE)
         self.temp_mode = True
         self.created_new = True
         eventloop.add_timeout(300,
@@ -570,6 +860,7 @@ class LiveStorage:
             self._dc.cancel()
             self._dc = None
         self.finish_transaction()
+        self._close_read_pool()
 
         # the unittests run in memory and vacuum causes a segfault if
         # the db is in memory.
@@ -787,24 +1078,151 @@ class LiveStorage:
         key = (obj.id, app.db.table_name(obj.__class__))
         self._object_map[key] = obj
         self._ids_loaded.add(key)
+        self._touch_object(key)
 
     def forget_object(self, obj):
         key = (obj.id, app.db.table_name(obj.__class__))
         try:
             del self._object_map[key]
         except KeyError:
-            details = ('storedatabase.forget_object: '
-                       'key error in forget_object: %s (obj: %s)' %
-                       (obj.id, obj))
-            logging.error(details)
+            if self._evicted_objects.get(key) is obj:
+                del self._evicted_objects[key]
+            else:
+                details = ('storedatabase.forget_object: '
+                           'key error in forget_object: %s (obj: %s)' %
+                           (obj.id, obj))
+                logging.error(details)
         self._ids_loaded.discard(key)
+        self._access_ticks.pop(key, None)
+
+    def _touch_object(self, key):
+        if (self.object_cache_size is not None and
+                key[1] in self.evictable_tables):
+            self._access_ticks[key] = self._access_counter.next()
+
+    def _get_object(self, key):
+        """Get an object that's in memory.
+
+        This will move evicted objects that are still alive back into
+        _object_map.
+
+        :returns: DDBObject or None if it's not in memory
+        """
+        obj = self._object_map.get(key)
+        if obj is None:
+            obj = self._evicted_objects.get(key)
+            if obj is None:
+                return None
+            del self._evicted_objects[key]
+            self._object_map[key] = obj
+            self._ids_loaded.add(key)
+        self._touch_object(key)
+        return obj
+
+    def evict_objects(self):
+        """Evict cold objects from memory.
+
+        If we have more than object_cache_size objects from evictable_tables
+        loaded, we drop the least recently used ones that aren't pinned (see
+        DDBObject.is_pinned()).  They get restored from disk when they're
+        needed again.
+
+        :returns: number of objects evicted
+        """
+        if (self.object_cache_size is None or
+                len(self._access_ticks) <= self._next_eviction_size):
+            return 0
+        # Evict down to 90% of the limit, so that we don't need to do this
+        # after every event.
+        to_evict = len(self._access_ticks) - self.object_cache_size * 9 // 10
+        evicted = 0
+        by_age = sorted((tick, key) for key, tick in
+                        self._access_ticks.iteritems())
+        for tick, key in by_age:
+            obj = self._object_map[key]
+            if obj.is_pinned():
+                continue
+            del self._object_map[key]
+            del self._access_ticks[key]
+            self._ids_loaded.discard(key)
+            self._evicted_objects[key] = obj
+            evicted += 1
+            if evicted >= to_evict:
+                break
+        # If pinned objects keep us over the limit, wait until a good chunk
+        # of new objects get loaded before trying again.
+        self._next_eviction_size = max(self.object_cache_size,
+                len(self._access_ticks) + self.object_cache_size // 10)
+        return evicted
+
+    def object_memory_report(self):
+        """Get a report on the objects that we have in memory.
+
+        :returns: dict mapping table names to dicts with these keys:
+            - resident -- objects in our object map
+            - pinned -- resident objects that can't be evicted
+            - evicted_alive -- evicted objects that are still referenced
+            - approx_bytes -- estimated memory used by resident objects
+        """
+        report = {}
+        samples = {}
+        for key, obj in self._object_map.iteritems():
+            table_name = key[1]
+            if table_name not in report:
+                report[table_name] = {'resident': 0, 'pinned': 0,
+                                      'evicted_alive': 0, 'approx_bytes': 0}
+                samples[table_name] = []
+            info = report[table_name]
+            info['resident'] += 1
+            if obj.is_pinned():
+                info['pinned'] += 1
+            if len(samples[table_name]) < 100:
+                samples[table_name].append(obj)
+        for key in self._evicted_objects.keys():
+            if key[1] in report:
+                report[key[1]]['evicted_alive'] += 1
+        # estimate memory usage by sampling objects
+        for table_name, sample in samples.iteritems():
+            sample_size = 0
+            for obj in sample:
+                sample_size += (sys.getsizeof(obj) +
+                                sys.getsizeof(obj.__dict__))
+                for value in obj.__dict__.itervalues():
+                    sample_size += sys.getsizeof(value)
+            info = report[table_name]
+            info['approx_bytes'] = (sample_size * info['resident'] //
+                                    len(sample))
+        return report
 
     def _insert_sql_for_schema(self, obj_schema):
+        return self.sql_cache.get(('insert', obj_schema.table_name),
+                self._build_insert_sql, obj_schema)
+
+    def _build_insert_sql(self, obj_schema):
         return "INSERT INTO %s (%s) VALUES(%s)" % (obj_schema.table_name,
                 ', '.join(name for name, schema_item in obj_schema.fields),
                 ', '.join('?' for i in xrange(len(obj_schema.fields))))
 
+    def _update_sql(self, table_name, columns):
+        """Get the SQL to update columns for a row.
+
+        The last parameter is the id of the row to update.
+        """
+        return self.sql_cache.get(('update', table_name, columns),
+                self._build_update_sql, table_name, columns)
+
+    def _build_update_sql(self, table_name, columns):
+        return "UPDATE %s SET %s WHERE id=?" % (table_name,
+                ', '.join('%s=?' % name for name in columns))
+
     def _values_for_obj(self, obj_schema, obj):
+        try:
+            return self._row_encoders[obj_schema](obj)
+        except schema.ValidationError:
+            # use the slow path, which logs the value that failed
+            return self._values_for_obj_slow(obj_schema, obj)
+
+    def _values_for_obj_slow(self, obj_schema, obj):
         values = []
         for name, schema_item in obj_schema.fields:
             value = getattr(obj, name)
@@ -824,7 +1242,8 @@ class LiveStorage:
         obj_schema = self._schema_map[obj.__class__]
         values = self._values_for_obj(obj_schema, obj)
         sql = self._insert_sql_for_schema(obj_schema)
-        self._execute(sql, values, is_update=True)
+        durable = obj_schema.table_name in self.durable_tables
+        self._execute(sql, values, is_update=True, durable=durable)
         obj.reset_changed_attributes()
 
     def bulk_insert(self, objects):
@@ -842,7 +1261,9 @@ class LiveStorage:
                 raise ValueError("Incompatible types for bulk insert")
             value_list.append(self._values_for_obj(obj_schema, obj))
         sql = self._insert_sql_for_schema(obj_schema)
-        self._execute(sql, value_list, is_update=True, many=True)
+        durable = obj_schema.table_name in self.durable_tables
+        self._execute(sql, value_list, is_update=True, many=True,
+                      durable=durable)
         for obj in objects:
             obj.reset_changed_attributes()
 
@@ -850,13 +1271,13 @@ class LiveStorage:
         """Update a DDBObject on disk."""
 
         obj_schema = self._schema_map[obj.__class__]
-        setters = []
+        columns = []
         values = []
         for name, schema_item in obj_schema.fields:
             if (isinstance(schema_item, schema.SchemaSimpleItem) and
                     name not in obj.changed_attributes):
                 continue
-            setters.append('%s=?' % name)
+            columns.append(name)
             value = getattr(obj, name)
             try:
                 schema_item.validate(value)
@@ -868,8 +1289,8 @@ class LiveStorage:
                 schema_item, value))
         obj.reset_changed_attributes()
         if values:
-            sql = "UPDATE %s SET %s WHERE id=%s" % (obj_schema.table_name,
-                    ', '.join(setters), obj.id)
+            sql = self._update_sql(obj_schema.table_name, tuple(columns))
+            values.append(obj.id)
             self._execute(sql, values, is_update=True)
             if (self.cursor.rowcount != 1 and not
                     self._quitting_from_operational_error):
@@ -885,8 +1306,9 @@ class LiveStorage:
         """Remove a DDBObject from disk."""
 
         schema = self._schema_map[obj.__class__]
-        sql = "DELETE FROM %s WHERE id=?" % (schema.table_name)
-        self._execute(sql, (obj.id,), is_update=True)
+        sql = self.sql_cache.get(('remove', schema.table_name),
+                self._build_remove_sql, schema.table_name, 1)
+        self._execute(sql, (obj.id,), is_update=True, durable=True)
         self.forget_object(obj)
 
     def bulk_remove(self, objects):
@@ -905,13 +1327,20 @@ class LiveStorage:
         # we can only feed sqlite so many variables at once, send it chunks of
         # 900 ids at once
         for objects_chunk in util.split_values_for_sqlite(objects):
-            commas = ','.join('?' for x in xrange(len(objects_chunk)))
-            sql = "DELETE FROM %s WHERE id IN (%s)" % (obj_schema.table_name,
-                    commas)
-            self._execute(sql, [o.id for o in objects_chunk], is_update=True)
+            sql = self.sql_cache.get(('remove', obj_schema.table_name,
+                len(objects_chunk)), self._build_remove_sql,
+                obj_schema.table_name, len(objects_chunk))
+            self._execute(sql, [o.id for o in objects_chunk], is_update=True,
+                          durable=True)
         for obj in objects:
             self.forget_object(obj)
 
+    def _build_remove_sql(self, table_name, id_count):
+        if id_count == 1:
+            return "DELETE FROM %s WHERE id=?" % table_name
+        return "DELETE FROM %s WHERE id IN (%s)" % (table_name,
+                ','.join('?' for x in xrange(id_count)))
+
     def get_last_id(self):
         try:
             return self._get_last_id()
@@ -933,11 +1362,30 @@ class LiveStorage:
         This will throw a KeyError if id is not in the database, or if the
         object for id has not been loaded yet.
         """
-        return self._object_map[(id_, app.db.table_name(klass))]
+        obj = self._get_object((id_, app.db.table_name(klass)))
+        if obj is None:
+            raise KeyError(id_)
+        return obj
 
     def id_alive(self, id_, klass):
         """Check if an id exists and is loaded in the database."""
-        return (id_, app.db.table_name(klass)) in self._object_map
+        return self._get_object((id_, app.db.table_name(klass))) is not None
+
+    def get_loaded_object(self, table_name, id_):
+        """Get a DDBObject if it's loaded in memory.
+
+        :returns: the DDBObject or None if it's not loaded
+        """
+        return self._get_object((id_, table_name))
+
+    def table_columns(self, table_name):
+        """Get the columns for a table.
+
+        :returns: dict mapping lower-case column names to (name,
+            schema_item) tuples
+        :raises KeyError: table_name is not a table in our schema
+        """
+        return self._table_column_map[table_name]
 
     def table_name(self, klass):
         return self._schema_map[klass].table_name
@@ -948,6 +1396,25 @@ class LiveStorage:
     def object_from_class_table(self, obj, klass):
         return self._schema_map[klass] is self._schema_map[obj.__class__]
 
+    def _query_sql(self, select, table_name, where, joins, order_by, limit):
+        """Get the SQL for a SELECT statement.
+
+        :param select: what to select (for example "COUNT(*)")
+        """
+        if joins is not None:
+            join_key = tuple(joins.items())
+        else:
+            join_key = None
+        key = ('select', select, table_name, where, join_key, order_by,
+               limit)
+        return self.sql_cache.get(key, self._build_query_sql, select,
+                table_name, where, joins, order_by, limit)
+
+    def _build_query_sql(self, select, table_name, where, joins, order_by,
+            limit):
+        return "SELECT %s %s" % (select, self._get_query_bottom(table_name,
+            where, joins, order_by, limit))
+
     def _get_query_bottom(self, table_name, where, joins, order_by, limit):
         sql = StringIO()
         sql.write("FROM %s\n" % table_name)
@@ -970,7 +1437,8 @@ class LiveStorage:
         table_name = app.db.table_name(klass)
         unrestored_ids = []
         for id_ in id_list:
-            if (id_, table_name) not in self._ids_loaded:
+            key = (id_, table_name)
+            if key not in self._ids_loaded and self._get_object(key) is None:
                 unrestored_ids.append(id_)
         if unrestored_ids:
             # restore any objects that we don't already have in memory.
@@ -981,31 +1449,97 @@ class LiveStorage:
 
     def query_ids(self, table_name, where, values=None, order_by=None,
             joins=None, limit=None):
-        sql = StringIO()
-        sql.write("SELECT %s.id " % table_name)
-        sql.write(self._get_query_bottom(table_name, where, joins,
-            order_by, limit))
-        self.cursor.execute(sql.getvalue(), values)
+        sql = self._query_sql("%s.id" % table_name, table_name, where, joins,
+                order_by, limit)
+        self.cursor.execute(sql, values)
         return (row[0] for row in self.cursor.fetchall())
 
-    def _restore_objects(self, schema, id_set, db_info):
-        column_names = ['%s.%s' % (schema.table_name, f[0])
-                for f in schema.fields]
+    def read_in_thread(self, callback, errback, function, name, *args):
+        """Run a read-only database function in a worker thread.
+
+        function will be called with a cursor from our read pool followed by
+        args.  It must not write to the database and it only sees committed
+        data, so call finish_transaction() first if it needs to see our
+        changes.  callback/errback work like they do for
+        eventloop.call_in_thread().
+
+        If we don't have a read pool (we aren't in WAL mode), function is
+        called right away using our main cursor and callback/errback are
+        called from an idle callback.
+        """
+        if self.read_pool is not None:
+            # whoever is reading is usually waiting on the results, so use
+            # PRIORITY_UI
+            eventloop.call_in_thread_pool('disk', eventloop.PRIORITY_UI,
+                    callback, errback, self._call_with_read_cursor, name,
+                    self.read_pool, function, args)
+            return
+        try:
+            result = function(self.cursor, *args)
+        except StandardError, e:
+            eventloop.add_idle(errback, name, args=(e,))
+        else:
+            eventloop.add_idle(callback, name, args=(result,))
+
+    def _call_with_read_cursor(self, read_pool, function, args):
+        connection = read_pool.acquire()
+        try:
+            return function(connection.cursor(), *args)
+        finally:
+            read_pool.release(connection)
+
+    def acquire_read_cursor(self):
+        """Get a cursor to run a large read-only query with.
+
+        If we have a read pool and there are no uncommitted changes (which
+        other connections can't see), this returns a cursor from the pool.
+        This keeps large reads from filling up the main connection's page
+        cache.  Otherwise it returns our main cursor.
+
+        Call release_read_cursor() when done with the cursor.
+        """
+        if self.read_pool is None or self._statements_in_transaction:
+            return self.cursor
+        return self.read_pool.acquire().cursor()
 
+    def release_read_cursor(self, cursor):
+        if cursor is self.cursor:
+            return
+        if self.read_pool is not None:
+            self.read_pool.release(cursor.connection)
+        else:
+            # the pool got closed while the cursor was in use
+            cursor.connection.close()
+
+    def _restore_objects(self, schema, id_set, db_info):
         # we can only feed sqlite so many variables at once, send it chunks of
         # 900 ids at once
         id_list = tuple(id_set)
         for id_list_chunk in util.split_values_for_sqlite(id_list):
-            sql = StringIO()
-            sql.write("SELECT %s " % (', '.join(column_names),))
-            sql.write("FROM %s WHERE id IN (%s)" % (schema.table_name, 
-                ', '.join('?' for i in xrange(len(id_list_chunk)))))
-
-            self.cursor.execute(sql.getvalue(), id_list_chunk)
+            sql = self.sql_cache.get(('restore', schema.table_name,
+                len(id_list_chunk)), self._build_restore_sql, schema,
+                len(id_list_chunk))
+            self.cursor.execute(sql, id_list_chunk)
             for row in self.cursor.fetchall():
                 self._restore_object_from_row(schema, row, db_info)
 
+    def _build_restore_sql(self, schema, id_count):
+        column_names = ['%s.%s' % (schema.table_name, f[0])
+                for f in schema.fields]
+        return "SELECT %s FROM %s WHERE id IN (%s)" % (
+                ', '.join(column_names), schema.table_name,
+                ', '.join('?' for i in xrange(id_count)))
+
     def _restore_object_from_row(self, schema, db_row, db_info):
+        try:
+            restored_data = self._row_decoders[schema](db_row)
+        except StandardError:
+            # Use the slow path, which handles malformed data
+            restored_data = self._restore_data_slow(schema, db_row)
+        klass = schema.get_ddb_class(restored_data)
+        return klass(restored_data=restored_data, db_info=db_info)
+
+    def _restore_data_slow(self, schema, db_row):
         restored_data = {}
         columns_to_update = []
         values_to_update = []
@@ -1035,40 +1569,40 @@ class LiveStorage:
         if columns_to_update:
             # We are using some values that are different than what's stored
             # in disk.  Update the database to make things match.
-            setters = ['%s=?' % c for c in columns_to_update]
-            sql = "UPDATE %s SET %s WHERE id=%s" % (schema.table_name,
-                    ', '.join(setters), restored_data['id'])
+            sql = self._update_sql(schema.table_name,
+                    tuple(columns_to_update))
+            values_to_update.append(restored_data['id'])
             self._execute(sql, values_to_update)
-        klass = schema.get_ddb_class(restored_data)
-        return klass(restored_data=restored_data, db_info=db_info)
+        return restored_data
 
     def persistent_object_count(self):
         return len(self._object_map)
 
     def query_count(self, table_name, where, values=None, joins=None,
             limit=None):
-        sql = StringIO()
-        sql.write('SELECT COUNT(*) ')
-        sql.write(self._get_query_bottom(table_name, where, joins,
-            None, limit))
-        return self._execute(sql.getvalue(), values)[0][0]
+        sql = self._query_sql('COUNT(*)', table_name, where, joins, None,
+                limit)
+        return self._execute(sql, values)[0][0]
 
     def delete(self, klass, where, values):
         schema = self._schema_map[klass]
+        sql = self.sql_cache.get(('delete', schema.table_name, where),
+                self._build_delete_sql, schema.table_name, where)
+        self._execute(sql, values, is_update=True, durable=True)
+
+    def _build_delete_sql(self, table_name, where):
         sql = StringIO()
-        sql.write('DELETE FROM %s' % schema.table_name)
+        sql.write('DELETE FROM %s' % table_name)
         if where is not None:
             sql.write('\nWHERE %s' % where)
-        self._execute(sql.getvalue(), values, is_update=True)
+        return sql.getvalue()
 
     def select(self, klass, columns, where, values, joins=None, limit=None,
             convert=True):
         schema = self._schema_map[klass]
-        sql = StringIO()
-        sql.write('SELECT %s ' % ', '.join(columns))
-        sql.write(self._get_query_bottom(schema.table_name, where, joins, None,
-            limit))
-        results = self._execute(sql.getvalue(), values)
+        sql = self._query_sql(', '.join(columns), schema.table_name, where,
+                joins, None, limit)
+        results = self._execute(sql, values)
         if not convert:
             return results
         schema_items = [self._schema_column_map[schema, c] for c in columns]
@@ -1082,31 +1616,173 @@ class LiveStorage:
             rows.append(converted_row)
         return rows
 
+    def set_group_commit(self, enabled, max_delay=None, max_statements=None):
+        """Turn group-commit mode on or off.
+
+        In group-commit mode we don't commit at the end of each event.
+        Instead, changes are coalesced and committed once max_delay seconds
+        have passed since the first uncommitted change, or once
+        max_statements statements are waiting.  Durability-critical changes
+        (deletions and inserts into durable_tables) get committed at the end
+        of the event that made them.
+
+        Each event's changes are wrapped in a SAVEPOINT, so an event that
+        fails only rolls back its own changes.
+
+        :param enabled: should group-commit mode be on?
+        :param max_delay: max seconds to wait before committing
+        :param max_statements: max statements to put in one transaction
+        """
+        if max_delay is not None:
+            self._group_commit_delay = max_delay
+        if max_statements is not None:
+            self._group_commit_max_statements = max_statements
+        self._group_commit = enabled
+        if not enabled:
+            self.finish_transaction()
+
+    def get_sql_cache_stats(self):
+        """Get a dict summarizing how well our SQL string cache is working.
+
+        Besides the SQLStringCache stats, this includes slow_queries, the
+        number of queries that _check_time() logged as slow.
+        """
+        stats = self.sql_cache.get_stats()
+        stats['slow_queries'] = self.slow_query_count
+        return stats
+
+    def get_commit_stats(self):
+        """Get a dict summarizing our commit latency and statements per
+        commit.
+        """
+        return self.commit_stats.get_stats()
+
     def on_event_finished(self, eventloop, success):
-        self.finish_transaction(commit=success)
+        if self.object_cache_size is not None:
+            self.evict_objects()
+        if not self._group_commit:
+            self.finish_transaction(commit=success)
+            return
+        if self._savepoint_index is not None:
+            self._finish_event_savepoint(success)
+        if not self._statements_in_transaction:
+            return
+        if (self._durable_change or
+                (len(self._statements_in_transaction) >=
+                    self._group_commit_max_statements) or
+                (time.time() - self._transaction_start >=
+                    self._group_commit_delay)):
+            self.finish_transaction()
+        elif self._group_commit_dc is None:
+            self._schedule_group_commit()
+
+    def _finish_event_savepoint(self, success):
+        """Release or rollback the SAVEPOINT for the current event."""
+        index = self._savepoint_index
+        self._savepoint_index = None
+        if self._quitting_from_operational_error:
+            return
+        if index == 0:
+            # The transaction started with this event, so there's no
+            # SAVEPOINT, the transaction itself plays that role.
+            if not success:
+                self.finish_transaction(commit=False)
+            return
+        if success:
+            self.cursor.execute("RELEASE SAVEPOINT event_changes")
+        else:
+            self.cursor.execute("ROLLBACK TO SAVEPOINT event_changes")
+            self.cursor.execute("RELEASE SAVEPOINT event_changes")
+            del self._statements_in_transaction[index:]
+
+    def _schedule_group_commit(self):
+        delay = (self._transaction_start + self._group_commit_delay -
+                 time.time())
+        self._group_commit_dc = eventloop.add_timeout(max(delay, 0),
+                self._group_commit_timeout,
+                "commit grouped database changes")
+
+    def _group_commit_timeout(self):
+        self._group_commit_dc = None
+        self.finish_transaction()
 
     def finish_transaction(self, commit=True):
+        if self._group_commit_dc is not None:
+            self._group_commit_dc.cancel()
+            self._group_commit_dc = None
+        # COMMIT and ROLLBACK both end any SAVEPOINT we have open
+        self._savepoint_index = None
         if len(self._statements_in_transaction) == 0:
             return
         if not self._quitting_from_operational_error:
             if commit:
+                start = time.time()
                 self.cursor.execute("COMMIT TRANSACTION")
+                end = time.time()
+                self._check_time("COMMIT TRANSACTION", end - start)
+                self.commit_stats.record_commit(
+                        len(self._statements_in_transaction), end - start,
+                        end - self._transaction_start)
             else:
                 self.cursor.execute("ROLLBACK TRANSACTION")
         self._statements_in_transaction = []
+        self._durable_change = False
+
+    def run_in_transaction(self, function, *args):
+        """Run a function that writes to the database in its own transaction.
+
+        function is called with our cursor, followed by args.  Its changes
+        are committed if it returns normally and rolled back if it raises an
+        exception.
+
+        This is meant for code that manages its own tables outside of the
+        DDBObject system.  sqlite doesn't nest transactions, so any changes
+        that are waiting to be committed get committed first.  This is
+        usually only the case in group-commit mode.
 
-    def _execute(self, sql, values, is_update=False, many=False):
+        :returns: the return value of function
+        """
+        self.finish_transaction()
+        self.cursor.execute("BEGIN TRANSACTION")
+        try:
+            rv = function(self.cursor, *args)
+        except:
+            self.cursor.execute("ROLLBACK TRANSACTION")
+            raise
+        start = time.time()
+        self.cursor.execute("COMMIT TRANSACTION")
+        self._check_time("COMMIT TRANSACTION", time.time() - start)
+        return rv
+
+    def execute_update(self, sql, values=None):
+        """Run a statement that changes a table outside the DDBObject system.
+
+        Unlike run_in_transaction(), the statement is part of the current
+        transaction, so it gets committed or rolled back together with the
+        object changes made by the current event.
+        """
+        self._execute(sql, values, is_update=True)
+
+    def _execute(self, sql, values, is_update=False, many=False,
+                 durable=False):
         if is_update and self._quitting_from_operational_error:
             # We want to avoid updating the database at this point.
             return
 
         if is_update and len(self._statements_in_transaction) == 0:
             self.cursor.execute("BEGIN TRANSACTION")
+            self._transaction_start = time.time()
 
         if values is None:
             values = ()
 
         if is_update:
+            if self._group_commit and self._savepoint_index is None:
+                self._savepoint_index = len(self._statements_in_transaction)
+                if self._savepoint_index > 0:
+                    self.cursor.execute("SAVEPOINT event_changes")
+            if durable:
+                self._durable_change = True
             self._statements_in_transaction.append((sql, values, many))
         try:
             self._time_execute(sql, values, many)
@@ -1154,7 +1830,10 @@ class LiveStorage:
         to_run = self._statements_in_transaction[:]
         if self._current_select_statement:
             to_run.append(self._current_select_statement)
-        for (sql, values, many) in to_run:
+        for i, (sql, values, many) in enumerate(to_run):
+            if i > 0 and i == self._savepoint_index:
+                # recreate the SAVEPOINT for the current event
+                self.cursor.execute("SAVEPOINT event_changes")
             try:
                 self._time_execute(sql, values, many)
             except sqlite3.OperationalError:
@@ -1210,6 +1889,8 @@ class LiveStorage:
             # reset _statements_in_transaction.  The data for the old DB is
             # now lost
             self._statements_in_transaction = []
+            self._savepoint_index = None
+            self._durable_change = False
             self.cursor = self.connection.cursor()
             self._init_database()
             return False
@@ -1221,6 +1902,7 @@ class LiveStorage:
         SINGLE_QUERY_LIMIT = 0.5
         CUMULATIVE_LIMIT = 1.0
         if query_time > SINGLE_QUERY_LIMIT:
+            self.slow_query_count += 1
             logging.timing("query slow (%0.3f seconds): %s", query_time, sql)
 
         return # comment out to test cumulative query times
@@ -1255,6 +1937,8 @@ class LiveStorage:
                         (name, schema.table_name, ', '.join(columns)))
         self._create_variables_table()
         self.cursor.execute(iteminfocache.create_sql())
+        self.cursor.execute(feedcounts.create_sql())
+        self.cursor.execute(searchindex.create_sql())
         self.set_version()
 
     def _get_size_info(self):
@@ -1330,6 +2014,7 @@ class LiveStorage:
 
         :param init_schema: should we create tables for our schema?
         """
+        self._close_read_pool()
         self.connection.close()
         self.save_invalid_db()
         self.open_connection()
@@ -1353,6 +2038,12 @@ class LiveStorage:
         save_name = self._find_unused_db_name(
             target_path, "corrupt_database")
         os.rename(self.path, os.path.join(target_path, save_name))
+        # move any WAL files along with the database, they must not get
+        # applied to the fresh database we create at self.path
+        for suffix in ('-wal', '-shm'):
+            if os.path.exists(self.path + suffix):
+                os.rename(self.path + suffix,
+                          os.path.join(target_path, save_name + suffix))
 
     def _find_unused_db_name(self, target_path, save_name):
         org_save_name = save_name
@@ -1389,6 +2080,17 @@ class SQLiteConverter(object):
             self._to_sql_converters[schema_class] = self._repr_to_sql
             self._from_sql_converters[schema_class] = self._repr_from_sql
 
+        # values with these exact types always pass validate() for a schema
+        # item class.
+        self._known_valid_types = {
+                schema.SchemaBool: (bool,),
+                schema.SchemaFloat: (float,),
+                schema.SchemaString: (unicode,),
+                schema.SchemaInt: (int, long),
+                schema.SchemaBinary: (str,),
+                schema.SchemaDateTime: (datetime.datetime,),
+        }
+
     def to_sql(self, schema, name, schema_item, value):
         if value is None:
             return None
@@ -1403,6 +2105,61 @@ class SQLiteConverter(object):
                 self._null_convert)
         return converter(value, schema_item)
 
+    def make_row_decoder(self, schema):
+        """Build a function that converts a row from the DB into a dict.
+
+        The function takes a row with a value for each field in schema and
+        returns a dict mapping field names to values.  This is a fast path
+        for calling from_sql() on each value: values that don't need
+        converting (ints, text, timestamps, etc.) are copied over as-is.
+        Malformed data isn't handled, if the function raises an error the
+        caller should fall back to from_sql().
+        """
+        names = [name for name, schema_item in schema.fields]
+        conversions = []
+        for index, (name, schema_item) in enumerate(schema.fields):
+            converter = self._from_sql_converters.get(schema_item.__class__)
+            if converter is not None:
+                conversions.append((index, name, converter, schema_item))
+        def decode_row(row):
+            data = dict(itertools.izip(names, row))
+            for index, name, converter, schema_item in conversions:
+                value = row[index]
+                if value is not None:
+                    data[name] = converter(value, schema_item)
+            return data
+        return decode_row
+
+    def make_row_encoder(self, schema):
+        """Build a function that converts a DDBObject into a list of values.
+
+        The function takes an object that uses schema and returns the values
+        to store for each of its fields.  This is a fast path for validating
+        and calling to_sql() on each value.  Values whose type is exactly
+        the one that their schema item expects don't need to be validated,
+        and values that don't need converting are used as-is.
+
+        The function raises a ValidationError for invalid values.
+        """
+        plan = []
+        for name, schema_item in schema.fields:
+            converter = self._to_sql_converters.get(schema_item.__class__)
+            valid_types = self._known_valid_types.get(schema_item.__class__,
+                                                      ())
+            plan.append((name, valid_types, schema_item.validate, converter,
+                         schema_item))
+        def encode_obj(obj):
+            values = []
+            for name, valid_types, validate, converter, schema_item in plan:
+                value = getattr(obj, name)
+                if type(value) not in valid_types:
+                    validate(value)
+                if converter is not None and value is not None:
+                    value = converter(value, schema_item)
+                values.append(value)
+            return values
+        return encode_obj
+
     def get_malformed_data_handler(self, schema, name, schema_item, value):
         handler_name = 'handle_malformed_%s' % name
         if hasattr(schema, handler_name):
@@ -1444,10 +2201,10 @@ class SQLiteConverter(object):
         return filename_to_unicode(value)
 
     def _repr_to_sql(self, value, schema_item):
-        return repr(value)
+        return dump_repr_value(value)
 
     def _repr_from_sql(self, value, schema_item):
-        return eval(value, __builtins__, {'datetime': datetime, 'time': _TIME_MODULE_SHADOW})
+        return load_repr_value(value)
 
     def _status_from_sql(self, repr_value, schema_item):
         status_dict = self._repr_from_sql(repr_value, schema_item)
@@ -1465,7 +2222,7 @@ class SQLiteConverter(object):
             value = to_save.get(key)
             if value is not None:
                 to_save[key] = filename_to_unicode(value)
-        return repr(to_save)
+        return dump_repr_value(to_save)
 
     def _string_set_to_sql(self, value, schema_item):
         return schema_item.delimiter.join(value)
@@ -1482,3 +2239,39 @@ class TimeModuleShadow:
         return (tm_year, tm_mon, tm_mday, tm_hour, tm_min, tm_sec, tm_wday, tm_yday, tm_isdst)
 
 _TIME_MODULE_SHADOW = TimeModuleShadow()
+
+# Leading bytes for the binary encodings of pythonrepr columns.  Values
+# that marshal can handle (the vast majority of them) use marshal, which
+# is much faster to load and dump than repr()/eval().  Everything else
+# (datetimes, timedeltas, struct_time values, ...) falls back to pickle.
+BINARY_REPR_MARSHAL = '\x01'
+BINARY_REPR_PICKLE = '\x02'
+BINARY_REPR_MARSHAL_VERSION = 2
+
+def dump_repr_value(value):
+    """Encode a value for a pythonrepr column."""
+    try:
+        data = BINARY_REPR_MARSHAL + marshal.dumps(value,
+                BINARY_REPR_MARSHAL_VERSION)
+    except ValueError:
+        data = BINARY_REPR_PICKLE + cPickle.dumps(value,
+                cPickle.HIGHEST_PROTOCOL)
+    return buffer(data)
+
+def load_repr_value(value):
+    """Decode a value from a pythonrepr column.
+
+    value can either be a buffer created with dump_repr_value() or a
+    string created by repr(), which is how older databases stored these
+    columns.
+    """
+    if not isinstance(value, buffer):
+        return eval(value, __builtins__,
+                {'datetime': datetime, 'time': _TIME_MODULE_SHADOW})
+    data = str(value)
+    if data.startswith(BINARY_REPR_MARSHAL):
+        return marshal.loads(data[1:])
+    elif data.startswith(BINARY_REPR_PICKLE):
+        return cPickle.loads(data[1:])
+    else:
+        raise ValueError("Unknown pythonrepr encoding: %r" % data[:1])
@@ -7,6 +7,7 @@ from miro import databaselog
 from miro import item
 from miro import feed
 from miro import schema
+from miro import viewpredicate
 
 class DatabaseTestCase(MiroTestCase):
     def setUp(self):
@@ -146,6 +147,67 @@ class ViewTrackerTest(DatabaseTestCase):
         self.assertEquals(self.remove_callbacks, [self.i2])
         self.assertEquals(self.change_callbacks, [self.i1])
 
+    def test_check_objects(self):
+        self.setup_view(item.Item.make_view("feed.userTitle='booya'",
+                joins={'feed': 'feed.id=item.feed_id'}))
+        bulk_callbacks = []
+        def on_bulk(tracker, objects, signal):
+            bulk_callbacks.append((signal, objects))
+        for signal in ('bulk-added', 'bulk-removed', 'bulk-changed'):
+            self.tracker.connect(signal, on_bulk, signal)
+        self.tracker.set_bulk_mode(True)
+        self.feed2.set_title(u"booya")
+        self.feed.revert_title()
+        # make sure we can't use the predicate, so that we test the SQL path
+        self.tracker.predicate = None
+        self.tracker.check_objects([self.i1, self.i2, self.i3])
+        self.assertEquals(bulk_callbacks, [
+            ('bulk-removed', [self.i1, self.i2]),
+            ('bulk-added', [self.i3]),
+        ])
+        bulk_callbacks[:] = []
+        self.tracker.check_objects([self.i1, self.i2, self.i3])
+        self.assertEquals(bulk_callbacks, [('bulk-changed', [self.i3])])
+
+    def test_check_objects_many_values(self):
+        # views with lots of values (like the ones ManualItemTracker
+        # creates) shouldn't make us bind more than 999 variables.
+        ids = [self.i1.id, self.i3.id] + range(-1, -951, -1)
+        where = 'item.id IN (%s)' % ', '.join('?' for i in ids)
+        self.setup_view(item.Item.make_view(where, tuple(ids)))
+        self.tracker.predicate = None
+        objects = [self.i1, self.i2, self.i3]
+        for i in xrange(100):
+            objects.append(item.Item(
+                item.FeedParserValues({'title': u'extra item'}),
+                feed_id=self.feed.id))
+        db = self.tracker.db_info.db
+        value_counts = []
+        def query_ids(table_name, where, values=None, **kwargs):
+            value_counts.append(len(values))
+            return real_query_ids(table_name, where, values, **kwargs)
+        real_query_ids = db.query_ids
+        db.query_ids = query_ids
+        try:
+            self.tracker.check_objects(objects)
+        finally:
+            del db.query_ids
+        self.assert_(max(value_counts) <= 999)
+        self.assertSameSet(self.tracker.current_ids,
+                           [self.i1.id, self.i3.id])
+
+    def test_changes_delayed_in_bulk_mode(self):
+        self.setup_view(item.Item.make_view("feed.userTitle='booya'",
+                joins={'feed': 'feed.id=item.feed_id'}))
+        app.bulk_sql_manager.start()
+        self.i1.mark_item_skipped()
+        self.i1.mark_item_seen()
+        self.i2.signal_change(can_change_views=False)
+        self.assertEquals(self.change_callbacks, [])
+        app.bulk_sql_manager.finish()
+        # i1 changed twice, but should only be checked once
+        self.assertEquals(self.change_callbacks, [self.i1, self.i2])
+
     def test_unlink(self):
         self.tracker.unlink()
         self.feed2.set_title(u"booya")
@@ -159,6 +221,64 @@ class ViewTrackerTest(DatabaseTestCase):
         self.clear_ddb_object_cache()
         tracker.check_all_objects()
 
+class ViewPredicateTest(DatabaseTestCase):
+    def setUp(self):
+        DatabaseTestCase.setUp(self)
+        self.feed.set_title(u'booya')
+        self.i2.mark_item_seen()
+        self.manual_feed = feed.Feed(u'dtv:manualFeed')
+        self.i4 = item.Item(item.FeedParserValues({'title': u'item4'}),
+                            feed_id=self.manual_feed.id)
+        self.all_items = [self.i1, self.i2, self.i3, self.i4]
+
+    def check_predicate(self, view):
+        tracker = view.make_tracker()
+        self.assertNotEquals(tracker.predicate, None)
+        for obj in self.all_items:
+            self.assertEquals(tracker.predicate.matches(obj),
+                              tracker._obj_in_view_sql(obj))
+        tracker.unlink()
+
+    def test_matches_sql(self):
+        self.check_predicate(item.Item.feed_view(self.feed.id))
+        self.check_predicate(item.Item.visible_feed_view(self.feed2.id))
+        self.check_predicate(item.Item.toplevel_view())
+        self.check_predicate(item.Item.auto_pending_view())
+        self.check_predicate(item.Item.download_tab_view())
+        self.check_predicate(item.Item.unique_new_video_view())
+        self.check_predicate(item.Item.watchable_video_view())
+        self.check_predicate(item.Item.feed_available_view(self.feed.id))
+        self.check_predicate(item.Item.make_view(
+            "feed.userTitle LIKE 'BOOYA%' AND seen",
+            joins={'feed': 'feed.id=item.feed_id'}))
+
+    def test_uncompilable(self):
+        for view in (item.Item.orphaned_from_feed_view(),
+                     item.Item.items_with_path_view('/foo/bar'),
+                     item.Item.watchable_other_view()):
+            tracker = view.make_tracker()
+            self.assertEquals(tracker.predicate, None)
+            tracker.unlink()
+
+    def test_unsaved_changes(self):
+        # if a column that the view uses has changed, but we haven't saved
+        # it, then the predicate can't be used.
+        tracker = item.Item.make_view('seen').make_tracker()
+        self.i1.seen = True
+        self.assertRaises(viewpredicate.CantEvaluate,
+                          tracker.predicate.matches, self.i1)
+        self.i1.signal_change()
+        self.assert_(tracker.predicate.matches(self.i1))
+
+    def test_joined_object_not_loaded(self):
+        tracker = item.Item.make_view("feed.userTitle='booya'",
+                joins={'feed': 'feed.id=item.feed_id'}).make_tracker()
+        app.db.forget_object(self.feed)
+        self.assertRaises(viewpredicate.CantEvaluate,
+                          tracker.predicate.matches, self.i1)
+        # falling back to SQL should still work
+        self.assert_(tracker._obj_in_view(self.i1))
+
 # class TestViewLimiter(database.ViewLimiter):
 #     def __init__(self, *feeds_to_include):
 #         self.feeds_to_include = feeds_to_include
@@ -5,9 +5,13 @@ from time import sleep
 from miro import app
 from miro import prefs
 from miro import dialogs
+from miro import feedcounts
 from miro import feedparserutil
-from miro.item import Item
+from miro.item import Item, FileItem, FeedParserValues
 from miro.feed import validate_feed_url, normalize_feed_url, Feed
+from miro.fileobject import FilenameType
+from miro.folder import ChannelFolder
+from miro.singleclick import _build_entry
 
 from miro.test.framework import MiroTestCase, EventLoopTest
 
@@ -465,6 +469,8 @@ class FeedParserAttributesTestCase(FeedTestCase):
 
     def save_then_restore_db(self):
         self.reload_database(self.tempdb)
+        # the count tracker is hooked up to the old database, start over
+        self.setup_new_feed_count_tracker()
         self.feed = Feed.make_view().get_singleton()
         self.item = Item.make_view().get_singleton()
 
@@ -523,5 +529,107 @@ by-nd/1.0</creativeCommons:license>
         self.save_then_restore_db()
         self.assertEquals(self.item.get_rss_id(), None)
 
+class FeedCountTest(EventLoopTest):
+    def setUp(self):
+        EventLoopTest.setUp(self)
+        self.feed = Feed(u'http://example.com/',
+                         initiallyAutoDownloadable=False)
+        self.items = []
+        for i in xrange(3):
+            url = u'http://example.com/%d.mp4' % i
+            self.items.append(Item(FeedParserValues(_build_entry(url,
+                'video/x-unknown')), feed_id=self.feed.id))
+        self.file_item = FileItem(FilenameType('/videos/movie.avi'),
+                                  feed_id=self.feed.id)
+        self.file_item.file_type = u'video'
+        self.file_item.signal_change()
+
+    def check_counts(self, available, unwatched, downloaded):
+        self.assertEquals(self.feed.num_available(), available)
+        self.assertEquals(self.feed.num_unwatched(), unwatched)
+        self.assertEquals(self.feed.num_downloaded(), downloaded)
+        # double check against the views that we used to use for counts
+        self.assertEquals(self.feed.num_available(),
+                          self.feed.available_items.count() -
+                          self.feed.auto_pending_items.count())
+        self.assertEquals(self.feed.num_unwatched(),
+                          self.feed.unwatched_items.count())
+        self.assertEquals(self.feed.num_downloaded(),
+                          self.feed.downloaded_items.count())
+        self.assertEquals(self.feed.num_downloading(),
+                          self.feed.downloading_items.count())
+
+    def test_counts(self):
+        self.check_counts(3, 1, 1)
+
+    def test_item_changes(self):
+        self.file_item.mark_item_seen()
+        self.check_counts(3, 0, 1)
+        self.items[0].remove()
+        self.check_counts(2, 0, 1)
+        Item(FeedParserValues(_build_entry(u'http://example.com/new.mp4',
+            'video/x-unknown')), feed_id=self.feed.id)
+        self.check_counts(3, 0, 1)
+
+    def test_mark_as_viewed(self):
+        self.feed.mark_as_viewed()
+        self.check_counts(0, 1, 1)
+
+    def test_folder(self):
+        folder = ChannelFolder(u'test folder')
+        self.feed.set_folder(folder)
+        self.assertEquals(folder.num_available(), 3)
+        self.assertEquals(folder.num_unwatched(), 1)
+        self.assert_(folder.has_downloaded_items())
+        self.items[0].remove()
+        self.assertEquals(folder.num_available(), 2)
+        self.feed.set_folder(None)
+        self.assertEquals(folder.num_available(), 0)
+        self.assertEquals(folder.num_unwatched(), 0)
+        self.assert_(not folder.has_downloaded_items())
+
+    def test_signal(self):
+        self.runPendingIdles()
+        tracker = app.feed_count_tracker
+        self.items[0].remove()
+        # the feed should get signalled from an idle callback
+        self.assertEquals(tracker._feeds_to_signal, set([self.feed.id]))
+        self.runPendingIdles()
+        self.assertEquals(tracker._feeds_to_signal, set())
+
+    def test_persistence(self):
+        app.feed_count_tracker.save()
+        self.setup_new_feed_count_tracker()
+        self.assertNotEquals(app.feed_count_tracker._quick_load(), None)
+        self.check_counts(3, 1, 1)
+
+    def check_item_flags(self):
+        # flags calculated from the in-memory items should match the ones
+        # from the item table
+        sql_flags = app.feed_count_tracker._calc_flags()
+        for item in self.items + [self.file_item]:
+            self.assertEquals(feedcounts._calc_item_flags(item),
+                              sql_flags[item.id])
+
+    def test_item_flags(self):
+        self.check_item_flags()
+        self.items[0].mark_item_seen()
+        self.items[1].set_auto_downloaded()
+        self.file_item.mark_item_seen()
+        self.check_item_flags()
+        self.feed.set_auto_download_mode(u'all')
+        self.check_item_flags()
+        self.feed.mark_as_viewed()
+        self.check_item_flags()
+
+    def test_reconcile(self):
+        self.assertEquals(app.feed_count_tracker.reconcile(), 0)
+        # change the DB behind the tracker's back
+        app.db.cursor.execute("UPDATE item SET seen=1 WHERE id=?",
+                              (self.file_item.id,))
+        self.assertEquals(self.feed.num_unwatched(), 1)
+        self.assertEquals(app.feed_count_tracker.reconcile(), 1)
+        self.assertEquals(self.feed.num_unwatched(), 0)
+
 if __name__ == "__main__":
     unittest.main()
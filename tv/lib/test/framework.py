@@ -13,6 +13,7 @@ from miro import database
 from miro import eventloop
 from miro import extensionmanager
 from miro import feed
+from miro import feedcounts
 from miro import downloader
 from miro import httpauth
 from miro import httpclient
@@ -23,6 +24,7 @@ from miro import util
 from miro import prefs
 from miro import schema
 from miro import searchengines
+from miro import searchindex
 from miro import signals
 from miro import storedatabase
 from time import sleep
@@ -284,6 +286,8 @@ class MiroTestCase(unittest.TestCase):
         self.allow_db_upgrade_error_dialog = False
         self.reload_database()
         self.setup_new_item_info_cache()
+        self.setup_new_feed_count_tracker()
+        self.setup_new_item_search_index()
         item.setup_metadata_manager(self.tempdir)
         searchengines._engines = [
             searchengines.SearchEngineInfo(u"all", u"Search All", u"", -1)
@@ -340,6 +344,10 @@ class MiroTestCase(unittest.TestCase):
         # unload extensions
         self.unload_extensions()
 
+        # Stop the item info cache writer thread
+        if app.item_info_cache is not None:
+            app.item_info_cache.close()
+
         # Remove any leftover database
         app.db.close()
         app.db = None
@@ -457,6 +465,18 @@ class MiroTestCase(unittest.TestCase):
         app.item_info_cache = iteminfocache.ItemInfoCache()
         app.item_info_cache.load()
 
+    def setup_new_feed_count_tracker(self):
+        if app.feed_count_tracker is not None:
+            app.feed_count_tracker.unlink()
+        app.feed_count_tracker = feedcounts.FeedCountTracker()
+        app.feed_count_tracker.load()
+
+    def setup_new_item_search_index(self):
+        if app.item_search_index is not None:
+            app.item_search_index.unlink()
+        app.item_search_index = searchindex.ItemSearchIndex()
+        app.item_search_index.load()
+
     def reset_failed_soft_count(self):
         app.controller.failed_soft_count = 0
 
@@ -481,6 +501,8 @@ class MiroTestCase(unittest.TestCase):
     def clear_ddb_object_cache(self):
         app.db._ids_loaded = set()
         app.db._object_map = {}
+        app.db._evicted_objects.clear()
+        app.db._access_ticks = {}
         app.db.cache = storedatabase.DatabaseObjectCache()
 
     def setup_new_database(self, path, **kwargs):
@@ -620,7 +642,7 @@ class EventLoopTest(MiroTestCase):
 
     def processThreads(self):
         eventloop._eventloop.threadpool.init_threads()
-        while not eventloop._eventloop.threadpool.queue.empty():
+        while eventloop._eventloop.threadpool.has_pending_calls():
             sleep(0.05)
         eventloop._eventloop.threadpool.close_threads()
 
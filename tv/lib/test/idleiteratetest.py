@@ -7,6 +7,8 @@ class IdleIterateTest(EventLoopTest):
     def setUp(self):
         self.current_value = None
         EventLoopTest.setUp(self)
+        # Run a single step each time through the event loop
+        eventloop._eventloop.iterator_scheduler.budget = 0
 
     def check_idle_iterator(self, *values):
         """Check the progress of our idle iterator.
@@ -41,3 +43,90 @@ class IdleIterateTest(EventLoopTest):
                 yield
         foo()
         self.check_idle_iterator(0, 1, 2, 3, 4)
+
+    def test_budget(self):
+        # with a large budget, we should run all the steps at once
+        eventloop._eventloop.iterator_scheduler.budget = 100
+        def foo():
+            for x in xrange(5):
+                self.current_value = x
+                yield
+        eventloop.idle_iterate(foo, "test idle iterator")
+        self.run_idles_for_this_loop()
+        self.assertEquals(self.current_value, 4)
+
+    def test_round_robin(self):
+        eventloop._eventloop.iterator_scheduler.budget = 100
+        steps = []
+        def foo(name):
+            for x in xrange(3):
+                steps.append((name, x))
+                yield
+        eventloop.idle_iterate(foo, "iterator a", args=('a',))
+        eventloop.idle_iterate(foo, "iterator b", args=('b',))
+        self.runPendingIdles()
+        self.assertEquals(steps, [('a', 0), ('b', 0), ('a', 1), ('b', 1),
+                                  ('a', 2), ('b', 2)])
+
+    def test_priority(self):
+        steps = []
+        def foo(name):
+            for x in xrange(2):
+                steps.append((name, x))
+                yield
+        eventloop.idle_iterate(foo, "background", args=('background',),
+                priority=eventloop.PRIORITY_BACKGROUND)
+        eventloop.idle_iterate(foo, "ui", args=('ui',),
+                priority=eventloop.PRIORITY_UI)
+        self.runPendingIdles()
+        # the background iterator was added first, but the UI iterator
+        # should finish before it runs.
+        self.assertEquals(steps, [('ui', 0), ('ui', 1), ('background', 0),
+                                  ('background', 1)])
+
+    def test_paused_value(self):
+        eventloop._eventloop.iterator_scheduler.budget = 100
+        paused_values = []
+        def foo():
+            for x in xrange(3):
+                paused_values.append((yield))
+        def bar():
+            yield
+        eventloop.idle_iterate(foo, "foo")
+        self.run_idles_for_this_loop()
+        # we ran foo's steps one after another
+        self.assertEquals(paused_values, [False, False, False])
+
+        paused_values = []
+        eventloop.idle_iterate(foo, "foo")
+        eventloop.idle_iterate(bar, "bar")
+        self.runPendingIdles()
+        # we ran bar in between foo's first, second and third steps
+        self.assertEquals(paused_values, [True, True, False])
+
+    def test_exception(self):
+        # an exception in one iterator shouldn't stop the others
+        self.error_signal_okay = True
+        eventloop._eventloop.iterator_scheduler.budget = 100
+        def bad():
+            yield
+            raise ValueError()
+        def foo():
+            for x in xrange(3):
+                self.current_value = x
+                yield
+        eventloop.idle_iterate(bad, "bad iterator")
+        eventloop.idle_iterate(foo, "foo")
+        self.runPendingIdles()
+        self.assertEquals(self.current_value, 2)
+        # the exception should be reported
+        self.assert_(self.saw_error)
+
+    def test_decorator_priority(self):
+        @eventloop.idle_iterator(priority=eventloop.PRIORITY_BACKGROUND)
+        def foo():
+            for x in xrange(5):
+                self.current_value = x
+                yield
+        foo()
+        self.check_idle_iterator(0, 1, 2, 3, 4)
@@ -321,6 +321,27 @@ class HaveItemForPathTest(MiroTestCase):
         self.remove_item(u'VIDEO\xe4-3')
         self.check_have_item_for_path()
 
+    def test_evict_and_restore(self):
+        # make LiveStorage evict every item that it can
+        app.db.object_cache_size = app.db._next_eviction_size = 0
+        self.add_item(u'video-1')
+        path = '/videos/video-1'
+        item_id = self.added_items.pop(path).id
+        self.assertEquals(Item._path_count_tracker.get_count(path), 1)
+        # evict the item and restore it a couple times.  The count shouldn't
+        # change.
+        app.db.finish_transaction()
+        for i in xrange(3):
+            app.db.evict_objects()
+            self.assert_((item_id, 'item') not in app.db._object_map)
+            # pretend that the evicted item got garbage collected, so that
+            # it gets restored from disk
+            app.db._evicted_objects.clear()
+            self.assertEquals(Item.get_by_id(item_id).filename, path)
+            self.assertEquals(Item._path_count_tracker.get_count(path), 1)
+        Item.get_by_id(item_id).remove()
+        self.assertEquals(Item.have_item_for_path(path), False)
+
 class ItemMetadataTest(MiroTestCase):
     # Test integration between the item and metadata modules.
     def setUp(self):
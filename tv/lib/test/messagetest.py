@@ -4,14 +4,17 @@ import functools
 
 from miro import app
 from miro import prefs
+from miro import util
 
 from miro.feed import Feed
 from miro.guide import ChannelGuide
 from miro.item import Item, FeedParserValues
+from miro.downloader import RemoteDownloader
 from miro.playlist import SavedPlaylist
 from miro.folder import PlaylistFolder, ChannelFolder
 from miro.singleclick import _build_entry
 from miro.tabs import TabOrder
+from miro import iteminfocache
 from miro import itemsource
 from miro import messages
 from miro import messagehandler
@@ -464,6 +467,28 @@ class FeedItemTrackTest(TrackerTest):
         self.assertEquals(len(self.test_handler.messages), 2)
         self.check_changed_message(1, changed=[self.items[0]])
 
+    def test_update_delta(self):
+        messages.TrackItems('feed', self.feed.id,
+                            send_deltas=True).send_to_backend()
+        self.runUrgentCalls()
+        initial_infos = dict((info.id, info)
+                             for info in self.test_handler.messages[1].items)
+        self.items[0].entry_title = u'new name'
+        self.items[0].signal_change()
+        self.runUrgentCalls()
+        self.assertEquals(len(self.test_handler.messages), 3)
+        message = self.test_handler.messages[2]
+        self.assertEquals(len(message.changed), 0)
+        self.assertSameSet(message.deltas.keys(), [self.items[0].id])
+        delta = message.deltas[self.items[0].id]
+        self.assertEquals(delta['name'], u'new name')
+        self.assert_('description' not in delta)
+        # applying the delta to the info we had should give us the new info
+        patched = initial_infos[self.items[0].id].apply_delta(delta)
+        self.check_info(patched, self.items[0])
+        self.assertEquals(initial_infos[self.items[0].id].name,
+                          u'my first item')
+
     def test_multiple_updates(self):
         # see #15782
         self.items[0].mark_item_skipped()
@@ -497,6 +522,155 @@ class FeedItemTrackTest(TrackerTest):
         self.runUrgentCalls()
         self.assertEquals(len(self.test_handler.messages), 1)
 
+class WindowedItemTrackTest(TrackerTest):
+    def setUp(self):
+        TrackerTest.setUp(self)
+        self.feed = Feed(u'dtv:manualFeed')
+        self.items = []
+        for i in xrange(5):
+            url = u'http://example.com/%d' % i
+            entry = _build_entry(url, 'video/x-unknown',
+                                 {'title': u'item %d' % i})
+            self.items.append(Item(FeedParserValues(entry),
+                                   feed_id=self.feed.id))
+        self.runUrgentCalls()
+        messages.TrackItems('feed', self.feed.id, 2,
+                            lambda info: info.name).send_to_backend()
+        self.runUrgentCalls()
+
+    def fetch(self, ids):
+        self.test_handler.messages = []
+        messages.FetchItemInfos('feed', self.feed.id, ids).send_to_backend()
+        self.runUrgentCalls()
+        self.check_message_count(1)
+        message = self.test_handler.messages[0]
+        self.assert_(isinstance(message, messages.ItemInfosFetched))
+        return message.items
+
+    def test_initial_list(self):
+        self.check_message_count(1)
+        message = self.test_handler.messages[0]
+        self.assert_(isinstance(message, messages.ItemList))
+        self.assertEquals([info.name for info in message.items],
+                          [u'item 0', u'item 1'])
+        self.assertEquals(message.pending_ids,
+                          [i.id for i in self.items[2:]])
+
+    def test_fetch(self):
+        ids = [i.id for i in self.items[2:4]]
+        self.assertEquals([info.id for info in self.fetch(ids)], ids)
+        # infos only get sent once
+        self.assertEquals(self.fetch(ids), [])
+
+    def test_change_pending(self):
+        self.test_handler.messages = []
+        self.items[3].entry_title = u'new name'
+        self.items[3].signal_change()
+        self.runUrgentCalls()
+        # the frontend doesn't have the item, so we shouldn't send changes
+        self.check_message_count(0)
+        infos = self.fetch([self.items[3].id])
+        self.assertEquals(infos[0].name, u'new name')
+        # once it's fetched, changes should be sent normally
+        self.test_handler.messages = []
+        self.items[3].entry_title = u'newer name'
+        self.items[3].signal_change()
+        self.runUrgentCalls()
+        self.check_message_count(1)
+        self.assert_(isinstance(self.test_handler.messages[0],
+                                messages.ItemsChanged))
+
+    def test_remove_pending(self):
+        self.test_handler.messages = []
+        self.items[4].remove()
+        self.runUrgentCalls()
+        self.check_message_count(0)
+        self.assertEquals(self.fetch([self.items[4].id]), [])
+
+class DownloadProgressTest(TrackerTest):
+    def setUp(self):
+        TrackerTest.setUp(self)
+        self.feed = Feed(u'dtv:manualFeed')
+        url = u'http://example.com/movie.mpeg'
+        entry = _build_entry(url, 'video/mpeg', {'title': u'my item'})
+        self.item = Item(FeedParserValues(entry), feed_id=self.feed.id)
+        self.downloader = RemoteDownloader(url, self.item, u'video/mpeg')
+        self.item.set_downloader(self.downloader)
+        # set_downloader() queued a start command, which freezes status
+        # updates until the downloader says it's done with it.
+        self.update_status(cmd_done=True, currentSize=0, rate=0, eta=0)
+        self.runUrgentCalls()
+        messages.TrackItems('feed', self.feed.id).send_to_backend()
+        self.runUrgentCalls()
+        self.test_handler.messages = []
+
+    def update_status(self, cmd_done=False, **kwargs):
+        data = {'dlid': self.downloader.dlid, 'state': u'downloading',
+                'totalSize': 1000}
+        data.update(kwargs)
+        # avoid the rate limiting in update_status()
+        self.downloader.last_update = 0
+        RemoteDownloader.update_status(data, cmd_done=cmd_done)
+
+    def test_progress(self):
+        self.update_status(currentSize=500, rate=100, eta=5)
+        self.runUrgentCalls()
+        # progress changes shouldn't send ItemsChanged
+        self.check_message_count(0)
+        app.download_state_manager.send_progress()
+        self.check_message_count(1)
+        message = self.test_handler.messages[0]
+        self.assert_(isinstance(message, messages.DownloadProgress))
+        self.assertEquals(message.progress,
+                          [(self.item.id, 500, 100, 5, u'downloading')])
+        # the ItemInfo cache should have the new values
+        info = app.item_info_cache.get_info(self.item.id)
+        self.assertEquals(info.download_info.downloaded_size, 500)
+        self.assertEquals(info.download_info.rate, 100)
+        self.assertEquals(info.download_info.eta, 5)
+
+    def test_progress_for_unloaded_item(self):
+        app.db.finish_transaction()
+        app.item_info_cache.save()
+        self.setup_new_item_info_cache()
+        # load() unpickles one ItemInfo right away, make sure that our item
+        # is one that hasn't been loaded yet.
+        cache = app.item_info_cache
+        if self.item.id in cache.id_to_info:
+            app.db.cursor.execute("SELECT pickle FROM item_info_cache "
+                                  "WHERE id=?", (self.item.id,))
+            cache._id_to_blob[self.item.id] = app.db.cursor.fetchone()[0]
+            del cache.id_to_info[self.item.id]
+        self.update_status(currentSize=500, rate=100, eta=5)
+        self.runUrgentCalls()
+        info = cache.get_info(self.item.id)
+        self.assertEquals(info.download_info.downloaded_size, 500)
+        self.assertEquals(info.download_info.rate, 100)
+        self.assertEquals(info.download_info.eta, 5)
+
+    def test_unchanged_download_not_resent(self):
+        # a new ItemInfo for the item has a new DownloadInfo, but it's
+        # equal to the last one, so we shouldn't send ItemsChanged
+        self.item.signal_change()
+        self.runUrgentCalls()
+        self.check_message_count(0)
+
+    def test_full_update_discards_progress(self):
+        self.update_status(currentSize=500, rate=100, eta=5)
+        self.update_status(currentSize=500, rate=0, eta=0, state=u'paused')
+        self.runUrgentCalls()
+        app.download_state_manager.send_progress()
+        # we should only send the ItemsChanged, since the progress we
+        # queued is older
+        self.check_message_count(1)
+        message = self.test_handler.messages[0]
+        self.assert_(isinstance(message, messages.ItemsChanged))
+        self.assertEquals(message.changed[0].id, self.item.id)
+        download_info = message.changed[0].download_info
+        self.assertEquals(download_info.state, u'paused')
+        self.assertEquals(download_info.downloaded_size, 500)
+        self.assertEquals(download_info.rate, 0)
+
 class PlaylistItemTrackTest(TrackerTest):
     def setUp(self):
         TrackerTest.setUp(self)
@@ -704,3 +878,266 @@ class ItemInfoCacheErrorTest(MiroTestCase):
         self.setup_new_item_info_cache()
         app.db.cursor.execute("SELECT COUNT(*) FROM item_info_cache")
         self.assertEquals(app.db.cursor.fetchone()[0], 0)
+
+class ItemInfoCacheLazyLoadTest(EventLoopTest):
+    def setUp(self):
+        EventLoopTest.setUp(self)
+        self.feed = Feed(u'dtv:manualFeed')
+        self.items = []
+        for i in xrange(5):
+            entry = _build_entry(u'http://example.com/%d' % i,
+                                 'video/x-unknown')
+            self.items.append(Item(FeedParserValues(entry),
+                                   feed_id=self.feed.id))
+        app.db.finish_transaction()
+        app.item_info_cache.save()
+        self.setup_new_item_info_cache()
+
+    def check_info(self, item):
+        info = app.item_info_cache.get_info(item.id)
+        real_info = itemsource.DatabaseItemSource._item_info_for(item)
+        self.assertEquals(info.__dict__, real_info.__dict__)
+
+    def test_lazy_load(self):
+        # load() should only unpickle 1 ItemInfo
+        self.assertEquals(len(app.item_info_cache.id_to_info), 1)
+        self.assertEquals(len(app.item_info_cache._id_to_blob), 4)
+        # get_info() should unpickle infos as needed
+        for item in self.items:
+            self.check_info(item)
+        self.assertEquals(len(app.item_info_cache._id_to_blob), 0)
+
+    def test_load_in_idles(self):
+        app.item_info_cache.LOAD_BATCH_SIZE = 3
+        app.item_info_cache._load_batch()
+        self.assertEquals(len(app.item_info_cache._id_to_blob), 1)
+        self.runPendingIdles()
+        self.assertEquals(len(app.item_info_cache._id_to_blob), 0)
+        self.assertEquals(len(app.item_info_cache.id_to_info), 5)
+        for item in self.items:
+            self.check_info(item)
+
+    def test_load_saved_data_from_thread(self):
+        # startup reads the saved data using LiveStorage.read_in_thread(),
+        # then passes it to load()
+        results = []
+        errors = []
+        cache = iteminfocache.ItemInfoCache()
+        app.db.read_in_thread(results.append, errors.append,
+                              cache.read_saved_data, 'read item info cache')
+        self.processThreads()
+        self.runPendingIdles()
+        self.assertEquals(errors, [])
+        cache.load(results[0])
+        app.item_info_cache = cache
+        self.assertEquals(len(cache.id_to_info) + len(cache._id_to_blob), 5)
+        for item in self.items:
+            self.check_info(item)
+
+    def test_saved_data_count_mismatch(self):
+        # if the item count doesn't match the saved data, we should do a
+        # failsafe load
+        cache = iteminfocache.ItemInfoCache()
+        id_to_blob, item_count = cache.read_saved_data(app.db.cursor)
+        id_to_blob.popitem()
+        cache.load((id_to_blob, item_count))
+        self.assertEquals(len(cache.id_to_info), 5)
+        self.assertEquals(cache._id_to_blob, {})
+
+    def test_all_infos(self):
+        self.assertEquals(len(app.item_info_cache.all_infos()), 5)
+        self.assertEquals(len(app.item_info_cache._id_to_blob), 0)
+
+    def test_bogus_data(self):
+        # Bogus data for a single item should be fixed when we load it
+        id_ = app.item_info_cache._id_to_blob.keys()[0]
+        app.item_info_cache._id_to_blob[id_] = buffer('BOGUS')
+        item = Item.get_by_id(id_)
+        self.check_info(item)
+        app.db.finish_transaction()
+        app.item_info_cache.save()
+        app.db.cursor.execute("SELECT pickle FROM item_info_cache "
+                "WHERE id=%s" % id_)
+        db_info = cPickle.loads(str(app.db.cursor.fetchone()[0]))
+        real_info = itemsource.DatabaseItemSource._item_info_for(item)
+        self.assertEquals(db_info.__dict__, real_info.__dict__)
+
+    def test_change_unloaded(self):
+        id_ = app.item_info_cache._id_to_blob.keys()[0]
+        item = Item.get_by_id(id_)
+        item.title = u'new title'
+        item.signal_change()
+        self.assert_(id_ not in app.item_info_cache._id_to_blob)
+        self.assertEquals(app.item_info_cache.get_info(id_).name,
+                          u'new title')
+
+    def test_remove_unloaded(self):
+        removed = []
+        def on_removed(cache, info):
+            removed.append(info.id)
+        app.item_info_cache.connect('removed', on_removed)
+        id_ = app.item_info_cache._id_to_blob.keys()[0]
+        Item.get_by_id(id_).remove()
+        self.assertEquals(removed, [id_])
+        self.assert_(id_ not in app.item_info_cache._id_to_blob)
+        self.assert_(id_ not in app.item_info_cache.id_to_info)
+
+class ItemInfoPickleTest(MiroTestCase):
+    def setUp(self):
+        MiroTestCase.setUp(self)
+        self.feed = Feed(u'dtv:manualFeed')
+        entry = _build_entry(u'http://example.com/1', 'video/x-unknown',
+                             {'description': u'<b>Bold</b> description'})
+        self.item = Item(FeedParserValues(entry), feed_id=self.feed.id)
+        self.info = itemsource.DatabaseItemSource._item_info_for(self.item)
+        self.old_calc_search_terms = messages.search.calc_search_terms
+        self.search_terms_calls = []
+        def calc_search_terms(info):
+            self.search_terms_calls.append(info.id)
+            return self.old_calc_search_terms(info)
+        messages.search.calc_search_terms = calc_search_terms
+
+    def tearDown(self):
+        messages.search.calc_search_terms = self.old_calc_search_terms
+        MiroTestCase.tearDown(self)
+
+    def round_trip(self, info):
+        return cPickle.loads(cPickle.dumps(info))
+
+    def test_derived_attributes_saved(self):
+        info = self.round_trip(self.info)
+        self.assertEquals(info.__dict__, self.info.__dict__)
+        # we shouldn't recalculate anything
+        self.assertEquals(self.search_terms_calls, [])
+
+    def test_source_changed(self):
+        self.info.description = u'<i>New</i> text'
+        self.info.name = u'New name'
+        info = self.round_trip(self.info)
+        self.assertEquals(self.search_terms_calls, [self.info.id])
+        self.assertEquals(info.description_stripped[0], u'New text')
+        self.assert_(u'new' in info.search_terms)
+        self.assertEquals(info.name_sort_key,
+                          util.name_sort_key(u'New name'))
+        # after recalculating, the hash should match again
+        self.round_trip(info)
+        self.assertEquals(self.search_terms_calls, [self.info.id])
+
+    def test_version_changed(self):
+        data = cPickle.dumps(self.info)
+        old_version = messages.ItemInfo.DERIVED_VERSION
+        messages.ItemInfo.DERIVED_VERSION += 1
+        try:
+            cPickle.loads(data)
+        finally:
+            messages.ItemInfo.DERIVED_VERSION = old_version
+        self.assertEquals(self.search_terms_calls, [self.info.id])
+
+    def test_old_pickle_data(self):
+        # data pickled before we saved the derived attributes
+        state = self.info.__dict__.copy()
+        del state['description_stripped']
+        del state['search_terms']
+        del state['derived_hash']
+        info = messages.ItemInfo.__new__(messages.ItemInfo)
+        info.__setstate__(state)
+        self.assertEquals(info.description_stripped,
+                          self.info.description_stripped)
+        self.assertEquals(info.search_terms, self.info.search_terms)
+        self.assertEquals(info.derived_hash, self.info.derived_hash)
+
+class EmptySnapshot(object):
+    def make_rows(self):
+        return [], [], []
+
+class ItemInfoCacheWriterTest(EventLoopTest):
+    def setUp(self):
+        EventLoopTest.setUp(self)
+        self.feed = Feed(u'dtv:manualFeed')
+        app.db.finish_transaction()
+        app.item_info_cache.save()
+        app.item_info_cache.writer.reset_stats()
+
+    def make_item(self, url):
+        entry = _build_entry(url, 'video/x-unknown')
+        return Item(FeedParserValues(entry), feed_id=self.feed.id)
+
+    def get_saved_ids(self):
+        app.db.cursor.execute("SELECT id FROM item_info_cache")
+        return set(row[0] for row in app.db.cursor.fetchall())
+
+    def test_save_in_background(self):
+        item1 = self.make_item(u'http://example.com/1')
+        item2 = self.make_item(u'http://example.com/2')
+        app.item_info_cache._save_in_background()
+        item1.title = u'new title'
+        item1.signal_change()
+        item2.remove()
+        app.item_info_cache._save_in_background()
+        writer = app.item_info_cache.writer
+        writer.flush()
+        self.assertEquals(self.get_saved_ids(), set([item1.id]))
+        app.db.cursor.execute("SELECT pickle FROM item_info_cache "
+                "WHERE id=%s" % item1.id)
+        db_info = cPickle.loads(str(app.db.cursor.fetchone()[0]))
+        self.assertEquals(db_info.name, u'new title')
+        stats = app.item_info_cache.get_save_stats()
+        self.assertEquals(stats['saves'], 2)
+        self.assertEquals(stats['rows_written'], 4)
+        self.assertEquals(stats['queue_depth'], 0)
+
+    def test_queue_full(self):
+        writer = app.item_info_cache.writer
+        for i in xrange(writer.QUEUE_SIZE):
+            writer.queue.put_nowait(EmptySnapshot())
+        item = self.make_item(u'http://example.com/1')
+        app.item_info_cache._save_in_background()
+        # the queue was full, so the changes should still be waiting
+        self.assert_(item.id in app.item_info_cache._infos_added)
+        self.assertEquals(app.item_info_cache.get_save_stats()[
+            'queue_full_count'], 1)
+        while not writer.queue.empty():
+            writer.queue.get_nowait()
+        app.item_info_cache.save()
+        self.assertEquals(self.get_saved_ids(), set([item.id]))
+
+    def test_main_thread_chunks(self):
+        # Without WAL, the writer hands the rows back to the event loop.  It
+        # should write them a chunk at a time.
+        writer = app.item_info_cache.writer
+        self.assertEquals(writer.db_path, None)
+        writer.MAIN_THREAD_CHUNK_SIZE = 2
+        items = [self.make_item(u'http://example.com/%d' % i)
+                 for i in xrange(3)]
+        app.item_info_cache._save_in_background()
+        writer.queue.join()
+        self.assertEquals(len(writer._main_thread_rows), 2)
+        writer._write_main_thread_chunk()
+        self.assertEquals(len(self.get_saved_ids()), 2)
+        writer._write_main_thread_chunk()
+        self.assertEquals(self.get_saved_ids(),
+                          set(item.id for item in items))
+
+    def test_pickle_error(self):
+        # If an ItemInfo can't be pickled, the rest of the snapshot should
+        # still get saved and the failed item should be retried.
+        item1 = self.make_item(u'http://example.com/1')
+        item2 = self.make_item(u'http://example.com/2')
+        real_info_to_blob = iteminfocache._info_to_blob
+        def info_to_blob(info):
+            if info.id == item1.id:
+                raise cPickle.PicklingError("can't pickle")
+            return real_info_to_blob(info)
+        iteminfocache._info_to_blob = info_to_blob
+        try:
+            app.item_info_cache._save_in_background()
+            app.item_info_cache.writer.flush()
+            self.runPendingIdles()
+        finally:
+            iteminfocache._info_to_blob = real_info_to_blob
+        self.assertEquals(self.get_saved_ids(), set([item2.id]))
+        self.assertEquals(app.item_info_cache.get_save_stats()[
+            'pickle_errors'], 1)
+        self.assert_(item1.id in app.item_info_cache._infos_added)
+        app.item_info_cache.save()
+        self.assertEquals(self.get_saved_ids(), set([item1.id, item2.id]))
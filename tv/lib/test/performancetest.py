@@ -1,14 +1,24 @@
+import gc
+import random
 import shutil
+import sys
+import time
 import os
 import pstats
 import cProfile
 
 from miro import app
+from miro import item
 from miro import messagehandler
 from miro import messages
 from miro import models
+from miro import iteminfocache
+from miro import queryplan
+from miro import search
+from miro import ngrams
 from miro.fileobject import FilenameType
-from miro.test.framework import EventLoopTest
+from miro.singleclick import _build_entry
+from miro.test.framework import MiroTestCase, EventLoopTest
 from miro.test import messagetest
 
 class PerformanceTest(EventLoopTest):
@@ -66,3 +76,509 @@ class PerformanceTest(EventLoopTest):
     def track_item_count(self):
         messages.TrackNewVideoCount().send_to_backend()
         self.runUrgentCalls()
+
+class ViewTrackerPerformanceTest(EventLoopTest):
+    """Compare checking view membership using SQL vs compiled predicates."""
+
+    ITEM_COUNT = 50000
+    CHANGED_ITEM_COUNT = 300
+
+    def setUp(self):
+        EventLoopTest.setUp(self)
+        save_path = FilenameType(self.make_temp_path(extension=".db"))
+        self.reload_database(save_path)
+        self.feeds = [models.Feed(u'http://example.com/feed%d' % i)
+                      for i in xrange(10)]
+        self.feeds.append(models.Feed(u'dtv:manualFeed'))
+        app.bulk_sql_manager.start()
+        for i in xrange(self.ITEM_COUNT):
+            feed = self.feeds[i % len(self.feeds)]
+            models.Item(item.FeedParserValues({'title': u'item%d' % i}),
+                        feed_id=feed.id)
+        app.bulk_sql_manager.finish()
+        self.views = [
+            models.Item.feed_view(self.feeds[0].id),
+            models.Item.visible_feed_view(self.feeds[1].id),
+            models.Item.feed_available_view(self.feeds[2].id),
+            models.Item.toplevel_view(),
+            models.Item.auto_pending_view(),
+            models.Item.download_tab_view(),
+            models.Item.unique_new_video_view(),
+            models.Item.unique_new_audio_view(),
+            models.Item.watchable_video_view(),
+            models.Item.watchable_audio_view(),
+        ]
+        self.trackers = [view.make_tracker() for view in self.views]
+        self.changed_items = list(models.Item.make_view(
+            limit=self.CHANGED_ITEM_COUNT))
+
+    def _time_checks(self, check_func):
+        start = time.time()
+        for obj in self.changed_items:
+            for tracker in self.trackers:
+                check_func(tracker, obj)
+        return time.time() - start
+
+    def test_check_object(self):
+        def check_sql(tracker, obj):
+            return tracker._obj_in_view_sql(obj)
+        def check_predicate(tracker, obj):
+            return tracker.predicate.matches(obj)
+        for tracker in self.trackers:
+            self.assertNotEquals(tracker.predicate, None)
+        sql_time = self._time_checks(check_sql)
+        predicate_time = self._time_checks(check_predicate)
+        checks = len(self.changed_items) * len(self.trackers)
+        print
+        print 'view checks on %d items: %d' % (self.ITEM_COUNT, checks)
+        print 'SQL:       %0.3f seconds (%0.1f usec/check)' % (sql_time,
+                sql_time * 1000000 / checks)
+        print 'predicate: %0.3f seconds (%0.1f usec/check)' % (
+                predicate_time, predicate_time * 1000000 / checks)
+
+class _RowObject(object):
+    """Stand-in for a DDBObject when timing row encoders."""
+    def __init__(self, data):
+        self.__dict__.update(data)
+
+class RowConverterPerformanceTest(EventLoopTest):
+    """Compare the per-table row decoders/encoders with converting values
+    one at a time.
+    """
+
+    ITEM_COUNT = 10000
+
+    def setUp(self):
+        EventLoopTest.setUp(self)
+        save_path = FilenameType(self.make_temp_path(extension=".db"))
+        self.reload_database(save_path)
+        feeds = [models.Feed(u'http://example.com/feed%d' % i)
+                 for i in xrange(10)]
+        app.bulk_sql_manager.start()
+        for i in xrange(self.ITEM_COUNT):
+            models.Item(item.FeedParserValues({'title': u'item%d' % i}),
+                        feed_id=feeds[i % len(feeds)].id)
+        app.bulk_sql_manager.finish()
+
+    def _rows_for_schema(self, obj_schema):
+        columns = ', '.join(name for name, schema_item in obj_schema.fields)
+        app.db.cursor.execute("SELECT %s FROM %s" % (columns,
+                              obj_schema.table_name))
+        return app.db.cursor.fetchall()
+
+    def _time_calls(self, func, args_list):
+        start = time.time()
+        for args in args_list:
+            func(*args)
+        return time.time() - start
+
+    def test_row_converters(self):
+        converter = app.db._converter
+        def decode_slow(obj_schema, row):
+            data = {}
+            for (name, schema_item), value in zip(obj_schema.fields, row):
+                data[name] = converter.from_sql(obj_schema, name,
+                        schema_item, value)
+            return data
+        def decode_fast(obj_schema, row):
+            return app.db._row_decoders[obj_schema](row)
+        def encode_slow(obj_schema, obj):
+            return app.db._values_for_obj_slow(obj_schema, obj)
+        def encode_fast(obj_schema, obj):
+            return app.db._row_encoders[obj_schema](obj)
+
+        print
+        print '%-26s %6s %14s %14s %14s %14s' % ('table', 'rows',
+                'restore/s', 'restore/s fast', 'insert/s', 'insert/s fast')
+        for obj_schema in app.db._all_schemas:
+            rows = self._rows_for_schema(obj_schema)
+            if not rows:
+                continue
+            decode_args = [(obj_schema, row) for row in rows]
+            objects = [_RowObject(decode_fast(obj_schema, row))
+                       for row in rows]
+            encode_args = [(obj_schema, obj) for obj in objects]
+            results = []
+            for func, args_list in ((decode_slow, decode_args),
+                                    (decode_fast, decode_args),
+                                    (encode_slow, encode_args),
+                                    (encode_fast, encode_args)):
+                elapsed = self._time_calls(func, args_list)
+                results.append(len(rows) / max(elapsed, 0.000001))
+            print '%-26s %6d %14d %14d %14d %14d' % tuple(
+                    [obj_schema.table_name, len(rows)] + results)
+
+class QueryPlanPerformanceTest(EventLoopTest):
+    """Audit the query plans for all Item views and time how much the
+    suggested indexes help.
+    """
+
+    ITEM_COUNT = 100000
+    FEED_COUNT = 50
+
+    # indexes added in upgrade181
+    ADDED_INDEXES = (
+        ('downloader_main_item', 'remote_downloader', ('main_item_id',)),
+        ('item_feed_release', 'item', ('feed_id', 'releaseDateObj')),
+    )
+
+    def setUp(self):
+        EventLoopTest.setUp(self)
+        save_path = FilenameType(self.make_temp_path(extension=".db"))
+        self.reload_database(save_path)
+        feeds = [models.Feed(u'http://example.com/feed%d' % i)
+                 for i in xrange(self.FEED_COUNT)]
+        feeds.append(models.Feed(u'dtv:manualFeed'))
+        app.bulk_sql_manager.start()
+        for i in xrange(self.ITEM_COUNT):
+            models.Item(item.FeedParserValues({'title': u'item%d' % i}),
+                        feed_id=feeds[i % len(feeds)].id)
+        app.bulk_sql_manager.finish()
+
+    def _time_view(self, view, repeat=3):
+        best = None
+        for i in xrange(repeat):
+            start = time.time()
+            view.id_list()
+            elapsed = time.time() - start
+            if best is None or elapsed < best:
+                best = elapsed
+        return best
+
+    def _time_all_views(self):
+        return dict((name, self._time_view(view))
+                    for name, view in queryplan.item_views())
+
+    def test_added_indexes(self):
+        with_indexes = self._time_all_views()
+        for name, table, columns in self.ADDED_INDEXES:
+            app.db.cursor.execute("DROP INDEX %s" % name)
+        without_indexes = self._time_all_views()
+        for name, table, columns in self.ADDED_INDEXES:
+            app.db.cursor.execute("CREATE INDEX %s ON %s (%s)" % (name,
+                                  table, ', '.join(columns)))
+        print
+        print 'views on %d items, without/with upgrade181 indexes' % (
+                self.ITEM_COUNT)
+        for name in sorted(with_indexes):
+            print '%-32s %9.2fms %9.2fms' % (name,
+                    without_indexes[name] * 1000, with_indexes[name] * 1000)
+
+    def test_suggestions(self):
+        plans = queryplan.audit_item_views()
+        print
+        print queryplan.format_report(plans)
+        print
+        print 'views on %d items, before/after suggested indexes' % (
+                self.ITEM_COUNT)
+        views = dict(queryplan.item_views())
+        for plan in plans:
+            if not plan.suggestions:
+                continue
+            view = views[plan.name]
+            before = self._time_view(view)
+            for suggestion in plan.suggestions:
+                app.db.cursor.execute(suggestion.sql())
+            after = self._time_view(view)
+            for suggestion in plan.suggestions:
+                app.db.cursor.execute("DROP INDEX %s" % suggestion.name)
+            print '%-32s %9.2fms %9.2fms' % (plan.name, before * 1000,
+                                              after * 1000)
+
+class ItemInfoCacheLoadPerformanceTest(EventLoopTest):
+    """Time loading the item info cache at startup.
+
+    Compare using the derived ItemInfo attributes that we pickled with
+    recalculating them (which is what we used to do for every item).
+    """
+
+    ITEM_COUNT = 20000
+
+    def setUp(self):
+        EventLoopTest.setUp(self)
+        save_path = FilenameType(self.make_temp_path(extension=".db"))
+        self.reload_database(save_path)
+        feed = models.Feed(u'http://example.com/feed')
+        description = (u'<p>This is the <b>description</b> for '
+                       u'<a href="http://example.com/">an item</a>.</p>' * 5)
+        app.bulk_sql_manager.start()
+        for i in xrange(self.ITEM_COUNT):
+            models.Item(item.FeedParserValues({
+                'title': u'item%d' % i,
+                'description': description,
+                }), feed_id=feed.id)
+        app.bulk_sql_manager.finish()
+        app.db.finish_transaction()
+        app.item_info_cache.save()
+
+    def _time_load(self):
+        start = time.time()
+        cache = iteminfocache.ItemInfoCache()
+        cache.load()
+        cache.all_infos()
+        return time.time() - start
+
+    def test_load(self):
+        saved_time = self._time_load()
+        old_version = messages.ItemInfo.DERIVED_VERSION
+        # changing DERIVED_VERSION makes all the pickled data invalid, so
+        # we have to recalculate everything
+        messages.ItemInfo.DERIVED_VERSION += 1
+        try:
+            recalc_time = self._time_load()
+        finally:
+            messages.ItemInfo.DERIVED_VERSION = old_version
+        print
+        print 'loading %d item infos' % self.ITEM_COUNT
+        print 'saved derived attributes:   %0.3f seconds' % saved_time
+        print 'recalculated attributes:    %0.3f seconds' % recalc_time
+
+class DownloadProgressPerformanceTest(EventLoopTest):
+    """Time the backend handling status updates for active downloads.
+
+    Compare sending progress with DownloadProgress messages against
+    rebuilding the ItemInfos and sending ItemsChanged.
+    """
+
+    DOWNLOAD_COUNT = 100
+    ROUNDS = 30
+
+    def setUp(self):
+        EventLoopTest.setUp(self)
+        models.Feed(u'dtv:search')
+        self.test_handler = messagetest.TestFrontendMessageHandler()
+        messages.FrontendMessage.install_handler(self.test_handler)
+        self.backend_message_handler = messagehandler.BackendMessageHandler(
+            None)
+        messages.BackendMessage.install_handler(self.backend_message_handler)
+        feed = models.Feed(u'dtv:manualFeed')
+        self.downloaders = []
+        for i in xrange(self.DOWNLOAD_COUNT):
+            url = u'http://example.com/movie%d.mpeg' % i
+            entry = _build_entry(url, 'video/mpeg', {'title': u'item%d' % i})
+            item_ = models.Item(item.FeedParserValues(entry),
+                                feed_id=feed.id)
+            downloader = models.RemoteDownloader(url, item_, u'video/mpeg')
+            item_.set_downloader(downloader)
+            self.downloaders.append(downloader)
+        self.current_size = 0
+        self.send_status_updates()
+        # track the lists that the frontend would show while downloading
+        messages.TrackItems('downloading', 'downloading').send_to_backend()
+        messages.TrackItems('feed', feed.id).send_to_backend()
+        self.runUrgentCalls()
+
+    def tearDown(self):
+        EventLoopTest.tearDown(self)
+        messages.BackendMessage.reset_handler()
+        messages.FrontendMessage.reset_handler()
+
+    def send_status_updates(self):
+        self.current_size += 1000
+        for downloader in self.downloaders:
+            downloader.last_update = 0
+            models.RemoteDownloader.update_status({
+                'dlid': downloader.dlid,
+                'state': u'downloading',
+                'totalSize': 1000000,
+                'currentSize': self.current_size,
+                'rate': self.current_size,
+                'eta': 1000000 - self.current_size,
+                })
+        self.runUrgentCalls()
+        app.download_state_manager.send_progress()
+
+    def _time_updates(self):
+        start = time.clock()
+        for i in xrange(self.ROUNDS):
+            self.send_status_updates()
+        return time.clock() - start
+
+    def test_progress(self):
+        progress_time = self._time_updates()
+        only_progress_changed = models.RemoteDownloader._only_progress_changed
+        models.RemoteDownloader._only_progress_changed = (
+            lambda self, old_status: False)
+        try:
+            items_changed_time = self._time_updates()
+        finally:
+            models.RemoteDownloader._only_progress_changed = (
+                only_progress_changed)
+        print
+        print '%d rounds of updates for %d downloads' % (self.ROUNDS,
+                                                         self.DOWNLOAD_COUNT)
+        print 'DownloadProgress:    %0.3f CPU seconds' % progress_time
+        print 'ItemsChanged:        %0.3f CPU seconds' % items_changed_time
+
+def _memory_usage(obj):
+    """Estimate the memory used by an object and everything it contains."""
+    seen = set()
+    to_check = [obj]
+    total = 0
+    while to_check:
+        obj = to_check.pop()
+        if id(obj) in seen:
+            continue
+        seen.add(id(obj))
+        total += sys.getsizeof(obj)
+        if isinstance(obj, dict):
+            to_check.extend(obj.iterkeys())
+            to_check.extend(obj.itervalues())
+        elif isinstance(obj, (list, tuple, set, frozenset)):
+            to_check.extend(obj)
+    return total
+
+class ItemSearcherPerformanceTest(MiroTestCase):
+    """Compare ItemSearcher with the old way of storing the index.
+
+    The old ItemSearcher stored a set of item ids for each N-gram and a list
+    of N-grams for each item.
+    """
+
+    ITEM_COUNT = 5000
+    WORDS_PER_ITEM = 20
+    QUERIES = [u'abc', u'item', u'hello world', u'abcde fgh', u'-xyz foo']
+
+    def setUp(self):
+        MiroTestCase.setUp(self)
+        rand = random.Random(1)
+        letters = u'abcdefghijklmnopqrstuvwxyz'
+        vocabulary = [u''.join(rand.choice(letters)
+                               for j in xrange(rand.randint(3, 10)))
+                      for i in xrange(2000)]
+        vocabulary.extend([u'hello', u'world', u'item'])
+        self.item_terms = [(i, [rand.choice(vocabulary)
+                                for j in xrange(self.WORDS_PER_ITEM)])
+                           for i in xrange(self.ITEM_COUNT)]
+
+    def build_set_index(self):
+        ngram_map = {}
+        item_ngrams = {}
+        for item_id, terms in self.item_terms:
+            grams = ngrams.breakup_list(terms, search.NGRAM_MIN,
+                                        search.NGRAM_MAX)
+            for gram in grams:
+                ngram_map.setdefault(gram, set()).add(item_id)
+            item_ngrams[item_id] = grams
+        return ngram_map, item_ngrams
+
+    def search_set_index(self, ngram_map, query):
+        parsed_search = search._get_boolean_search(query)
+        matches = None
+        for term in parsed_search.positive_terms:
+            for gram in search._ngrams_for_term(term):
+                if matches is None:
+                    matches = set(ngram_map.get(gram, ()))
+                else:
+                    matches.intersection_update(ngram_map.get(gram, ()))
+        for term in parsed_search.negative_terms:
+            term_matches = None
+            for gram in search._ngrams_for_term(term):
+                if term_matches is None:
+                    term_matches = set(ngram_map.get(gram, ()))
+                else:
+                    term_matches.intersection_update(ngram_map.get(gram, ()))
+            matches.difference_update(term_matches or ())
+        return matches
+
+    def build_searcher(self):
+        searcher = search.ItemSearcher()
+        for item_id, terms in self.item_terms:
+            searcher.add_item_terms(item_id, terms)
+        return searcher
+
+    def time_queries(self, search_func, repeat=20):
+        start = time.time()
+        for i in xrange(repeat):
+            for query in self.QUERIES:
+                search_func(query)
+        return (time.time() - start) / (repeat * len(self.QUERIES))
+
+    def test_benchmark(self):
+        gc.collect()
+        start = time.time()
+        ngram_map, item_ngrams = self.build_set_index()
+        set_build_time = time.time() - start
+        set_memory = _memory_usage((ngram_map, item_ngrams))
+        set_search_time = self.time_queries(
+            lambda query: self.search_set_index(ngram_map, query))
+
+        start = time.time()
+        searcher = self.build_searcher()
+        build_time = time.time() - start
+        memory = _memory_usage((searcher._ngram_ids, searcher._ngrams,
+                                searcher._postings, searcher._item_ngrams))
+        search_time = self.time_queries(searcher.search)
+
+        for query in self.QUERIES:
+            self.assertEquals(searcher.search(query),
+                              self.search_set_index(ngram_map, query))
+        self.assert_(memory < set_memory)
+
+        print
+        print 'indexing %d items' % self.ITEM_COUNT
+        print 'sets:          %0.3fs build, %0.1f MB, %0.3fms/search' % (
+            set_build_time, set_memory / 1048576.0, set_search_time * 1000)
+        print 'posting lists: %0.3fs build, %0.1f MB, %0.3fms/search' % (
+            build_time, memory / 1048576.0, search_time * 1000)
+
+class _TermsInfo(object):
+    def __init__(self, search_terms):
+        self.search_terms = search_terms
+
+class ListMatchesPerformanceTest(MiroTestCase):
+    """Time list_matches() for an incremental search over a large list."""
+
+    ITEM_COUNT = 50000
+    WORDS_PER_ITEM = 20
+    # searches that a user would go through while typing "hello"
+    QUERIES = [u'hel', u'hell', u'hello']
+
+    def setUp(self):
+        MiroTestCase.setUp(self)
+        rand = random.Random(1)
+        letters = u'abcdefghijklmnopqrstuvwxyz'
+        vocabulary = [u''.join(rand.choice(letters)
+                               for j in xrange(rand.randint(3, 10)))
+                      for i in xrange(2000)]
+        vocabulary.append(u'hello')
+        self.infos = [_TermsInfo([rand.choice(vocabulary)
+                                  for j in xrange(self.WORDS_PER_ITEM)])
+                      for i in xrange(self.ITEM_COUNT)]
+
+    def old_list_matches(self, query):
+        # how list_matches() used to work: calculate a set of N-grams for
+        # each item
+        positive_set = set(search._ngrams_for_term(query))
+        return [info for info in self.infos
+                if positive_set.issubset(set(ngrams.breakup_list(
+                    info.search_terms, search.NGRAM_MIN, search.NGRAM_MAX)))]
+
+    def time_call(self, func, *args):
+        start = time.time()
+        rv = func(*args)
+        return rv, time.time() - start
+
+    def test_benchmark(self):
+        print
+        print 'incremental search of %d items' % self.ITEM_COUNT
+        for query in self.QUERIES:
+            old_results, old_time = self.time_call(self.old_list_matches,
+                                                   query)
+            results, new_time = self.time_call(list, search.list_matches(
+                self.infos, query))
+            self.assertEquals(results, old_results)
+            print '%-6s old: %0.3fs  list_matches(): %0.3fs' % (query,
+                    old_time, new_time)
+        infos = self.infos[:1000]
+        start = time.time()
+        for info in infos:
+            set(ngrams.breakup_list(info.search_terms, search.NGRAM_MIN,
+                                    search.NGRAM_MAX))
+        list_time = time.time() - start
+        start = time.time()
+        for info in infos:
+            search._ngrams_for_item(info)
+        set_time = time.time() - start
+        print 'N-grams for %d items: breakup_list: %0.3fs  ' \
+                'breakup_set: %0.3fs' % (len(infos), list_time, set_time)
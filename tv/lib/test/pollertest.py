@@ -0,0 +1,163 @@
+import select
+import socket
+
+from miro import eventloop
+from miro import util
+from miro.test.framework import MiroTestCase, EventLoopTest
+
+class PollerTestBase(object):
+    def setUp(self):
+        self.poller = self.make_poller()
+        self.sender, self.receiver = util.make_dummy_socket_pair()
+
+    def tearDown(self):
+        self.poller.close()
+        self.sender.close()
+        self.receiver.close()
+
+    def check_poll(self, read_ready, write_ready):
+        got_read, got_write, got_exc = self.poller.poll(0)
+        self.assertEquals(sorted(got_read), sorted(read_ready))
+        self.assertEquals(sorted(got_write), sorted(write_ready))
+
+    def check_exc_poll(self, exc_ready):
+        got_read, got_write, got_exc = self.poller.poll(0)
+        self.assertEquals(got_read, [])
+        self.assertEquals(got_write, [])
+        self.assertEquals(list(got_exc), exc_ready)
+
+    def test_read(self):
+        fd = self.receiver.fileno()
+        self.poller.add_reader(fd)
+        self.check_poll([], [])
+        self.sender.send("a")
+        # wait for the data to arrive
+        self.poller.poll(1.0)
+        self.check_poll([fd], [])
+        self.poller.remove_reader(fd)
+        self.check_poll([], [])
+
+    def test_write(self):
+        fd = self.sender.fileno()
+        self.poller.add_writer(fd)
+        self.check_poll([], [fd])
+        self.poller.add_reader(fd)
+        self.check_poll([], [fd])
+        self.poller.remove_writer(fd)
+        self.check_poll([], [])
+        self.poller.remove_reader(fd)
+        self.check_poll([], [])
+
+    def test_remove_unregistered(self):
+        # removing fds that aren't registered should be a no-op
+        self.poller.remove_reader(self.receiver.fileno())
+        self.poller.remove_writer(self.receiver.fileno())
+        self.check_poll([], [])
+
+    def test_set_fds(self):
+        read_fd = self.receiver.fileno()
+        write_fd = self.sender.fileno()
+        self.sender.send("a")
+        self.poller.set_fds([read_fd], [write_fd])
+        self.poller.poll(1.0)
+        self.check_poll([read_fd], [write_fd])
+        self.poller.set_fds([], [write_fd])
+        self.check_poll([], [write_fd])
+        self.poller.set_fds([], [])
+        self.check_poll([], [])
+
+    def test_exceptional_condition(self):
+        # urgent data is an exceptional condition for select()
+        fd = self.receiver.fileno()
+        self.poller.set_fds([], [], [fd])
+        self.check_exc_poll([])
+        self.sender.send("a", socket.MSG_OOB)
+        self.poller.poll(1.0)
+        self.check_exc_poll([fd])
+        self.poller.set_fds([], [], [])
+        self.check_exc_poll([])
+
+    def test_hangup(self):
+        # when the other end closes, readers should wake up
+        fd = self.receiver.fileno()
+        self.poller.add_reader(fd)
+        self.sender.close()
+        self.poller.poll(1.0)
+        self.check_poll([fd], [])
+
+class SelectPollerTest(PollerTestBase, MiroTestCase):
+    def setUp(self):
+        MiroTestCase.setUp(self)
+        PollerTestBase.setUp(self)
+
+    def tearDown(self):
+        PollerTestBase.tearDown(self)
+        MiroTestCase.tearDown(self)
+
+    def make_poller(self):
+        return eventloop.SelectPoller()
+
+if hasattr(select, 'poll'):
+    class PollPollerTest(SelectPollerTest):
+        def make_poller(self):
+            return eventloop.PollPoller()
+
+if hasattr(select, 'epoll'):
+    class EpollPollerTest(SelectPollerTest):
+        def make_poller(self):
+            return eventloop.EpollPoller()
+
+        def test_closed_fd_reused(self):
+            # the kernel drops closed fds from the epoll set.  Make sure
+            # we can still register a new socket that reuses the fd.
+            fd = self.receiver.fileno()
+            self.poller.add_reader(fd)
+            self.receiver.close()
+            self.sender.close()
+            self.sender, self.receiver = util.make_dummy_socket_pair()
+            new_fd = self.receiver.fileno()
+            self.poller.remove_reader(fd)
+            self.poller.add_reader(new_fd)
+            self.sender.send("a")
+            self.poller.poll(1.0)
+            self.check_poll([new_fd], [])
+
+class EventLoopPollerTest(EventLoopTest):
+    def setUp(self):
+        EventLoopTest.setUp(self)
+        self.sender, self.receiver = util.make_dummy_socket_pair()
+        self.got_data = []
+
+    def tearDown(self):
+        self.sender.close()
+        self.receiver.close()
+        EventLoopTest.tearDown(self)
+
+    def on_readable(self):
+        self.got_data.append(self.receiver.recv(1024))
+        eventloop.remove_read_callback(self.receiver)
+        eventloop.shutdown()
+
+    def test_read_callback(self):
+        eventloop.add_read_callback(self.receiver, self.on_readable)
+        self.sender.send("abc")
+        self.runEventLoop()
+        self.assertEquals(self.got_data, ["abc"])
+        poller = eventloop._eventloop.poller
+        self.assert_(self.receiver.fileno() not in poller.readers)
+
+    def test_failing_callback_is_unregistered(self):
+        self.error_signal_okay = True
+        def bad_callback():
+            eventloop.shutdown()
+            raise ValueError("bad callback")
+        eventloop.add_read_callback(self.receiver, bad_callback)
+        self.sender.send("abc")
+        self.runEventLoop()
+        # the error should be reported...
+        self.assert_(self.saw_error)
+        # ...and the callback removed
+        self.assert_(self.receiver.fileno() not in
+                     eventloop._eventloop.read_callbacks)
+        poller = eventloop._eventloop.poller
+        self.assert_(self.receiver.fileno() not in poller.readers)
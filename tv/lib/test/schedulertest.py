@@ -1,8 +1,9 @@
 from time import time, sleep
+import os
 import threading
 
 from miro import eventloop
-from miro.test.framework import EventLoopTest
+from miro.test.framework import EventLoopTest, MiroTestCase
 
 class SchedulerTest(EventLoopTest):
     def setUp(self):
@@ -57,3 +58,239 @@ class SchedulerTest(EventLoopTest):
         self.runEventLoop()
         totalCalls = len(timeouts) * threadCount + 1
         self.assertEquals(len(self.got_args), totalCalls)
+
+class SchedulerHeapTest(MiroTestCase):
+    def setUp(self):
+        MiroTestCase.setUp(self)
+        self.scheduler = eventloop.Scheduler(slack=0)
+        self.called = []
+
+    def callback(self, value):
+        self.called.append(value)
+
+    def add_timeout(self, delay, value):
+        return self.scheduler.add_timeout(delay, self.callback, "foo",
+                                          args=(value,))
+
+    def run_timeouts(self):
+        while self.scheduler.has_pending_timeout():
+            self.scheduler.process_next_timeout()
+
+    def test_cancel(self):
+        self.add_timeout(0, 1)
+        dc = self.add_timeout(0, 2)
+        self.add_timeout(0, 3)
+        dc.cancel()
+        # canceling twice shouldn't mess up the counts
+        dc.cancel()
+        stats = self.scheduler.get_stats()
+        self.assertEquals(stats['live_timers'], 2)
+        self.assertEquals(stats['canceled_entries'], 1)
+        self.run_timeouts()
+        self.assertEquals(self.called, [1, 3])
+        stats = self.scheduler.get_stats()
+        self.assertEquals(stats['live_timers'], 0)
+        self.assertEquals(stats['canceled_entries'], 0)
+        self.assertEquals(stats['dispatched'], 2)
+
+    def test_cancel_after_dispatch(self):
+        dc = self.add_timeout(0, 1)
+        self.run_timeouts()
+        dc.cancel()
+        self.assertEquals(self.scheduler.get_stats()['canceled_entries'], 0)
+
+    def test_canceled_timeouts_dont_wake_us_up(self):
+        self.add_timeout(10, 1)
+        dc = self.add_timeout(0, 2)
+        dc.cancel()
+        self.assert_(self.scheduler.next_timeout() > 5)
+
+    def test_compact(self):
+        count = eventloop.Scheduler.COMPACT_THRESHOLD * 2
+        dcs = [self.add_timeout(10, i) for i in xrange(count)]
+        self.add_timeout(0, 'live')
+        for dc in dcs:
+            dc.cancel()
+        stats = self.scheduler.get_stats()
+        self.assert_(stats['compactions'] > 0)
+        self.assertEquals(stats['live_timers'], 1)
+        self.assert_(len(self.scheduler.heap) < count)
+        self.run_timeouts()
+        self.assertEquals(self.called, ['live'])
+
+    def test_fifo_order(self):
+        for i in xrange(10):
+            self.add_timeout(0, i)
+        self.run_timeouts()
+        self.assertEquals(self.called, range(10))
+
+    def test_coalesce(self):
+        self.scheduler.slack = 0.5
+        for i in xrange(10):
+            self.add_timeout(1.0 + i * 0.01, i)
+        times = set(entry[0] for entry in self.scheduler.heap)
+        self.assert_(len(times) <= 2)
+        # short timeouts shouldn't be delayed
+        self.add_timeout(0, 'now')
+        self.run_timeouts()
+        self.assertEquals(self.called, ['now'])
+
+class InstrumentationTest(EventLoopTest):
+    def setUp(self):
+        EventLoopTest.setUp(self)
+        eventloop.enable_instrumentation()
+        self.instrumentation = eventloop.get_instrumentation()
+
+    def callback(self):
+        pass
+
+    def test_record_events(self):
+        eventloop.add_idle(self.callback, "idle callback")
+        eventloop.add_urgent_call(self.callback, "urgent callback")
+        eventloop.add_timeout(0.05, self.callback, "timeout callback")
+        eventloop.add_timeout(0.1, eventloop.shutdown, "stop")
+        self.runEventLoop()
+        run_times = self.instrumentation.run_times
+        self.assert_(('idle', 'idle (idle callback)') in run_times)
+        self.assert_(('urgent', 'idle (urgent callback)') in run_times)
+        self.assert_(('timeout', 'timeout (timeout callback)') in
+                     run_times)
+        self.assert_(('idle', 'idle (idle callback)') in
+                     self.instrumentation.wait_times)
+        self.assert_(self.instrumentation.iteration_times.count > 0)
+        # just check that formatting the report doesn't crash
+        self.instrumentation.format_report()
+
+    def test_slowest_calls(self):
+        for i in range(5):
+            self.instrumentation.record_event('idle', 'fast', 0, 0.001)
+        self.instrumentation.record_event('idle', 'slow', 0, 1.0)
+        self.instrumentation.record_event('timeout', 'medium', None, 0.1)
+        slowest = self.instrumentation.slowest_calls(2)
+        self.assertEquals(slowest, [(1.0, 'idle', 'slow', 1),
+                                    (0.1, 'timeout', 'medium', 1)])
+
+    def test_iteration_percentiles(self):
+        for i in range(100):
+            self.instrumentation.record_iteration(i / 100.0)
+        percentiles = self.instrumentation.iteration_percentiles((50, 99))
+        self.assertAlmostEqual(percentiles[50], 0.49)
+        self.assertAlmostEqual(percentiles[99], 0.98)
+
+    def test_histogram(self):
+        histogram = eventloop.Histogram()
+        for value in (0.00001, 0.002, 0.003, 2.0):
+            histogram.add(value)
+        self.assertEquals(histogram.count, 4)
+        self.assertEquals(histogram.max, 2.0)
+        self.assertEquals(histogram.percentile(50), 0.005)
+        self.assertEquals(histogram.percentile(100), 2.0)
+
+    def test_disable(self):
+        eventloop.disable_instrumentation()
+        self.assertEquals(eventloop.get_instrumentation(), None)
+        eventloop.add_idle(self.callback, "idle callback")
+        eventloop.add_timeout(0.05, eventloop.shutdown, "stop")
+        self.runEventLoop()
+        self.assertEquals(self.instrumentation.run_times, {})
+
+    def test_dump_on_shutdown(self):
+        path = os.path.join(self.tempdir, 'loopstats.txt')
+        eventloop.enable_instrumentation(path)
+        eventloop.add_idle(self.callback, "idle callback")
+        eventloop.add_timeout(0.05, eventloop.shutdown, "stop")
+        self.runEventLoop()
+        self.assert_(os.path.exists(path))
+        self.assert_('idle callback' in open(path).read())
+
+class ThreadPoolTest(EventLoopTest):
+    def setUp(self):
+        EventLoopTest.setUp(self)
+        self.results = []
+        self.errors = []
+
+    def tearDown(self):
+        eventloop.thread_pool_quit()
+        EventLoopTest.tearDown(self)
+
+    def callback(self, result):
+        self.results.append(result)
+
+    def errback(self, error):
+        self.errors.append(error)
+
+    def test_category(self):
+        eventloop.thread_pool_init()
+        eventloop.call_in_thread_pool('disk', eventloop.PRIORITY_NORMAL,
+                self.callback, self.errback,
+                lambda: threading.currentThread().getName(), 'test call')
+        eventloop.call_in_thread(self.callback, self.errback,
+                lambda: threading.currentThread().getName(), 'test call')
+        eventloop.thread_pool_quit()
+        self.runPendingIdles()
+        self.assertEquals(len(self.results), 2)
+        self.assert_(self.results[0].startswith('ThreadPool (disk)'))
+        self.assert_(self.results[1].startswith('ThreadPool (default)'))
+
+    def test_threads_start_lazily(self):
+        eventloop.thread_pool_init()
+        stats = eventloop.thread_pool_stats()
+        self.assertEquals(stats['disk']['threads'], 0)
+        self.assertEquals(stats['network']['threads'], 0)
+        eventloop.call_in_thread_pool('disk', eventloop.PRIORITY_NORMAL,
+                self.callback, self.errback, lambda: None, 'test call')
+        stats = eventloop.thread_pool_stats()
+        self.assertEquals(stats['disk']['threads'], 1)
+        self.assertEquals(stats['network']['threads'], 0)
+        eventloop.thread_pool_quit()
+        self.runPendingIdles()
+        self.assertEquals(self.results, [None])
+
+    def test_unknown_category(self):
+        self.assertRaises(ValueError, eventloop.call_in_thread_pool, 'foo',
+                eventloop.PRIORITY_NORMAL, self.callback, self.errback,
+                lambda: None, 'test call')
+
+    def test_errback(self):
+        def bad_function():
+            raise ValueError()
+        eventloop.thread_pool_init()
+        eventloop.call_in_thread(self.callback, self.errback, bad_function,
+                'test call')
+        eventloop.thread_pool_quit()
+        self.runPendingIdles()
+        self.assertEquals(self.results, [])
+        self.assertEquals(len(self.errors), 1)
+        self.assert_(isinstance(self.errors[0], ValueError))
+
+    def test_priority(self):
+        eventloop.set_thread_pool_size('disk', 1)
+        eventloop.thread_pool_init()
+        # block the only thread in the pool while we queue up calls
+        blocker = threading.Event()
+        started = threading.Event()
+        def block():
+            started.set()
+            blocker.wait()
+        eventloop.call_in_thread_pool('disk', eventloop.PRIORITY_NORMAL,
+                self.callback, self.errback, block, 'block')
+        started.wait()
+        for priority, value in ((eventloop.PRIORITY_BACKGROUND, 'bg'),
+                                (eventloop.PRIORITY_NORMAL, 'normal-1'),
+                                (eventloop.PRIORITY_UI, 'ui'),
+                                (eventloop.PRIORITY_NORMAL, 'normal-2')):
+            eventloop.call_in_thread_pool('disk', priority, self.callback,
+                    self.errback, lambda value=value: value, 'test call')
+        stats = eventloop.thread_pool_stats()['disk']
+        self.assertEquals(stats['queue_depth'], 4)
+        self.assertEquals(stats['busy'], 1)
+        blocker.set()
+        # closing the pool should let the queued calls finish
+        eventloop.thread_pool_quit()
+        self.runPendingIdles()
+        self.assertEquals(self.results,
+                          [None, 'ui', 'normal-1', 'normal-2', 'bg'])
+        stats = eventloop.thread_pool_stats()['disk']
+        self.assertEquals(stats['queue_depth'], 0)
+        self.assertEquals(stats['calls'], 5)
+        self.assert_(stats['max_wait'] > 0)
@@ -1,14 +1,20 @@
 import gc
+import random
 
+from miro import app
 from miro import messages
 from miro import models
 from miro import search
+from miro import searchindex
 from miro import ngrams
 from miro import itemsource
 from miro.item import FeedParserValues
 from miro.singleclick import _build_entry
 from miro.test.framework import MiroTestCase
+from miro.frontends.widgets import itemlist
 from miro.frontends.widgets.itemtrack import SearchFilter
+from miro.frontends.widgets.itemtrack import SharedIndexSearcher
+from miro.frontends.widgets.itemtrack import ItemSearchTermsIndex
 
 class NGramTest(MiroTestCase):
     def test_simple(self):
@@ -25,6 +31,51 @@ class NGramTest(MiroTestCase):
                 'ba', 'ar', 'bar',
                 'az', 'zb', 'baz', 'azb', 'zba'])
 
+    def test_set(self):
+        word_list = [u'foo', u'bar', u'bazbaz', u'foo']
+        results = ngrams.breakup_set(word_list, 2, 3)
+        self.assert_(isinstance(results, frozenset))
+        self.assertEquals(results,
+                frozenset(ngrams.breakup_list(word_list, 2, 3)))
+        self.assertEquals(ngrams.breakup_set(['ab'], 3, 5), frozenset())
+        self.assertEquals(ngrams.breakup_set([], 3, 5), frozenset())
+
+    def test_set_str_and_unicode(self):
+        results = ngrams.breakup_set(['abc'], 3, 3)
+        self.assertEquals([type(ngram) for ngram in results], [str])
+        results = ngrams.breakup_set([u'abc'], 3, 3)
+        self.assertEquals([type(ngram) for ngram in results], [unicode])
+        self.assertRaises(TypeError, ngrams.breakup_set, [1], 3, 3)
+
+    def test_set_interned(self):
+        ngrams1 = ngrams.breakup_set([u'foobar'], 3, 3)
+        ngrams2 = ngrams.breakup_set([u'barfoo'], 3, 3)
+        foo1 = [ngram for ngram in ngrams1 if ngram == u'foo'][0]
+        foo2 = [ngram for ngram in ngrams2 if ngram == u'foo'][0]
+        self.assert_(foo1 is foo2)
+
+    def test_set_hashed(self):
+        results = ngrams.breakup_set([u'foobar', u'foo'], 3, 5, True)
+        self.assertEquals(len(results),
+                len(ngrams.breakup_set([u'foobar'], 3, 5)))
+        for ngram in results:
+            self.assert_(isinstance(ngram, (int, long)))
+            self.assert_(0 <= ngram < 2 ** 32)
+        # hashes should be the same no matter what word they come from
+        self.assert_(ngrams.breakup_set([u'oba'], 3, 3, True) <= results)
+        self.assertEquals(ngrams.breakup_set(['oba'], 3, 3, True),
+                          ngrams.breakup_set([u'oba'], 3, 3, True))
+
+    def test_set_different_sizes(self):
+        # we cache N-grams for each word, make sure that changing the sizes
+        # doesn't mess that up.
+        self.assertEquals(ngrams.breakup_set([u'foobar'], 3, 3),
+                          frozenset([u'foo', u'oob', u'oba', u'bar']))
+        self.assertEquals(ngrams.breakup_set([u'foobar'], 5, 5),
+                          frozenset([u'fooba', u'oobar']))
+        self.assertEquals(len(ngrams.breakup_set([u'foobar'], 5, 5, True)),
+                          2)
+
 class SearchTest(MiroTestCase):
     def setUp(self):
         MiroTestCase.setUp(self)
@@ -90,6 +141,15 @@ class SearchTest(MiroTestCase):
         self.assertEquals(list(search.list_matches(items, 'foo')),
                           [])
 
+    def test_list_matches_edge_cases(self):
+        items = [self.item1, self.item2]
+        for query in ['firs', 'irst', 'my -first', '-second', 'my item',
+                      '"my first"', 'y fi', 'firstmy', 'tmy', 'd',
+                      '-foo', 'my -foo']:
+            self.assertEquals(list(search.list_matches(items, query)),
+                              [i for i in items
+                               if search.item_matches(i, query)])
+
     def test_ngrams_for_term(self):
         self.assertEquals(search._ngrams_for_term('abc'),
                 ['abc'])
@@ -142,6 +202,357 @@ class ItemSearcherTest(MiroTestCase):
         self.check_search_results('my', self.item1)
         self.check_empty_result('second')
 
+class FakeInfo(object):
+    """Minimal ItemInfo for testing scores."""
+    def __init__(self, id_, name, description=u'', artist=None, album=None,
+                 genre=None, feed_name=None, video_path=None,
+                 release_date=0):
+        self.id = id_
+        self.name = name
+        self.description = description
+        self.artist = artist
+        self.album = album
+        self.genre = genre
+        self.feed_name = feed_name
+        self.download_info = None
+        self.video_path = video_path
+        self.release_date = release_date
+        self.search_terms = search.calc_search_terms(self)
+
+class RankedSearchTest(MiroTestCase):
+    def check_ranking(self, query, *infos):
+        """Check that rank_items() puts infos in order."""
+        shuffled = list(reversed(infos))
+        self.assertEquals(search.rank_items(shuffled, query), list(infos))
+
+    def test_field_weights(self):
+        self.check_ranking(u'foo',
+                FakeInfo(1, u'foo'),
+                FakeInfo(2, u'bar', artist=u'foo'),
+                FakeInfo(3, u'bar', feed_name=u'foo'),
+                FakeInfo(4, u'bar', description=u'foo'),
+                FakeInfo(5, u'bar', video_path='/tmp/foo.mp4'),
+                FakeInfo(6, u'bar'))
+
+    def test_match_types(self):
+        # exact word matches beat prefix matches, which beat substring
+        # matches
+        self.check_ranking(u'foo',
+                FakeInfo(1, u'a foo'),
+                FakeInfo(2, u'a foobar'),
+                FakeInfo(3, u'a barfoo'))
+
+    def test_field_prefix(self):
+        self.check_ranking(u'foo',
+                FakeInfo(1, u'foo bar'),
+                FakeInfo(2, u'bar foo'))
+
+    def test_term_frequency(self):
+        self.check_ranking(u'foo',
+                FakeInfo(1, u'bar', description=u'foo foo foo'),
+                FakeInfo(2, u'bar', description=u'foo'))
+        # repeating a term shouldn't beat a match in a better field
+        self.check_ranking(u'foo',
+                FakeInfo(1, u'bar', artist=u'foo'),
+                FakeInfo(2, u'bar', description=u'foo ' * 20))
+
+    def test_multiple_terms(self):
+        self.check_ranking(u'foo bar',
+                FakeInfo(1, u'foo bar'),
+                FakeInfo(2, u'foo baz'),
+                FakeInfo(3, u'baz'))
+
+    def test_limit(self):
+        infos = [FakeInfo(i, u'foo ' * (i % 7), description=u'foo ' * i)
+                 for i in xrange(50)]
+        full_ranking = search.rank_items(infos, u'foo')
+        self.assertEquals(search.rank_items(infos, u'foo', limit=10),
+                          full_ranking[:10])
+
+    def test_list_matches_ranked(self):
+        info1 = FakeInfo(1, u'bar', description=u'foo')
+        info2 = FakeInfo(2, u'foo')
+        info3 = FakeInfo(3, u'bar')
+        self.assertEquals(search.list_matches_ranked([info1, info2, info3],
+                                                     u'foo'),
+                          [info2, info1])
+        self.assertEquals(search.list_matches_ranked([info1, info2, info3],
+                                                     u'foo', limit=1),
+                          [info2])
+
+    def test_searcher_ranked(self):
+        infos = dict((info.id, info) for info in [
+            FakeInfo(1, u'bar', description=u'foo'),
+            FakeInfo(2, u'foo'),
+            FakeInfo(3, u'bar')])
+        searcher = search.ItemSearcher()
+        for info in infos.values():
+            searcher.add_item(info)
+        self.assertEquals(searcher.search_ranked(u'foo', infos),
+                          [infos[2], infos[1]])
+
+    def test_relevance_sort(self):
+        sorter = itemlist.RelevanceSort(False)
+        self.assertTrue(sorter.set_search(u'foo'))
+        info1 = FakeInfo(1, u'foo')
+        info2 = FakeInfo(2, u'bar', description=u'foo', release_date=2)
+        info3 = FakeInfo(3, u'bar', description=u'foo', release_date=1)
+        infos = [info3, info1, info2]
+        infos.sort(key=sorter.sort_key, reverse=sorter.reverse)
+        self.assertEquals(infos, [info1, info2, info3])
+        # changed ItemInfos should get new scores
+        new_info1 = FakeInfo(1, u'bar')
+        infos = [new_info1, info2, info3]
+        infos.sort(key=sorter.sort_key, reverse=sorter.reverse)
+        self.assertEquals(infos, [info2, info3, new_info1])
+        # setting the same search again shouldn't throw away the scores
+        self.assertFalse(sorter.set_search(u'foo'))
+        self.assertEquals(sorted(sorter._scores), [1, 2, 3])
+        sorter.items_removed([2])
+        self.assertEquals(sorted(sorter._scores), [1, 3])
+        self.assertTrue(sorter.set_search(u'bar'))
+        self.assertEquals(sorter._scores, {})
+
+    def test_relevance_sort_ascending(self):
+        # ascending sorts should still put the best matches first, only ties
+        # get ordered differently
+        sorter = itemlist.RelevanceSort(True)
+        sorter.set_search(u'foo')
+        info1 = FakeInfo(1, u'foo')
+        info2 = FakeInfo(2, u'bar', description=u'foo', release_date=2)
+        info3 = FakeInfo(3, u'bar', description=u'foo', release_date=1)
+        infos = [info3, info1, info2]
+        infos.sort(key=sorter.sort_key, reverse=sorter.reverse)
+        self.assertEquals(infos, [info1, info3, info2])
+
+class SearchTermsMessageHandler(object):
+    """Passes ItemSearchTermsChanged messages to an ItemSearchTermsIndex."""
+    def __init__(self, index):
+        self.index = index
+
+    def handle(self, message):
+        if isinstance(message, messages.ItemSearchTermsChanged):
+            self.index.handle_search_terms_changed(message)
+
+class ItemSearchIndexTest(MiroTestCase):
+    def setUp(self):
+        MiroTestCase.setUp(self)
+        self.feed = models.Feed(u'http://example.com/')
+        self.item1 = self.make_item(u'my first item')
+        self.item2 = self.make_item(u'my second item')
+        self.start_tracking()
+
+    def tearDown(self):
+        messages.FrontendMessage.reset_handler()
+        MiroTestCase.tearDown(self)
+
+    def make_item(self, title):
+        additional = {'title': title}
+        entry = _build_entry(u'http://example.com/', 'video/x-unknown',
+                             additional)
+        return models.Item(FeedParserValues(entry), feed_id=self.feed.id)
+
+    def start_tracking(self):
+        """Build a new frontend copy of the index."""
+        self.frontend_index = ItemSearchTermsIndex()
+        messages.FrontendMessage.install_handler(
+            SearchTermsMessageHandler(self.frontend_index))
+        app.item_search_index.start_tracking()
+
+    def reload_index(self):
+        app.item_search_index.save()
+        self.setup_new_item_search_index()
+        self.start_tracking()
+
+    def check_search_results(self, search_text, *correct_items):
+        self.assertSameSet(self.frontend_index.search(search_text),
+                           [i.id for i in correct_items])
+
+    def test_search(self):
+        self.assertTrue(app.item_search_index.is_ready())
+        self.assertTrue(self.frontend_index.is_ready())
+        self.check_search_results('my', self.item1, self.item2)
+        self.check_search_results('first', self.item1)
+        self.check_search_results('miro')
+
+    def test_search_restricted(self):
+        self.assertSameSet(self.frontend_index.search('my', [self.item2.id]),
+                           [self.item2.id])
+
+    def test_change(self):
+        self.item1.entry_title = u'my new title'
+        self.item1.signal_change()
+        self.check_search_results('title', self.item1)
+        self.check_search_results('first')
+
+    def test_remove(self):
+        self.item2.remove()
+        self.check_search_results('my', self.item1)
+        self.check_search_results('second')
+        # the N-grams only used by item2 should be gone
+        self.assertFalse(u'seco' in self.frontend_index.searcher._ngram_ids)
+
+    def test_load(self):
+        self.reload_index()
+        # we should use the saved terms, not rebuild the index
+        self.assertFalse(app.item_search_index._rebuilding)
+        self.assertFalse(app.item_search_index.is_ready())
+        self.assertFalse(self.frontend_index.is_ready())
+        app.item_search_index.load_all()
+        self.assertTrue(app.item_search_index.is_ready())
+        self.assertTrue(self.frontend_index.is_ready())
+        self.check_search_results('my', self.item1, self.item2)
+        self.check_search_results('second', self.item2)
+
+    def test_changes_before_load(self):
+        self.reload_index()
+        # changes that happen before the index is built should override the
+        # saved terms
+        self.item1.entry_title = u'my new title'
+        self.item1.signal_change()
+        self.item2.remove()
+        item3 = self.make_item(u'my third item')
+        app.item_search_index.load_all()
+        self.check_search_results('my', self.item1, item3)
+        self.check_search_results('first')
+        # check that the changes get saved
+        self.reload_index()
+        app.item_search_index.load_all()
+        self.assertFalse(app.item_search_index._rebuilding)
+        self.check_search_results('title', self.item1)
+        self.check_search_results('my', self.item1, item3)
+
+    def test_rebuild_version_changed(self):
+        app.item_search_index.save()
+        app.db.set_variable(searchindex.ItemSearchIndex.VERSION_KEY, 'old')
+        self.setup_new_item_search_index()
+        self.start_tracking()
+        self.assertTrue(app.item_search_index._rebuilding)
+        app.item_search_index.load_all()
+        self.check_search_results('my', self.item1, self.item2)
+        self.check_search_results('second', self.item2)
+        # the rebuilt data should be saved
+        self.setup_new_item_search_index()
+        self.assertFalse(app.item_search_index._rebuilding)
+
+    def check_reindexed(self, *items):
+        """Check that the items are pending without saved terms."""
+        pending = app.item_search_index._pending
+        for item in items:
+            self.assertEquals(pending[item.id], None)
+
+    def test_missing_rows(self):
+        app.item_search_index.save()
+        app.db.cursor.execute("DELETE FROM item_search_terms "
+                              "WHERE item_id=?", (self.item1.id,))
+        self.setup_new_item_search_index()
+        self.start_tracking()
+        # we should only re-index item1, not rebuild everything
+        self.assertFalse(app.item_search_index._rebuilding)
+        self.check_reindexed(self.item1)
+        self.assertNotEquals(app.item_search_index._pending[self.item2.id],
+                             None)
+        app.item_search_index.load_all()
+        self.check_search_results('first', self.item1)
+        self.check_search_results('my', self.item1, self.item2)
+
+    def test_unsaved_changes(self):
+        # simulate quitting after an item change was committed, but before
+        # the new terms were saved
+        app.item_search_index.save()
+        self.item1.entry_title = u'my new title'
+        self.item1.signal_change()
+        item3 = self.make_item(u'my third item')
+        self.item2.remove()
+        app.db.finish_transaction()
+        app.item_search_index.unlink()
+        self.setup_new_item_search_index()
+        self.start_tracking()
+        self.assertFalse(app.item_search_index._rebuilding)
+        self.check_reindexed(self.item1, item3)
+        self.assertFalse(self.item2.id in app.item_search_index._pending)
+        app.item_search_index.load_all()
+        self.check_search_results('title', self.item1)
+        self.check_search_results('first')
+        self.check_search_results('my', self.item1, item3)
+        # the stale row for item2 should get deleted
+        app.item_search_index.save()
+        app.db.cursor.execute("SELECT item_id FROM item_search_terms "
+                              "WHERE dirty=0")
+        self.assertSameSet([row[0] for row in app.db.cursor],
+                           [self.item1.id, item3.id])
+
+    def test_search_filter(self):
+        searcher = SharedIndexSearcher(self.frontend_index)
+        filterer = SearchFilter(searcher)
+        infos = [app.item_info_cache.get_info(self.item1.id)]
+        filterer.filter_initial_list(infos)
+        added, removed = filterer.set_search('my')
+        # item2 matches, but it's not in the list
+        self.assertEquals(added, [])
+        self.assertSameSet(filterer.matching_ids, [self.item1.id])
+        added, removed = filterer.set_search('second')
+        self.assertSameSet(removed, [self.item1.id])
+
+class PostingListTest(MiroTestCase):
+    def check_intersection(self, list1, list2):
+        correct = sorted(set(list1).intersection(list2))
+        for small, large in ((list1, list2), (list2, list1)):
+            result = search._galloping_intersection(sorted(small),
+                                                    sorted(large))
+            self.assertEquals(list(result), correct)
+
+    def test_galloping_intersection(self):
+        self.check_intersection([], [1, 2, 3])
+        self.check_intersection([1, 2, 3], [1, 2, 3])
+        self.check_intersection([2], [1, 2, 3])
+        self.check_intersection([0, 4], [1, 2, 3])
+        self.check_intersection([1, 50, 99], range(100))
+        self.check_intersection(range(0, 1000, 3), range(0, 1000, 7))
+        rand = random.Random(1)
+        for i in xrange(20):
+            self.check_intersection(rand.sample(xrange(5000), 50),
+                                    rand.sample(xrange(5000), 2000))
+
+    def test_add_out_of_order(self):
+        searcher = search.ItemSearcher()
+        for item_id in (5, 1, 3, 2, 4):
+            searcher.add_item_terms(item_id, [u'foo'])
+        ngram_id = searcher._ngram_ids[u'foo']
+        self.assertEquals(list(searcher._postings[ngram_id]),
+                          [1, 2, 3, 4, 5])
+        searcher.remove_item(3)
+        self.assertEquals(list(searcher._postings[ngram_id]), [1, 2, 4, 5])
+        self.assertSameSet(searcher.search(u'foo'), [1, 2, 4, 5])
+
+    def test_prune_ngrams(self):
+        searcher = search.ItemSearcher()
+        searcher.add_item_terms(1, [u'foo'])
+        searcher.add_item_terms(2, [u'foo', u'bar'])
+        searcher.remove_item(2)
+        # N-grams that no item contains any more should be forgotten
+        self.assertFalse(u'bar' in searcher._ngram_ids)
+        self.assertSameSet(searcher.search(u'bar'), [])
+        self.assertSameSet(searcher.search(u'foo'), [1])
+        # ...and their ids reused for new N-grams
+        ngram_count = len(searcher._postings)
+        searcher.add_item_terms(3, [u'baz'])
+        self.assertEquals(len(searcher._postings), ngram_count)
+        self.assertSameSet(searcher.search(u'baz'), [3])
+        self.assertSameSet(searcher.search(u'foo'), [1])
+        for item_id in (1, 3):
+            searcher.remove_item(item_id)
+        self.assertEquals(searcher._ngram_ids, {})
+
+    def test_missing_ngram(self):
+        searcher = search.ItemSearcher()
+        searcher.add_item_terms(1, [u'foobar'])
+        self.assertSameSet(searcher.search(u'foobaz'), [])
+        self.assertSameSet(searcher.search(u'-foobaz'), [1])
+        # searching shouldn't add anything to the index
+        self.assertEquals(len(searcher._ngram_ids), len(searcher._postings))
+        self.assertFalse(u'foobaz' in searcher._ngram_ids)
+
 class SearchFilterTest(MiroTestCase):
     def setUp(self):
         MiroTestCase.setUp(self)
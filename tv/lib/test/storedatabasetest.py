@@ -3,6 +3,7 @@ import os
 import unittest
 import string
 import random
+import threading
 import time
 
 import sqlite3
@@ -20,6 +21,7 @@ from miro import guide
 from miro import schema
 from miro import signals
 from miro import tabs
+from miro import queryplan
 from miro import theme
 from miro.fileobject import FilenameType
 import shutil
@@ -226,6 +228,28 @@ class DBUpgradeTest(StoreDatabaseTest):
                 raise AssertionError("different column types for %s (%s)" %
                                      (table_name, diff))
 
+    @skip_for_platforms('win32')
+    def test_object_tables(self):
+        shutil.copy(resources.path("testdata/olddatabase.v79"),
+                    self.save_path2)
+        self.reload_database(self.save_path2)
+        tables = databaseupgrade.get_object_tables(app.db.cursor)
+        self.assert_('item' in tables)
+        self.assert_('feed_item_counts' not in tables)
+        self.assert_('item_search_terms' not in tables)
+
+    @skip_for_platforms('win32')
+    def test_get_next_id(self):
+        shutil.copy(resources.path("testdata/olddatabase.v79"),
+                    self.save_path2)
+        self.reload_database(self.save_path2)
+        max_id = 0
+        for table in databaseupgrade.get_object_tables(app.db.cursor):
+            app.db.cursor.execute("SELECT MAX(id) FROM %s" % table)
+            max_id = max(max_id, app.db.cursor.fetchone()[0])
+        self.assertEquals(databaseupgrade.get_next_id(app.db.cursor),
+                          max_id + 1)
+
     def _get_column_types(self):
         app.db.cursor.execute("SELECT name FROM sqlite_master "
                               "WHERE type='table'")
@@ -492,6 +516,76 @@ class DiskTest(FakeSchemaTest):
         lee_view = Human.make_view("id=?", values=(lee.id,))
         self.assertEquals(lee_view.count(), 0)
 
+class WALDiskTest(DiskTest):
+    # Runs all of the DiskTest tests again, using WAL journaling
+    def reload_test_database(self, version=0):
+        self.reload_database(self.save_path, schema_version=version,
+                object_schemas=self.OBJECT_SCHEMAS, use_wal=True)
+
+    def journal_mode(self):
+        app.db.cursor.execute("PRAGMA journal_mode")
+        return app.db.cursor.fetchone()[0].lower()
+
+    def test_wal_enabled(self):
+        self.assert_(app.db.wal_enabled)
+        self.assert_(app.db.read_pool is not None)
+        self.assertEquals(self.journal_mode(), 'wal')
+
+    def test_switch_back_from_wal(self):
+        self.reload_database(self.save_path, schema_version=0,
+                object_schemas=self.OBJECT_SCHEMAS)
+        self.assert_(not app.db.wal_enabled)
+        self.assertEquals(app.db.read_pool, None)
+        self.assertEquals(self.journal_mode(), 'persist')
+        self.check_database()
+
+    def test_read_cursor(self):
+        app.db.finish_transaction()
+        cursor = app.db.acquire_read_cursor()
+        self.assert_(cursor is not app.db.cursor)
+        try:
+            cursor.execute("SELECT COUNT(*) FROM human")
+            self.assertEquals(cursor.fetchone()[0], 1)
+        finally:
+            app.db.release_read_cursor(cursor)
+        # the read connections can't see uncommitted changes, so we should
+        # get the main cursor in that case
+        Human(u"ann", 30, 1.5, [])
+        cursor = app.db.acquire_read_cursor()
+        self.assert_(cursor is app.db.cursor)
+        app.db.release_read_cursor(cursor)
+
+    def test_read_in_thread(self):
+        app.db.finish_transaction()
+        results = []
+        errors = []
+        def read_names(cursor):
+            cursor.execute("SELECT name FROM human")
+            return ([row[0] for row in cursor],
+                    threading.currentThread().getName())
+        app.db.read_in_thread(results.append, errors.append, read_names,
+                              'read names')
+        self.processThreads()
+        self.runPendingIdles()
+        self.assertEquals(errors, [])
+        self.assertEquals(len(results), 1)
+        names, thread_name = results[0]
+        self.assertEquals(names, [u'lee'])
+        self.assert_(thread_name.startswith('ThreadPool (disk)'))
+
+    def test_read_in_thread_error(self):
+        app.db.finish_transaction()
+        results = []
+        errors = []
+        def bad_read(cursor):
+            cursor.execute("SELECT * FROM no_such_table")
+        app.db.read_in_thread(results.append, errors.append, bad_read,
+                              'bad read')
+        self.processThreads()
+        self.runPendingIdles()
+        self.assertEquals(results, [])
+        self.assertEquals(len(errors), 1)
+
 class ObjectMemoryTest(FakeSchemaTest):
     def test_remove_remove_object_map(self):
         self.reload_test_database()
@@ -508,6 +602,212 @@ class ObjectMemoryTest(FakeSchemaTest):
         lee.remove()
         self.assertEquals(0, len(app.db._object_map))
 
+class ObjectEvictionTest(FakeSchemaTest):
+    def setUp(self):
+        FakeSchemaTest.setUp(self)
+        for i in xrange(30):
+            Human(u"clone-%s" % i, 25, 1.4, [])
+        self.reload_database(self.save_path, schema_version=0,
+                object_schemas=self.OBJECT_SCHEMAS, object_cache_size=10)
+        app.db.evictable_tables = frozenset(['human'])
+
+    def resident_humans(self):
+        return app.db.object_memory_report()['human']['resident']
+
+    def test_eviction(self):
+        human_ids = [h.id for h in Human.make_view()]
+        self.assertEquals(self.resident_humans(), 31)
+        self.assertEquals(app.db.evict_objects(), 22)
+        self.assertEquals(self.resident_humans(), 9)
+        # the most recently used objects should be the ones that stay
+        for id_ in human_ids[-9:]:
+            self.assert_((id_, 'human') in app.db._object_map)
+        # evicted objects should get restored when they're needed again
+        for id_ in human_ids:
+            self.assertEquals(Human.get_by_id(id_).id, id_)
+        self.assertEquals(Human.make_view().count(), 31)
+
+    def test_evicted_object_reused(self):
+        # if something still references an evicted object, we should keep
+        # using it rather than restoring a second copy
+        humans = list(Human.make_view())
+        app.db.evict_objects()
+        for human in humans:
+            self.assert_(Human.get_by_id(human.id) is human)
+
+    def test_pinned(self):
+        humans = list(Human.make_view())
+        for human in humans:
+            human.age = 30
+        app.db.evict_objects()
+        self.assertEquals(self.resident_humans(), 31)
+        for human in humans:
+            human.signal_change()
+        app.db._next_eviction_size = 10
+        app.db.evict_objects()
+        self.assertEquals(self.resident_humans(), 9)
+
+    def test_remove_evicted_object(self):
+        humans = list(Human.make_view())
+        app.db.evict_objects()
+        for human in humans:
+            human.remove()
+        self.assertEquals(len(app.db._object_map), 0)
+        self.assertEquals(len(app.db._evicted_objects), 0)
+        self.assertEquals(Human.make_view().count(), 0)
+
+class SQLCacheTest(FakeSchemaTest):
+    def setUp(self):
+        FakeSchemaTest.setUp(self)
+        app.db.sql_cache.clear()
+        app.db.sql_cache.reset_stats()
+
+    def test_update_sql_cached(self):
+        self.lee.age = 26
+        self.lee.signal_change()
+        self.ben.age = 26
+        self.ben.signal_change()
+        self.lee.age = 27
+        self.lee.signal_change()
+        stats = app.db.get_sql_cache_stats()
+        # lee's updates share SQL text with the id bound as a parameter.
+        # ben is in a different table, so he needs his own SQL
+        self.assertEquals(stats['misses'], 2)
+        self.assertEquals(stats['hits'], 1)
+        update_sql = app.db._update_sql('human', ('age',))
+        self.assert_('WHERE id=?' in update_sql)
+        self.reload_test_database()
+        self.assertEquals(Human.get_by_id(self.lee.id).age, 27)
+
+    def test_query_sql_cached(self):
+        for i in xrange(3):
+            view = Human.make_view('age=?', (25,), order_by='name')
+            self.assertEquals([h.id for h in view], [self.lee.id])
+        stats = app.db.get_sql_cache_stats()
+        self.assertEquals(stats['misses'], 1)
+        self.assertEquals(stats['hits'], 2)
+        # different limits use different SQL
+        self.assertEquals(app.db.query_count('human', None, limit=1), 1)
+        self.assertEquals(app.db.query_count('human', None, limit=2), 1)
+        self.assertEquals(app.db.get_sql_cache_stats()['misses'], 3)
+
+    def test_max_size(self):
+        app.db.sql_cache.max_size = 5
+        for i in xrange(10):
+            app.db.query_count('human', 'age=%d' % i)
+        self.assert_(app.db.get_sql_cache_stats()['size'] <= 5)
+
+class GroupCommitTest(FakeSchemaTest):
+    def setUp(self):
+        FakeSchemaTest.setUp(self)
+        app.db.finish_transaction()
+        app.db.set_group_commit(True, max_delay=1000, max_statements=3)
+        # don't count the commits from setting up the test database
+        app.db.commit_stats.reset()
+
+    def names_on_disk(self):
+        # use a separate connection so that we only see committed data
+        connection = sqlite3.connect(self.save_path)
+        try:
+            cursor = connection.execute("SELECT name FROM human")
+            return set(row[0] for row in cursor)
+        finally:
+            connection.close()
+
+    def finish_event(self, success=True):
+        app.db.on_event_finished(None, success)
+
+    def test_changes_grouped(self):
+        Human(u"ann", 30, 1.5, [])
+        self.finish_event()
+        Human(u"bob", 30, 1.5, [])
+        self.finish_event()
+        self.assertEquals(self.names_on_disk(), set([u'lee']))
+        self.assertEquals(app.db.get_commit_stats()['commits'], 0)
+        # the third statement hits max_statements
+        Human(u"cat", 30, 1.5, [])
+        self.finish_event()
+        self.assertEquals(self.names_on_disk(),
+                set([u'lee', u'ann', u'bob', u'cat']))
+        stats = app.db.get_commit_stats()
+        self.assertEquals(stats['commits'], 1)
+        self.assertEquals(stats['statements_per_commit'], 3)
+
+    def test_commit_after_delay(self):
+        app.db.set_group_commit(True, max_delay=0)
+        Human(u"ann", 30, 1.5, [])
+        self.finish_event()
+        self.assertEquals(self.names_on_disk(), set([u'lee', u'ann']))
+
+    def test_commit_timeout(self):
+        Human(u"ann", 30, 1.5, [])
+        self.finish_event()
+        self.assert_(app.db._group_commit_dc is not None)
+        app.db._group_commit_timeout()
+        self.assertEquals(self.names_on_disk(), set([u'lee', u'ann']))
+
+    def test_durable_change(self):
+        Human(u"ann", 30, 1.5, [])
+        self.finish_event()
+        self.lee.remove()
+        self.finish_event()
+        self.assertEquals(self.names_on_disk(), set([u'ann']))
+
+    def test_failed_event(self):
+        # a failed event should only rollback its own changes
+        Human(u"ann", 30, 1.5, [])
+        self.finish_event()
+        Human(u"bob", 30, 1.5, [])
+        self.finish_event(success=False)
+        app.db.finish_transaction()
+        self.assertEquals(self.names_on_disk(), set([u'lee', u'ann']))
+
+    def test_failed_first_event(self):
+        Human(u"ann", 30, 1.5, [])
+        self.finish_event(success=False)
+        Human(u"bob", 30, 1.5, [])
+        self.finish_event()
+        app.db.finish_transaction()
+        self.assertEquals(self.names_on_disk(), set([u'lee', u'bob']))
+
+    def test_rerun_transaction(self):
+        mock_handler = mock.Mock()
+        mock_handler.handle_save_error.return_value = \
+                storedatabase.LiveStorageErrorHandler.ACTION_RETRY
+        app.db.error_handler = mock_handler
+        Human(u"ann", 30, 1.5, [])
+        self.finish_event()
+        Human(u"bob", 30, 1.5, [])
+        app.db.simulate_db_save_error()
+        self.assertEquals(mock_handler.handle_save_error.call_count, 1)
+        # the statements from both events should have been re-run, with the
+        # SAVEPOINT for the second event in place.
+        self.finish_event(success=False)
+        app.db.finish_transaction()
+        self.assertEquals(self.names_on_disk(), set([u'lee', u'ann']))
+
+    def test_run_in_transaction(self):
+        # run_in_transaction() should commit the pending changes, then run
+        # the function in a transaction of its own.
+        Human(u"ann", 30, 1.5, [])
+        self.finish_event()
+        def rename(cursor, old_name, new_name):
+            cursor.execute("UPDATE human SET name=? WHERE name=?",
+                           (new_name, old_name))
+            return cursor.rowcount
+        self.assertEquals(app.db.run_in_transaction(rename, u'ann', u'bob'),
+                          1)
+        self.assertEquals(self.names_on_disk(), set([u'lee', u'bob']))
+        self.assertEquals(app.db._statements_in_transaction, [])
+
+    def test_run_in_transaction_error(self):
+        def rename_then_fail(cursor):
+            cursor.execute("UPDATE human SET name='bob' WHERE name='lee'")
+            raise ValueError()
+        self.assertRaises(ValueError, app.db.run_in_transaction,
+                          rename_then_fail)
+        self.assertEquals(self.names_on_disk(), set([u'lee']))
+
 class ValidationTest(FakeSchemaTest):
     def assert_object_valid(self, obj):
         obj.signal_change()
@@ -565,7 +865,7 @@ class CorruptReprTest(FakeSchemaTest):
         self.assertEqual(restored_lee.stuff, 'testing123')
         app.db.cursor.execute("SELECT stuff from human WHERE name='lee'")
         row = app.db.cursor.fetchone()
-        self.assertEqual(row[0], "'testing123'")
+        self.assertEqual(storedatabase.load_repr_value(row[0]), 'testing123')
 
     def test_repr_failure_no_handler(self):
         app.db.cursor.execute("UPDATE pcf_programmer SET stuff='{baddata' "
@@ -591,6 +891,81 @@ tm_isdst=0)}"""
         self.assertEquals(val, {"updated_parsed":
                                 (2009, 6, 5, 1, 30, 0, 4, 156, 0)})
 
+    def test_binary_repr(self):
+        values = [
+            {'foo': [1, 2.0, u'three'], None: (4, 5L), u'bar': set([6])},
+            {'now': datetime.now(), 'struct': time.localtime()},
+            'testing123',
+        ]
+        for value in values:
+            sql_value = storedatabase.dump_repr_value(value)
+            self.assert_(isinstance(sql_value, buffer))
+            self.assertEquals(storedatabase.load_repr_value(sql_value), value)
+        # marshal handles the simple values, pickle handles the rest
+        self.assertEquals(str(storedatabase.dump_repr_value(values[0]))[0],
+                          storedatabase.BINARY_REPR_MARSHAL)
+        self.assertEquals(str(storedatabase.dump_repr_value(values[1]))[0],
+                          storedatabase.BINARY_REPR_PICKLE)
+        self.assertRaises(ValueError, storedatabase.load_repr_value,
+                          buffer('\xffbaddata'))
+
+class ReprColumnTest(FakeSchemaTest):
+    def test_old_repr_rows(self):
+        # databases from before version 179 store pythonrepr columns using
+        # repr().  Make sure we can still read those.
+        stuff = {'foo': [1, 2.0, u'three'], 'when': datetime.now()}
+        app.db.cursor.execute("UPDATE human SET stuff=? WHERE name='lee'",
+                              (repr(stuff),))
+        restored_lee = self.reload_object(self.lee)
+        self.assertEquals(restored_lee.stuff, stuff)
+
+    def test_upgrade(self):
+        stuff = {'foo': [1, 2.0, u'three'], 'when': datetime.now()}
+        app.db.cursor.execute("UPDATE human SET stuff=? WHERE name='lee'",
+                              (repr(stuff),))
+        app.db.cursor.execute("UPDATE restorable_human SET stuff='{baddata' "
+                              "WHERE name='joe'")
+        databaseupgrade.upgrade179(app.db.cursor)
+        app.db.cursor.execute("SELECT stuff, typeof(stuff) FROM human "
+                              "WHERE name='lee'")
+        row = app.db.cursor.fetchone()
+        self.assertEquals(row[1], 'blob')
+        self.assertEquals(storedatabase.load_repr_value(row[0]), stuff)
+        # malformed values are left for the handle_malformed_* methods
+        app.db.cursor.execute("SELECT stuff FROM restorable_human "
+                              "WHERE name='joe'")
+        self.assertEquals(app.db.cursor.fetchone()[0], '{baddata')
+        self.assertEquals(self.reload_object(self.lee).stuff, stuff)
+
+class RowConverterTest(FakeSchemaTest):
+    def check_row_converters(self, obj):
+        obj_schema = app.db._schema_map[obj.__class__]
+        # check the encoder against calling to_sql() on each value
+        values = app.db._row_encoders[obj_schema](obj)
+        self.assertEquals(values,
+                          app.db._values_for_obj_slow(obj_schema, obj))
+        # check the decoder against calling from_sql() on each value
+        decoded = app.db._row_decoders[obj_schema](values)
+        for (name, schema_item), value in zip(obj_schema.fields, values):
+            correct_value = app.db._converter.from_sql(obj_schema, name,
+                    schema_item, value)
+            self.assertEquals(decoded[name], correct_value)
+            self.assertEquals(type(decoded[name]), type(correct_value))
+
+    def test_row_converters(self):
+        self.joe.id_code = 'abc'
+        self.joe.stuff = {'foo': [1, 2.0, u'three']}
+        for obj in self.db:
+            self.check_row_converters(obj)
+
+    def test_encoder_validates(self):
+        self.lee.age = u'old'
+        self.assertRaises(schema.ValidationError, app.db._values_for_obj,
+                          HumanSchema, self.lee)
+        self.lee.age = None
+        self.assertRaises(schema.ValidationError, app.db._values_for_obj,
+                          HumanSchema, self.lee)
+
 class CorruptDDBObjectReprTest(StoreDatabaseTest):
     # test corrupt SchemaReprContainer columns in real DDBObjects
     def setUp(self):
@@ -842,5 +1217,57 @@ class TemporaryModeTest(MiroTestCase):
             self.last_connect_path = path
             return self.real_sqlite3_connect(path, *args, **kwargs)
 
+class QueryPlanTest(EventLoopTest):
+    def test_audit_item_views(self):
+        plans = dict((plan.name, plan)
+                     for plan in queryplan.audit_item_views())
+        for name in ('watchable_other_view', 'latest_in_feed_view',
+                     'feed_view', 'unwatched_downloaded_items'):
+            self.assert_(name in plans)
+            self.assert_(plans[name].details)
+        # these views were fixed by the indexes added in upgrade181
+        self.assertEquals(plans['watchable_other_view'].full_scans.count(
+            'remote_downloader'), 0)
+        self.assertEquals(plans['latest_in_feed_view'].temp_sort, False)
+        self.assert_(not plans['feed_view'].has_problems())
+
+    def test_suggest_index(self):
+        view = item.Item.make_view('rating=?', (3,))
+        plan = queryplan.audit_view('rating_view', view)
+        self.assertEquals(plan.full_scans, ['item'])
+        self.assertEquals(plan.suggestions[0].kind, 'index')
+        self.assertEquals(plan.suggestions[0].columns, ('rating',))
+        suggestion = plan.suggestions[0]
+        app.db.cursor.execute(suggestion.sql())
+        plan = queryplan.audit_view('rating_view', view)
+        self.assertEquals(plan.full_scans, [])
+        self.assert_(suggestion.name in ' '.join(plan.details))
+
+    def test_suggest_partial_index(self):
+        if not queryplan.PARTIAL_INDEXES_SUPPORTED:
+            return
+        plan = queryplan.audit_view('containers_view',
+                                    item.Item.containers_view())
+        self.assertEquals(plan.full_scans, ['item'])
+        self.assertEquals(plan.suggestions[0].kind, 'partial')
+        self.assertEquals(plan.suggestions[0].where, 'isContainerItem')
+
+    def test_report(self):
+        report = queryplan.format_report(queryplan.audit_item_views())
+        self.assert_('containers_view: full scan of item' in report)
+        self.assert_('\nfeed_view:' not in report)
+
+    def test_broken_view(self):
+        # views that SQLite can't explain should be reported as errors,
+        # without stopping the rest of the audit
+        view = item.Item.make_view('no_such_column=?', (3,))
+        plan = queryplan.audit_view('broken_view', view)
+        self.assert_(plan.error is not None)
+        self.assert_('no_such_column' in plan.error)
+        self.assert_(plan.has_problems())
+        report = queryplan.format_report([plan])
+        self.assert_('broken_view: error: ' in report)
+        self.assert_(report.startswith('1 of 1 views'))
+
 if __name__ == '__main__':
     unittest.main()
@@ -469,6 +469,38 @@ def db_mem_usage_test():
     logging.debug("feed count: %s", models.Feed.make_view().count())
     logging.debug("item count: %s", models.Item.make_view().count())
 
+def db_object_cache_test(chunk_size=1000):
+    """Check that LiveStorage keeps the number of items in memory bounded.
+
+    This loads every item, chunk_size at a time, and logs the memory usage
+    and number of resident items after each chunk.
+    """
+    from miro import app
+    from miro import models
+    limit = app.db.object_cache_size
+    logging.debug("object cache limit: %s baseline memory usage: %s",
+                  limit, get_mem_usage())
+    id_list = list(models.Item.make_view().id_list())
+    max_resident = 0
+    for start in xrange(0, len(id_list), chunk_size):
+        chunk = id_list[start:start+chunk_size]
+        where = 'id IN (%s)' % ', '.join('?' for i in xrange(len(chunk)))
+        count = len(list(models.Item.make_view(where, chunk)))
+        app.db.evict_objects()
+        info = app.db.object_memory_report().get('item', {})
+        resident = info.get('resident', 0)
+        max_resident = max(max_resident, resident)
+        logging.debug("loaded %s items: %s resident (%s pinned, ~%s bytes), "
+                      "memory usage: %s", start + count, resident,
+                      info.get('pinned', 0), info.get('approx_bytes', 0),
+                      get_mem_usage())
+    if limit is not None and max_resident > limit:
+        logging.warn("object cache bound not held: %s items resident "
+                     "(limit: %s)", max_resident, limit)
+    else:
+        logging.debug("max items resident: %s (limit: %s)", max_resident,
+                      limit)
+
 def get_mem_usage():
     return int(call_command('ps', '-o', 'rss', 'hp', str(os.getpid())))
 
@@ -1196,16 +1228,23 @@ def make_file_url(path):
     # there are no unicode to infect us for a unicode type upgrade.
     return 'file:///' + path_part
 
-def split_values_for_sqlite(value_list):
+SQLITE_CHUNK_SIZE = 990 # use 990 just to be on the safe side.
+
+def split_values_for_sqlite(value_list, reserved=0):
     """Split a list of values into chunks that SQL can handle.
 
     The cursor.execute() method can only handle 999 values at once, this
     method splits long lists into chunks where each chunk has is safe to feed
     to sqlite.
+
+    :param reserved: number of values that the rest of the statement uses.
+        Chunks are made smaller to leave room for them.
     """
-    CHUNK_SIZE = 990 # use 990 just to be on the safe side.
-    for start in xrange(0, len(value_list), CHUNK_SIZE):
-        yield value_list[start:start+CHUNK_SIZE]
+    chunk_size = SQLITE_CHUNK_SIZE - reserved
+    if chunk_size < 1:
+        raise ValueError("no room for values (%s reserved)" % reserved)
+    for start in xrange(0, len(value_list), chunk_size):
+        yield value_list[start:start+chunk_size]
 
 
 class SupportDirBackup(object):
@@ -0,0 +1,527 @@
+# Miro - an RSS based video player application
+# Copyright (C) 2005, 2006, 2007, 2008, 2009, 2010, 2011
+# Participatory Culture Foundation
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 51 Franklin St, Fifth Floor, Boston, MA  02110-1301 USA
+#
+# In addition, as a special exception, the copyright holders give
+# permission to link the code of portions of this program with the OpenSSL
+# library.
+#
+# You must obey the GNU General Public License in all respects for all of
+# the code used other than OpenSSL. If you modify file(s) with this
+# exception, you may extend this exception to your version of the file(s),
+# but you are not obligated to do so. If you do not wish to do so, delete
+# this exception statement from your version. If you delete this exception
+# statement from all source files in the program, then also delete it here.
+
+"""``miro.viewpredicate`` -- Check view membership without running SQL.
+
+ViewTracker needs to know if an object is in its view every time that object
+changes.  Running an SQL query for every tracker on every change is
+expensive, so this module compiles the where/joins strings that our views use
+into python functions that work on the DDBObjects that we have in memory.
+
+Only a subset of SQL is supported: column references, literals, ``?``
+placeholders, comparisons, ``IN``, ``IS [NOT] NULL``, ``LIKE``, ``AND``,
+``OR`` and ``NOT``.  Joins must be of the form ``<column> = <alias>.id``.
+compile_view() returns None for anything else and the caller should fall
+back to running SQL.
+"""
+
+import datetime
+import operator
+import re
+
+class CantCompile(StandardError):
+    """Raised internally when a view uses SQL that we don't support."""
+    pass
+
+class CantEvaluate(StandardError):
+    """Raised by ViewPredicate.matches() when it can't check an object.
+
+    This happens when a joined object isn't loaded, when an object has
+    unsaved changes to a column that we use or when we see values that SQLite
+    would compare differently than python.  Callers should fall back to SQL.
+    """
+    pass
+
+# Column types that we can read directly off DDBObjects.  Other types are
+# stored differently than how they're represented in python.  Calculated by
+# _simple_column_types(), since schema imports database, which imports us.
+_SIMPLE_COLUMN_TYPES = None
+
+def _simple_column_types():
+    global _SIMPLE_COLUMN_TYPES
+    if _SIMPLE_COLUMN_TYPES is None:
+        from miro import schema
+        _SIMPLE_COLUMN_TYPES = (schema.SchemaBool, schema.SchemaInt,
+                                schema.SchemaFloat, schema.SchemaString,
+                                schema.SchemaURL, schema.SchemaDateTime)
+    return _SIMPLE_COLUMN_TYPES
+
+_NUMBER_TYPES = (bool, int, long, float)
+_STRING_TYPES = (str, unicode)
+
+_TOKEN_RE = re.compile(r"""
+    \s*(?:
+        (?P<string>'(?:[^']|'')*')
+      | (?P<number>\d+(?:\.\d+)?)
+      | (?P<op>==|!=|<>|<=|>=|=|<|>|\(|\)|,|\.|\?)
+      | (?P<ident>[A-Za-z_][A-Za-z_0-9]*)
+    )""", re.VERBOSE)
+
+_KEYWORDS = set(['and', 'or', 'not', 'in', 'is', 'null', 'like', 'as'])
+
+_COMPARISONS = {
+    '=': operator.eq,
+    '==': operator.eq,
+    '!=': operator.ne,
+    '<>': operator.ne,
+    '<': operator.lt,
+    '<=': operator.le,
+    '>': operator.gt,
+    '>=': operator.ge,
+}
+
+def _tokenize(sql):
+    tokens = []
+    pos = 0
+    sql = sql.rstrip()
+    while pos < len(sql):
+        m = _TOKEN_RE.match(sql, pos)
+        if m is None:
+            raise CantCompile("can't tokenize %r" % sql[pos:])
+        pos = m.end()
+        kind = m.lastgroup
+        text = m.group(kind)
+        if kind == 'ident' and text.lower() in _KEYWORDS:
+            tokens.append(('keyword', text.lower()))
+        else:
+            tokens.append((kind, text))
+    return tokens
+
+# Three-valued logic helpers.  None represents SQL NULL.
+
+def _truth(value):
+    if value is None:
+        return None
+    elif isinstance(value, _NUMBER_TYPES):
+        return value != 0
+    elif isinstance(value, datetime.datetime):
+        # SQLite stores these as "YYYY-MM-DD ..." strings, which convert to
+        # a non-zero number in a boolean context
+        return True
+    else:
+        # SQLite converts strings to numbers using their prefix, don't try to
+        # emulate that.
+        raise CantEvaluate("truth value of %r" % (value,))
+
+def _compare(func, left, right):
+    if left is None or right is None:
+        return None
+    if not ((isinstance(left, _NUMBER_TYPES) and
+             isinstance(right, _NUMBER_TYPES)) or
+            (isinstance(left, _STRING_TYPES) and
+             isinstance(right, _STRING_TYPES)) or
+            (isinstance(left, datetime.datetime) and
+             isinstance(right, datetime.datetime))):
+        raise CantEvaluate("can't compare %r and %r" % (left, right))
+    return func(left, right)
+
+def _not(value):
+    if value is None:
+        return None
+    return not value
+
+def _like_regex(pattern):
+    parts = []
+    for c in pattern:
+        if c == '%':
+            parts.append('.*')
+        elif c == '_':
+            parts.append('.')
+        else:
+            parts.append(re.escape(c))
+    # SQLite's LIKE is case-insensitive for ASCII characters only, which is
+    # what re.IGNORECASE does without re.UNICODE
+    return re.compile(''.join(parts) + r'\Z', re.IGNORECASE | re.DOTALL)
+
+class _Parser(object):
+    """Recursive descent parser that turns SQL into python closures.
+
+    Each closure takes a row -- a list containing the main object followed by
+    the joined objects -- and returns a value using SQL's NULL semantics.
+    """
+    def __init__(self, tokens, resolver, values):
+        self.tokens = tokens
+        self.pos = 0
+        self.resolver = resolver
+        self.values = values
+        self.value_index = 0
+
+    def peek(self):
+        if self.pos < len(self.tokens):
+            return self.tokens[self.pos]
+        return (None, None)
+
+    def next(self):
+        token = self.peek()
+        self.pos += 1
+        return token
+
+    def accept(self, kind, text=None):
+        token = self.peek()
+        if token[0] == kind and (text is None or token[1] == text):
+            self.pos += 1
+            return True
+        return False
+
+    def expect(self, kind, text=None):
+        if not self.accept(kind, text):
+            raise CantCompile("expected %s %s, got %s" % (kind, text,
+                                                          self.peek()))
+
+    def parse(self):
+        func = self.parse_or()
+        if self.pos != len(self.tokens):
+            raise CantCompile("unexpected token: %s" % (self.peek(),))
+        return func
+
+    def parse_or(self):
+        terms = [self.parse_and()]
+        while self.accept('keyword', 'or'):
+            terms.append(self.parse_and())
+        if len(terms) == 1:
+            return terms[0]
+        def or_func(row):
+            rv = False
+            for term in terms:
+                value = _truth(term(row))
+                if value:
+                    return True
+                elif value is None:
+                    rv = None
+            return rv
+        return or_func
+
+    def parse_and(self):
+        terms = [self.parse_not()]
+        while self.accept('keyword', 'and'):
+            terms.append(self.parse_not())
+        if len(terms) == 1:
+            return terms[0]
+        def and_func(row):
+            rv = True
+            for term in terms:
+                value = _truth(term(row))
+                if value is False:
+                    return False
+                elif value is None:
+                    rv = None
+            return rv
+        return and_func
+
+    def parse_not(self):
+        if self.accept('keyword', 'not'):
+            term = self.parse_not()
+            return lambda row: _not(_truth(term(row)))
+        return self.parse_predicate()
+
+    def parse_predicate(self):
+        left = self.parse_operand()
+        kind, text = self.peek()
+        if kind == 'op' and text in _COMPARISONS:
+            self.next()
+            right = self.parse_operand()
+            func = _COMPARISONS[text]
+            return lambda row: _compare(func, left(row), right(row))
+        elif kind == 'keyword' and text == 'is':
+            self.next()
+            negate = self.accept('keyword', 'not')
+            self.expect('keyword', 'null')
+            if negate:
+                return lambda row: left(row) is not None
+            else:
+                return lambda row: left(row) is None
+        negate = self.accept('keyword', 'not')
+        if self.accept('keyword', 'in'):
+            func = self.parse_in(left)
+        elif self.accept('keyword', 'like'):
+            func = self.parse_like(left)
+        elif negate:
+            raise CantCompile("NOT without IN or LIKE")
+        else:
+            return left
+        if negate:
+            return lambda row: _not(func(row))
+        return func
+
+    def parse_in(self, left):
+        self.expect('op', '(')
+        choices = [self.parse_operand()]
+        while self.accept('op', ','):
+            choices.append(self.parse_operand())
+        self.expect('op', ')')
+        def in_func(row):
+            value = left(row)
+            if value is None:
+                return None
+            rv = False
+            for choice in choices:
+                result = _compare(operator.eq, value, choice(row))
+                if result:
+                    return True
+                elif result is None:
+                    rv = None
+            return rv
+        return in_func
+
+    def parse_like(self, left):
+        pattern = self.parse_operand()
+        cache = {}
+        def like_func(row):
+            value = left(row)
+            pattern_value = pattern(row)
+            if value is None or pattern_value is None:
+                return None
+            if not (isinstance(value, _STRING_TYPES) and
+                    isinstance(pattern_value, _STRING_TYPES)):
+                raise CantEvaluate("LIKE on non-string")
+            try:
+                regex = cache[pattern_value]
+            except KeyError:
+                regex = cache[pattern_value] = _like_regex(pattern_value)
+            return regex.match(value) is not None
+        return like_func
+
+    def parse_operand(self):
+        kind, text = self.next()
+        if kind == 'op' and text == '(':
+            func = self.parse_or()
+            self.expect('op', ')')
+            return func
+        elif kind == 'op' and text == '?':
+            if self.value_index >= len(self.values):
+                raise CantCompile("not enough values")
+            value = self.values[self.value_index]
+            self.value_index += 1
+            return lambda row: value
+        elif kind == 'string':
+            value = text[1:-1].replace("''", "'")
+            return lambda row: value
+        elif kind == 'number':
+            if '.' in text:
+                value = float(text)
+            else:
+                value = int(text)
+            return lambda row: value
+        elif kind == 'keyword' and text == 'null':
+            return lambda row: None
+        elif kind == 'ident':
+            if self.accept('op', '.'):
+                kind, column = self.next()
+                if kind != 'ident':
+                    raise CantCompile("bad column reference")
+                return self.resolver.column(text, column)
+            elif self.peek() == ('op', '('):
+                raise CantCompile("function calls not supported")
+            else:
+                return self.resolver.column(None, text)
+        raise CantCompile("unexpected token: %s %s" % (kind, text))
+
+def _column_getter(index, attr_name):
+    def getter(row):
+        obj = row[index]
+        if obj is None:
+            return None
+        try:
+            return obj.__dict__[attr_name]
+        except KeyError:
+            raise CantEvaluate("%s not set on %s" % (attr_name, obj))
+    return getter
+
+class _ColumnResolver(object):
+    """Maps column references to getter functions.
+
+    :param table_columns: function that inputs a table name and returns a
+        dict mapping lower-case column names to (name, schema_item) pairs
+    """
+    def __init__(self, table_columns):
+        self.table_columns = table_columns
+        # list of (alias, table_name, columns) for each table in the query.
+        # The main table is always first.
+        self.tables = []
+        # for each table, the set of attributes that we read
+        self.used_columns = []
+
+    def add_table(self, alias, table_name):
+        try:
+            columns = self.table_columns(table_name)
+        except KeyError:
+            raise CantCompile("unknown table: %s" % table_name)
+        self.tables.append((alias.lower(), table_name, columns))
+        self.used_columns.append(set())
+
+    def lookup(self, alias, column):
+        """Find a column
+
+        :returns: (table index, attribute name) tuple
+        """
+        column = column.lower()
+        if alias is not None:
+            alias = alias.lower()
+            candidates = [i for i, t in enumerate(self.tables)
+                          if t[0] == alias]
+        else:
+            candidates = [i for i, t in enumerate(self.tables)
+                          if column in t[2]]
+        if len(candidates) != 1:
+            raise CantCompile("can't resolve column %s.%s" % (alias, column))
+        index = candidates[0]
+        try:
+            attr_name, schema_item = self.tables[index][2][column]
+        except KeyError:
+            raise CantCompile("unknown column %s.%s" % (alias, column))
+        if not isinstance(schema_item, _simple_column_types()):
+            raise CantCompile("unsupported column type for %s" % column)
+        return index, attr_name
+
+    def column(self, alias, column):
+        index, attr_name = self.lookup(alias, column)
+        self.used_columns[index].add(attr_name)
+        return _column_getter(index, attr_name)
+
+def _parse_join(join_table, join_on, resolver):
+    """Parse a join from a view's joins dict.
+
+    :returns: (attribute name, joined table name) tuple.  The attribute is
+        a column of the main table that stores the id of the joined object.
+    """
+    parts = join_table.split()
+    if len(parts) == 1:
+        table_name = alias = parts[0]
+    elif len(parts) == 2:
+        table_name, alias = parts
+    elif len(parts) == 3 and parts[1].lower() == 'as':
+        table_name, alias = parts[0], parts[2]
+    else:
+        raise CantCompile("can't parse join: %s" % join_table)
+    resolver.add_table(alias, table_name)
+    join_index = len(resolver.tables) - 1
+
+    tokens = _tokenize(join_on)
+    sides = []
+    pos = 0
+    for i in xrange(2):
+        if tokens[pos+1:pos+2] == [('op', '.')]:
+            names = [tokens[pos], tokens[pos+2]]
+            pos += 3
+        else:
+            names = [('ident', None), tokens[pos]]
+            pos += 1
+        if names[0][0] != 'ident' or names[1][0] != 'ident':
+            raise CantCompile("can't parse join: %s" % join_on)
+        sides.append((names[0][1], names[1][1]))
+        if i == 0:
+            if tokens[pos] not in (('op', '='), ('op', '==')):
+                raise CantCompile("join must be an equality")
+            pos += 1
+    if pos != len(tokens):
+        raise CantCompile("can't parse join: %s" % join_on)
+
+    for joined, main in (sides, sides[::-1]):
+        joined_index, joined_attr = resolver.lookup(*joined)
+        main_index, main_attr = resolver.lookup(*main)
+        if (joined_index == join_index and joined_attr == 'id' and
+                main_index == 0):
+            return main_attr, table_name
+    raise CantCompile("join must match a column to %s.id" % alias)
+
+class ViewPredicate(object):
+    """Python version of a view's where clause.
+
+    Use compile_view() to create these.
+    """
+    def __init__(self, where_func, joins, used_columns, get_loaded_object):
+        self._where_func = where_func
+        # list of (attribute, table_name) for each joined table
+        self._joins = joins
+        self._used_columns = used_columns
+        self._get_loaded_object = get_loaded_object
+
+    def matches(self, obj):
+        """Check if a DDBObject is in the view.
+
+        :raises CantEvaluate: if we can't tell using python
+        """
+        row = [obj]
+        for attr_name, table_name in self._joins:
+            try:
+                join_id = obj.__dict__[attr_name]
+            except KeyError:
+                raise CantEvaluate("%s not set on %s" % (attr_name, obj))
+            if join_id is None:
+                row.append(None)
+                continue
+            joined = self._get_loaded_object(table_name, join_id)
+            if joined is None:
+                raise CantEvaluate("%s %s not loaded" % (table_name, join_id))
+            row.append(joined)
+        for obj, used in zip(row, self._used_columns):
+            # unsaved changes mean that SQLite sees different values than we
+            # do.
+            if (obj is not None and obj.changed_attributes and
+                    not used.isdisjoint(obj.changed_attributes)):
+                raise CantEvaluate("unsaved changes for %s" % obj)
+        return _truth(self._where_func(row)) is True
+
+def compile_view(table_name, where, values, joins, table_columns,
+                 get_loaded_object):
+    """Compile a view's where clause to a ViewPredicate.
+
+    :param table_name: main table for the view
+    :param where: SQL where clause (or None)
+    :param values: values for the ? placeholders in where
+    :param joins: dict mapping joined tables to join constraints (or None)
+    :param table_columns: function that maps table names to dicts of
+        lower-case column name -> (attribute name, schema item)
+    :param get_loaded_object: function that inputs a table name and id and
+        returns the DDBObject in memory, or None if it's not loaded
+    :returns: ViewPredicate, or None if the view can't be compiled
+    """
+    resolver = _ColumnResolver(table_columns)
+    try:
+        resolver.add_table(table_name, table_name)
+        join_list = []
+        if joins is not None:
+            for join_table, join_on in joins.items():
+                join_list.append(_parse_join(join_table, join_on, resolver))
+        if where is not None:
+            parser = _Parser(_tokenize(where), resolver, values)
+            where_func = parser.parse()
+            if parser.value_index != len(values):
+                raise CantCompile("too many values")
+        else:
+            if values:
+                raise CantCompile("values without a where clause")
+            where_func = lambda row: True
+    except (CantCompile, IndexError):
+        return None
+    # we need to watch the join columns for unsaved changes too
+    for attr_name, joined_table in join_list:
+        resolver.used_columns[0].add(attr_name)
+    return ViewPredicate(where_func, join_list, resolver.used_columns,
+                         get_loaded_object)